@@ -7,6 +7,7 @@ import torch.nn as nn
 from torch.nn import functional as F
 import torchvision
 
+from models.conditioning_pyramid import get_conditioning_pyramid
 
 class AdaIN(nn.Module):
     def __init__( self, n_hin_channles, n_in_channles, net_type = "conv", norm_type = "batch", resize_type = "nearest" ):
@@ -41,11 +42,10 @@ class AdaIN(nn.Module):
         """
         [args]
             h_in : 前段のネットワークからの活性化入力のテンソル
-            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル
+            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル or ConditioningPyramid
         """
         # ネットワーク外部から入力するデータ（セグメンテーション画像など）のサイズを、前段のネットワークからの活性化入力のサイズにリサイズして合わせる
-        if( len(input.shape) == 4 and h_in.shape[2:] != input.shape[2:] ):
-            input = F.interpolate(input, size=h_in.size()[2:], mode=self.resize_type)
+        input = get_conditioning_pyramid(input).get( h_in.shape[2:], self.resize_type )
 
         h_act = self.norm_layer(h_in)
         if( self.net_type == "fc" ):
@@ -94,8 +94,11 @@ class AdaINResBlock(nn.Module):
         """
         [args]
             h_in : 前段のネットワークからの活性化入力のテンソル
-            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル
+            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル or ConditioningPyramid
         """
+        # 同じ解像度の AdaIN 層で、リサイズしたデータを共有する
+        input = get_conditioning_pyramid(input)
+
         #print( "[AdaINResBlock] h_in.shape : ", h_in.shape )
         #print( "[AdaINResBlock] input.shape : ", input.shape )
 
@@ -112,7 +115,7 @@ class AdaINResBlock(nn.Module):
             skip_connection = self.activate3(skip_connection)
             skip_connection = self.conv3(skip_connection)
         else:
-            skip_connection = input
+            skip_connection = input.input
 
         #print( "[AdaINResBlock] output2.shape : ", output2.shape )
         #print( "[AdaINResBlock] skip_connection.shape : ", skip_connection.shape )
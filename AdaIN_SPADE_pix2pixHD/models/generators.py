@@ -9,6 +9,7 @@ import torchvision
 
 from models.adain import AdaIN, AdaINResBlock
 from models.spade import SPADE, SPADEResBlock
+from models.conditioning_pyramid import ConditioningPyramid
 
 def weights_init(m):
     classname = m.__class__.__name__
@@ -133,8 +134,11 @@ class Pix2PixHDAdaINGenerator( nn.Module ):
         output = self.encoder(input)
         output = self.bottle_neck(output)
         #print( "[bottle_neck] output.shape : ", output.shape )
+
+        # 各解像度にリサイズした入力データを全ての decoder で共有する
+        input_pyramid = ConditioningPyramid(input)
         for i in range(self.n_downsampling):
-            output = self.decoder["decoder_{}".format(i)](output, input)
+            output = self.decoder["decoder_{}".format(i)](output, input_pyramid)
             output = F.interpolate(output, scale_factor=2, mode='bilinear', align_corners=True)
             #print( "[decoder] output.shape : ", output.shape )
 
@@ -143,7 +147,7 @@ class Pix2PixHDAdaINGenerator( nn.Module ):
 
 
 class Pix2PixHDSPADEGenerator( nn.Module ):
-    def __init__( self, input_nc = 3, output_nc = 3, ngf=64, n_downsampling=3, n_blocks=9, norm_layer=nn.BatchNorm2d, padding_type='reflect', resize_type = "nearest"):
+    def __init__( self, input_nc = 3, output_nc = 3, ngf=64, n_downsampling=3, n_blocks=9, norm_layer=nn.BatchNorm2d, padding_type='reflect', resize_type = "nearest", fused_spade = False):
         assert(n_blocks >= 0)
         super(Pix2PixHDSPADEGenerator, self).__init__()        
         self.n_downsampling = n_downsampling
@@ -171,7 +175,8 @@ class Pix2PixHDSPADEGenerator( nn.Module ):
                 n_hin_channles = int(ngf * 2**(n_downsampling - i)), 
                 n_hout_channles = int(ngf * 2**(n_downsampling - i) / 2), 
                 n_in_channles = input_nc,
-                resize_type = resize_type
+                resize_type = resize_type,
+                fused = fused_spade
             ) for i in range(n_downsampling) }
         )
 
@@ -185,8 +190,11 @@ class Pix2PixHDSPADEGenerator( nn.Module ):
         output = self.encoder(input)
         output = self.bottle_neck(output)
         #print( "[bottle_neck] output.shape : ", output.shape )
+
+        # 各解像度にリサイズした入力データを全ての decoder で共有する
+        input_pyramid = ConditioningPyramid(input)
         for i in range(self.n_downsampling):
-            output = self.decoder["decoder_{}".format(i)](output, input)
+            output = self.decoder["decoder_{}".format(i)](output, input_pyramid)
             output = F.interpolate(output, scale_factor=2, mode='bilinear', align_corners=True)
             #print( "[decoder] output.shape : ", output.shape )
 
@@ -7,16 +7,37 @@ import torch.nn as nn
 from torch.nn import functional as F
 import torchvision
 
+from models.conditioning_pyramid import get_conditioning_pyramid
+
+def remap_spade_state_dict( state_dict, prefix = "", fused = True ):
+    """
+    SPADE の gamma_layer / beta_layer の重みと、fused 版の gamma_beta_layer（出力チャンネル方向に gamma, beta の順で結合）の重みを相互に変換する。
+    fused = True の場合は gamma_layer / beta_layer -> gamma_beta_layer、fused = False の場合はその逆
+    """
+    for param_name in ["weight", "bias"]:
+        gamma_key = prefix + "gamma_layer." + param_name
+        beta_key = prefix + "beta_layer." + param_name
+        fused_key = prefix + "gamma_beta_layer." + param_name
+        if( fused and gamma_key in state_dict and beta_key in state_dict ):
+            state_dict[fused_key] = torch.cat( [ state_dict.pop(gamma_key), state_dict.pop(beta_key) ], dim = 0 )
+        elif( not fused and fused_key in state_dict ):
+            state_dict[gamma_key], state_dict[beta_key] = state_dict.pop(fused_key).chunk(2, dim = 0)
+
+    return state_dict
+
+
 class SPADE(nn.Module):
-    def __init__( self, n_hin_channles, n_in_channles, n_hiddens = 128, norm_type = "batch", resize_type = "nearest" ):
+    def __init__( self, n_hin_channles, n_in_channles, n_hiddens = 128, norm_type = "batch", resize_type = "nearest", fused = False ):
         """
         [args]
             resize_type : ネットワーク外部から入力するデータ（セグメンテーション画像など）のサイズを、前段のネットワークからの活性化入力のサイズにリサイズして合わせるときのリサイズ手法
                 'nearest' | 'linear' | 'bilinear' | 'bicubic' | 'trilinear' | 'area'
+            fused : gamma と beta を出力チャンネル数 2×n_hin_channles の１つの畳み込みでまとめて計算するか
         """
         super(SPADE, self).__init__()
         self.norm_type = norm_type
         self.resize_type = resize_type
+        self.fused = fused
         if( self.norm_type == "batch" ):
             self.norm_layer = nn.BatchNorm2d(n_hin_channles, affine=False)
         elif( self.norm_type == "instance" ):
@@ -28,25 +49,36 @@ class SPADE(nn.Module):
             nn.Conv2d(n_in_channles, n_hiddens, kernel_size=3, stride=1, padding=1),
             nn.ReLU()
         )
-        self.gamma_layer = nn.Conv2d(n_hiddens, n_hin_channles, kernel_size=3, stride=1, padding=1)
-        self.beta_layer = nn.Conv2d(n_hiddens, n_hin_channles, kernel_size=3, stride=1, padding=1)
+        if( self.fused ):
+            self.gamma_beta_layer = nn.Conv2d(n_hiddens, 2 * n_hin_channles, kernel_size=3, stride=1, padding=1)
+        else:
+            self.gamma_layer = nn.Conv2d(n_hiddens, n_hin_channles, kernel_size=3, stride=1, padding=1)
+            self.beta_layer = nn.Conv2d(n_hiddens, n_hin_channles, kernel_size=3, stride=1, padding=1)
+        return
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # fused 版と非 fused 版のどちらで保存したチェックポイントも読み込めるように、重みの key と shape を変換する
+        remap_spade_state_dict( state_dict, prefix, self.fused )
+        super(SPADE, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
         return
 
     def forward(self, h_in, input ):
         """
         [args]
             h_in : 前段のネットワークからの活性化入力のテンソル
-            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル
+            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル or ConditioningPyramid
         """
         # ネットワーク外部から入力するデータ（セグメンテーション画像など）のサイズを、前段のネットワークからの活性化入力のサイズにリサイズして合わせる
-        if( h_in.shape[2:] != input.shape[2:] ):
-            input = F.interpolate(input, size=h_in.size()[2:], mode=self.resize_type)
+        input = get_conditioning_pyramid(input).get( h_in.shape[2:], self.resize_type )
 
         h_act = self.norm_layer(h_in)
 
         input = self.common_layer(input)
-        gamma = self.gamma_layer(input)
-        beta = self.beta_layer(input)
+        if( self.fused ):
+            gamma, beta = self.gamma_beta_layer(input).chunk(2, dim=1)
+        else:
+            gamma = self.gamma_layer(input)
+            beta = self.beta_layer(input)
 
         #print( "[SPADE] h_in.shape", h_in.shape )
         #print( "[SPADE] h_act.shape", h_act.shape )
@@ -58,22 +90,22 @@ class SPADE(nn.Module):
 
 
 class SPADEResBlock(nn.Module):
-    def __init__( self, n_hin_channles, n_hout_channles, n_in_channles, norm_type = "batch", resize_type = "nearest" ):
+    def __init__( self, n_hin_channles, n_hout_channles, n_in_channles, norm_type = "batch", resize_type = "nearest", fused = False ):
         super(SPADEResBlock, self).__init__()
         self.n_hin_channles = n_hin_channles
         self.n_hout_channles = n_hout_channles
 
-        self.spade1 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type )
+        self.spade1 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type, fused )
         self.activate1 = nn.ReLU()
         self.conv1 = nn.Conv2d(n_hin_channles, n_hin_channles, kernel_size=3, stride=1, padding=1)
 
-        self.spade2 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type )
+        self.spade2 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type, fused )
         self.activate2 = nn.ReLU()
         self.conv2 = nn.Conv2d(n_hin_channles, n_hout_channles, kernel_size=3, stride=1, padding=1)
 
         # skip connection でチャンネル数を一致させるための畳込み
         if( self.n_hin_channles != self.n_hout_channles ):
-            self.spade3 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type )
+            self.spade3 = SPADE(n_hin_channles, n_in_channles, 128, norm_type, resize_type, fused )
             self.activate3 = nn.ReLU()
             self.conv3 = nn.Conv2d(n_hin_channles, n_hout_channles, kernel_size=1, bias=False)
 
@@ -83,8 +115,11 @@ class SPADEResBlock(nn.Module):
         """
         [args]
             h_in : 前段のネットワークからの活性化入力のテンソル
-            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル
+            input : ネットワーク外部から入力するデータ（セグメンテーション画像など）のテンソル or ConditioningPyramid
         """
+        # 同じ解像度の SPADE 層で、リサイズしたデータを共有する
+        input = get_conditioning_pyramid(input)
+
         #print( "[SPADEResBlock] h_in.shape : ", h_in.shape )
         #print( "[SPADEResBlock] input.shape : ", input.shape )
 
@@ -101,7 +136,7 @@ class SPADEResBlock(nn.Module):
             skip_connection = self.activate3(skip_connection)
             skip_connection = self.conv3(skip_connection)
         else:
-            skip_connection = input
+            skip_connection = input.input
 
         #print( "[SPADEResBlock] output2.shape : ", output2.shape )
         #print( "[SPADEResBlock] skip_connection.shape : ", skip_connection.shape )
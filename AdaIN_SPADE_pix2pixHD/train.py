@@ -27,7 +27,10 @@ from models.discriminators import PatchGANDiscriminator
 from models.losses import VGGLoss, LSGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.gan_step import RequiresGradSwitch, forward_D_fused, StepPerfMeter
 from utils.decode_labels import decode_labels_tsr
+from utils.eval_worker import EvalWorker
+from utils.valid_evaluator import build_valid_loader, build_valid_evaluator, evaluate_valid
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -54,9 +57,14 @@ if __name__ == '__main__':
     parser.add_argument('--n_display_valid', type=int, default=8, help="valid データの tensorboard への表示数")
     parser.add_argument('--data_augument', action='store_true')
     parser.add_argument('--net_G_type', choices=['pix2pixhd', 'pix2pixhd_adain', "pix2pixhd_spade"], default="pix2pixhd", help="ネットワークの種類")
+    parser.add_argument('--fused_spade', action='store_true', help="SPADE の gamma と beta を１つの畳み込みでまとめて計算する（非 fused 版のチェックポイントもそのまま読み込める）")
     parser.add_argument('--lambda_l1', type=float, default=10.0, help="L1損失関数の係数値")
     parser.add_argument('--lambda_vgg', type=float, default=10.0, help="VGG perceptual loss_G の係数値")
     parser.add_argument('--lambda_adv', type=float, default=1.0, help="Adv loss_G の係数値")
+    parser.add_argument('--d_forward_type', choices=['fused','separate'], default="fused", help="識別器の本物画像・偽物画像の forward 方法（fused : 結合した 1 つのバッチで forward）")
+    parser.add_argument('--d_bn_mode', choices=['per_half','joint'], default="per_half", help="fused 時の識別器内の BatchNorm の正規化方法（per_half : 本物画像・偽物画像毎に正規化）")
+    parser.add_argument('--use_eval_worker', action='store_true', help="valid データでの評価を別プロセスで非同期に行う（学習を止めない）")
+    parser.add_argument('--eval_worker_device', choices=['same', 'cpu'], default="same", help="評価用プロセスの実行デバイス（same : 学習と同じデバイス）")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
@@ -114,7 +122,8 @@ if __name__ == '__main__':
 
     # tensorboard 出力
     board_train = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name) )
-    board_valid = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid") )
+    if not( args.use_eval_worker ):
+        board_valid = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid") )
 
     #================================
     # データセットの読み込み
@@ -132,7 +141,16 @@ if __name__ == '__main__':
         print( "valid_index[0:10] : ", valid_index[0:10] )
 
     dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
-    dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
+
+    # valid データの評価用プロセス（自前のデータローダー・評価用モデルを持ち、同じ TensorBoard のディレクトリに書き込む）
+    # 評価用プロセスを使う場合は、学習側では valid データのデータローダーを作らない
+    if( args.use_eval_worker ):
+        eval_worker = EvalWorker(
+            build_valid_evaluator, args, valid_index, log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid"),
+            device_name = str(device) if args.eval_worker_device == "same" else "cpu",
+        )
+    else:
+        dloader_valid = build_valid_loader( args, ds_train, valid_index, device )
 
     #================================
     # モデルの構造を定義する。
@@ -142,7 +160,7 @@ if __name__ == '__main__':
     elif( args.net_G_type == "pix2pixhd_adain" ):
         model_G = Pix2PixHDAdaINGenerator(input_nc = args.n_classes, output_nc = 3).to(device)
     elif( args.net_G_type == "pix2pixhd_spade" ):
-        model_G = Pix2PixHDSPADEGenerator(input_nc = args.n_classes, output_nc = 3).to(device)
+        model_G = Pix2PixHDSPADEGenerator(input_nc = args.n_classes, output_nc = 3, fused_spade = args.fused_spade).to(device)
     else:
         NotImplementedError()
 
@@ -163,6 +181,10 @@ if __name__ == '__main__':
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # 識別器のパラメーターの勾配計算の切り替え / 学習ステップの処理時間・メモリ使用量の計測
+    requires_grad_D = RequiresGradSwitch( model_D )
+    perf_meter = StepPerfMeter( device )
+
     #================================
     # loss 関数の設定
     #================================
@@ -205,12 +227,13 @@ if __name__ == '__main__':
             # 識別器の更新処理
             #----------------------------------------------------
             # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
+            requires_grad_D.set(True)
 
-            # 学習用データをモデルに流し込む
-            d_real = model_D( torch.cat([pose_parse_onehot, pose_gt], dim=1) )
-            d_fake = model_D( torch.cat([pose_parse_onehot, output.detach()], dim=1) )
+            # 学習用データをモデルに流し込む（本物画像・偽物画像を結合した 1 つのバッチで forward）
+            d_real, d_fake = forward_D_fused(
+                model_D, [ torch.cat([pose_parse_onehot, pose_gt], dim=1), torch.cat([pose_parse_onehot, output.detach()], dim=1) ],
+                fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+            )
             if( args.debug and n_print > 0 ):
                 print( "d_real.shape :", d_real.shape )
                 print( "d_fake.shape :", d_fake.shape )
@@ -220,16 +243,18 @@ if __name__ == '__main__':
 
             # ネットワークの更新処理
             optimizer_D.zero_grad()
-            loss_D.backward(retain_graph=True)
+            loss_D.backward()
             optimizer_D.step()
 
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
+            # 識別器 D のネットワークの勾配計算を無効化。
+            requires_grad_D.set(False)
 
             #----------------------------------------------------
             # 生成器の更新処理
             #----------------------------------------------------
+            # 更新後の識別器での偽物画像の出力（生成器へ勾配を伝搬させるため、output は detach しない）
+            d_fake = model_D( torch.cat([pose_parse_onehot, output], dim=1) )
+
             # 損失関数を計算する
             loss_l1 = loss_l1_fn( pose_gt, output )
             loss_vgg = loss_vgg_fn( pose_gt, output )
@@ -240,6 +265,7 @@ if __name__ == '__main__':
             optimizer_G.zero_grad()
             loss_G.backward()
             optimizer_G.step()
+            perf_meter.update()
 
             #====================================================
             # 学習過程の表示
@@ -260,8 +286,14 @@ if __name__ == '__main__':
                 board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
                 board_train.add_scalar('D/loss_D', loss_D.item(), step)
 
+                # 学習ステップの処理時間・ピークメモリ使用量
+                step_time, max_memory = perf_meter.report()
+                board_train.add_scalar('perf/step_time_ms', step_time, step)
+                board_train.add_scalar('perf/max_memory_allocated_MB', max_memory, step)
+
                 print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
                 print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
+                print( "step={}, step_time={:.2f}ms, max_memory_allocated={:.1f}MB".format(step, step_time, max_memory) )
                 
                 # visual images
                 visuals = [
@@ -272,65 +304,12 @@ if __name__ == '__main__':
             #====================================================
             # valid データでの処理
             #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total = 0, 0, 0, 0
-                loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()
-                    model_D.eval()            
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["pose_parse_onehot"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    pose_parse_onehot = inputs["pose_parse_onehot"].to(device)
-                    pose_parse_onehot_vis = decode_labels_tsr(pose_parse_onehot)
-                    pose_gt = inputs["pose_gt"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output = model_G( pose_parse_onehot )
-
-                    with torch.no_grad():
-                        d_real = model_D( torch.cat([pose_parse_onehot, pose_gt], dim=1) )
-                        d_fake = model_D( torch.cat([pose_parse_onehot, output.detach()], dim=1) )
-
-                    # 損失関数を計算する
-                    loss_l1 = loss_l1_fn( pose_gt, output )
-                    loss_vgg = loss_vgg_fn( pose_gt, output )
-                    loss_adv = loss_adv_fn.forward_G( d_fake )
-                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
-                    loss_adv_total += loss_adv
-                    loss_G_total += loss_G
-
-                    loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-                    loss_D_total += loss_D
-                    loss_D_real_total += loss_D_real
-                    loss_D_fake_total += loss_D_fake
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        visuals = [
-                            [ pose_parse_onehot_vis, pose_gt, output ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-                # loss 値表示
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
+            if( args.use_eval_worker and step % args.n_display_valid_step == 0 ):
+                # 重みのスナップショットを評価用プロセスに渡すのみで、評価の完了は待たない
+                if not( eval_worker.submit( step, { "model_G" : model_G, "model_D" : model_D } ) ):
+                    print( "step={}, eval worker is busy. skip valid evaluation (n_skipped={})".format(step, eval_worker.n_skipped) )
+            elif( step % args.n_display_valid_step == 0 ):
+                evaluate_valid( args, model_G, model_D, dloader_valid, loss_l1_fn, loss_vgg_fn, loss_adv_fn, board_valid, step, device )
 
             step += 1
             n_print -= 1
@@ -344,4 +323,7 @@ if __name__ == '__main__':
             print( "saved checkpoints" )
 
     print("Finished Training Loop.")
+    if( args.use_eval_worker ):
+        eval_worker.close()
+
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
@@ -0,0 +1,63 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from models.generators import Pix2PixHDGenerator, Pix2PixHDAttentionGenerator
+from utils.model_export import ExportWrapper, export_model, load_state_dict_cpu
+
+if __name__ == '__main__':
+    """
+    pix2pixHD の生成器を TorchScript / ONNX にエクスポートし、eager モードとの出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exper_name", default="pix2pixhd_G", help="実験名（エクスポートするファイル名）")
+    parser.add_argument('--load_checkpoints_G_path', type=str, default="", help="生成器モデルの読み込みファイルのパス")
+    parser.add_argument('--image_height', type=int, default=128, help="入力画像の高さ（pixel単位）")
+    parser.add_argument('--image_width', type=int, default=128, help="入力画像の幅（pixel単位）")
+    parser.add_argument('--net_G_type', choices=['pix2pixhd', 'pix2pixhd_attention'], default="pix2pixhd", help="ネットワークの種類")
+    parser.add_argument('--export_dir', type=str, default="exports", help="エクスポートしたモデルの出力ディレクトリ")
+    parser.add_argument('--export_format', choices=['torchscript','onnx','both'], default="both", help="エクスポート形式")
+    parser.add_argument('--torchscript_method', choices=['trace','script'], default="trace", help="TorchScript への変換方法")
+    parser.add_argument('--dynamic_axes', choices=['fixed','batch','batch_hw'], default="batch_hw", help="ONNX で可変にする軸")
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX の opset version")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=71)
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    if( args.net_G_type == "pix2pixhd" ):
+        model_G = Pix2PixHDGenerator(input_nc = 3, output_nc = 3)
+    else:
+        model_G = Pix2PixHDAttentionGenerator(input_nc = 3, output_nc = 3)
+
+    # モデルを読み込む
+    if not args.load_checkpoints_G_path == '' and os.path.exists(args.load_checkpoints_G_path):
+        load_state_dict_cpu( model_G, args.load_checkpoints_G_path )
+
+    # Pix2PixHDAttentionGenerator の dict の出力は tuple に変換する
+    if( args.net_G_type == "pix2pixhd" ):
+        model, output_names = model_G, ["output"]
+    else:
+        output_names = ["output", "mask", "content"]
+        model = ExportWrapper( model_G, output_keys = output_names )
+
+    example_input = torch.randn( size = (1, 3, args.image_height, args.image_width) )
+    # エクスポート
+    export_model(
+        model, [example_input], args.export_dir, args.exper_name,
+        input_names = ["input"], output_names = output_names,
+        export_format = args.export_format, torchscript_method = args.torchscript_method,
+        dynamic_axes_type = args.dynamic_axes, opset_version = args.opset_version,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
@@ -140,8 +140,9 @@ class Pix2PixHDAttentionGenerator( nn.Module ):
         output = self.encoder(input)
         output = self.bottle_neck(output)
         #print( "[bottle_neck] output.shape : ", output.shape )
-        for i in range(self.n_downsampling):
-            output = self.decoder["decoder_{}".format(i)](output)
+        # TorchScript でコンパイルできるように、ModuleDict は文字列のキーではなく登録順（decoder_0, decoder_1, ...）で走査する
+        for decoder in self.decoder.values():
+            output = decoder(output)
             #print( "[decoder] output.shape : ", output.shape )
 
         mask = self.mask_layer(output)
@@ -0,0 +1,52 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from models.generators import Pix2PixHDGenerator
+from utils.model_export import load_state_dict_cpu
+from utils.inference_optimization import optimize_for_inference, check_inference_optimization, randomize_batch_norm_stats
+
+if __name__ == '__main__':
+    """
+    pix2pixHD の生成器を推論用に最適化（BatchNorm の畳み込み・ReflectionPad2d の畳み込み・活性化関数の融合・channels last）し、
+    最適化前との出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--load_checkpoints_G_path', type=str, default="", help="生成器モデルの読み込みファイルのパス")
+    parser.add_argument('--image_height', type=int, default=128, help="入力画像の高さ（pixel単位）")
+    parser.add_argument('--image_width', type=int, default=128, help="入力画像の幅（pixel単位）")
+    parser.add_argument('--no_channels_last', action='store_true', help="channels last への変換を行わない")
+    parser.add_argument('--torchscript', action='store_true', help="TorchScript の freeze で畳み込みと活性化関数を融合する")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=71)
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    model_G = Pix2PixHDGenerator(input_nc = 3, output_nc = 3)
+
+    # モデルを読み込む
+    if not args.load_checkpoints_G_path == '' and os.path.exists(args.load_checkpoints_G_path):
+        load_state_dict_cpu( model_G, args.load_checkpoints_G_path )
+    else:
+        # 学習済みの重みがない場合は、BatchNorm の畳み込みの誤りが出力の一致の確認で検出されるように、running stats をデフォルト値以外にする
+        randomize_batch_norm_stats( model_G, seed = args.seed )
+    model_G.eval()
+
+    # 推論用の最適化
+    example_input = torch.randn( size = (1, 3, args.image_height, args.image_width) )
+    model_G_opt = optimize_for_inference( model_G, channels_last = not args.no_channels_last, example_inputs = [example_input] if args.torchscript else None )
+    check_inference_optimization(
+        model_G, model_G_opt, [example_input], channels_last = not args.no_channels_last,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Subset
+
+# 自作クラス
+from data.neutral2happiness_dataset import Neutral2HappinessDataset
+from models.generators import Pix2PixHDGenerator
+from utils.model_export import load_state_dict_cpu
+from utils.model_quantization import build_quantized_model, save_quantized_checkpoint, benchmark_latency, calc_l1, calc_psnr, print_quantization_report
+
+if __name__ == '__main__':
+    """
+    pix2pixHD の生成器の int8 静的量子化と、fp32 とのレイテンシー・出力の劣化（L1 / PSNR）の比較
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_dir", type=str, default="dataset/bu3dfe_neutral2happiness_n12")
+    parser.add_argument('--load_checkpoints_G_path', type=str, default="", help="生成器モデルの読み込みファイルのパス")
+    parser.add_argument('--save_quantized_path', type=str, default="checkpoints/pix2pixhd_G_int8.pth", help="量子化済みモデルの保存ファイルのパス")
+    parser.add_argument('--batch_size', type=int, default=4, help="バッチサイズ")
+    parser.add_argument('--image_height', type=int, default=128, help="入力画像の高さ（pixel単位）")
+    parser.add_argument('--image_width', type=int, default=128, help="入力画像の幅（pixel単位）")
+    parser.add_argument('--n_calibrations', type=int, default=64, help="キャリブレーションに使う学習用データの枚数")
+    parser.add_argument('--n_evals', type=int, default=64, help="出力の劣化の評価に使う valid データの枚数")
+    parser.add_argument('--per_tensor', action='store_true', help="重みを per-tensor で量子化する（デフォルトは出力チャンネル毎）")
+    parser.add_argument('--fp32_modules', type=str, default="reflection_pad,instance_norm", help="量子化せずに fp32 で実行するモジュールの種類（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=71)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # データセット
+    ds_train = Neutral2HappinessDataset( args, args.dataset_dir, pairs_file = "train_pairs.csv", datamode = "train", image_height = args.image_height, image_width = args.image_width, data_augument = False, debug = args.debug )
+    ds_valid = Neutral2HappinessDataset( args, args.dataset_dir, pairs_file = "valid_pairs.csv", datamode = "valid", image_height = args.image_height, image_width = args.image_width, data_augument = False, debug = args.debug )
+    calibration_index = np.random.permutation(len(ds_train))[:args.n_calibrations]
+    dloader_calibration = DataLoader( Subset(ds_train, calibration_index), batch_size = args.batch_size, shuffle = False )
+    dloader_eval = DataLoader( Subset(ds_valid, np.arange(min(args.n_evals, len(ds_valid)))), batch_size = args.batch_size, shuffle = False )
+
+    # fp32 のモデル
+    model_G = Pix2PixHDGenerator(input_nc = 3, output_nc = 3)
+    if not args.load_checkpoints_G_path == '' and os.path.exists(args.load_checkpoints_G_path):
+        load_state_dict_cpu( model_G, args.load_checkpoints_G_path )
+    model_G.eval()
+
+    # 量子化
+    quant_config = { "per_channel" : not args.per_tensor, "fp32_modules" : [ name for name in args.fp32_modules.split(",") if name != "" ] }
+    example_inputs = ( torch.zeros(1, 3, args.image_height, args.image_width), )
+    calibration_inputs = [ (inputs["domainA"],) for inputs in tqdm(dloader_calibration, desc = "calibration") ]
+    model_G_q = build_quantized_model( model_G, example_inputs, calibration_inputs, **quant_config )
+    if( os.path.dirname(args.save_quantized_path) != "" and not os.path.isdir(os.path.dirname(args.save_quantized_path)) ):
+        os.makedirs( os.path.dirname(args.save_quantized_path) )
+    save_quantized_checkpoint( model_G_q, args.save_quantized_path, **quant_config )
+
+    # fp32 / 正解画像との比較
+    l1_total, psnr_total, l1_gt_fp32_total, l1_gt_int8_total, n_evals = 0, 0, 0, 0, 0
+    with torch.no_grad():
+        for inputs in tqdm( dloader_eval, desc = "eval" ):
+            output = model_G( inputs["domainA"] )
+            output_q = model_G_q( inputs["domainA"] )
+            l1_total += calc_l1( output, output_q )
+            psnr_total += calc_psnr( output, output_q, data_range = 2.0 )
+            l1_gt_fp32_total += calc_l1( inputs["domainB_gt"], output )
+            l1_gt_int8_total += calc_l1( inputs["domainB_gt"], output_q )
+            n_evals += 1
+
+    inputs = ( next(iter(dloader_eval))["domainA"], )
+    report = {
+        "latency_fp32_ms" : benchmark_latency( model_G, inputs ),
+        "latency_int8_ms" : benchmark_latency( model_G_q, inputs ),
+        "l1_fp32_vs_int8" : l1_total / max(n_evals, 1),
+        "psnr_fp32_vs_int8" : psnr_total / max(n_evals, 1),
+        "l1_gt_vs_fp32" : l1_gt_fp32_total / max(n_evals, 1),
+        "l1_gt_vs_int8" : l1_gt_int8_total / max(n_evals, 1),
+    }
+    print_quantization_report( report )
+    with open( os.path.splitext(args.save_quantized_path)[0] + "_report.json", "w" ) as f:
+        json.dump( report, f, indent = 4 )
@@ -27,6 +27,11 @@ from models.discriminators import PatchGANDiscriminator
 from models.losses import VGGLoss, LSGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.gan_step import RequiresGradSwitch, forward_D_fused, StepPerfMeter
+from utils.activation_checkpointing import setup_activation_checkpointing, print_checkpointing_report
+from utils.gradient_accumulation import split_micro_batches, ForwardReplay, MicroBatchLosses
+from utils.module_profiler import ModuleProfiler
+from utils.step_timer import StepPhaseTimer
 from utils.decode_labels import decode_labels_tsr
 
 if __name__ == '__main__':
@@ -56,12 +61,24 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_l1', type=float, default=10.0, help="L1損失関数の係数値")
     parser.add_argument('--lambda_vgg', type=float, default=10.0, help="VGG perceptual loss_G の係数値")
     parser.add_argument('--lambda_adv', type=float, default=1.0, help="Adv loss_G の係数値")
+    parser.add_argument('--d_forward_type', choices=['fused','separate'], default="fused", help="識別器の本物画像・偽物画像の forward 方法（fused : 結合した 1 つのバッチで forward）")
+    parser.add_argument('--d_bn_mode', choices=['per_half','joint'], default="per_half", help="fused 時の識別器内の BatchNorm の正規化方法（per_half : 本物画像・偽物画像毎に正規化）")
+    parser.add_argument('--n_accum_steps', type=int, default=1, help="勾配を累積するマイクロバッチ数（batch_size x n_accum_steps が 1 回のパラメーター更新での実効バッチサイズ）")
+    parser.add_argument('--checkpoint_blocks', type=str, default="", help="生成器で activation checkpointing するブロックのモジュール名 or クラス名（カンマ区切り・ワイルドカード可。例 : ResnetBlock）")
+    parser.add_argument('--checkpoint_memory_budget', type=float, default=0, help="activation checkpointing 後の生成器の活性化のメモリ量の上限 [MB]（0 の場合は checkpoint_blocks に一致する全てのブロックを checkpoint する）")
+    parser.add_argument('--checkpoint_check_grads', action='store_true', help="activation checkpointing 前後の生成器で、パラメーターの勾配が一致するかを確認する")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
+    parser.add_argument('--n_timing_log_steps', type=int, default=0, help="学習ステップのフェーズ毎の処理時間・スループットを出力する間隔（0 の場合は計測しない）")
+    parser.add_argument('--data_wait_alert', type=float, default=0.3, help="データ待ちの時間が学習ステップの時間のこの割合を超えた場合に警告を表示する")
+    parser.add_argument('--profile_every_n_steps', type=int, default=0, help="モジュール単位のプロファイルを行う学習ステップの間隔（0 の場合はプロファイルしない）")
+    parser.add_argument('--profile_max_depth', type=int, default=2, help="プロファイル対象のサブモジュールの階層の深さ")
+    parser.add_argument('--profile_modules', type=str, default="", help="プロファイル対象のサブモジュール名 or クラス名（カンマ区切り・ワイルドカード可。指定した場合は profile_max_depth は無視）")
+    parser.add_argument('--profile_trace', action='store_true', help="プロファイルするステップで torch.profiler の Chrome trace / TensorBoard プロファイルを出力する")
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args()
@@ -135,7 +152,7 @@ if __name__ == '__main__':
     dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
     dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
     """
-    dloader_train = torch.utils.data.DataLoader(ds_train, batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
+    dloader_train = torch.utils.data.DataLoader(ds_train, batch_size=args.batch_size * args.n_accum_steps, shuffle=True, num_workers = args.n_workers, pin_memory = True )
     dloader_valid = torch.utils.data.DataLoader(ds_valid, batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
 
     #================================
@@ -159,12 +176,38 @@ if __name__ == '__main__':
     if not args.load_checkpoints_D_path == '' and os.path.exists(args.load_checkpoints_D_path):
         load_checkpoint(model_D, device, args.load_checkpoints_D_path )
 
+    # 生成器の activation checkpointing（逆伝播時に活性化を再計算して、学習時のメモリ使用量を削減する）
+    if( args.checkpoint_blocks != "" ):
+        checkpointing_inputs = ( torch.randn( args.batch_size, 3, args.image_height, args.image_width ).to(device), )
+        checkpointing_report = setup_activation_checkpointing( model_G, checkpointing_inputs, args.checkpoint_blocks.split(","), args.checkpoint_memory_budget, check_gradients = args.checkpoint_check_grads )
+        print_checkpointing_report( checkpointing_report )
+
     #================================
     # optimizer_G の設定
     #================================
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # 識別器のパラメーターの勾配計算の切り替え / 学習ステップの処理時間・メモリ使用量の計測
+    requires_grad_D = RequiresGradSwitch( model_D )
+    perf_meter = StepPerfMeter( device )
+
+    # モジュール単位の forward / backward のプロファイラー
+    if( args.profile_every_n_steps > 0 ):
+        module_profiler = ModuleProfiler(
+            { "G" : model_G, "D" : model_D }, device, every_n_steps = args.profile_every_n_steps, max_depth = args.profile_max_depth,
+            patterns = [ pattern for pattern in args.profile_modules.split(",") if pattern != "" ],
+            log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_profile"), board = board_train, trace = args.profile_trace,
+        )
+    else:
+        module_profiler = None
+
+    # 学習ステップのフェーズ毎の処理時間の計測
+    step_timer = StepPhaseTimer(
+        device, log_path = os.path.join(args.tensorboard_dir, args.exper_name + "_timing.jsonl"), board = board_train,
+        n_log_steps = max(args.n_timing_log_steps, 1), data_wait_alert = args.data_wait_alert, enabled = args.n_timing_log_steps > 0,
+    )
+
     #================================
     # loss 関数の設定
     #================================
@@ -175,82 +218,128 @@ if __name__ == '__main__':
     #================================
     # モデルの学習
     #================================    
+    print( "effective batch size : {} (batch_size={} x n_accum_steps={})".format(args.batch_size * args.n_accum_steps, args.batch_size, args.n_accum_steps) )
     print("Starting Training Loop...")
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
+        # DataLoader のキューの深さの計測用にイテレーターを保持する（ループ変数 iter で組み込み関数 iter() が上書きされるため __iter__() を使う）
+        dloader_train_iter = dloader_train.__iter__()
+        for iter, inputs in enumerate( tqdm( dloader_train_iter, total = len(dloader_train), desc = "epoch={}".format(epoch) ) ):
+            step_timer.start( dloader_train_iter )
             model_G.train()
             model_D.train()
 
             # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["domainA"].shape[0] != args.batch_size:
+            if inputs["domainA"].shape[0] != args.batch_size * args.n_accum_steps:
                 break
 
-            # ミニバッチデータを GPU へ転送
-            domainA = inputs["domainA"].to(device)
-            domainB_gt = inputs["domainB_gt"].to(device)
+            if( module_profiler is not None ):
+                module_profiler.begin( step )
 
-            if( args.debug and n_print > 0):
-                print( "[domainA] shape={}, dtype={}, min={}, max={} : ".format(domainA.shape, domainA.dtype, torch.min(domainA), torch.max(domainA) ) )
-                print( "[domainB_gt] shape={}, dtype={}, min={}, max={} : ".format(domainB_gt.shape, domainB_gt.dtype, torch.min(domainB_gt), torch.max(domainB_gt) ) )
+            # ミニバッチデータを GPU へ転送し、n_accum_steps 個のマイクロバッチに分割する
+            micro_batches = split_micro_batches( { "domainA" : inputs["domainA"].to(device), "domainB_gt" : inputs["domainB_gt"].to(device) }, args.n_accum_steps )
+            n_micro_batches = len(micro_batches)
+            step_timer.lap("h2d")
 
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            if( args.net_G_type == "pix2pixhd" ):
-                output = model_G( domainA )
-            elif( args.net_G_type == "pix2pixhd_attention" ):
-                outputs = model_G( domainA )
-                output = outputs["output"]
-            else:
-                NotImplementedError()
-
-            if( args.debug and n_print > 0 ):
-                print( "output.shape : ", output.shape )
-                if( args.net_G_type == "pix2pixhd_attention" ):
-                    print( "outputs[mask].shape : ", outputs["mask"].shape )
-                    print( "outputs[content].shape : ", outputs["content"].shape )
+            # マイクロバッチが複数の場合は、生成器の forward の計算グラフをマイクロバッチ間で保持しないように、
+            # 識別器の更新処理では勾配計算なしで forward し、生成器の更新処理で同じ乱数の状態から再度 forward する
+            replay_G = ForwardReplay( model_G, device )
 
             #----------------------------------------------------
             # 識別器の更新処理
             #----------------------------------------------------
             # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
-
-            # 学習用データをモデルに流し込む
-            d_real = model_D( torch.cat([domainA, domainB_gt], dim=1) )
-            d_fake = model_D( torch.cat([domainA, output.detach()], dim=1) )
-            if( args.debug and n_print > 0 ):
-                print( "d_real.shape :", d_real.shape )
-                print( "d_fake.shape :", d_fake.shape )
+            requires_grad_D.set(True)
+            optimizer_D.zero_grad()
 
-            # 損失関数を計算する
-            loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+            losses_D = MicroBatchLosses( n_micro_batches )
+            for micro_batch in micro_batches:
+                domainA = micro_batch["domainA"]
+                domainB_gt = micro_batch["domainB_gt"]
+                if( args.debug and n_print > 0):
+                    print( "[domainA] shape={}, dtype={}, min={}, max={} : ".format(domainA.shape, domainA.dtype, torch.min(domainA), torch.max(domainA) ) )
+                    print( "[domainB_gt] shape={}, dtype={}, min={}, max={} : ".format(domainB_gt.shape, domainB_gt.dtype, torch.min(domainB_gt), torch.max(domainB_gt) ) )
+
+                # 生成器 の forword 処理
+                replay_G.record()
+                with torch.set_grad_enabled( n_micro_batches == 1 ):
+                    if( args.net_G_type == "pix2pixhd" ):
+                        output = model_G( domainA )
+                    elif( args.net_G_type == "pix2pixhd_attention" ):
+                        outputs = model_G( domainA )
+                        output = outputs["output"]
+                    else:
+                        NotImplementedError()
+
+                if( args.debug and n_print > 0 ):
+                    print( "output.shape : ", output.shape )
+                    if( args.net_G_type == "pix2pixhd_attention" ):
+                        print( "outputs[mask].shape : ", outputs["mask"].shape )
+                        print( "outputs[content].shape : ", outputs["content"].shape )
+                step_timer.lap("G_forward_backward")
+
+                # 学習用データをモデルに流し込む（本物画像・偽物画像を結合した 1 つのバッチで forward。本物画像・偽物画像の組はマイクロバッチ毎）
+                d_real, d_fake = forward_D_fused(
+                    model_D, [ torch.cat([domainA, domainB_gt], dim=1), torch.cat([domainA, output.detach()], dim=1) ],
+                    fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                )
+                if( args.debug and n_print > 0 ):
+                    print( "d_real.shape :", d_real.shape )
+                    print( "d_fake.shape :", d_fake.shape )
+
+                # 損失関数を計算し、勾配を累積する
+                loss_D_micro, loss_D_real_micro, loss_D_fake_micro = loss_adv_fn.forward_D( d_real, d_fake )
+                ( loss_D_micro / n_micro_batches ).backward()
+                loss_D, loss_D_real, loss_D_fake = losses_D.add( loss_D_micro, loss_D_real_micro, loss_D_fake_micro )
+                step_timer.lap("D_forward_backward")
 
             # ネットワークの更新処理
-            optimizer_D.zero_grad()
-            loss_D.backward(retain_graph=True)
             optimizer_D.step()
 
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
+            # 識別器 D のネットワークの勾配計算を無効化。
+            requires_grad_D.set(False)
+            step_timer.lap("D_forward_backward")
 
             #----------------------------------------------------
             # 生成器の更新処理
             #----------------------------------------------------
-            # 損失関数を計算する
-            loss_l1 = loss_l1_fn( domainB_gt, output )
-            loss_vgg = loss_vgg_fn( domainB_gt, output )
-            loss_adv = loss_adv_fn.forward_G( d_fake )
-            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+            optimizer_G.zero_grad()
+
+            losses_G = MicroBatchLosses( n_micro_batches )
+            for i, micro_batch in enumerate(micro_batches):
+                domainA = micro_batch["domainA"]
+                domainB_gt = micro_batch["domainB_gt"]
+                if( n_micro_batches > 1 ):
+                    with replay_G.replay( i ):
+                        if( args.net_G_type == "pix2pixhd" ):
+                            output = model_G( domainA )
+                        elif( args.net_G_type == "pix2pixhd_attention" ):
+                            outputs = model_G( domainA )
+                            output = outputs["output"]
+                        else:
+                            NotImplementedError()
+
+                # 更新後の識別器での偽物画像の出力（生成器へ勾配を伝搬させるため、output は detach しない）
+                d_fake = model_D( torch.cat([domainA, output], dim=1) )
+
+                # 損失関数を計算し、勾配を累積する
+                loss_l1_micro = loss_l1_fn( domainB_gt, output )
+                step_timer.lap("G_forward_backward")
+                loss_vgg_micro = loss_vgg_fn( domainB_gt, output )
+                step_timer.lap("perceptual_loss")
+                loss_adv_micro = loss_adv_fn.forward_G( d_fake )
+                loss_G_micro =  args.lambda_l1 * loss_l1_micro + args.lambda_vgg * loss_vgg_micro + args.lambda_adv * loss_adv_micro
+                ( loss_G_micro / n_micro_batches ).backward()
+                loss_G, loss_l1, loss_vgg, loss_adv = losses_G.add( loss_G_micro, loss_l1_micro, loss_vgg_micro, loss_adv_micro )
+                step_timer.lap("G_forward_backward")
 
             # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            loss_G.backward()
             optimizer_G.step()
+            perf_meter.update()
+            step_timer.lap("G_forward_backward")
+            if( module_profiler is not None ):
+                module_profiler.end( step )
 
             #====================================================
             # 学習過程の表示
@@ -270,8 +359,15 @@ if __name__ == '__main__':
                 board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
                 board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
                 board_train.add_scalar('D/loss_D', loss_D.item(), step)
+
+                # 学習ステップの処理時間・ピークメモリ使用量
+                step_time, max_memory = perf_meter.report()
+                board_train.add_scalar('perf/step_time_ms', step_time, step)
+                board_train.add_scalar('perf/max_memory_allocated_MB', max_memory, step)
+                board_train.add_scalar('perf/effective_batch_size', args.batch_size * args.n_accum_steps, step)
                 print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
                 print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
+                print( "step={}, step_time={:.2f}ms, max_memory_allocated={:.1f}MB".format(step, step_time, max_memory) )
                 
                 # visual images
                 if( args.net_G_type == "pix2pixhd" ):
@@ -287,6 +383,8 @@ if __name__ == '__main__':
 
                 board_add_images(board_train, 'train', visuals, step+1)
 
+            step_timer.lap("logging")
+
             #====================================================
             # valid データでの処理
             #====================================================
@@ -363,6 +461,8 @@ if __name__ == '__main__':
                 board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
                 board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
 
+            step_timer.lap("validation")
+            step_timer.end( step, args.batch_size * args.n_accum_steps )
             step += 1
             n_print -= 1
 
@@ -373,6 +473,7 @@ if __name__ == '__main__':
             save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_ep%03d.pth' % (epoch)) )
             save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
             print( "saved checkpoints" )
+            step_timer.lap("checkpoint")
 
     print("Finished Training Loop.")
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
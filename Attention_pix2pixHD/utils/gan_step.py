@@ -0,0 +1,122 @@
+# -*- coding:utf-8 -*-
+import time
+import functools
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+
+#====================================================
+# GAN の学習ステップ関連
+#====================================================
+class RequiresGradSwitch(object):
+    """
+    ネットワークのパラメーターのリストを 1 度だけ取得してキャッシュし、requires_grad の切り替えを状態が変わる時のみ行う
+    """
+    def __init__( self, model, requires_grad = True ):
+        self.params = list(model.parameters())
+        self.requires_grad = None
+        self.set( requires_grad )
+        return
+
+    def set( self, requires_grad ):
+        if( self.requires_grad == requires_grad ):
+            return
+        for param in self.params:
+            param.requires_grad_(requires_grad)
+        self.requires_grad = requires_grad
+        return
+
+
+def _split_batch_norm_forward( module, n_splits, input ):
+    return torch.cat( [ type(module).forward(module, x) for x in input.chunk(n_splits, dim=0) ], dim=0 )
+
+
+@contextmanager
+def split_batch_norm( model, n_splits = 2 ):
+    """
+    with ブロック内では model 内の BatchNorm 層がバッチを n_splits 個に分割して、分割毎に正規化する。
+    本物画像と偽物画像を結合したバッチを 1 回の forward で処理する場合に、別々に forward した場合と同じ統計量で正規化するため
+    """
+    bn_layers = [ m for m in model.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) ]
+    for m in bn_layers:
+        m.forward = functools.partial(_split_batch_norm_forward, m, n_splits)
+    try:
+        yield
+    finally:
+        for m in bn_layers:
+            del m.forward
+
+
+def split_batch( outputs, n_splits = 2 ):
+    """
+    識別器の出力（Tensor / Tensor の list, tuple）をバッチ方向に n_splits 個に分割する
+    """
+    if isinstance(outputs, torch.Tensor):
+        return list(outputs.chunk(n_splits, dim=0))
+
+    splits = [ split_batch(output, n_splits) for output in outputs ]
+    return [ type(outputs)( split[i] for split in splits ) for i in range(n_splits) ]
+
+
+def forward_D_fused( model_D, inputs, fused = True, split_bn = True ):
+    """
+    識別器への複数の入力（本物画像・偽物画像など、同じバッチサイズ）に対する出力のリストを返す。
+    fused = True の場合は、入力をバッチ方向に結合して 1 回の forward で処理する
+
+    [Args]
+        inputs : <list> 識別器への入力 Tensor のリスト
+        split_bn : <bool> 結合したバッチ内の BatchNorm を入力毎に分割して行うか
+    """
+    if not( fused ):
+        return [ model_D(input) for input in inputs ]
+
+    input = torch.cat( inputs, dim=0 )
+    if( split_bn ):
+        with split_batch_norm(model_D, len(inputs)):
+            outputs = model_D(input)
+    else:
+        outputs = model_D(input)
+
+    return split_batch(outputs, len(inputs))
+
+
+class StepPerfMeter(object):
+    """
+    学習ステップ 1 回あたりの処理時間とピークメモリ使用量を計測する。
+    GPU との同期は report() を呼んだ時のみ行う
+    """
+    def __init__( self, device ):
+        self.device = device
+        self.reset()
+        return
+
+    def synchronize( self ):
+        if( self.device.type == "cuda" ):
+            torch.cuda.synchronize(self.device)
+        return
+
+    def reset( self ):
+        self.synchronize()
+        if( self.device.type == "cuda" ):
+            torch.cuda.reset_peak_memory_stats(self.device)
+        self.start_time = time.time()
+        self.n_steps = 0
+        return
+
+    def update( self ):
+        self.n_steps += 1
+        return
+
+    def report( self ):
+        """
+        前回の report() からの 1 ステップあたりの平均処理時間 [ms] と、ピークメモリ使用量 [MB]
+        """
+        self.synchronize()
+        step_time = ( time.time() - self.start_time ) / max(self.n_steps, 1) * 1000
+        if( self.device.type == "cuda" ):
+            max_memory = torch.cuda.max_memory_allocated(self.device) / 1024 / 1024
+        else:
+            max_memory = 0.0
+        self.reset()
+        return step_time, max_memory
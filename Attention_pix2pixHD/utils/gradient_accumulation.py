@@ -0,0 +1,86 @@
+# -*- coding:utf-8 -*-
+from contextlib import contextmanager
+
+import torch
+
+from utils.activation_checkpointing import snapshot_buffers, restore_buffers, freeze_buffers
+
+#====================================================
+# マイクロバッチでの勾配の累積
+#====================================================
+def split_micro_batches( inputs, n_micro_batches ):
+    """
+    データローダーからのミニバッチ（dict）を、バッチ方向に n_micro_batches 個のマイクロバッチ（dict）に分割する。
+    同じマイクロバッチ内では入力画像と正解画像などの組み合わせは変わらない
+    """
+    if( n_micro_batches == 1 ):
+        return [ inputs ]
+
+    micro_batches = [ {} for _ in range(n_micro_batches) ]
+    for key, value in inputs.items():
+        values = value.chunk( n_micro_batches, dim = 0 ) if isinstance(value, torch.Tensor) else [ value ] * n_micro_batches
+        for micro_batch, v in zip( micro_batches, values ):
+            micro_batch[key] = v
+
+    return micro_batches
+
+
+def get_rng_state( device ):
+    return ( torch.get_rng_state(), torch.cuda.get_rng_state(device) if device.type == "cuda" else None )
+
+
+def set_rng_state( rng_state, device ):
+    cpu_state, cuda_state = rng_state
+    torch.set_rng_state( cpu_state )
+    if( cuda_state is not None ):
+        torch.cuda.set_rng_state( cuda_state, device )
+    return
+
+
+class ForwardReplay(object):
+    """
+    識別器の更新処理で行った生成器の forward（勾配計算なし）を、生成器の更新処理で勾配計算ありで再実行するための乱数・buffer の状態の記録と復元。
+    ・再実行時は forward 前の乱数の状態を復元するため、NoiseInjection のノイズや DiffAugment の変換は識別器の更新時と同じになる
+    ・再実行時は forward 前の buffer の値（BatchNorm の running stats・spectral norm の u / v）を復元するため、spectral norm の重みも識別器の更新時と同じになる
+    ・with ブロックを抜けた時に、再実行前の乱数の状態と buffer の値に戻す（再実行が以降の乱数列に影響せず、buffer が 1 回の学習ステップで 2 回更新されないように）
+    """
+    def __init__( self, model, device ):
+        self.model = model
+        self.device = device
+        self.rng_states = []
+        self.buffers = []
+        return
+
+    def record( self ):
+        self.rng_states.append( get_rng_state(self.device) )
+        self.buffers.append( snapshot_buffers(self.model) )
+        return
+
+    @contextmanager
+    def replay( self, index ):
+        rng_state = get_rng_state( self.device )
+        set_rng_state( self.rng_states[index], self.device )
+        try:
+            with freeze_buffers( self.model ):
+                restore_buffers( self.buffers[index] )
+                yield
+        finally:
+            set_rng_state( rng_state, self.device )
+
+
+class MicroBatchLosses(object):
+    """
+    マイクロバッチ毎の損失値（detach したもの）の平均。全てのマイクロバッチを add() した後の値が、ミニバッチ全体での損失値になる
+    """
+    def __init__( self, n_micro_batches ):
+        self.n_micro_batches = n_micro_batches
+        self.totals = None
+        return
+
+    def add( self, *losses ):
+        losses = [ loss.detach() / self.n_micro_batches for loss in losses ]
+        if( self.totals is None ):
+            self.totals = losses
+        else:
+            self.totals = [ total + loss for total, loss in zip(self.totals, losses) ]
+        return self.totals
@@ -0,0 +1,192 @@
+# -*- coding:utf-8 -*-
+import copy
+import time
+import numpy as np
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import QConfig, QConfigMapping, HistogramObserver, default_weight_observer, default_per_channel_weight_observer
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+#====================================================
+# FX graph mode での int8 静的量子化（CPU 推論用）
+#====================================================
+# int8 で実行できないため fp32 のまま実行するモジュール（前後で dequantize / quantize される）
+FP32_MODULE_TYPES = {
+    "reflection_pad" : nn.ReflectionPad2d,
+    "instance_norm" : nn.InstanceNorm2d,
+}
+
+def get_qconfig_mapping( per_channel = True, fp32_modules = ["reflection_pad", "instance_norm"] ):
+    """
+    量子化の設定。重みは出力チャンネル毎（per_channel = True）、活性化はヒストグラムから範囲を決める per-tensor の量子化。
+    fp32_modules に指定したモジュールは量子化しない
+    """
+    activation_observer = HistogramObserver.with_args( reduce_range = True )
+    qconfig = QConfig( activation = activation_observer, weight = default_per_channel_weight_observer if per_channel else default_weight_observer )
+    qconfig_mapping = QConfigMapping().set_global( qconfig )
+
+    # fbgemm の ConvTranspose2d は per-channel の重みに対応していないため per-tensor にする
+    qconfig_mapping.set_object_type( nn.ConvTranspose2d, QConfig( activation = activation_observer, weight = default_weight_observer ) )
+
+    for name in fp32_modules:
+        qconfig_mapping.set_object_type( FP32_MODULE_TYPES[name], None )
+    return qconfig_mapping
+
+
+def get_submodule( model, name ):
+    return model if name == "" else model.get_submodule(name)
+
+
+def set_submodule( model, name, module ):
+    parent_name, _, child_name = name.rpartition(".")
+    setattr( get_submodule(model, parent_name), child_name, module )
+    return
+
+
+def capture_submodule_inputs( model, submodule_names, inputs ):
+    """
+    model(*inputs) を実行した時の各サブモジュールへの入力（prepare_fx の example_inputs）を取得する
+    """
+    submodule_inputs = {}
+    handles = []
+    for name in submodule_names:
+        def hook( module, module_inputs, name = name ):
+            submodule_inputs[name] = module_inputs
+        handles.append( get_submodule(model, name).register_forward_pre_hook(hook) )
+
+    with torch.no_grad():
+        model( *inputs )
+
+    for handle in handles:
+        handle.remove()
+    return submodule_inputs
+
+
+def build_quantized_model( model, example_inputs, calibration_inputs = [], submodule_names = [""], per_channel = True, fp32_modules = ["reflection_pad", "instance_norm"], backend = "fbgemm" ):
+    """
+    model（fp32）をコピーし、submodule_names のサブモジュールを int8 に量子化したモデルを返す。
+    量子化しないサブモジュール（グラフ畳み込みなど）は fp32 のまま残る
+
+    [Args]
+        example_inputs : <tuple> model への入力の例（FX でのグラフの作成用）
+        calibration_inputs : <list> 活性化の量子化範囲を決めるためのキャリブレーション用の入力（model への入力の tuple）のリスト
+        submodule_names : <list> 量子化するサブモジュールの名前。"" の場合はモデル全体
+    """
+    torch.backends.quantized.engine = backend
+    model = copy.deepcopy(model).cpu().eval()
+    qconfig_mapping = get_qconfig_mapping( per_channel, fp32_modules )
+
+    # 各サブモジュールを observer を挿入したグラフに変換する
+    if( submodule_names == [""] ):
+        model = prepare_fx( model, qconfig_mapping, example_inputs )
+    else:
+        submodule_inputs = capture_submodule_inputs( model, submodule_names, example_inputs )
+        for name in submodule_names:
+            set_submodule( model, name, prepare_fx( get_submodule(model, name), qconfig_mapping, submodule_inputs[name] ) )
+
+    # キャリブレーション
+    with torch.no_grad():
+        for inputs in calibration_inputs:
+            model( *inputs )
+
+    # int8 のモジュールに変換する
+    if( submodule_names == [""] ):
+        model = convert_fx( model )
+    else:
+        for name in submodule_names:
+            set_submodule( model, name, convert_fx( get_submodule(model, name) ) )
+
+    return model
+
+
+def save_quantized_checkpoint( model_q, save_path, submodule_names = [""], per_channel = True, fp32_modules = ["reflection_pad", "instance_norm"], backend = "fbgemm" ):
+    """
+    量子化済みモデルの重みと、load_quantized_checkpoint() でモデルの構造を再現するための量子化の設定を保存する
+    """
+    torch.save(
+        {
+            "quant_config" : { "submodule_names" : submodule_names, "per_channel" : per_channel, "fp32_modules" : fp32_modules, "backend" : backend },
+            "model_state_dict" : model_q.state_dict(),
+        }, save_path
+    )
+    return
+
+
+def load_quantized_checkpoint( model, checkpoint_path, example_inputs ):
+    """
+    fp32 のモデルから量子化済みモデルの構造を作り直し（キャリブレーションなし）、save_quantized_checkpoint() で保存した重みと量子化パラメーターを読み込む
+    """
+    checkpoint = torch.load( checkpoint_path, map_location = "cpu" )
+    model_q = build_quantized_model( model, example_inputs, calibration_inputs = [], **checkpoint["quant_config"] )
+    model_q.load_state_dict( checkpoint["model_state_dict"] )
+    return model_q
+
+
+#====================================================
+# 量子化の評価
+#====================================================
+def benchmark_latency( model, inputs, n_warmups = 3, n_iters = 20 ):
+    """
+    CPU でのレイテンシー [ms]（中央値）
+    """
+    with torch.no_grad():
+        for _ in range(n_warmups):
+            model( *inputs )
+
+        elapsed_times = []
+        for _ in range(n_iters):
+            start_time = time.perf_counter()
+            model( *inputs )
+            elapsed_times.append( time.perf_counter() - start_time )
+
+    return float( np.median(elapsed_times) ) * 1000
+
+
+def calc_l1( output_ref, output ):
+    return ( output_ref - output ).abs().mean().item()
+
+
+def calc_psnr( output_ref, output, data_range = 2.0 ):
+    """
+    出力の値の範囲が data_range（tanh 出力の場合は 2.0）での PSNR [dB]
+    """
+    mse = ( ( output_ref - output ) ** 2 ).mean().item()
+    if( mse == 0 ):
+        return float("inf")
+    return 10 * np.log10( data_range ** 2 / mse )
+
+
+def calc_confusion_matrix( predicts, targets, n_classes ):
+    """
+    セグメンテーションのラベル（[B,H,W] の long）から混同行列 [n_classes, n_classes] を計算する
+    """
+    mask = ( targets >= 0 ) & ( targets < n_classes )
+    return torch.bincount( n_classes * targets[mask] + predicts[mask], minlength = n_classes ** 2 ).reshape(n_classes, n_classes)
+
+
+def calc_miou( confusion_matrix ):
+    """
+    混同行列から mIoU を計算する（正解にも予測にも現れないクラスは除く）
+    """
+    confusion_matrix = confusion_matrix.double()
+    intersection = confusion_matrix.diag()
+    union = confusion_matrix.sum(dim=0) + confusion_matrix.sum(dim=1) - intersection
+    valid = union > 0
+    return ( intersection[valid] / union[valid] ).mean().item()
+
+
+def print_quantization_report( report ):
+    """
+    fp32 と int8 のレイテンシーと出力の劣化の比較
+    """
+    print( "----------------------------------------------" )
+    print( "quantization report" )
+    print( "----------------------------------------------" )
+    print( "latency fp32 : {:.2f} ms".format(report["latency_fp32_ms"]) )
+    print( "latency int8 : {:.2f} ms (x{:.2f})".format(report["latency_int8_ms"], report["latency_fp32_ms"] / report["latency_int8_ms"]) )
+    for key, value in report.items():
+        if( key.startswith("latency") ):
+            continue
+        print( "{} : {:.5f}".format(key, value) )
+    return
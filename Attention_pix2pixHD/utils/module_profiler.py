@@ -0,0 +1,301 @@
+# -*- coding:utf-8 -*-
+import os
+import csv
+import time
+import fnmatch
+
+import torch
+import torch.nn as nn
+
+#====================================================
+# モジュール単位の forward / backward のプロファイラー
+#====================================================
+FLOPS_LAYER_TYPES = (nn.Conv1d, nn.Conv2d, nn.Conv3d, nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d, nn.Linear)
+CONV_TRANSPOSE_TYPES = (nn.ConvTranspose1d, nn.ConvTranspose2d, nn.ConvTranspose3d)
+
+PROFILE_COLUMNS = [ "module", "class", "n_calls", "forward_ms", "backward_ms", "gflops", "activation_mb", "grad_mb", "param_grad_mb" ]
+
+def iter_tensors( x ):
+    """
+    Tensor / Tensor の list, tuple, dict に含まれる Tensor
+    """
+    if isinstance(x, torch.Tensor):
+        yield x
+    elif isinstance(x, (tuple, list)):
+        for value in x:
+            yield from iter_tensors(value)
+    elif isinstance(x, dict):
+        for value in x.values():
+            yield from iter_tensors(value)
+
+
+def get_tensor_bytes( tensors ):
+    return sum( tensor.numel() * tensor.element_size() for tensor in tensors )
+
+
+def get_layer_flops( module, inputs, output ):
+    """
+    畳み込み層・全結合層の forward の FLOPs（積和演算を 2 FLOPs として数える）
+    """
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+
+    kernel_size = 1
+    for k in module.kernel_size:
+        kernel_size *= k
+    # 転置畳み込みは入力の各画素から out_channels x kernel_size の積和演算
+    if isinstance(module, CONV_TRANSPOSE_TYPES):
+        return 2 * inputs[0].numel() * ( module.out_channels // module.groups ) * kernel_size
+    return 2 * output.numel() * ( module.in_channels // module.groups ) * kernel_size
+
+
+class Clock(object):
+    """
+    GPU の場合は CUDA Event で、同期せずに処理時間を計測する（経過時間は synchronize 後に計算する）
+    """
+    def __init__( self, device ):
+        self.use_cuda = ( device.type == "cuda" )
+        return
+
+    def now( self ):
+        if( self.use_cuda ):
+            event = torch.cuda.Event( enable_timing = True )
+            event.record()
+            return event
+        return time.perf_counter()
+
+    def elapsed_ms( self, start, end ):
+        if( start is None or end is None ):
+            return 0.0
+        if( self.use_cuda ):
+            return start.elapsed_time(end)
+        return ( end - start ) * 1000
+
+
+class ModuleProfiler(object):
+    """
+    every_n_steps 毎の学習ステップでのみ、名前付きサブモジュールに hook を付けて、モジュール毎の
+    forward / backward の処理時間・FLOPs・活性化と勾配のメモリ量を記録する（それ以外のステップでは hook を付けないためオーバーヘッドはない）。
+    ・backward の処理時間は、モジュールの出力の勾配が計算されてから入力の勾配が計算されるまでの時間（入力が他のモジュールと共有されている場合は長めになる）
+    ・活性化のメモリ量は、GPU の場合は forward 前後のメモリ使用量の差分、CPU の場合は出力のメモリ量
+    ・集計結果は log_dir 内の csv と TensorBoard に出力し、trace = True の場合は torch.profiler の Chrome trace も出力する
+
+    [Args]
+        models : <dict> 名前 -> プロファイル対象のモデル（"G", "D" など）
+        max_depth : <int> patterns を指定しない場合に、プロファイル対象とするサブモジュールの階層の深さ
+        patterns : <list> プロファイル対象とするサブモジュール名 or クラス名（ワイルドカード可）
+    """
+    def __init__( self, models, device, every_n_steps = 100, max_depth = 2, patterns = [], log_dir = "profile", board = None, trace = False, n_display = 20 ):
+        self.models = models
+        self.device = device
+        self.every_n_steps = every_n_steps
+        self.max_depth = max_depth
+        self.patterns = patterns
+        self.log_dir = log_dir
+        self.board = board
+        self.trace = trace
+        self.n_display = n_display
+        self.clock = Clock( device )
+
+        self.active = False
+        self.handles = []
+        self.calls = {}
+        self.leaf_flops = {}
+        self.torch_profiler = None
+        self.totals = {}
+        self.n_samples = 0
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        return
+
+    def is_target( self, name, module ):
+        if( len(self.patterns) > 0 ):
+            return any( fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(type(module).__name__, pattern) for pattern in self.patterns )
+        return name.count(".") + 1 <= self.max_depth
+
+    def get_target_modules( self ):
+        for model_name, model in self.models.items():
+            for name, module in model.named_modules():
+                if( name != "" and self.is_target(name, module) ):
+                    yield "{}/{}".format(model_name, name), module
+
+    def is_sampled( self, step ):
+        return self.every_n_steps > 0 and step > 0 and step % self.every_n_steps == 0
+
+    #--------------------------
+    # hook
+    #--------------------------
+    def make_pre_hook( self, key ):
+        def pre_hook( module, inputs ):
+            call = { "forward_start" : self.clock.now(), "forward_end" : None, "backward_start" : None, "backward_end" : None, "activation_bytes" : 0, "grad_bytes" : 0 }
+            if( self.clock.use_cuda ):
+                call["memory_before"] = torch.cuda.memory_allocated(self.device)
+
+            # 入力の勾配が計算された時点を、このモジュールの backward の終了とする
+            def input_grad_hook( grad ):
+                call["backward_end"] = self.clock.now()
+            for tensor in iter_tensors(inputs):
+                if( tensor.requires_grad ):
+                    tensor.register_hook( input_grad_hook )
+
+            self.calls[key].append( call )
+        return pre_hook
+
+    def make_hook( self, key ):
+        def hook( module, inputs, outputs ):
+            call = self.calls[key][-1]
+            call["forward_end"] = self.clock.now()
+            if( self.clock.use_cuda ):
+                call["activation_bytes"] = torch.cuda.memory_allocated(self.device) - call["memory_before"]
+            else:
+                call["activation_bytes"] = get_tensor_bytes( iter_tensors(outputs) )
+
+            # 出力の勾配が計算された時点を、このモジュールの backward の開始とする
+            def output_grad_hook( grad ):
+                if( call["backward_start"] is None ):
+                    call["backward_start"] = self.clock.now()
+                call["grad_bytes"] += grad.numel() * grad.element_size()
+            for tensor in iter_tensors(outputs):
+                if( tensor.requires_grad ):
+                    tensor.register_hook( output_grad_hook )
+        return hook
+
+    def make_flops_hook( self, key ):
+        def flops_hook( module, inputs, output ):
+            self.leaf_flops[key] = self.leaf_flops.get(key, 0) + get_layer_flops( module, inputs, output )
+        return flops_hook
+
+    #--------------------------
+    # 学習ステップの開始・終了
+    #--------------------------
+    def begin( self, step ):
+        """
+        学習ステップの開始時（forward の前）に呼ぶ。サンプリング対象のステップの場合のみ hook を付ける
+        """
+        if not self.is_sampled( step ):
+            return
+
+        self.active = True
+        self.calls = {}
+        self.leaf_flops = {}
+        for key, module in self.get_target_modules():
+            self.calls[key] = []
+            self.handles.append( module.register_forward_pre_hook( self.make_pre_hook(key) ) )
+            self.handles.append( module.register_forward_hook( self.make_hook(key) ) )
+
+        for model_name, model in self.models.items():
+            for name, module in model.named_modules():
+                if isinstance(module, FLOPS_LAYER_TYPES):
+                    self.handles.append( module.register_forward_hook( self.make_flops_hook("{}/{}".format(model_name, name)) ) )
+
+        if( self.trace ):
+            activities = [ torch.profiler.ProfilerActivity.CPU ] + ( [ torch.profiler.ProfilerActivity.CUDA ] if self.clock.use_cuda else [] )
+            self.torch_profiler = torch.profiler.profile(
+                activities = activities, profile_memory = True,
+                on_trace_ready = torch.profiler.tensorboard_trace_handler( os.path.join(self.log_dir, "trace") ),
+            )
+            self.torch_profiler.__enter__()
+        return
+
+    def end( self, step ):
+        """
+        学習ステップの終了時（optimizer.step() の後）に呼ぶ。hook を外して、このステップの計測結果を集計・出力する
+        """
+        if not self.active:
+            return
+
+        if( self.clock.use_cuda ):
+            torch.cuda.synchronize(self.device)
+        if( self.torch_profiler is not None ):
+            self.torch_profiler.__exit__( None, None, None )
+            self.torch_profiler = None
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        self.active = False
+
+        rows = self.get_step_rows()
+        self.n_samples += 1
+        for row in rows:
+            total = self.totals.setdefault( row["module"], { "module" : row["module"], "class" : row["class"] } )
+            for column in PROFILE_COLUMNS[2:]:
+                total[column] = total.get(column, 0) + row[column]
+
+        self.write_step_rows( step, rows )
+        self.write_summary( step )
+        return
+
+    #--------------------------
+    # 集計・出力
+    #--------------------------
+    def get_step_rows( self ):
+        modules = dict( self.get_target_modules() )
+        rows = []
+        for key, calls in self.calls.items():
+            if( len(calls) == 0 ):
+                continue
+            module = modules[key]
+            # サブモジュールに含まれる畳み込み層・全結合層の FLOPs の合計
+            flops = sum( value for leaf_key, value in self.leaf_flops.items() if leaf_key == key or leaf_key.startswith(key + ".") )
+            param_grad_bytes = get_tensor_bytes( param for param in module.parameters() if param.requires_grad )
+            rows.append( {
+                "module" : key,
+                "class" : type(module).__name__,
+                "n_calls" : len(calls),
+                "forward_ms" : sum( self.clock.elapsed_ms(call["forward_start"], call["forward_end"]) for call in calls ),
+                "backward_ms" : sum( self.clock.elapsed_ms(call["backward_start"], call["backward_end"]) for call in calls ),
+                "gflops" : flops / 1e9,
+                "activation_mb" : sum( call["activation_bytes"] for call in calls ) / 1024 ** 2,
+                "grad_mb" : sum( call["grad_bytes"] for call in calls ) / 1024 ** 2,
+                "param_grad_mb" : param_grad_bytes / 1024 ** 2,
+            } )
+        return rows
+
+    def write_step_rows( self, step, rows ):
+        path = os.path.join( self.log_dir, "module_profile_steps.csv" )
+        write_header = not os.path.exists(path)
+        with open( path, "a", newline = "" ) as f:
+            writer = csv.DictWriter( f, fieldnames = [ "step" ] + PROFILE_COLUMNS )
+            if( write_header ):
+                writer.writeheader()
+            for row in rows:
+                writer.writerow( dict( row, step = step ) )
+
+        if( self.board is not None ):
+            for model_name in self.models.keys():
+                # 最上位のサブモジュール（入れ子の重複を除く）の合計
+                model_rows = [ row for row in rows if row["module"].startswith(model_name + "/") and not any( other["module"] != row["module"] and row["module"].startswith(other["module"] + ".") for other in rows ) ]
+                self.board.add_scalar( "profile/{}/forward_ms".format(model_name), sum( row["forward_ms"] for row in model_rows ), step )
+                self.board.add_scalar( "profile/{}/backward_ms".format(model_name), sum( row["backward_ms"] for row in model_rows ), step )
+                self.board.add_scalar( "profile/{}/gflops".format(model_name), sum( row["gflops"] for row in model_rows ), step )
+                self.board.add_scalar( "profile/{}/activation_mb".format(model_name), sum( row["activation_mb"] for row in model_rows ), step )
+        return
+
+    def get_summary( self ):
+        """
+        サンプリングしたステップでの平均値を、forward + backward の処理時間の降順に並べたもの
+        """
+        summary = []
+        for total in self.totals.values():
+            row = { "module" : total["module"], "class" : total["class"] }
+            for column in PROFILE_COLUMNS[2:]:
+                row[column] = total[column] / self.n_samples
+            summary.append( row )
+        return sorted( summary, key = lambda row : row["forward_ms"] + row["backward_ms"], reverse = True )
+
+    def write_summary( self, step ):
+        summary = self.get_summary()
+        with open( os.path.join( self.log_dir, "module_profile_summary.csv" ), "w", newline = "" ) as f:
+            writer = csv.DictWriter( f, fieldnames = PROFILE_COLUMNS )
+            writer.writeheader()
+            for row in summary:
+                writer.writerow( row )
+
+        lines = [ "| " + " | ".join(PROFILE_COLUMNS) + " |", "|" + "---|" * len(PROFILE_COLUMNS) ]
+        for row in summary[:self.n_display]:
+            lines.append( "| {module} | {class} | {n_calls:.1f} | {forward_ms:.2f} | {backward_ms:.2f} | {gflops:.3f} | {activation_mb:.1f} | {grad_mb:.1f} | {param_grad_mb:.1f} |".format(**row) )
+        print( "[module profile] step={}, n_samples={}".format(step, self.n_samples) )
+        print( "\n".join(lines) )
+        if( self.board is not None ):
+            self.board.add_text( "profile/summary", "\n".join(lines), step )
+        return
@@ -0,0 +1,177 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import time
+from collections import deque, OrderedDict
+
+import numpy as np
+import torch
+
+#====================================================
+# 学習ステップのフェーズ毎の処理時間の計測
+#====================================================
+def get_queue_depth( data_iter ):
+    """
+    マルチプロセスの DataLoader のイテレーターで、ワーカーに依頼済みで未取得のミニバッチ数と、そのうち取得可能なミニバッチ数。
+    シングルプロセスの場合や取得できない場合は None
+    """
+    n_outstanding = getattr( data_iter, "_tasks_outstanding", None )
+    try:
+        n_ready = data_iter._data_queue.qsize()
+    except ( AttributeError, NotImplementedError ):
+        n_ready = None
+    return n_outstanding, n_ready
+
+
+class StepPhaseTimer(object):
+    """
+    学習ステップを、データ待ち・H2D 転送・識別器・生成器・perceptual loss・評価指標・ログ出力・チェックポイント保存などのフェーズに分けて処理時間を計測する。
+    ・lap(name) を呼ぶと、前回の lap() からの時間を name のフェーズの時間として加算する（同じ名前のフェーズは合計される）
+    ・GPU の場合は CUDA Event を記録するだけで同期しないため、各フェーズの時間は GPU 上での処理時間になる。経過時間は n_log_steps 毎にまとめて計算する
+    ・データ待ちの時間は、CPU がミニバッチの取得で待たされた時間
+    ・n_log_steps 毎に、直近 window ステップでのフェーズ毎の処理時間のパーセンタイル・images/sec・DataLoader のキューの深さを TensorBoard と json lines ファイルに出力する
+    ・データ待ちの時間が学習ステップの時間の data_wait_alert 倍を超えた場合は警告を表示する
+    ・enabled = False の場合は何もしない
+    """
+    def __init__( self, device, log_path = None, board = None, window = 100, n_log_steps = 100, data_wait_alert = 0.3, percentiles = [50, 90, 99], enabled = True ):
+        self.enabled = enabled
+        self.use_cuda = ( device.type == "cuda" )
+        self.log_path = log_path
+        self.board = board
+        self.n_log_steps = n_log_steps
+        self.data_wait_alert = data_wait_alert
+        self.percentiles = percentiles
+
+        self.records = deque( maxlen = window )
+        self.pending_records = []
+        self.phases = []
+        self.last_mark = self.mark()
+        self.last_end_time = self.last_mark[0]
+        self.step_record = None
+        if( enabled and log_path is not None and os.path.dirname(log_path) != "" and not os.path.isdir(os.path.dirname(log_path)) ):
+            os.makedirs( os.path.dirname(log_path) )
+        return
+
+    def mark( self ):
+        if( self.use_cuda ):
+            event = torch.cuda.Event( enable_timing = True )
+            event.record()
+            return ( time.perf_counter(), event )
+        return ( time.perf_counter(), None )
+
+    def lap( self, name ):
+        if not self.enabled:
+            return
+        mark = self.mark()
+        self.phases.append( ( name, self.last_mark, mark ) )
+        self.last_mark = mark
+        return
+
+    def start( self, data_iter = None ):
+        """
+        DataLoader からミニバッチを取得した直後に呼ぶ
+        """
+        if not self.enabled:
+            return
+        # 前回の end()（またはその後の lap()）からミニバッチの取得までの時間がデータ待ち
+        mark = self.mark()
+        data_wait_ms = ( mark[0] - self.last_mark[0] ) * 1000
+        self.last_mark = mark
+        n_outstanding, n_ready = get_queue_depth( data_iter ) if data_iter is not None else ( None, None )
+        self.step_record = {
+            "data_wait_ms" : data_wait_ms,
+            "queue_outstanding" : n_outstanding,
+            "queue_ready" : n_ready,
+        }
+        return
+
+    def end( self, step, n_images ):
+        """
+        学習ステップの最後に呼ぶ。前回の end() から（start() 以前に lap() したチェックポイント保存などを含む）のフェーズの時間を 1 ステップ分として記録する
+        """
+        if( self.step_record is None ):
+            return
+        end_time = time.perf_counter()
+        self.step_record.update( { "step" : step, "n_images" : n_images, "step_ms" : ( end_time - self.last_end_time ) * 1000, "phases" : self.phases } )
+        self.pending_records.append( self.step_record )
+        self.step_record = None
+        self.phases = []
+        self.last_end_time = end_time
+        self.last_mark = self.mark()
+
+        if( step % self.n_log_steps == 0 ):
+            self.flush( step )
+        return
+
+    def elapsed_ms( self, start, end ):
+        if( self.use_cuda ):
+            return start[1].elapsed_time( end[1] )
+        return ( end[0] - start[0] ) * 1000
+
+    def flush( self, step ):
+        """
+        未計算のステップのフェーズ毎の時間を計算して、直近 window ステップの統計量を出力する
+        """
+        if( self.use_cuda ):
+            torch.cuda.synchronize()
+
+        for record in self.pending_records:
+            phases_ms = OrderedDict( [ ( "data_wait", record["data_wait_ms"] ) ] )
+            for name, start, end in record["phases"]:
+                phases_ms[name] = phases_ms.get(name, 0.0) + self.elapsed_ms(start, end)
+            record["phases_ms"] = phases_ms
+            del record["phases"]
+            self.records.append( record )
+        self.pending_records = []
+
+        if( len(self.records) > 0 ):
+            self.write( step, self.get_stats() )
+        return
+
+    def get_stats( self ):
+        phase_names = []
+        for record in self.records:
+            for name in record["phases_ms"].keys():
+                if( name not in phase_names ):
+                    phase_names.append( name )
+
+        stats = { "phases" : OrderedDict() }
+        for name in phase_names:
+            values = np.array( [ record["phases_ms"].get(name, 0.0) for record in self.records ] )
+            stats["phases"][name] = OrderedDict( [ ( "mean", float(values.mean()) ) ] + [ ( "p{}".format(p), float(np.percentile(values, p)) ) for p in self.percentiles ] )
+
+        step_ms = np.array( [ record["step_ms"] for record in self.records ] )
+        stats["step_ms"] = OrderedDict( [ ( "mean", float(step_ms.mean()) ) ] + [ ( "p{}".format(p), float(np.percentile(step_ms, p)) ) for p in self.percentiles ] )
+        stats["images_per_sec"] = sum( record["n_images"] for record in self.records ) / max( step_ms.sum() / 1000, 1e-6 )
+        stats["data_wait_ratio"] = stats["phases"]["data_wait"]["mean"] / max( stats["step_ms"]["mean"], 1e-6 )
+        stats["queue_outstanding"] = self.records[-1]["queue_outstanding"]
+        stats["queue_ready"] = self.records[-1]["queue_ready"]
+        return stats
+
+    def write( self, step, stats ):
+        if( self.board is not None ):
+            for name, values in stats["phases"].items():
+                for key, value in values.items():
+                    self.board.add_scalar( "timing/{}_{}_ms".format(name, key), value, step )
+            for key, value in stats["step_ms"].items():
+                self.board.add_scalar( "timing/step_{}_ms".format(key), value, step )
+            self.board.add_scalar( "timing/images_per_sec", stats["images_per_sec"], step )
+            self.board.add_scalar( "timing/data_wait_ratio", stats["data_wait_ratio"], step )
+            if( stats["queue_outstanding"] is not None ):
+                self.board.add_scalar( "timing/queue_outstanding", stats["queue_outstanding"], step )
+            if( stats["queue_ready"] is not None ):
+                self.board.add_scalar( "timing/queue_ready", stats["queue_ready"], step )
+
+        if( self.log_path is not None ):
+            with open( self.log_path, "a" ) as f:
+                f.write( json.dumps( dict( { "step" : step }, **stats ) ) + "\n" )
+
+        print( "step={}, step_time={:.2f}ms, images/sec={:.1f}, {}".format(
+            step, stats["step_ms"]["mean"], stats["images_per_sec"],
+            ", ".join( [ "{}={:.2f}ms".format(name, values["mean"]) for name, values in stats["phases"].items() ] ),
+        ) )
+        if( stats["data_wait_ratio"] > self.data_wait_alert ):
+            print( "[WARNING] data loading bound : data_wait={:.2f}ms is {:.1f}% of the step time (> {:.1f}%). n_workers を増やすか、データの前処理を軽くしてください".format(
+                stats["phases"]["data_wait"]["mean"], stats["data_wait_ratio"] * 100, self.data_wait_alert * 100,
+            ) )
+        return
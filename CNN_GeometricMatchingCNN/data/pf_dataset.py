@@ -26,17 +26,47 @@ IMG_EXTENSIONS = (
 )
 
 class PFDataset(data.Dataset):
-    def __init__( self, args, dataset_dir, image_height = 240, image_width = 240, debug = False ):
+    """
+    Proposal-Flow データセット / 参照画像と目標画像のペアデータ
+    pairs_csv_path を指定した場合は、ペアリストの csv（imageA, imageB, XA, YA, XB, YB / 座標は ';' 区切りの 1-based pixel 座標）から
+    画像ペアと対応キーポイントを読み込む。キーポイントは n_max_points 個にパディングし、マスクと共に返す（PCK 評価用）
+    n_max_points = None の場合は、csv 内のペアの最大キーポイント数にパディングする
+    """
+    def __init__( self, args, dataset_dir, image_height = 240, image_width = 240, pairs_csv_path = None, n_max_points = None, debug = False ):
         super(PFDataset, self).__init__()
         self.args = args
         self.image_height = image_height
         self.image_width = image_width
+        self.n_max_points = n_max_points
         self.debug = debug
 
-        self.image_s_dir = os.path.join( dataset_dir, "car(G)" )
-        self.image_t_dir = os.path.join( dataset_dir, "car(M)" )
-        self.image_s_names = sorted( [f for f in os.listdir(self.image_s_dir) if f.endswith(IMG_EXTENSIONS)], key=lambda s: int(re.search(r'\d+', s).group()) )
-        self.image_t_names = sorted( [f for f in os.listdir(self.image_t_dir) if f.endswith(IMG_EXTENSIONS)], key=lambda s: int(re.search(r'\d+', s).group()) )
+        if( pairs_csv_path is not None ):
+            # csv 内の画像パスは dataset_dir（or その親ディレクトリ）からの相対パス
+            df_pairs = pd.read_csv( pairs_csv_path )
+            self.image_s_dir = dataset_dir
+            self.image_t_dir = dataset_dir
+            if not os.path.exists( os.path.join(dataset_dir, df_pairs.iloc[0,0]) ):
+                self.image_s_dir = os.path.dirname( os.path.normpath(dataset_dir) )
+                self.image_t_dir = self.image_s_dir
+
+            self.image_s_names = df_pairs.iloc[:,0].tolist()
+            self.image_t_names = df_pairs.iloc[:,1].tolist()
+            self.points_s = [ self.parse_points(xs, ys) for xs, ys in zip(df_pairs.iloc[:,2], df_pairs.iloc[:,3]) ]
+            self.points_t = [ self.parse_points(xs, ys) for xs, ys in zip(df_pairs.iloc[:,4], df_pairs.iloc[:,5]) ]
+
+            # パディング後のキーポイント数
+            max_points = max( [ points.shape[1] for points in self.points_s + self.points_t ] )
+            if( self.n_max_points is None ):
+                self.n_max_points = max_points
+            elif( max_points > self.n_max_points ):
+                raise ValueError( "pairs csv {} has a pair with {} keypoints, which exceeds n_max_points={}".format(pairs_csv_path, max_points, self.n_max_points) )
+        else:
+            self.image_s_dir = os.path.join( dataset_dir, "car(G)" )
+            self.image_t_dir = os.path.join( dataset_dir, "car(M)" )
+            self.image_s_names = sorted( [f for f in os.listdir(self.image_s_dir) if f.endswith(IMG_EXTENSIONS)], key=lambda s: int(re.search(r'\d+', s).group()) )
+            self.image_t_names = sorted( [f for f in os.listdir(self.image_t_dir) if f.endswith(IMG_EXTENSIONS)], key=lambda s: int(re.search(r'\d+', s).group()) )
+            self.points_s = None
+            self.points_t = None
 
         # transform
         self.transform = transforms.Compose(
@@ -59,6 +89,26 @@ class PFDataset(data.Dataset):
     def __len__(self):
         return len(self.image_s_names)
 
+    def parse_points( self, xs, ys ):
+        """
+        ';' 区切りの座標文字列 -> [2,N] の numpy 配列
+        """
+        xs = np.array( [float(x) for x in str(xs).split(';')] )
+        ys = np.array( [float(y) for y in str(ys).split(';')] )
+        return np.stack( [xs, ys], 0 ).astype(np.float32)
+
+    def pad_points( self, points, image_width, image_height ):
+        """
+        1-based pixel 座標 [2,N] を [-1,1] に正規化し、n_max_points 個にパディングする
+        """
+        n_points = points.shape[1]
+        points_norm = np.zeros( (2, self.n_max_points), dtype = np.float32 )
+        points_norm[0,:n_points] = (points[0] - 1) / (image_width - 1) * 2 - 1
+        points_norm[1,:n_points] = (points[1] - 1) / (image_height - 1) * 2 - 1
+        mask = np.zeros( (self.n_max_points,), dtype = np.float32 )
+        mask[:n_points] = 1
+        return torch.from_numpy(points_norm), torch.from_numpy(mask)
+
     def __getitem__(self, index):
         image_s_name = self.image_s_names[index]
         image_t_name = self.image_t_names[index]
@@ -67,12 +117,14 @@ class PFDataset(data.Dataset):
         # image_s / 変換前画像
         #--------------------
         image_s = Image.open( os.path.join(self.image_s_dir,image_s_name) ).convert('RGB')
+        image_s_width, image_s_height = image_s.size
         image_s = self.transform(image_s)
 
         #-----------------------------------------------
         # image_t / 変換後画像
         #-----------------------------------------------
         image_t = Image.open( os.path.join(self.image_t_dir,image_t_name) ).convert('RGB')
+        image_t_width, image_t_height = image_t.size
         image_t = self.transform(image_t)
 
         #-----------------------------------------------
@@ -85,6 +137,20 @@ class PFDataset(data.Dataset):
             "image_t" : image_t,                # 目標画像
         }
 
+        #-----------------------------------------------
+        # キーポイント / PCK 評価用
+        #-----------------------------------------------
+        if( self.points_s is not None ):
+            point_s, point_mask = self.pad_points( self.points_s[index], image_s_width, image_s_height )
+            point_t, _ = self.pad_points( self.points_t[index], image_t_width, image_t_height )
+            # PCK の閾値の基準長 / 参照画像のキーポイントの bounding box の長辺（pixel 単位）
+            L_pck = np.max( np.max(self.points_s[index], 1) - np.min(self.points_s[index], 1) )
+            results_dict["point_s"] = point_s                   # 参照画像のキーポイント [2,n_max_points] / [-1,1] に正規化
+            results_dict["point_t"] = point_t                   # 目標画像のキーポイント [2,n_max_points] / [-1,1] に正規化
+            results_dict["point_mask"] = point_mask             # パディングしたキーポイントのマスク [n_max_points]
+            results_dict["image_s_size"] = torch.FloatTensor( [image_s_width, image_s_height] )
+            results_dict["L_pck"] = torch.tensor( L_pck, dtype = torch.float32 )
+
         return results_dict
 
 
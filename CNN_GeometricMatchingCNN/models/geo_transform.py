@@ -10,6 +10,7 @@ import torchvision
 from torchvision.utils import save_image
 
 from utils.utils import expand_dim_tsr
+from models.point_transform import PointTransformKernel
 
 #=======================================
 # Geometric transform 関連
@@ -343,92 +344,20 @@ class TpsTransform(nn.Module):
         return torch.cat((points_X_prime,points_Y_prime),3)
 
 
-class PointTranform(nn.Module):
+class PointTranform(PointTransformKernel):
     """
     座標点 (x,y) を幾何学的変換モデルで変換する
     Class with functions for transforming a set of points with affine/tps transformations    
+    処理の実体は models.point_transform.PointTransformKernel（TpsTransform のグリッドは生成しない）
     """
     def __init__(
         self, device = torch.device("cuda"),
         image_height = 240, image_width = 240,
         tps_grid_size = 3, tps_reg_factor = 0
     ):
-        super(PointTranform, self).__init__()
-        self.device=device
-        self.tps_transform = TpsTransform( device = device, image_height = image_height, image_width = image_width, grid_size = tps_grid_size, reg_factor = tps_reg_factor )   
+        super(PointTranform, self).__init__( device = device, tps_grid_size = tps_grid_size, tps_reg_factor = tps_reg_factor )
         return    
 
-    def homography_mat_from_4_pts( self, theta ):
-        b=theta.size(0)
-        if not theta.size()==(b,8):
-            theta = theta.view(b,8)
-            theta = theta.contiguous()
-        
-        xp=theta[:,:4].unsqueeze(2) ;yp=theta[:,4:].unsqueeze(2) 
-        x = Variable(torch.FloatTensor([-1, -1, 1, 1])).unsqueeze(1).unsqueeze(0).expand(b,4,1)
-        y = Variable(torch.FloatTensor([-1,  1,-1, 1])).unsqueeze(1).unsqueeze(0).expand(b,4,1)
-        z = Variable(torch.zeros(4)).unsqueeze(1).unsqueeze(0).expand(b,4,1)
-        o = Variable(torch.ones(4)).unsqueeze(1).unsqueeze(0).expand(b,4,1)
-        single_o = Variable(torch.ones(1)).unsqueeze(1).unsqueeze(0).expand(b,1,1)
-        
-        if theta.is_cuda:
-            x = x.cuda()
-            y = y.cuda()
-            z = z.cuda()
-            o = o.cuda()
-            single_o = single_o.cuda()
-
-        A=torch.cat([torch.cat([-x,-y,-o,z,z,z,x*xp,y*xp,xp],2),torch.cat([z,z,z,-x,-y,-o,x*yp,y*yp,yp],2)],1)
-        # find homography by assuming h33 = 1 and inverting the linear system
-        h=torch.bmm(torch.inverse(A[:,:,:8]),-A[:,:,8].unsqueeze(2))
-        # add h33
-        h=torch.cat([h,single_o],1)
-        H = h.squeeze(2)
-        return H
-
-    def transform_affine( self, theta, points ):
-        theta_mat = theta.view(-1,2,3)
-        warped_points = torch.bmm(theta_mat[:,:,:2],points)
-        warped_points += theta_mat[:,:,2].unsqueeze(2).expand_as(warped_points)
-        return warped_points
-
-    def transform_tps( self, theta, points ):
-        # points are expected in [B,2,N], where first row is X and second row is Y
-        # reshape points for applying Tps transformation
-        points=points.unsqueeze(3).transpose(1,3)
-        # apply transformation
-        warped_points = self.tps_transform.apply_transformation(theta,points)
-        # undo reshaping
-        warped_points=warped_points.transpose(3,1).squeeze(3)      
-        return warped_points
-
-    def transform_hom( self, theta, points, eps = 1e-5 ):
-        b=theta.size(0)
-        if theta.size(1)==9:
-            H = theta            
-        else:
-            H = self.homography_mat_from_4_pts(theta)            
-
-        h0=H[:,0].unsqueeze(1).unsqueeze(2)
-        h1=H[:,1].unsqueeze(1).unsqueeze(2)
-        h2=H[:,2].unsqueeze(1).unsqueeze(2)
-        h3=H[:,3].unsqueeze(1).unsqueeze(2)
-        h4=H[:,4].unsqueeze(1).unsqueeze(2)
-        h5=H[:,5].unsqueeze(1).unsqueeze(2)
-        h6=H[:,6].unsqueeze(1).unsqueeze(2)
-        h7=H[:,7].unsqueeze(1).unsqueeze(2)
-        h8=H[:,8].unsqueeze(1).unsqueeze(2)
-
-        X=points[:,0,:].unsqueeze(1)
-        Y=points[:,1,:].unsqueeze(1)
-        Xp = X*h0+Y*h1+h2
-        Yp = X*h3+Y*h4+h5
-        k = X*h6+Y*h7+h8
-        # prevent division by 0
-        k = k+torch.sign(k)*eps
-        Xp /= k; Yp /= k
-        return torch.cat((Xp,Yp),1)
-    
 
 class GeoPadTransform(nn.Module):
     """
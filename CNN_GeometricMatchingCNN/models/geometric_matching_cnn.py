@@ -5,6 +5,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from torch.nn import functional as F
+from torch.utils.checkpoint import checkpoint
 import torchvision
 import torchvision.models as models
 
@@ -73,15 +74,27 @@ class FeatureExtraction( nn.Module ):
 
 
 class FeatureCorrelation(torch.nn.Module):
-    def __init__( self, matching_type = 'correlation', shape = '3D', l2_norm = True ):
+    def __init__( self, matching_type = 'correlation', shape = '3D', l2_norm = True, correlation_mode = 'global', max_displacement = 4, chunk_size = 64 ):
         """
         [Args]
-
+            matching_type : <str> 類似度の計算方法 ('correlation' / 'subtraction' / 'concatenation')
+            shape : <str> 'correlation' での出力 shape ('3D' / '4D')
+            l2_norm : <bool> 'correlation' の出力を relu + L2 Norm で正規化するか
+            correlation_mode : <str> 'correlation' の計算範囲
+                'global' : 全画素間の相関 [B,H*W,H,W] を torch.bmm で一括計算（従来の処理）
+                'global_chunked' : 'global' と同じ相関を feature_A の画素単位で chunk 分割して計算し、chunk 毎に FeatureRegression の最初の conv 層に通す（global_correlation_conv()）
+                    相関ボリューム [B,H*W,H,W] 全体を確保しないため、メモリ使用量は chunk 分に抑えられる（相関の計算量は L2 Norm のために 2 倍になる）
+                'local' : 最大変位 max_displacement 内の局所相関 [B,(2*d+1)^2,H,W] を sliding window で計算する（メモリ O(B*C*H*W*(2d+1))）
+            max_displacement : <int> 'local' での最大変位 d（特徴マップ上の画素単位）
+            chunk_size : <int> 'global_chunked' で一度に計算する feature_A の画素数
         """
         super(FeatureCorrelation, self).__init__()
         self.matching_type = matching_type
         self.shape = shape
         self.l2_norm = l2_norm
+        self.correlation_mode = correlation_mode
+        self.max_displacement = max_displacement
+        self.chunk_size = chunk_size
         self.relu = nn.ReLU()
         return
 
@@ -89,9 +102,98 @@ class FeatureCorrelation(torch.nn.Module):
         norm = torch.pow(torch.sum(torch.pow(feature,2),1)+epsilon,0.5).unsqueeze(1).expand_as(feature)
         return torch.div(feature,norm)
 
+    def get_n_out_channels( self, n_in_channels, feature_height, feature_width ):
+        """
+        出力チャンネル数（FeatureRegression の入力チャンネル数）を返す
+        """
+        if( self.matching_type == "correlation" ):
+            if( self.correlation_mode == "local" ):
+                return (2 * self.max_displacement + 1) ** 2
+            else:
+                return feature_height * feature_width
+        elif( self.matching_type == "subtraction" ):
+            return n_in_channels
+        elif( self.matching_type == "concatenation" ):
+            return n_in_channels * 2
+        else:
+            NotImplementedError()
+
+    def global_correlation_conv( self, feature_A, feature_B, conv ):
+        """
+        'global' の 3D 出力 [B,H*W,H,W] に conv 層（FeatureRegression の最初の conv 層）を適用した出力を、相関ボリューム全体を確保せずに計算する。
+        conv はチャンネル（feature_A の画素 idx_A）方向に線形なので、idx_A を chunk_size 個ずつに分割して conv の重みの対応するチャンネルと畳み込み、和をとる。
+        relu + L2 Norm のノルムは idx_A 方向の和のため、1 回目の chunk ループでノルム [B,1,H*W] を計算し、2 回目の chunk ループで正規化して conv に通す。
+        学習時は chunk 毎に checkpoint して、backward 用に chunk の相関を保持しない（backward 時に再計算する）
+        """
+        b,c,h,w = feature_A.size()
+        # feature_A : [B,C,H,W] -> [B, W*H, C] (idx_A=row_A+h*col_A) / feature_B : [B,C,H,W] -> [B, C, H*W]
+        feature_A = feature_A.transpose(2,3).contiguous().view(b,c,h*w).transpose(1,2)
+        feature_B = feature_B.contiguous().view(b,c,h*w)
+
+        def run_chunk( fn, *inputs ):
+            if( torch.is_grad_enabled() ):
+                return checkpoint( fn, *inputs, use_reentrant = False )
+            return fn( *inputs )
+
+        def norm_chunk( feature_A_chunk, feature_B ):
+            # [B, chunk, H*W] -> [B, 1, H*W]
+            return torch.sum( torch.pow( self.relu(torch.bmm(feature_A_chunk, feature_B)), 2 ), 1, keepdim = True )
+
+        def conv_chunk( feature_A_chunk, feature_B, norm, weight_chunk ):
+            # [B, chunk, H*W]
+            corr_chunk = torch.bmm(feature_A_chunk, feature_B)
+            if( self.l2_norm ):
+                corr_chunk = torch.div( self.relu(corr_chunk), norm )
+            # indexed [batch,idx_A,row_B,col_B]
+            return F.conv2d( corr_chunk.view(b,-1,h,w), weight_chunk, None, conv.stride, conv.padding, conv.dilation )
+
+        norm = None
+        if( self.l2_norm ):
+            norm = 0
+            for i in range(0, h*w, self.chunk_size):
+                norm = norm + run_chunk( norm_chunk, feature_A[:,i:i+self.chunk_size], feature_B )
+            norm = torch.pow( norm + 1e-6, 0.5 )
+
+        output = 0
+        for i in range(0, h*w, self.chunk_size):
+            output = output + run_chunk( conv_chunk, feature_A[:,i:i+self.chunk_size], feature_B, norm, conv.weight[:,i:i+self.chunk_size] )
+
+        if( conv.bias is not None ):
+            output = output + conv.bias.view(1,-1,1,1)
+
+        return output
+
+    def local_correlation( self, feature_A, feature_B ):
+        """
+        feature_B の各画素 (y,x) と feature_A の (y+dy,x+dx) (|dy|,|dx| <= max_displacement) との局所相関 [B,(2d+1)^2,H,W] を計算する。
+        変位 dy ごとに feature_A の行をずらし、x 方向の窓は unfold（コピーなしの view）で取り出す。
+        チャンネル index は (dy+d)*(2d+1) + (dx+d)
+        """
+        b,c,h,w = feature_A.size()
+        d = self.max_displacement
+        k = 2 * d + 1
+        feature_A_pad = F.pad(feature_A, (d,d,d,d))
+
+        correlation = []
+        for dy in range(k):
+            # [B,C,H,W+2d] -> [B,C,H,W,2d+1]
+            feature_A_win = feature_A_pad[:,:,dy:dy+h,:].unfold(3, k, 1)
+            # [B,2d+1,H,W]
+            correlation.append( torch.einsum('bchw,bchwk->bkhw', feature_B, feature_A_win) )
+
+        correlation = torch.cat(correlation, 1)
+        if( self.l2_norm ):
+            # relu で負の値を０にして L2 Norm
+            correlation = self.featureL2Norm( self.relu(correlation) )
+
+        return correlation
+
     def forward( self, feature_A, feature_B ):
         # 内積で類似度を計算
         if( self.matching_type == "correlation" ):
+            if( self.correlation_mode == "local" ):
+                return self.local_correlation( feature_A, feature_B )
+
             b,c,h,w = feature_A.size()
             if( self.shape == '3D' ):
                 # feature_A : [B,C,H,W] -> [B, C, W*H] / feature_B : [B,C,H,W] -> [B, H*W, C]
@@ -127,22 +229,36 @@ class FeatureCorrelation(torch.nn.Module):
         return correlation
 
 class FeatureRegression(nn.Module):
-    def __init__( self, n_channels = [225,128,64], kernel_sizes = [7,5,5], n_out_channels = 6, batch_norm = True ):
+    def __init__( self, n_channels = [225,128,64], kernel_sizes = [7,5,5], n_out_channels = 6, batch_norm = True, feature_height = 15, feature_width = 15 ):
+        """
+        [Args]
+            n_channels : <list> 各 conv 層のチャンネル数。n_channels[0] は FeatureCorrelation の出力チャンネル数
+            feature_height, feature_width : <int> 入力特徴マップのサイズ（240px 入力 & VGG pool4 で 15x15）
+        """
         super(FeatureRegression, self).__init__()
         n_layers = len(kernel_sizes)
         modules = []
+        out_height, out_width = feature_height, feature_width
         for i in range(n_layers-1): # last layer is linear 
             modules.append( nn.Conv2d(n_channels[i], n_channels[i+1], kernel_size = kernel_sizes[i], padding=0) )
             if batch_norm:
                 modules.append( nn.BatchNorm2d(n_channels[i+1]) )
             modules.append( nn.ReLU(inplace=True) )
+            out_height, out_width = out_height - (kernel_sizes[i] - 1), out_width - (kernel_sizes[i] - 1)
 
         self.model = nn.Sequential(*modules)        
-        self.fc_layer = nn.Linear(n_channels[-1] * kernel_sizes[-1] * kernel_sizes[-1], n_out_channels )
+        self.fc_layer = nn.Linear(n_channels[-1] * out_height * out_width, n_out_channels )
         return
 
-    def forward(self, input):
-        output = self.model(input)
+    def forward( self, input, skip_first_conv = False ):
+        """
+        [Args]
+            skip_first_conv : <bool> input が最初の conv 層の出力の場合（FeatureCorrelation.global_correlation_conv() の出力）に True
+        """
+        if( skip_first_conv ):
+            output = self.model[1:](input)
+        else:
+            output = self.model(input)
 
         # [B,C,H,W] -> [B,C*H*W]
         output = output.view(output.shape[0], -1)
@@ -156,12 +272,27 @@ class GeometricMatchingCNN( nn.Module ):
     """
     Geometric-matching CNN / 論文「[Geometric-matching CNN] Convolutional neural network architecture for geometric matching」
     """
-    def __init__( self, n_out_channels = 6, pre_trained_model = 'vgg', matching_type = 'correlation', l2_norm = True ):
+    def __init__( 
+        self, n_out_channels = 6, pre_trained_model = 'vgg', matching_type = 'correlation', l2_norm = True,
+        image_height = 240, image_width = 240, correlation_mode = 'global', max_displacement = 4, chunk_size = 64,
+    ):
+        """
+        [Args]
+            image_height, image_width : <int> 入力画像サイズ。特徴マップのサイズ（1/16）から FeatureRegression の入力サイズを決める
+            correlation_mode : <str> FeatureCorrelation の計算範囲 ('global' / 'global_chunked' / 'local')
+            max_displacement : <int> 'local' での最大変位（特徴マップ上の画素単位）
+            chunk_size : <int> 'global_chunked' で一度に相関を計算して FeatureRegression の最初の conv 層に通す画素数
+        """
         super(GeometricMatchingCNN, self).__init__()
+        # VGG pool4 / resnet101 layer3 の特徴マップは入力の 1/16
+        feature_height, feature_width = image_height // 16, image_width // 16
+        feature_channels = {'vgg' : 512, 'resnet101' : 1024, 'resnet101_v2' : 1024, 'densenet201' : 256 }.get(pre_trained_model, 512)
+
         self.feature_extraction_A = FeatureExtraction( pre_trained_model = pre_trained_model, l2_norm = l2_norm, freeze = False )
         self.feature_extraction_B = FeatureExtraction( pre_trained_model = pre_trained_model, l2_norm = l2_norm, freeze = False )
-        self.feature_correlation = FeatureCorrelation( matching_type = matching_type, shape = '3D', l2_norm = l2_norm )
-        self.feature_regression = FeatureRegression( n_out_channels = n_out_channels, batch_norm = True )
+        self.feature_correlation = FeatureCorrelation( matching_type = matching_type, shape = '3D', l2_norm = l2_norm, correlation_mode = correlation_mode, max_displacement = max_displacement, chunk_size = chunk_size )
+        n_correlation_channels = self.feature_correlation.get_n_out_channels( feature_channels, feature_height, feature_width )
+        self.feature_regression = FeatureRegression( n_channels = [n_correlation_channels,128,64], n_out_channels = n_out_channels, batch_norm = True, feature_height = feature_height, feature_width = feature_width )
         return
 
     def forward( self, input_A, input_B ):
@@ -169,9 +300,13 @@ class GeometricMatchingCNN( nn.Module ):
         feature_A = self.feature_extraction_A(input_A)
         feature_B = self.feature_extraction_B(input_B)
 
-        # 抽出した２つの特徴量の類似度を計算
-        correlation = self.feature_correlation(feature_A, feature_B)
+        # 抽出した２つの特徴量の類似度を計算し、幾何変換パラメータ θ に回帰
+        if( self.feature_correlation.matching_type == "correlation" and self.feature_correlation.correlation_mode == "global_chunked" ):
+            # 相関ボリューム全体を確保せず、chunk 毎に FeatureRegression の最初の conv 層に通す
+            output = self.feature_correlation.global_correlation_conv( feature_A, feature_B, self.feature_regression.model[0] )
+            theta = self.feature_regression(output, skip_first_conv = True)
+        else:
+            correlation = self.feature_correlation(feature_A, feature_B)
+            theta = self.feature_regression(correlation)
 
-        # ２つの特徴量の類似を幾何変換パラメータ θ に回帰
-        theta = self.feature_regression(correlation)
         return theta
@@ -8,17 +8,23 @@ import torch.nn.functional as F
 from torchvision import models
 from torch.autograd import Variable
 
-from models.geo_transform import PointTranform
+from models.point_transform import PointTransformKernel
 
 #=============================================
 # Transformed Grid Loss
 #=============================================
 class TransformedGridLoss(nn.Module):
-    def __init__(self, device = torch.device("cuda"), geometric_model = 'affine', grid_size = 20 ):
+    def __init__(self, device = torch.device("cuda"), geometric_model = 'affine', grid_size = 20, point_transform = None ):
+        """
+        [Args]
+            point_transform : <PointTransformKernel> 座標点の変換カーネル。評価処理と共有する場合に指定（None の場合は新規作成）
+        """
         super(TransformedGridLoss, self).__init__()
         self.device = device
         self.geometric_model = geometric_model
-        self.point_transform = PointTranform(self.device)
+        if( point_transform is None ):
+            point_transform = PointTransformKernel(self.device)
+        self.point_transform = point_transform
         
         # define virtual grid of points to be transformed
         axis_coords = np.linspace(-1,1,grid_size)
@@ -27,26 +33,22 @@ class TransformedGridLoss(nn.Module):
         X = np.reshape(X,(1,1,self.N))
         Y = np.reshape(Y,(1,1,self.N))
         P = np.concatenate((X,Y),1)
-        self.P = Variable(torch.FloatTensor(P),requires_grad=False).to(self.device)
+        self.register_buffer( "P", torch.FloatTensor(P).to(self.device) )
         return
 
     def forward(self, theta, theta_gt):
-        # expand grid according to batch size
-        batch_size = theta.size()[0]
-        P = self.P.expand(batch_size,2,self.N)
-
         # compute transformed grid points using estimated and GT tnfs
-        if( self.geometric_model == 'affine' ):
-            P_prime = self.point_transform.transform_affine(theta,P)
-            P_prime_gt = self.point_transform.transform_affine(theta_gt,P)
-        elif( self.geometric_model == 'tps' ):
-            P_prime = self.point_transform.transform_tps(theta.unsqueeze(2).unsqueeze(3),P)
-            P_prime_gt = self.point_transform.transform_tps(theta_gt,P)
-        elif( self.geometric_model == 'hom' ):
-            P_prime = self.point_transform.transform_hom(theta,P)
-            P_prime_gt = self.point_transform.transform_hom(theta_gt,P)
+        batch_size = theta.size()[0]
+        theta = theta.reshape(batch_size,-1)
+        theta_gt = theta_gt.reshape(batch_size,-1).to(theta.dtype)
+        if( theta.shape == theta_gt.shape ):
+            # 推論値と正解値を batch 方向に結合して 1 回で変換する
+            P_prime_all = self.point_transform( torch.cat([theta, theta_gt], 0), self.P, geometric_model = self.geometric_model )
+            P_prime, P_prime_gt = P_prime_all[:batch_size], P_prime_all[batch_size:]
         else:
-            NotImplementedError()
+            # homography で theta [B,9] / theta_gt [B,8] の場合
+            P_prime = self.point_transform( theta, self.P, geometric_model = self.geometric_model )
+            P_prime_gt = self.point_transform( theta_gt, self.P, geometric_model = self.geometric_model )
 
         # compute MSE loss on transformed grid points
         loss = torch.sum(torch.pow(P_prime - P_prime_gt,2),1)
@@ -0,0 +1,158 @@
+# -*- coding:utf-8 -*-
+import os
+import numpy as np
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+#=======================================
+# 座標点の幾何学的変換カーネル
+#=======================================
+class PointTransformKernel(nn.Module):
+    """
+    座標点 [B,2,N] を affine / homography / tps の変換パラメータ theta で変換する軽量カーネル。
+    ・定数テンソル（homography の 4 隅の点 / tps の制御点と L 行列の逆行列）は buffer としてキャッシュし、呼び出し毎に生成・転送しない
+    ・homography は 8x8 の連立方程式を torch.linalg.solve でバッチ単位に解く
+    ・affine / homography は同次座標 [B,3,N] に対する 1 回の行列積で変換する
+    TransformedGridLoss と評価処理で同じインスタンスを共有して使う想定
+    """
+    def __init__( self, device = torch.device("cuda"), tps_grid_size = 3, tps_reg_factor = 0 ):
+        super(PointTransformKernel, self).__init__()
+        self.device = device
+        self.tps_grid_size = tps_grid_size
+        self.tps_reg_factor = tps_reg_factor
+
+        # homography の 4 隅の点 (x,y) / shape = [1,4]
+        self.register_buffer( "hom_x", torch.FloatTensor([[-1, -1, 1, 1]]) )
+        self.register_buffer( "hom_y", torch.FloatTensor([[-1,  1,-1, 1]]) )
+
+        # tps の制御点 P_i / shape = [N]
+        axis_coords = np.linspace(-1,1,tps_grid_size)
+        P_Y, P_X = np.meshgrid(axis_coords,axis_coords)
+        self.tps_N = tps_grid_size * tps_grid_size
+        self.register_buffer( "tps_P_X", torch.FloatTensor(P_X.reshape(-1)) )
+        self.register_buffer( "tps_P_Y", torch.FloatTensor(P_Y.reshape(-1)) )
+
+        # tps の L 行列の逆行列 / 最初に tps を使う時点で一度だけ計算する
+        self.register_buffer( "tps_Li", None )
+
+        self.to(self.device)
+        return
+
+    #-----------------------------------
+    # 変換行列 [B,3,3] の生成
+    #-----------------------------------
+    def affine_mat( self, theta ):
+        """
+        affine 変換パラメータ [B,6] -> 同次座標での変換行列 [B,3,3]
+        """
+        b = theta.size(0)
+        theta_mat = theta.reshape(b,2,3)
+        last_row = theta_mat.new_tensor([0,0,1]).view(1,1,3).expand(b,1,3)
+        return torch.cat( [theta_mat, last_row], 1 )
+
+    def homography_mat_from_4_pts( self, theta ):
+        """
+        4 隅の点の移動先 [B,8] (x'1..x'4, y'1..y'4) -> homography 行列 [B,9]（h33 = 1）
+        """
+        b = theta.size(0)
+        theta = theta.reshape(b,8)
+        xp, yp = theta[:,:4], theta[:,4:]
+        x, y = self.hom_x.expand(b,4), self.hom_y.expand(b,4)
+        z, o = torch.zeros_like(xp), torch.ones_like(xp)
+
+        # A h = rhs / shape = [B,8,8], [B,8]
+        A = torch.cat( [
+            torch.stack( [-x,-y,-o,z,z,z,x*xp,y*xp], 2 ),
+            torch.stack( [z,z,z,-x,-y,-o,x*yp,y*yp], 2 ),
+        ], 1 )
+        rhs = -torch.cat( [xp, yp], 1 )
+        h = torch.linalg.solve( A, rhs.unsqueeze(2) ).squeeze(2)
+        return torch.cat( [h, o[:,:1]], 1 )
+
+    def homography_mat( self, theta ):
+        """
+        homography 変換パラメータ [B,9] or [B,8] -> 同次座標での変換行列 [B,3,3]
+        """
+        b = theta.size(0)
+        theta = theta.reshape(b,-1)
+        if( theta.size(1) == 8 ):
+            theta = self.homography_mat_from_4_pts(theta)
+        return theta.reshape(b,3,3)
+
+    #-----------------------------------
+    # 座標点の変換
+    #-----------------------------------
+    def transform_mat( self, mat, points, perspective = False, eps = 1e-5 ):
+        """
+        同次座標での変換行列 [B,3,3] で座標点 [B,2,N] を変換する
+        """
+        b = mat.size(0)
+        points = points.expand(b,2,points.size(2))
+        points_hom = torch.cat( [points, torch.ones_like(points[:,:1,:])], 1 )
+        warped_points = torch.bmm( mat, points_hom )
+        if not( perspective ):
+            return warped_points[:,:2,:]
+
+        k = warped_points[:,2:,:]
+        # prevent division by 0
+        k = k + torch.sign(k) * eps
+        return warped_points[:,:2,:] / k
+
+    def transform_affine( self, theta, points ):
+        return self.transform_mat( self.affine_mat(theta), points, perspective = False )
+
+    def transform_hom( self, theta, points, eps = 1e-5 ):
+        return self.transform_mat( self.homography_mat(theta), points, perspective = True, eps = eps )
+
+    def compute_tps_L_inverse( self ):
+        X, Y = self.tps_P_X.unsqueeze(1), self.tps_P_Y.unsqueeze(1)
+        N = self.tps_N
+        P_dist_squared = (X - X.t())**2 + (Y - Y.t())**2
+        P_dist_squared[P_dist_squared==0] = 1 # make diagonal 1 to avoid NaN in log computation
+        K = P_dist_squared * torch.log(P_dist_squared)
+        if( self.tps_reg_factor != 0 ):
+            K = K + torch.eye(N, device = K.device) * self.tps_reg_factor
+
+        P = torch.cat( [torch.ones_like(X), X, Y], 1 )
+        L = torch.cat( [ torch.cat([K,P],1), torch.cat([P.t(),torch.zeros(3,3,device=K.device)],1) ], 0 )
+        return torch.linalg.inv(L)
+
+    def transform_tps( self, theta, points ):
+        """
+        tps 変換パラメータ（制御点の移動先）[B,2N] or [B,2N,1,1] で座標点 [B,2,M] を変換する
+        """
+        if( self.tps_Li is None ):
+            self.tps_Li = self.compute_tps_L_inverse()
+
+        b = theta.size(0)
+        N = self.tps_N
+        # Q : [B,N,2] (Q_X, Q_Y)
+        Q = theta.reshape(b,2,N).transpose(1,2)
+        # 非線形部分の重み W : [B,N,2] / affine 部分の重み A : [B,3,2]
+        W = torch.matmul( self.tps_Li[:N,:N], Q )
+        A = torch.matmul( self.tps_Li[N:,:N], Q )
+
+        points = points.expand(b,2,points.size(2))
+        X, Y = points[:,0,:], points[:,1,:]
+
+        # U = r^2 log r^2 : [B,M,N]
+        dist_squared = (X.unsqueeze(2) - self.tps_P_X)**2 + (Y.unsqueeze(2) - self.tps_P_Y)**2
+        dist_squared = torch.where( dist_squared == 0, torch.ones_like(dist_squared), dist_squared )    # avoid NaN in log computation
+        U = dist_squared * torch.log(dist_squared)
+
+        # [B,M,3] x [B,3,2] + [B,M,N] x [B,N,2] -> [B,M,2]
+        basis = torch.stack( [torch.ones_like(X), X, Y], 2 )
+        warped_points = torch.bmm(basis, A) + torch.bmm(U, W)
+        return warped_points.transpose(1,2)
+
+    def forward( self, theta, points, geometric_model = "affine" ):
+        if( geometric_model == "affine" ):
+            return self.transform_affine( theta, points )
+        elif( geometric_model == "tps" ):
+            return self.transform_tps( theta, points )
+        elif( geometric_model == "hom" ):
+            return self.transform_hom( theta, points )
+        else:
+            raise NotImplementedError()
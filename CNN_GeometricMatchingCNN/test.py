@@ -24,8 +24,10 @@ from tensorboardX import SummaryWriter
 from data.pf_dataset import PFDataset, PFDataLoader
 from models.geometric_matching_cnn import GeometricMatchingCNN
 from models.geo_transform import AffineTransform, TpsTransform
+from models.point_transform import PointTransformKernel
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.pck_evaluation import evaluate_pck
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -41,6 +43,12 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size_test', type=int, default=1, help="バッチサイズ")
     parser.add_argument('--image_height', type=int, default=240, help="入力画像の高さ（pixel単位）")
     parser.add_argument('--image_width', type=int, default=240, help="入力画像の幅（pixel単位）")
+    parser.add_argument('--correlation_mode', choices=['global','global_chunked','local'], default="global", help="FeatureCorrelation の計算範囲（global_chunked : 相関ボリュームを確保せず chunk 毎に回帰の conv 層に通す, local : 局所相関のみ計算。480px 以上の入力では local を推奨）")
+    parser.add_argument('--max_displacement', type=int, default=4, help="correlation_mode=local での最大変位（特徴マップ上の画素単位）")
+    parser.add_argument('--correlation_chunk_size', type=int, default=64, help="correlation_mode=global_chunked で一度に相関を計算する画素数")
+    parser.add_argument('--eval_pck', action='store_true', help="キーポイントの PCK 評価モード（ミニバッチ単位で推論し、画像は保存しない）")
+    parser.add_argument('--pairs_csv', type=str, default="", help="PCK 評価用のペアリスト csv（imageA, imageB, XA, YA, XB, YB）")
+    parser.add_argument('--pck_alphas', type=float, nargs='+', default=[0.05, 0.1, 0.15], help="PCK@α の α")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
@@ -50,6 +58,9 @@ if __name__ == '__main__':
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args()
+    if( args.eval_pck and args.pairs_csv == "" ):
+        parser.error( "--eval_pck requires --pairs_csv (keypoints are read from the pairs csv)" )
+
     if( args.debug ):
         for key, value in vars(args).items():
             print('%s: %s' % (str(key), str(value)))
@@ -103,7 +114,7 @@ if __name__ == '__main__':
     # データセットの読み込み
     #================================    
     # 学習用データセットとテスト用データセットの設定
-    ds_test = PFDataset( args, args.dataset_dir, image_height = args.image_height, image_width = args.image_width, debug = args.debug )
+    ds_test = PFDataset( args, args.dataset_dir, image_height = args.image_height, image_width = args.image_width, pairs_csv_path = args.pairs_csv if args.pairs_csv != "" else None, debug = args.debug )
     dloader_test = torch.utils.data.DataLoader(ds_test, batch_size=args.batch_size_test, shuffle = False, num_workers = args.n_workers, pin_memory = True )
 
     #================================
@@ -114,11 +125,11 @@ if __name__ == '__main__':
     #------------------------
     # GeometricMatchingCNN モデル
     if( args.geometric_model_1 == "affine" ):
-        model_G_1 = GeometricMatchingCNN( n_out_channels = 6 ).to(device)
+        model_G_1 = GeometricMatchingCNN( n_out_channels = 6, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model_1 == "tps" ):
-        model_G_1 = GeometricMatchingCNN( n_out_channels = 18 ).to(device)
+        model_G_1 = GeometricMatchingCNN( n_out_channels = 18, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model_1 == "hom" ):
-        model_G_1 = GeometricMatchingCNN( n_out_channels = 9 ).to(device)
+        model_G_1 = GeometricMatchingCNN( n_out_channels = 9, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     else:
         NotImplementedError()
 
@@ -143,11 +154,11 @@ if __name__ == '__main__':
     # stage 2
     #------------------------
     if( args.geometric_model_2 == "affine" ):
-        model_G_2 = GeometricMatchingCNN( n_out_channels = 6 ).to(device)
+        model_G_2 = GeometricMatchingCNN( n_out_channels = 6, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model_2 == "tps" ):
-        model_G_2 = GeometricMatchingCNN( n_out_channels = 18 ).to(device)
+        model_G_2 = GeometricMatchingCNN( n_out_channels = 18, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model_2 == "hom" ):
-        model_G_2 = GeometricMatchingCNN( n_out_channels = 9 ).to(device)
+        model_G_2 = GeometricMatchingCNN( n_out_channels = 9, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     else:
         NotImplementedError()
 
@@ -166,6 +177,23 @@ if __name__ == '__main__':
         print( "model_G_2 :\n", model_G_2 )
         print( "geo_transform_2 :\n", geo_transform_2 )
 
+    #================================
+    # PCK 評価
+    #================================    
+    if( args.eval_pck ):
+        point_transform = PointTransformKernel( device = device )
+        report = evaluate_pck(
+            model_G_1, model_G_2, geo_transform_1, point_transform, dloader_test, device,
+            geometric_model_1 = args.geometric_model_1, geometric_model_2 = args.geometric_model_2,
+            alphas = args.pck_alphas, n_samplings = args.n_samplings,
+            report_path = os.path.join( args.results_dir, args.exper_name, "pck_report.json" ),
+        )
+        for alpha, pck in report["pck"].items():
+            print( "PCK@{} : {:.4f}".format(alpha, pck) )
+            board_test.add_scalar('PCK/PCK@{}'.format(alpha), pck, 0 )
+        print( "n_pairs={}, total={:.2f}sec, {:.2f} pairs/sec".format(report["n_pairs"], report["time"]["total_sec"], report["time"]["pairs_per_sec"]) )
+        exit()
+
     #================================
     # モデルの推論
     #================================    
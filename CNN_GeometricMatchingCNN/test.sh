@@ -34,6 +34,16 @@ python test.py \
     --image_height ${IMAGE_HIGHT} --image_width ${IMAGE_WIDTH} --batch_size_test 1 \
     --debug
 
+# PCK 評価（ミニバッチ単位での推論 & JSON レポート出力）
+#python test.py \
+#    --exper_name ${EXPER_NAME} \
+#    --dataset_dir ${HOME}/ML_dataset/proposal-flow-willow/PF-dataset \
+#    --pairs_csv ${HOME}/ML_dataset/proposal-flow-willow/test_pairs_pf.csv \
+#    --load_checkpoints_path_1 ${LOAD_CHECKPOINTS_PATH_1} --load_checkpoints_path_2 ${LOAD_CHECKPOINTS_PATH_2} \
+#    --geometric_model_1 ${GEOMETRIC_MODEL_1} --geometric_model_2 ${GEOMETRIC_MODEL_2} \
+#    --image_height ${IMAGE_HIGHT} --image_width ${IMAGE_WIDTH} --batch_size_test 32 \
+#    --eval_pck --pck_alphas 0.05 0.1 0.15
+
 if [ $1 = "poweroff" ] ; then
     sudo poweroff
     sudo shutdown -h now
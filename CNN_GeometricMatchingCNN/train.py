@@ -23,8 +23,10 @@ from tensorboardX import SummaryWriter
 # 自作モジュール
 from data.geo_dataset import GeoDataset, GeoDataLoader
 from data.pf_dataset import PFDataset, PFDataLoader
+from data.prefetcher import DevicePrefetcher
 from models.geometric_matching_cnn import GeometricMatchingCNN
 from models.geo_transform import AffineTransform, TpsTransform, GeoPadTransform
+from models.point_transform import PointTransformKernel
 from models.losses import TransformedGridLoss, VGGLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
@@ -45,6 +47,9 @@ if __name__ == '__main__':
     parser.add_argument('--batch_size_valid', type=int, default=1, help="バッチサイズ")
     parser.add_argument('--image_height', type=int, default=240, help="入力画像の高さ（pixel単位）")
     parser.add_argument('--image_width', type=int, default=240, help="入力画像の幅（pixel単位）")
+    parser.add_argument('--correlation_mode', choices=['global','global_chunked','local'], default="global", help="FeatureCorrelation の計算範囲（global_chunked : 相関ボリュームを確保せず chunk 毎に回帰の conv 層に通す, local : 局所相関のみ計算。480px 以上の入力では local を推奨）")
+    parser.add_argument('--max_displacement', type=int, default=4, help="correlation_mode=local での最大変位（特徴マップ上の画素単位）")
+    parser.add_argument('--correlation_chunk_size', type=int, default=64, help="correlation_mode=global_chunked で一度に相関を計算する画素数")
     parser.add_argument('--lr', type=float, default=0.001, help="学習率")
     parser.add_argument('--beta1', type=float, default=0.5, help="学習率の減衰率")
     parser.add_argument('--beta2', type=float, default=0.999, help="学習率の減衰率")
@@ -63,6 +68,8 @@ if __name__ == '__main__':
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
+    parser.add_argument('--prefetch', action='store_true', help="次のミニバッチの device への転送を学習ステップの計算と並行して行う（GPU : 別の CUDA stream, CPU : バックグラウンドのスレッド）")
+    parser.add_argument('--channels_last', action='store_true', help="モデルと入力画像を channels_last のメモリ配置にする")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
@@ -146,11 +153,11 @@ if __name__ == '__main__':
     #================================
     # GeometricMatchingCNN モデル
     if( args.geometric_model == "affine" ):
-        model_G = GeometricMatchingCNN( n_out_channels = 6 ).to(device)
+        model_G = GeometricMatchingCNN( n_out_channels = 6, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model == "tps" ):
-        model_G = GeometricMatchingCNN( n_out_channels = 18 ).to(device)
+        model_G = GeometricMatchingCNN( n_out_channels = 18, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     elif( args.geometric_model == "hom" ):
-        model_G = GeometricMatchingCNN( n_out_channels = 9 ).to(device)
+        model_G = GeometricMatchingCNN( n_out_channels = 9, image_height = args.image_height, image_width = args.image_width, correlation_mode = args.correlation_mode, max_displacement = args.max_displacement, chunk_size = args.correlation_chunk_size ).to(device)
     else:
         NotImplementedError()
 
@@ -170,6 +177,9 @@ if __name__ == '__main__':
         load_checkpoint(model_G, device, args.load_checkpoints_path )
         #load_checkpoint(model_G.feature_regression, device, args.load_checkpoints_path )
 
+    if( args.channels_last ):
+        model_G = model_G.to( memory_format = torch.channels_last )
+
     if( args.debug ):
         print( "model_G :\n", model_G )
         print( "geo_pad_transform :\n", geo_pad_transform )
@@ -193,7 +203,9 @@ if __name__ == '__main__':
     #================================
     # loss 関数の設定
     #================================
-    loss_grid_fn = TransformedGridLoss( device = device, geometric_model = args.geometric_model )
+    # 座標点の変換カーネル（loss 関数と評価処理で共有）
+    point_transform = PointTransformKernel( device = device )
+    loss_grid_fn = TransformedGridLoss( device = device, geometric_model = args.geometric_model, point_transform = point_transform )
     loss_l1_fn = nn.L1Loss()
     loss_vgg_fn = VGGLoss(device = device, layids = [4] )
 
@@ -204,172 +216,185 @@ if __name__ == '__main__':
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
-            model_G.train()
-
-            # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["image_s"].shape[0] != args.batch_size:
-                break
-
-            # ミニバッチデータを GPU へ転送
-            image_s = inputs["image_s"].to(device)
-            theta_gt = inputs["theta_gt"].to(device)
-            if( args.debug and n_print > 0):
-                print( "image_s.shape : ", image_s.shape )
-                print( "theta_gt.shape : ", theta_gt.shape )
-
-            #----------------------------------------------------
-            # ランダムに生成した theta_gt から image_t（目標画像）を生成
-            #----------------------------------------------------
-            image_s_crop, image_t = geo_pad_transform( image_s, theta_gt )
-            if( args.debug and n_print > 0):
-                print( "image_s_crop.shape : ", image_s_crop.shape )
-                print( "image_t.shape : ", image_t.shape )
-
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            theta = model_G( image_s_crop, image_t )
-            if( args.debug and n_print > 0 ):
-                print( "theta.shape : ", theta.shape )
-
-            # 幾何学的変換モデルを用いて変換パラメータで変形
-            warp_image, _ = geo_transform( image_s_crop, theta )
-            if( args.debug and n_print > 0 ):
-                print( "warp_image.shape : ", warp_image.shape )
-
-            #----------------------------------------------------
-            # 生成器の更新処理
-            #----------------------------------------------------
-            # 損失関数を計算する
-            loss_grid = loss_grid_fn( theta, theta_gt )         # theta 間での損失関数 / Geometric-matching CNN の論文&公式実装に準拠
-            loss_l1 = loss_l1_fn( warp_image, image_t )         # 変形画像間での L1 Loss / Geometric-matching CNN の論文&公式実装から新規に追加
-            loss_vgg = loss_vgg_fn( warp_image, image_t )       # 変形画像間での VGG Loss / Geometric-matching CNN の論文&公式実装から新規に追加
-            loss_G = args.lambda_grid * loss_grid + args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg
-
-            # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            loss_G.backward()
-            optimizer_G.step()
-
-            if( args.lr_scheduler ):
-                scheduler_G.step()
-
-            #====================================================
-            # 学習過程の表示
-            #====================================================
-            if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
-                # lr
+        # 次のミニバッチを先読みして device に転送する（転送済みの Tensor の .to(device) は何もしない）
+        if( args.prefetch ):
+            dloader_train_iter = DevicePrefetcher( dloader_train, device, channels_last = args.channels_last )
+        else:
+            dloader_train_iter = dloader_train
+
+        # break で最後のミニバッチを読み飛ばした場合や例外の発生時にも、先読み用のスレッドを終了させる
+        try:
+            for iter, inputs in enumerate( tqdm( dloader_train_iter, desc = "epoch={}".format(epoch) ) ):
+                model_G.train()
+
+                # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                if inputs["image_s"].shape[0] != args.batch_size:
+                    break
+
+                # ミニバッチデータを GPU へ転送
+                image_s = inputs["image_s"].to(device)
+                theta_gt = inputs["theta_gt"].to(device)
+                if( args.channels_last ):
+                    image_s = image_s.contiguous( memory_format = torch.channels_last )
+                if( args.debug and n_print > 0):
+                    print( "image_s.shape : ", image_s.shape )
+                    print( "theta_gt.shape : ", theta_gt.shape )
+
+                #----------------------------------------------------
+                # ランダムに生成した theta_gt から image_t（目標画像）を生成
+                #----------------------------------------------------
+                image_s_crop, image_t = geo_pad_transform( image_s, theta_gt )
+                if( args.debug and n_print > 0):
+                    print( "image_s_crop.shape : ", image_s_crop.shape )
+                    print( "image_t.shape : ", image_t.shape )
+
+                #----------------------------------------------------
+                # 生成器 の forword 処理
+                #----------------------------------------------------
+                theta = model_G( image_s_crop, image_t )
+                if( args.debug and n_print > 0 ):
+                    print( "theta.shape : ", theta.shape )
+
+                # 幾何学的変換モデルを用いて変換パラメータで変形
+                warp_image, _ = geo_transform( image_s_crop, theta )
+                if( args.debug and n_print > 0 ):
+                    print( "warp_image.shape : ", warp_image.shape )
+
+                #----------------------------------------------------
+                # 生成器の更新処理
+                #----------------------------------------------------
+                # 損失関数を計算する
+                loss_grid = loss_grid_fn( theta, theta_gt )         # theta 間での損失関数 / Geometric-matching CNN の論文&公式実装に準拠
+                loss_l1 = loss_l1_fn( warp_image, image_t )         # 変形画像間での L1 Loss / Geometric-matching CNN の論文&公式実装から新規に追加
+                loss_vgg = loss_vgg_fn( warp_image, image_t )       # 変形画像間での VGG Loss / Geometric-matching CNN の論文&公式実装から新規に追加
+                loss_G = args.lambda_grid * loss_grid + args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg
+
+                # ネットワークの更新処理
+                optimizer_G.zero_grad()
+                loss_G.backward()
+                optimizer_G.step()
+
                 if( args.lr_scheduler ):
-                    board_train.add_scalar('lr/learning rate', scheduler_G.get_lr()[-1], step )
-                else:
-                    for param_group in optimizer_G.param_groups:
-                        lr = param_group['lr']
-
-                    board_train.add_scalar('lr/learning rate', lr, step )
-
-                # loss
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('G/loss_grid', loss_grid.item(), step)
-                board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
-                board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
-                print( "step={}, loss_G={:.5f}, loss_grid={:.5f}, loss_ls={:.5f}, loss_vgg={:.5f}".format(step, loss_G.item(), loss_grid.item(), loss_l1.item(), loss_vgg.item() ) )
-
-                # visual images
-                zero_tsr = torch.zeros( image_s.shape ).to(device)
-                visuals = [
-                    [ image_s,  image_s_crop, image_t       ],
-                    [ zero_tsr, image_s_crop, warp_image    ],
-                ]
-                board_add_images(board_train, 'train', visuals, step+1)
-
-            #====================================================
-            # valid データでの処理
-            #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_grid_total, loss_l1_total, loss_vgg_total = 0, 0, 0, 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()            
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s = inputs["image_s"].to(device)
-                    theta_gt = inputs["theta_gt"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        image_s_crop, image_t = geo_pad_transform( image_s, theta_gt )
-                        theta = model_G( image_s_crop, image_t )
-                        warp_image, _ = geo_transform( image_s_crop, theta )
-
-                    # 損失関数を計算する
-                    loss_grid = loss_grid_fn( theta, theta_gt )
-                    loss_l1 = loss_l1_fn( warp_image, image_t )
-                    loss_vgg = loss_vgg_fn( warp_image, image_t )
-                    loss_G = args.lambda_grid * loss_grid + args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg
-
-                    loss_G_total += loss_G
-                    loss_grid_total += loss_grid
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        zero_tsr = torch.zeros( image_s.shape ).to(device)
-                        visuals = [
-                            [ image_s,  image_s_crop, image_t       ],
-                            [ zero_tsr, image_s_crop, warp_image    ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-                # loss 値表示
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_grid', loss_grid_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-
-            #====================================================
-            # eval データでの処理
-            #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                n_eval_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_eval, desc = "eval") ):
-                    model_G.eval()            
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != 1:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s_name = inputs["image_s_name"]
-                    image_t_name = inputs["image_t_name"]
-                    image_s = inputs["image_s"].to(device)
-                    image_t = inputs["image_t"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        theta = model_G( image_s, image_t )
-
-                        # 幾何学的変換モデルを用いて変換パラメータで変形
-                        warp_image, grid = geo_transform( image_s, theta )
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        visuals = [
-                            [ image_s, image_t, warp_image ],
-                        ]
-                        board_add_images(board_eval, 'eval/{}'.format(iter), visuals, step+1)
-
-            step += 1
-            n_print -= 1
+                    scheduler_G.step()
+
+                #====================================================
+                # 学習過程の表示
+                #====================================================
+                if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
+                    # lr
+                    if( args.lr_scheduler ):
+                        board_train.add_scalar('lr/learning rate', scheduler_G.get_lr()[-1], step )
+                    else:
+                        for param_group in optimizer_G.param_groups:
+                            lr = param_group['lr']
+
+                        board_train.add_scalar('lr/learning rate', lr, step )
+
+                    # loss
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('G/loss_grid', loss_grid.item(), step)
+                    board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
+                    board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
+                    print( "step={}, loss_G={:.5f}, loss_grid={:.5f}, loss_ls={:.5f}, loss_vgg={:.5f}".format(step, loss_G.item(), loss_grid.item(), loss_l1.item(), loss_vgg.item() ) )
+
+                    # visual images
+                    zero_tsr = torch.zeros( image_s.shape ).to(device)
+                    visuals = [
+                        [ image_s,  image_s_crop, image_t       ],
+                        [ zero_tsr, image_s_crop, warp_image    ],
+                    ]
+                    board_add_images(board_train, 'train', visuals, step+1)
+
+                #====================================================
+                # valid データでの処理
+                #====================================================
+                if( step % args.n_display_valid_step == 0 ):
+                    loss_G_total, loss_grid_total, loss_l1_total, loss_vgg_total = 0, 0, 0, 0
+                    n_valid_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
+                        model_G.eval()            
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_s"].shape[0] != args.batch_size_valid:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        image_s = inputs["image_s"].to(device)
+                        theta_gt = inputs["theta_gt"].to(device)
+
+                        # 推論処理
+                        with torch.no_grad():
+                            image_s_crop, image_t = geo_pad_transform( image_s, theta_gt )
+                            theta = model_G( image_s_crop, image_t )
+                            warp_image, _ = geo_transform( image_s_crop, theta )
+
+                        # 損失関数を計算する
+                        loss_grid = loss_grid_fn( theta, theta_gt )
+                        loss_l1 = loss_l1_fn( warp_image, image_t )
+                        loss_vgg = loss_vgg_fn( warp_image, image_t )
+                        loss_G = args.lambda_grid * loss_grid + args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg
+
+                        loss_G_total += loss_G
+                        loss_grid_total += loss_grid
+                        loss_l1_total += loss_l1
+                        loss_vgg_total += loss_vgg
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            # visual images
+                            zero_tsr = torch.zeros( image_s.shape ).to(device)
+                            visuals = [
+                                [ image_s,  image_s_crop, image_t       ],
+                                [ zero_tsr, image_s_crop, warp_image    ],
+                            ]
+                            board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+
+                        n_valid_loop += 1
+
+                    # loss 値表示
+                    board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_grid', loss_grid_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
+
+                #====================================================
+                # eval データでの処理
+                #====================================================
+                if( step % args.n_display_valid_step == 0 ):
+                    n_eval_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_eval, desc = "eval") ):
+                        model_G.eval()            
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_s"].shape[0] != 1:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        image_s_name = inputs["image_s_name"]
+                        image_t_name = inputs["image_t_name"]
+                        image_s = inputs["image_s"].to(device)
+                        image_t = inputs["image_t"].to(device)
+
+                        # 推論処理
+                        with torch.no_grad():
+                            theta = model_G( image_s, image_t )
+
+                            # 幾何学的変換モデルを用いて変換パラメータで変形
+                            warp_image, grid = geo_transform( image_s, theta )
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            visuals = [
+                                [ image_s, image_t, warp_image ],
+                            ]
+                            board_add_images(board_eval, 'eval/{}'.format(iter), visuals, step+1)
+
+                step += 1
+                n_print -= 1
+        finally:
+            if( args.prefetch ):
+                dloader_train_iter.close()
 
         #====================================================
         # モデルの保存
@@ -0,0 +1,153 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import json
+from tqdm import tqdm
+
+import torch
+
+#====================================================
+# PCK 評価関連
+#====================================================
+class PCKMeter(object):
+    """
+    PCK@α を複数の α についてミニバッチ単位で逐次集計する。
+    集計値は device 上のテンソルで保持し、compute() を呼ぶまで CPU との同期を行わない
+    """
+    def __init__( self, alphas = [0.05, 0.1, 0.15], device = torch.device("cpu") ):
+        self.alphas = alphas
+        self.device = device
+        self.reset()
+        return
+
+    def reset( self ):
+        self.alphas_tsr = torch.tensor( self.alphas, dtype = torch.float32, device = self.device )
+        self.n_correct_points = torch.zeros( len(self.alphas), device = self.device )   # 正解キーポイント数（α 毎）
+        self.n_points = torch.zeros( 1, device = self.device )                          # 有効キーポイント数
+        self.pck_pairs_sum = torch.zeros( len(self.alphas), device = self.device )      # ペア毎の PCK の和（α 毎）
+        self.n_pairs = torch.zeros( 1, device = self.device )                           # 有効ペア数
+        return
+
+    def update( self, warp_points, points, point_mask, image_size, L_pck ):
+        """
+        [Args]
+            warp_points : <Tensor> 変換後のキーポイント [B,2,N] / [-1,1] に正規化
+            points : <Tensor> 正解キーポイント [B,2,N] / [-1,1] に正規化
+            point_mask : <Tensor> パディングしたキーポイントのマスク [B,N]
+            image_size : <Tensor> 画像サイズ (W,H) [B,2] / 正規化座標を pixel 座標に戻すため
+            L_pck : <Tensor> PCK の閾値の基準長（pixel 単位） [B]
+        """
+        # [-1,1] -> pixel 座標
+        scale = (image_size - 1).unsqueeze(2) * 0.5
+        dist = torch.norm( (warp_points - points) * scale, dim = 1 )                        # [B,N]
+
+        # [A,B,N]
+        correct = dist.unsqueeze(0) <= ( self.alphas_tsr.view(-1,1,1) * L_pck.view(1,-1,1) )
+        correct = correct.float() * point_mask.unsqueeze(0)
+
+        n_valid = point_mask.sum(1)                                                         # [B]
+        self.n_correct_points += correct.sum( (1,2) )
+        self.n_points += n_valid.sum()
+        self.pck_pairs_sum += ( correct.sum(2) / n_valid.clamp(min=1) ).sum(1)
+        self.n_pairs += (n_valid > 0).float().sum()
+        return
+
+    def compute( self ):
+        pck_pairs = ( self.pck_pairs_sum / self.n_pairs.clamp(min=1) ).cpu().tolist()
+        pck_points = ( self.n_correct_points / self.n_points.clamp(min=1) ).cpu().tolist()
+        results = {
+            "n_pairs" : int(self.n_pairs.item()),
+            "n_points" : int(self.n_points.item()),
+            "pck" : { "{}".format(alpha) : pck for alpha, pck in zip(self.alphas, pck_pairs) },                # ペア毎の PCK の平均（PF ベンチマークの評価値）
+            "pck_points" : { "{}".format(alpha) : pck for alpha, pck in zip(self.alphas, pck_points) },        # キーポイント全体での PCK
+        }
+        return results
+
+
+def evaluate_pck(
+    model_G_1, model_G_2, geo_transform_1, point_transform, dloader, device,
+    geometric_model_1 = "affine", geometric_model_2 = "tps",
+    alphas = [0.05, 0.1, 0.15], n_samplings = None, report_path = None,
+):
+    """
+    2 段階（stage1 -> stage2）の幾何学的変換モデルを、PFDataset のペア全体に対してミニバッチ単位で推論し PCK@α を計算する。
+
+    目標画像のキーポイントを stage2, stage1 の変換パラメータの順に変換して参照画像上の座標を求め、参照画像のキーポイントと比較する
+    （warp_image2 は参照画像を T1(T2(grid)) でサンプリングした画像であるため）
+
+    [Args]
+        model_G_1, model_G_2 : <GeometricMatchingCNN> stage1 / stage2 のモデル
+        geo_transform_1 : <nn.Module> stage1 の幾何学的変換モデル（stage2 の入力画像 warp_image1 の生成用）
+        point_transform : <PointTransformKernel> 座標点の変換カーネル
+        dloader : <DataLoader> pairs_csv_path を指定した PFDataset の DataLoader
+        n_samplings : <int> 評価する最大ペア数（None の場合は全て）
+        report_path : <str> JSON レポートの出力先（None の場合は出力しない）
+    [Returns]
+        report : <dict> PCK と処理時間
+    """
+    model_G_1.eval()
+    model_G_2.eval()
+    pck_meter = PCKMeter( alphas = alphas, device = device )
+
+    def synchronize():
+        if( device.type == "cuda" ):
+            torch.cuda.synchronize(device)
+
+    time_data, time_infer = 0.0, 0.0
+    n_evaluated = 0
+    synchronize()
+    start_time = time.time()
+    data_start_time = start_time
+    for inputs in tqdm( dloader, desc = "PCK eval" ):
+        # ミニバッチデータを GPU へ転送
+        image_s = inputs["image_s"].to(device, non_blocking = True)
+        image_t = inputs["image_t"].to(device, non_blocking = True)
+        point_s = inputs["point_s"].to(device, non_blocking = True)
+        point_t = inputs["point_t"].to(device, non_blocking = True)
+        point_mask = inputs["point_mask"].to(device, non_blocking = True)
+        image_s_size = inputs["image_s_size"].to(device, non_blocking = True)
+        L_pck = inputs["L_pck"].to(device, non_blocking = True)
+        infer_start_time = time.time()
+        time_data += infer_start_time - data_start_time
+
+        with torch.no_grad():
+            # stage 1
+            theta1 = model_G_1( image_s, image_t )
+            warp_image1, _ = geo_transform_1( image_s, theta1 )
+
+            # stage 2
+            theta2 = model_G_2( warp_image1, image_t )
+
+            # 目標画像のキーポイント -> stage2 -> stage1 -> 参照画像上の座標
+            warp_point = point_transform( theta2, point_t, geometric_model = geometric_model_2 )
+            warp_point = point_transform( theta1, warp_point, geometric_model = geometric_model_1 )
+            pck_meter.update( warp_point, point_s, point_mask, image_s_size, L_pck )
+
+        synchronize()
+        data_start_time = time.time()
+        time_infer += data_start_time - infer_start_time
+
+        n_evaluated += image_s.shape[0]
+        if( n_samplings is not None and n_evaluated >= n_samplings ):
+            break
+
+    time_total = time.time() - start_time
+    report = pck_meter.compute()
+    report["alphas"] = alphas
+    report["geometric_model_1"] = geometric_model_1
+    report["geometric_model_2"] = geometric_model_2
+    report["batch_size"] = dloader.batch_size
+    report["time"] = {
+        "total_sec" : time_total,
+        "data_sec" : time_data,
+        "inference_sec" : time_infer,
+        "pairs_per_sec" : n_evaluated / max(time_total, 1e-8),
+    }
+
+    if( report_path is not None ):
+        if not os.path.exists(os.path.dirname(os.path.abspath(report_path))):
+            os.makedirs(os.path.dirname(os.path.abspath(report_path)))
+        with open( report_path, "w" ) as f:
+            json.dump( report, f, indent = 4 )
+
+    return report
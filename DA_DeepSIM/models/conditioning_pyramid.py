@@ -0,0 +1,43 @@
+# -*- coding:utf-8 -*-
+import os
+import numpy as np
+
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+
+class ConditioningPyramid(object):
+    """
+    ネットワーク外部から入力するデータ（セグメンテーション画像など）を各解像度にリサイズしたものを保持し、
+    同じ解像度の SPADE / AdaIN 層の間で共有する（1 回の forward で各解像度へのリサイズは 1 度だけ行われる）
+    """
+    def __init__( self, input ):
+        self.input = input
+        self.resized_inputs = {}
+        return
+
+    def get( self, size, resize_type = "nearest" ):
+        """
+        [args]
+            size : リサイズ後の (高さ, 幅)
+            resize_type : リサイズ手法 'nearest' | 'linear' | 'bilinear' | 'bicubic' | 'trilinear' | 'area'
+        """
+        size = tuple(size)
+        if( len(self.input.shape) != 4 or tuple(self.input.shape[2:]) == size ):
+            return self.input
+
+        # 常に元の解像度の入力からリサイズする（各層で個別にリサイズしていた時と同じ値になる）
+        key = ( size, resize_type )
+        if( key not in self.resized_inputs ):
+            self.resized_inputs[key] = F.interpolate(self.input, size=size, mode=resize_type)
+        return self.resized_inputs[key]
+
+
+def get_conditioning_pyramid( input ):
+    """
+    input が Tensor の場合は ConditioningPyramid で包む（既に ConditioningPyramid の場合はそのまま共有する）
+    """
+    if isinstance(input, ConditioningPyramid):
+        return input
+    return ConditioningPyramid(input)
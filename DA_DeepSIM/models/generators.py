@@ -8,6 +8,9 @@ import torch.nn as nn
 from torch.nn import functional as F
 import torchvision
 
+from models.adain import AdaIN, AdaINResBlock
+from models.conditioning_pyramid import ConditioningPyramid
+
 def weights_init(m):
     classname = m.__class__.__name__
     if classname.find('Conv') != -1:
@@ -138,8 +141,11 @@ class Pix2PixHDAdaINGenerator( nn.Module ):
         output = self.encoder(input)
         output = self.bottle_neck(output)
         #print( "[bottle_neck] output.shape : ", output.shape )
+
+        # 各解像度にリサイズした入力データを全ての decoder で共有する
+        input_pyramid = ConditioningPyramid(input)
         for i in range(self.n_downsampling):
-            output = self.decoder["decoder_{}".format(i)](output, input)
+            output = self.decoder["decoder_{}".format(i)](output, input_pyramid)
             output = F.interpolate(output, scale_factor=2, mode='bilinear', align_corners=True)
             #print( "[decoder] output.shape : ", output.shape )
 
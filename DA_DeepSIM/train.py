@@ -23,11 +23,13 @@ from tensorboardX import SummaryWriter
 # 自作モジュール
 from data.zalando_dataset import ZalandoDataset, ZalandoDataLoader
 from data.deepsim_dataset import DeepSIMDataset, DeepSIMDataLoader
+from data.prefetcher import DevicePrefetcher
 from models.generators import Pix2PixHDGenerator
 from models.discriminators import PatchGANDiscriminator, MultiscaleDiscriminator
 from models.losses import VGGLoss, LSGANLoss, FeatureMatchingLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.gan_step import RequiresGradSwitch, forward_D_fused, StepPerfMeter
 from utils.decode_labels import decode_labels_tsr
 
 if __name__ == '__main__':
@@ -63,9 +65,13 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_vgg', type=float, default=10.0, help="VGG perceptual loss の係数値")
     parser.add_argument('--lambda_feat', type=float, default=10.0, help="Feature Matching Loss の係数値")
     parser.add_argument('--lambda_adv', type=float, default=1.0, help="Adv loss_G の係数値")
+    parser.add_argument('--d_forward_type', choices=['fused','separate'], default="fused", help="識別器の本物画像・偽物画像の forward 方法（fused : 結合した 1 つのバッチで forward）")
+    parser.add_argument('--d_bn_mode', choices=['per_half','joint'], default="per_half", help="fused 時の識別器内の BatchNorm の正規化方法（per_half : 本物画像・偽物画像毎に正規化）")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
+    parser.add_argument('--prefetch', action='store_true', help="次のミニバッチの device への転送を学習ステップの計算と並行して行う（GPU : 別の CUDA stream, CPU : バックグラウンドのスレッド）")
+    parser.add_argument('--channels_last', action='store_true', help="モデルと入力画像を channels_last のメモリ配置にする")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
@@ -167,6 +173,10 @@ if __name__ == '__main__':
     else:
         NotImplementedError()
 
+    if( args.channels_last ):
+        model_G = model_G.to( memory_format = torch.channels_last )
+        model_D = model_D.to( memory_format = torch.channels_last )
+
     if( args.debug ):
         print( "model_G\n", model_G )
         print( "model_D\n", model_D )
@@ -183,6 +193,10 @@ if __name__ == '__main__':
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # 識別器のパラメーターの勾配計算の切り替え / 学習ステップの処理時間・メモリ使用量の計測
+    requires_grad_D = RequiresGradSwitch( model_D )
+    perf_meter = StepPerfMeter( device )
+
     #================================
     # loss 関数の設定
     #================================
@@ -198,298 +212,336 @@ if __name__ == '__main__':
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
-            model_G.train()
-            model_D.train()
-
-            # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["image_s"].shape[0] != args.batch_size:
-                break
-
-            # ミニバッチデータを GPU へ転送
-            image_s = inputs["image_s"].to(device)
-            image_t_gt = inputs["image_t_gt"].to(device)
-            if( args.onehot ):
-                image_s_vis = decode_labels_tsr(image_s)
-            else:
-                image_s_vis = image_s
-
-            if( args.debug and n_print > 0):
-                print( "[image_s] shape={}, dtype={}, min={}, max={} : ".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s) ) )
-                print( "[image_t_gt] shape={}, dtype={}, min={}, max={} : ".format(image_t_gt.shape, image_t_gt.dtype, torch.min(image_t_gt), torch.max(image_t_gt) ) )
-
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            output = model_G( image_s )
-            if( args.debug and n_print > 0 ):
-                print( "output.shape : ", output.shape )
-
-            #----------------------------------------------------
-            # 識別器の更新処理
-            #----------------------------------------------------
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
-
-            # 学習用データをモデルに流し込む
-            if( args.net_D_type == "patch_gan" ):
-                d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                if( args.debug and n_print > 0 ):
-                    print( "d_real.shape :", d_real.shape )
-                    print( "d_fake.shape :", d_fake.shape )
-            elif( args.net_D_type == "multi_scale" ):
-                d_reals = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                d_fakes = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                d_real_D1 = d_reals[0][-1]
-                d_real_D2 = d_reals[1][-1]
-                d_fake_D1 = d_fakes[0][-1]
-                d_fake_D2 = d_fakes[1][-1]
+        # 次のミニバッチを先読みして device に転送する（転送済みの Tensor の .to(device) は何もしない）
+        if( args.prefetch ):
+            dloader_train_iter = DevicePrefetcher( dloader_train, device, channels_last = args.channels_last )
+        else:
+            dloader_train_iter = dloader_train
+
+        # break で最後のミニバッチを読み飛ばした場合や例外の発生時にも、先読み用のスレッドを終了させる
+        try:
+            for iter, inputs in enumerate( tqdm( dloader_train_iter, desc = "epoch={}".format(epoch) ) ):
+                model_G.train()
+                model_D.train()
+
+                # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                if inputs["image_s"].shape[0] != args.batch_size:
+                    break
+
+                # ミニバッチデータを GPU へ転送
+                image_s = inputs["image_s"].to(device)
+                image_t_gt = inputs["image_t_gt"].to(device)
+                if( args.channels_last ):
+                    image_s = image_s.contiguous( memory_format = torch.channels_last )
+                    image_t_gt = image_t_gt.contiguous( memory_format = torch.channels_last )
+                if( args.onehot ):
+                    image_s_vis = decode_labels_tsr(image_s)
+                else:
+                    image_s_vis = image_s
+
+                if( args.debug and n_print > 0):
+                    print( "[image_s] shape={}, dtype={}, min={}, max={} : ".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s) ) )
+                    print( "[image_t_gt] shape={}, dtype={}, min={}, max={} : ".format(image_t_gt.shape, image_t_gt.dtype, torch.min(image_t_gt), torch.max(image_t_gt) ) )
+
+                #----------------------------------------------------
+                # 生成器 の forword 処理
+                #----------------------------------------------------
+                output = model_G( image_s )
                 if( args.debug and n_print > 0 ):
-                    print( "len(d_reals) :", len(d_reals) )
-                    print( "len(d_fakes) :", len(d_fakes) )
-                    print( "len(d_reals) :", len(d_reals) )
-                    print( "d_real_D1.shape :", d_real_D1.shape )
-                    print( "d_fake_D1.shape :", d_fake_D1.shape )
-            else:
-                NotImplementedError()
-
-            # 損失関数を計算する
-            if( args.net_D_type == "patch_gan" ):
-                loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-            elif( args.net_D_type == "multi_scale" ):
-                loss_D1, loss_D1_real, loss_D1_fake = loss_adv_fn.forward_D( d_real_D1, d_fake_D1 )
-                loss_D2, loss_D2_real, loss_D2_fake = loss_adv_fn.forward_D( d_real_D2, d_fake_D2 )
-                loss_D_real = loss_D1_real + loss_D2_real
-                loss_D_fake = loss_D1_fake + loss_D2_fake
-                loss_D = loss_D1 + loss_D2
-            else:
-                NotImplementedError()
-
-            # ネットワークの更新処理
-            optimizer_D.zero_grad()
-            loss_D.backward(retain_graph=True)
-            optimizer_D.step()
-
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
-
-            #----------------------------------------------------
-            # 生成器の更新処理
-            #----------------------------------------------------
-            # 損失関数を計算する
-            loss_l1 = loss_l1_fn( image_t_gt, output )
-            loss_vgg = loss_vgg_fn( image_t_gt, output )
-
-            if( args.net_D_type == "multi_scale" ):
-                loss_feat = loss_feat_fn( d_reals, d_fakes )
-            else:
-                loss_feat = torch.zeros(1, requires_grad=False).float().to(device)
-
-            if( args.net_D_type == "patch_gan" ):
-                loss_adv = loss_adv_fn.forward_G( d_fake )
-            elif( args.net_D_type == "multi_scale" ):
-                loss_adv_D1 = loss_adv_fn.forward_G( d_fake_D1 )
-                loss_adv_D2 = loss_adv_fn.forward_G( d_fake_D2 )
-                loss_adv = loss_adv_D1 + loss_adv_D2
-            else:
-                NotImplementedError()
-
-            if( args.net_D_type == "patch_gan" ):
-                loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-            elif( args.net_D_type == "multi_scale" ):
-                loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_feat * loss_feat + args.lambda_adv * loss_adv
-            else:
-                NotImplementedError()
-
-            # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            loss_G.backward()
-            optimizer_G.step()
-
-            #====================================================
-            # 学習過程の表示
-            #====================================================
-            if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
-                # lr
-                for param_group in optimizer_G.param_groups:
-                    lr = param_group['lr']
-
-                board_train.add_scalar('lr/learning rate', lr, step )
-
-                # loss
-                board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
-                board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
-                board_train.add_scalar('G/loss_feat', loss_feat.item(), step)
-                board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
-                board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
-                board_train.add_scalar('D/loss_D', loss_D.item(), step)
-
-                print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_feat={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_feat.item(), loss_adv.item()) )
-                print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
+                    print( "output.shape : ", output.shape )
+
+                #----------------------------------------------------
+                # 識別器の更新処理
+                #----------------------------------------------------
+                # 無効化していた識別器 D のネットワークの勾配計算を有効化。
+                requires_grad_D.set(True)
+
+                # 学習用データをモデルに流し込む
+                # （本物画像・偽物画像を結合した 1 つのバッチで forward）
+                if( args.net_D_type == "patch_gan" ):
+                    d_real, d_fake = forward_D_fused(
+                        model_D, [ torch.cat([image_s, image_t_gt], dim=1), torch.cat([image_s, output.detach()], dim=1) ],
+                        fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                    )
+                    if( args.debug and n_print > 0 ):
+                        print( "d_real.shape :", d_real.shape )
+                        print( "d_fake.shape :", d_fake.shape )
+                elif( args.net_D_type == "multi_scale" ):
+                    d_reals, d_fakes = forward_D_fused(
+                        model_D, [ torch.cat([image_s, image_t_gt], dim=1), torch.cat([image_s, output.detach()], dim=1) ],
+                        fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                    )
+                    d_real_D1 = d_reals[0][-1]
+                    d_real_D2 = d_reals[1][-1]
+                    d_fake_D1 = d_fakes[0][-1]
+                    d_fake_D2 = d_fakes[1][-1]
+                    if( args.debug and n_print > 0 ):
+                        print( "len(d_reals) :", len(d_reals) )
+                        print( "len(d_fakes) :", len(d_fakes) )
+                        print( "len(d_reals) :", len(d_reals) )
+                        print( "d_real_D1.shape :", d_real_D1.shape )
+                        print( "d_fake_D1.shape :", d_fake_D1.shape )
+                else:
+                    NotImplementedError()
+
+                # 損失関数を計算する
+                if( args.net_D_type == "patch_gan" ):
+                    loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+                elif( args.net_D_type == "multi_scale" ):
+                    loss_D1, loss_D1_real, loss_D1_fake = loss_adv_fn.forward_D( d_real_D1, d_fake_D1 )
+                    loss_D2, loss_D2_real, loss_D2_fake = loss_adv_fn.forward_D( d_real_D2, d_fake_D2 )
+                    loss_D_real = loss_D1_real + loss_D2_real
+                    loss_D_fake = loss_D1_fake + loss_D2_fake
+                    loss_D = loss_D1 + loss_D2
+                else:
+                    NotImplementedError()
+
+                # ネットワークの更新処理
+                optimizer_D.zero_grad()
+                loss_D.backward()
+                optimizer_D.step()
+
+                # 識別器 D のネットワークの勾配計算を無効化。
+                requires_grad_D.set(False)
+
+                #----------------------------------------------------
+                # 生成器の更新処理
+                #----------------------------------------------------
+                # 更新後の識別器での偽物画像の出力（生成器へ勾配を伝搬させるため、output は detach しない）
+                if( args.net_D_type == "patch_gan" ):
+                    d_fake = model_D( torch.cat([image_s, output], dim=1) )
+                elif( args.net_D_type == "multi_scale" ):
+                    # feature matching loss 用に本物画像の中間特徴量も更新後の識別器で計算する
+                    d_reals, d_fakes = forward_D_fused(
+                        model_D, [ torch.cat([image_s, image_t_gt], dim=1), torch.cat([image_s, output], dim=1) ],
+                        fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                    )
+                    d_fake_D1 = d_fakes[0][-1]
+                    d_fake_D2 = d_fakes[1][-1]
+                else:
+                    NotImplementedError()
+
+                # 損失関数を計算する
+                loss_l1 = loss_l1_fn( image_t_gt, output )
+                loss_vgg = loss_vgg_fn( image_t_gt, output )
+
+                if( args.net_D_type == "multi_scale" ):
+                    loss_feat = loss_feat_fn( d_reals, d_fakes )
+                else:
+                    loss_feat = torch.zeros(1, requires_grad=False).float().to(device)
+
+                if( args.net_D_type == "patch_gan" ):
+                    loss_adv = loss_adv_fn.forward_G( d_fake )
+                elif( args.net_D_type == "multi_scale" ):
+                    loss_adv_D1 = loss_adv_fn.forward_G( d_fake_D1 )
+                    loss_adv_D2 = loss_adv_fn.forward_G( d_fake_D2 )
+                    loss_adv = loss_adv_D1 + loss_adv_D2
+                else:
+                    NotImplementedError()
+
+                if( args.net_D_type == "patch_gan" ):
+                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+                elif( args.net_D_type == "multi_scale" ):
+                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_feat * loss_feat + args.lambda_adv * loss_adv
+                else:
+                    NotImplementedError()
+
+                # ネットワークの更新処理
+                optimizer_G.zero_grad()
+                loss_G.backward()
+                optimizer_G.step()
+                perf_meter.update()
+
+                #====================================================
+                # 学習過程の表示
+                #====================================================
+                if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
+                    # lr
+                    for param_group in optimizer_G.param_groups:
+                        lr = param_group['lr']
+
+                    board_train.add_scalar('lr/learning rate', lr, step )
+
+                    # loss
+                    board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
+                    board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
+                    board_train.add_scalar('G/loss_feat', loss_feat.item(), step)
+                    board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
+                    board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
+                    board_train.add_scalar('D/loss_D', loss_D.item(), step)
+
+                    # 学習ステップの処理時間・ピークメモリ使用量
+                    step_time, max_memory = perf_meter.report()
+                    board_train.add_scalar('perf/step_time_ms', step_time, step)
+                    board_train.add_scalar('perf/max_memory_allocated_MB', max_memory, step)
+
+                    print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_feat={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_feat.item(), loss_adv.item()) )
+                    print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
+                    print( "step={}, step_time={:.2f}ms, max_memory_allocated={:.1f}MB".format(step, step_time, max_memory) )
                 
-                # visual images
-                visuals = [
-                    [ image_s_vis, image_t_gt, output ],
-                ]
-                board_add_images(board_train, 'train', visuals, step+1)
-
-            #====================================================
-            # valid データでの処理
-            #====================================================
-            if( args.dataset_type in ["zalando"] and step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_l1_total, loss_vgg_total, loss_feat_total, loss_adv_total = 0, 0, 0, 0, 0
-                loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()
-                    model_D.eval()            
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s = inputs["image_s"].to(device)
-                    image_t_gt = inputs["image_t_gt"].to(device)
-                    if( args.onehot ):
-                        image_s_vis = decode_labels_tsr(image_s)
-                    else:
-                        image_s_vis = image_s
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output = model_G( image_s )
-
-                    with torch.no_grad():
+                    # visual images
+                    visuals = [
+                        [ image_s_vis, image_t_gt, output ],
+                    ]
+                    board_add_images(board_train, 'train', visuals, step+1)
+
+                #====================================================
+                # valid データでの処理
+                #====================================================
+                if( args.dataset_type in ["zalando"] and step % args.n_display_valid_step == 0 ):
+                    loss_G_total, loss_l1_total, loss_vgg_total, loss_feat_total, loss_adv_total = 0, 0, 0, 0, 0
+                    loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
+                    n_valid_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
+                        model_G.eval()
+                        model_D.eval()            
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_s"].shape[0] != args.batch_size_valid:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        image_s = inputs["image_s"].to(device)
+                        image_t_gt = inputs["image_t_gt"].to(device)
+                        if( args.onehot ):
+                            image_s_vis = decode_labels_tsr(image_s)
+                        else:
+                            image_s_vis = image_s
+
+                        # 推論処理
+                        with torch.no_grad():
+                            output = model_G( image_s )
+
+                        with torch.no_grad():
+                            if( args.net_D_type == "patch_gan" ):
+                                d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
+                                d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
+                                if( args.debug and n_print > 0 ):
+                                    print( "d_real.shape :", d_real.shape )
+                                    print( "d_fake.shape :", d_fake.shape )
+                            elif( args.net_D_type == "multi_scale" ):
+                                d_reals = model_D( torch.cat([image_s, image_t_gt], dim=1) )
+                                d_fakes = model_D( torch.cat([image_s, output.detach()], dim=1) )
+                                d_real_D1 = d_reals[0][-1]
+                                d_real_D2 = d_reals[1][-1]
+                                d_fake_D1 = d_fakes[0][-1]
+                                d_fake_D2 = d_fakes[1][-1]
+                                if( args.debug and n_print > 0 ):
+                                    print( "len(d_reals) :", len(d_reals) )
+                                    print( "len(d_fakes) :", len(d_fakes) )
+                                    print( "len(d_reals) :", len(d_reals) )
+                                    print( "d_real_D1.shape :", d_real_D1.shape )
+                                    print( "d_fake_D1.shape :", d_fake_D1.shape )
+                            else:
+                                NotImplementedError()
+
+                        # 損失関数を計算する（生成器）
+                        loss_l1 = loss_l1_fn( image_t_gt, output )
+                        loss_vgg = loss_vgg_fn( image_t_gt, output )
+
+                        if( args.net_D_type == "multi_scale" ):
+                            loss_feat = loss_feat_fn( d_reals, d_fakes )
+                        else:
+                            loss_feat = torch.zeros(1, requires_grad=True).float().to(device)
+
                         if( args.net_D_type == "patch_gan" ):
-                            d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                            d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                            if( args.debug and n_print > 0 ):
-                                print( "d_real.shape :", d_real.shape )
-                                print( "d_fake.shape :", d_fake.shape )
+                            loss_adv = loss_adv_fn.forward_G( d_fake )
                         elif( args.net_D_type == "multi_scale" ):
-                            d_reals = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                            d_fakes = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                            d_real_D1 = d_reals[0][-1]
-                            d_real_D2 = d_reals[1][-1]
-                            d_fake_D1 = d_fakes[0][-1]
-                            d_fake_D2 = d_fakes[1][-1]
-                            if( args.debug and n_print > 0 ):
-                                print( "len(d_reals) :", len(d_reals) )
-                                print( "len(d_fakes) :", len(d_fakes) )
-                                print( "len(d_reals) :", len(d_reals) )
-                                print( "d_real_D1.shape :", d_real_D1.shape )
-                                print( "d_fake_D1.shape :", d_fake_D1.shape )
+                            loss_adv_D1 = loss_adv_fn.forward_G( d_fake_D1 )
+                            loss_adv_D2 = loss_adv_fn.forward_G( d_fake_D2 )
+                            loss_adv = loss_adv_D1 + loss_adv_D2
                         else:
                             NotImplementedError()
 
-                    # 損失関数を計算する（生成器）
-                    loss_l1 = loss_l1_fn( image_t_gt, output )
-                    loss_vgg = loss_vgg_fn( image_t_gt, output )
-
-                    if( args.net_D_type == "multi_scale" ):
-                        loss_feat = loss_feat_fn( d_reals, d_fakes )
-                    else:
-                        loss_feat = torch.zeros(1, requires_grad=True).float().to(device)
-
-                    if( args.net_D_type == "patch_gan" ):
-                        loss_adv = loss_adv_fn.forward_G( d_fake )
-                    elif( args.net_D_type == "multi_scale" ):
-                        loss_adv_D1 = loss_adv_fn.forward_G( d_fake_D1 )
-                        loss_adv_D2 = loss_adv_fn.forward_G( d_fake_D2 )
-                        loss_adv = loss_adv_D1 + loss_adv_D2
-                    else:
-                        NotImplementedError()
-
-                    if( args.net_D_type == "patch_gan" ):
-                        loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-                    elif( args.net_D_type == "multi_scale" ):
-                        loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_feat * loss_feat + args.lambda_adv * loss_adv
-                    else:
-                        NotImplementedError()
-
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
-                    loss_feat_total += loss_feat
-                    loss_adv_total += loss_adv
-                    loss_G_total += loss_G
-
-                    # 損失関数を計算する（識別器）
-                    if( args.net_D_type == "patch_gan" ):
-                        loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-                    elif( args.net_D_type == "multi_scale" ):
-                        loss_D1, loss_D1_real, loss_D1_fake = loss_adv_fn.forward_D( d_real_D1, d_fake_D1 )
-                        loss_D2, loss_D2_real, loss_D2_fake = loss_adv_fn.forward_D( d_real_D2, d_fake_D2 )
-                        loss_D_real = loss_D1_real + loss_D2_real
-                        loss_D_fake = loss_D1_fake + loss_D2_fake
-                        loss_D = loss_D1 + loss_D2
-                    else:
-                        NotImplementedError()
-
-                    loss_D_total += loss_D
-                    loss_D_real_total += loss_D_real
-                    loss_D_fake_total += loss_D_fake
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        visuals = [
-                            [ image_s_vis, image_t_gt, output ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-                # loss 値表示
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_feat', loss_feat_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
-
-            #====================================================
-            # test データでの処理
-            #====================================================
-            if( args.dataset_type in ["deepsim_car", "deepsim_face"] and step % args.n_display_valid_step == 0 ):
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s = inputs["image_s"].to(device)
-                    if( args.onehot ):
-                        image_s_vis = decode_labels_tsr(image_s)
-                    else:
-                        image_s_vis = image_s
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output = model_G( image_s )
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        visuals = [
-                            [ image_s_vis, output ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-            step += 1
-            n_print -= 1
+                        if( args.net_D_type == "patch_gan" ):
+                            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+                        elif( args.net_D_type == "multi_scale" ):
+                            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_feat * loss_feat + args.lambda_adv * loss_adv
+                        else:
+                            NotImplementedError()
+
+                        loss_l1_total += loss_l1
+                        loss_vgg_total += loss_vgg
+                        loss_feat_total += loss_feat
+                        loss_adv_total += loss_adv
+                        loss_G_total += loss_G
+
+                        # 損失関数を計算する（識別器）
+                        if( args.net_D_type == "patch_gan" ):
+                            loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+                        elif( args.net_D_type == "multi_scale" ):
+                            loss_D1, loss_D1_real, loss_D1_fake = loss_adv_fn.forward_D( d_real_D1, d_fake_D1 )
+                            loss_D2, loss_D2_real, loss_D2_fake = loss_adv_fn.forward_D( d_real_D2, d_fake_D2 )
+                            loss_D_real = loss_D1_real + loss_D2_real
+                            loss_D_fake = loss_D1_fake + loss_D2_fake
+                            loss_D = loss_D1 + loss_D2
+                        else:
+                            NotImplementedError()
+
+                        loss_D_total += loss_D
+                        loss_D_real_total += loss_D_real
+                        loss_D_fake_total += loss_D_fake
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            # visual images
+                            visuals = [
+                                [ image_s_vis, image_t_gt, output ],
+                            ]
+                            board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+
+                        n_valid_loop += 1
+
+                    # loss 値表示
+                    board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_feat', loss_feat_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
+
+                #====================================================
+                # test データでの処理
+                #====================================================
+                if( args.dataset_type in ["deepsim_car", "deepsim_face"] and step % args.n_display_valid_step == 0 ):
+                    n_valid_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
+                        model_G.eval()
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_s"].shape[0] != args.batch_size_valid:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        image_s = inputs["image_s"].to(device)
+                        if( args.onehot ):
+                            image_s_vis = decode_labels_tsr(image_s)
+                        else:
+                            image_s_vis = image_s
+
+                        # 推論処理
+                        with torch.no_grad():
+                            output = model_G( image_s )
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            # visual images
+                            visuals = [
+                                [ image_s_vis, output ],
+                            ]
+                            board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+
+                        n_valid_loop += 1
+
+                step += 1
+                n_print -= 1
+        finally:
+            if( args.prefetch ):
+                dloader_train_iter.close()
 
         #====================================================
         # モデルの保存
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from networks import Generator, MNISTGenerator
+from model_export import load_state_dict_cpu
+from inference_optimization import optimize_for_inference, check_inference_optimization, randomize_batch_norm_stats
+
+if __name__ == '__main__':
+    """
+    DCGAN の生成器を推論用に最適化（BatchNorm の畳み込み・活性化関数の融合・channels last）し、最適化前との出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', choices=['mnist', 'cifar-10'], default="mnist", help="データセットの種類")
+    parser.add_argument('--load_checkpoints_dir', type=str, default="", help="モデルの読み込みディレクトリ")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="特徴マップの枚数")
+    parser.add_argument('--n_input_noize_z', type=int, default=100, help="生成器に入力するノイズ z の次数")
+    parser.add_argument('--networkG_type', choices=['vanilla','mnist' ], default="vanilla", help="GAN の生成器の種類")
+    parser.add_argument('--no_channels_last', action='store_true', help="channels last への変換を行わない")
+    parser.add_argument('--torchscript', action='store_true', help="TorchScript の freeze で畳み込みと活性化関数を融合する")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=0, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    if( args.dataset == "mnist" and args.networkG_type == "mnist" ):
+        model = MNISTGenerator( n_input_noize_z = args.n_input_noize_z )
+        example_input = torch.randn( size = (1, args.n_input_noize_z) )
+    else:
+        model = Generator( n_input_noize_z = args.n_input_noize_z, n_channels = 1 if args.dataset == "mnist" else 3, n_fmaps = args.n_fmaps )
+        example_input = torch.randn( size = (1, args.n_input_noize_z, 1, 1) )
+
+    # モデルを読み込む
+    if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
+        load_state_dict_cpu( model, os.path.join(args.load_checkpoints_dir, "G", "G_final.pth") )
+    else:
+        # 学習済みの重みがない場合は、BatchNorm の畳み込みの誤りが出力の一致の確認で検出されるように、running stats をデフォルト値以外にする
+        randomize_batch_norm_stats( model, seed = args.seed )
+    model.eval()
+
+    # 推論用の最適化
+    model_opt = optimize_for_inference( model, channels_last = not args.no_channels_last, example_inputs = [example_input] if args.torchscript else None )
+    check_inference_optimization(
+        model, model_opt, [example_input], channels_last = not args.no_channels_last,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
@@ -0,0 +1,54 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from models.generators import LightweightGANGenerator
+from utils.model_export import export_model, load_state_dict_cpu
+
+if __name__ == '__main__':
+    """
+    light-weight GAN の生成器を TorchScript / ONNX にエクスポートし、eager モードとの出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exper_name", default="LightweightGAN_G", help="実験名（エクスポートするファイル名）")
+    parser.add_argument('--load_checkpoints_path', type=str, default="", help="モデルの読み込みファイルのパス")
+    parser.add_argument('--image_size', type=int, choices=[256, 512, 1024], default=1024, help="出力画像の解像度")
+    parser.add_argument('--z_dims', type=int, default=256, help="入力ノイズの次元数")
+    parser.add_argument('--export_dir', type=str, default="exports", help="エクスポートしたモデルの出力ディレクトリ")
+    parser.add_argument('--export_format', choices=['torchscript','onnx','both'], default="both", help="エクスポート形式")
+    parser.add_argument('--torchscript_method', choices=['trace','script'], default="trace", help="TorchScript への変換方法")
+    parser.add_argument('--dynamic_axes', choices=['fixed','batch','batch_hw'], default="batch", help="ONNX で可変にする軸")
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX の opset version")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=71)
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    model = LightweightGANGenerator( z_dims = args.z_dims, n_fmaps = 64, out_dims = 3, image_size = args.image_size )
+
+    # モデルを読み込む
+    if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
+        load_state_dict_cpu( model, args.load_checkpoints_path )
+
+    # 生成器内の NoiseInjection で乱数を使うため、TorchScript は乱数シードを揃えて parity を確認する（ONNX ランタイムの乱数は PyTorch と一致しないため確認しない）
+    example_input = torch.randn( size = (1, args.z_dims) )
+    # エクスポート
+    export_model(
+        model, [example_input], args.export_dir, args.exper_name,
+        input_names = ["latent_z"], output_names = ["output_resmax", "output_res128"],
+        export_format = args.export_format, torchscript_method = args.torchscript_method,
+        dynamic_axes_type = args.dynamic_axes, opset_version = args.opset_version,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+        seed = args.seed, check_onnx_parity = False,
+    )
@@ -11,6 +11,7 @@ import torchvision
 from torchvision import models
 
 from models.network_base import GLU, Swish
+from utils.image_pyramid import BatchImagePyramid
 
 #====================================
 # 識別器
@@ -199,6 +200,15 @@ class LightweightGANDiscriminator(nn.Module):
             return image_tsr[:,:,hw:,hw:]
 
     def forward(self, input, input_res128 = None, interpolate_mode = "bilinear" ):
+        """
+        [Args]
+            input : <Tensor> 最大解像度の画像 or <BatchImagePyramid> 画像ピラミッド（128 x 128 の入力はピラミッドのものを使う）
+        """
+        pyramid = None
+        if isinstance(input, BatchImagePyramid):
+            pyramid = input
+            input, input_res128 = pyramid.image, pyramid.res128
+
         if input_res128 is None : 
             input_res128 = F.interpolate(input, size=128, mode = interpolate_mode)
 
@@ -252,6 +262,10 @@ class LightweightGANDiscriminator(nn.Module):
         if self.crop_rand_idx == 3 :
             rec_img_f1 = self.decoder_f1(feat32_skip[:,:,8:,8:])
 
+        # reconstruction loss の正解画像を同じ位置で crop するため
+        if pyramid is not None :
+            pyramid.crop_rand_idx = self.crop_rand_idx
+
         rec_img_f2 = self.decoder_f2(feat8_skip)
         rec_img_res128 = self.decoder_res128(feat8_res128)
         #print( "[LightweightGANDiscriminator] rec_img_f1.shape", rec_img_f1.shape )
@@ -32,6 +32,7 @@ except ImportError:
 
 # 自作モジュール
 from data.noize_dataset import NoizeDataset
+from data.prefetcher import DevicePrefetcher
 from models.network_base import weights_init
 from models.generators import LightweightGANGenerator
 from models.discriminators import LightweightGANDiscriminator
@@ -40,7 +41,13 @@ from models.losses import VGGLoss, LSGANLoss, HingeGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
 from utils.scores import calculate_fretchet
+from utils.activation_checkpointing import setup_activation_checkpointing, print_checkpointing_report
+from utils.gradient_accumulation import split_micro_batches, ForwardReplay, MicroBatchLosses
+from utils.gan_step import RequiresGradSwitch
+from utils.module_profiler import ModuleProfiler
+from utils.step_timer import StepPhaseTimer
 from data.transforms.diffaug import DiffAugment
+from utils.image_pyramid import BatchImagePyramid, forward_D_real_fake
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -69,15 +76,28 @@ if __name__ == '__main__':
     parser.add_argument("--val_rate", type=float, default=0.05)
     parser.add_argument('--n_display_valid', type=int, default=8, help="valid データの tensorboard への表示数")
     parser.add_argument('--data_augument_type', choices=['none', 'color,translation'], default="color,translation",help="DAの種類")
+    parser.add_argument('--d_concat_real_fake', action='store_true', help="識別器の本物画像・偽物画像の forward を結合した 1 つのバッチで行う")
     parser.add_argument('--diaplay_scores', action='store_true')
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
+    parser.add_argument('--prefetch', action='store_true', help="次のミニバッチの device への転送を学習ステップの計算と並行して行う（GPU : 別の CUDA stream, CPU : バックグラウンドのスレッド）")
+    parser.add_argument('--channels_last', action='store_true', help="モデルと入力画像を channels_last のメモリ配置にする")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
     parser.add_argument('--use_amp', action='store_true', help="AMP [Automatic Mixed Precision] の使用有効化")
     parser.add_argument('--opt_level', choices=['O0','O1','O2','O3'], default='O1', help='mixed precision calculation mode')
+    parser.add_argument('--n_accum_steps', type=int, default=1, help="勾配を累積するマイクロバッチ数（batch_size x n_accum_steps が 1 回のパラメーター更新での実効バッチサイズ）")
+    parser.add_argument('--checkpoint_blocks', type=str, default="", help="生成器で activation checkpointing するブロックのモジュール名 or クラス名（カンマ区切り・ワイルドカード可。例 : upsampling_*）")
+    parser.add_argument('--checkpoint_memory_budget', type=float, default=0, help="activation checkpointing 後の生成器の活性化のメモリ量の上限 [MB]（0 の場合は checkpoint_blocks に一致する全てのブロックを checkpoint する）")
+    parser.add_argument('--checkpoint_check_grads', action='store_true', help="activation checkpointing 前後の生成器で、パラメーターの勾配が一致するかを確認する")
+    parser.add_argument('--n_timing_log_steps', type=int, default=0, help="学習ステップのフェーズ毎の処理時間・スループットを出力する間隔（0 の場合は計測しない）")
+    parser.add_argument('--data_wait_alert', type=float, default=0.3, help="データ待ちの時間が学習ステップの時間のこの割合を超えた場合に警告を表示する")
+    parser.add_argument('--profile_every_n_steps', type=int, default=0, help="モジュール単位のプロファイルを行う学習ステップの間隔（0 の場合はプロファイルしない）")
+    parser.add_argument('--profile_max_depth', type=int, default=2, help="プロファイル対象のサブモジュールの階層の深さ")
+    parser.add_argument('--profile_modules', type=str, default="", help="プロファイル対象のサブモジュール名 or クラス名（カンマ区切り・ワイルドカード可。指定した場合は profile_max_depth は無視）")
+    parser.add_argument('--profile_trace', action='store_true', help="プロファイルするステップで torch.profiler の Chrome trace / TensorBoard プロファイルを出力する")
     parser.add_argument('--debug', action='store_true')
     args = parser.parse_args()
     if( args.debug ):
@@ -146,7 +166,7 @@ if __name__ == '__main__':
         print( "train_index[0:10] : ", train_index[0:10] )
         print( "valid_index[0:10] : ", valid_index[0:10] )
 
-    dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
+    dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size * args.n_accum_steps, shuffle=True, num_workers = args.n_workers, pin_memory = True )
     dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
 
     #================================
@@ -161,6 +181,16 @@ if __name__ == '__main__':
     if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
         load_checkpoint(model_G, device, args.load_checkpoints_path )
 
+    # 生成器の activation checkpointing（逆伝播時に活性化を再計算して、学習時のメモリ使用量を削減する）
+    if( args.checkpoint_blocks != "" ):
+        checkpointing_inputs = ( torch.randn( args.batch_size, args.z_dims ).to(device), )
+        checkpointing_report = setup_activation_checkpointing( model_G, checkpointing_inputs, args.checkpoint_blocks.split(","), args.checkpoint_memory_budget, check_gradients = args.checkpoint_check_grads )
+        print_checkpointing_report( checkpointing_report )
+
+    if( args.channels_last ):
+        model_G = model_G.to( memory_format = torch.channels_last )
+        model_D = model_D.to( memory_format = torch.channels_last )
+
     if( args.debug ):
         print( "model_G\n", model_G )
         print( "model_D\n", model_D )
@@ -186,6 +216,31 @@ if __name__ == '__main__':
             num_losses = 2
         )
 
+    # 識別器のパラメーターの勾配計算の切り替え
+    requires_grad_D = RequiresGradSwitch( model_D )
+
+    # 先読み時のミニバッチの型（apex の O2 / O3 ではモデルの入力が半精度に変換されるため、転送時に変換しておく）
+    if( args.use_amp and args.opt_level in ["O2", "O3"] ):
+        prefetch_dtype = torch.float16
+    else:
+        prefetch_dtype = None
+
+    # モジュール単位の forward / backward のプロファイラー
+    if( args.profile_every_n_steps > 0 ):
+        module_profiler = ModuleProfiler(
+            { "G" : model_G, "D" : model_D }, device, every_n_steps = args.profile_every_n_steps, max_depth = args.profile_max_depth,
+            patterns = [ pattern for pattern in args.profile_modules.split(",") if pattern != "" ],
+            log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_profile"), board = board_train, trace = args.profile_trace,
+        )
+    else:
+        module_profiler = None
+
+    # 学習ステップのフェーズ毎の処理時間の計測
+    step_timer = StepPhaseTimer(
+        device, log_path = os.path.join(args.tensorboard_dir, args.exper_name + "_timing.jsonl"), board = board_train,
+        n_log_steps = max(args.n_timing_log_steps, 1), data_wait_alert = args.data_wait_alert, enabled = args.n_timing_log_steps > 0,
+    )
+
     #================================
     # loss 関数の設定
     #================================
@@ -211,244 +266,314 @@ if __name__ == '__main__':
     #================================
     # モデルの学習
     #================================    
+    print( "effective batch size : {} (batch_size={} x n_accum_steps={})".format(args.batch_size * args.n_accum_steps, args.batch_size, args.n_accum_steps) )
     print("Starting Training Loop...")
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
-            model_G.train()
-            model_D.train()
-
-            # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["image_t"].shape[0] != args.batch_size:
-                break
-
-            # ミニバッチデータを GPU へ転送
-            latent_z = inputs["latent_z"].to(device)
-            image_t = inputs["image_t"].to(device)
-            if( args.debug and n_print > 0):
-                print( "[latent_z] shape={}, dtype={}, min={}, max={}".format(latent_z.shape, latent_z.dtype, torch.min(latent_z), torch.max(latent_z)) )
-                print( "[image_t] shape={}, dtype={}, min={}, max={}".format(image_t.shape, image_t.dtype, torch.min(image_t), torch.max(image_t)) )
-
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            output, output_res128 = model_G( latent_z )
-            if( args.debug and n_print > 0 ):
-                print( "output.shape : ", output.shape )
-                print( "output_res128.shape : ", output_res128.shape )
-
-            # Differentiable Augmentation for Data-Efficient GAN Training
-            if( args.data_augument_type != "none" ):
-                image_t = DiffAugment(image_t, policy=args.data_augument_type)
-                output = DiffAugment(output, policy=args.data_augument_type)
-                output_res128 = DiffAugment(output_res128, policy=args.data_augument_type)
-
-            #----------------------------------------------------
-            # 識別器の更新処理
-            #----------------------------------------------------
-            """
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
-            """
-
-            # 学習用データをモデルに流し込む
-            d_outputs_real = model_D( image_t )
-            d_outputs_fake = model_D( output.detach(), output_res128.detach() )
-            d_real = d_outputs_real["d_output"]
-            d_fake = d_outputs_fake["d_output"]
-            if( args.debug and n_print > 0 ):
-                print( "d_real.shape :", d_real.shape )
-                print( "d_fake.shape :", d_fake.shape )
-                for key, value in d_outputs_real.items():
-                    print('[d_outputs_real] {} : shape={}, dype={}'.format(str(key), value.shape, value.dtype) )
-                for key, value in d_outputs_fake.items():
-                    print('[d_outputs_fake] {} : shape={}, dype={}'.format(str(key), value.shape, value.dtype) )
-
-            # 損失関数を計算する
-            _, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-            if( args.rec_loss_type == "vgg" ):
-                loss_D_rec_f1 = loss_rec_fn( F.interpolate(model_D.random_crop(image_t), d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] )
-                loss_D_rec_f2 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] )
-                loss_D_rec_res128 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] )
-            elif( args.rec_loss_type == "lpips" ):
-                loss_D_rec_f1 = loss_rec_fn( F.interpolate(model_D.random_crop(image_t), d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] ).sum()
-                loss_D_rec_f2 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] ).sum()
-                loss_D_rec_res128 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] ).sum()
-            else:
-                NotImplementedError()
-
-            loss_D = loss_D_real + loss_D_fake + loss_D_rec_f1 + loss_D_rec_f2 + loss_D_rec_res128
-
-            # ネットワークの更新処理
-            optimizer_D.zero_grad()
-            if( args.use_amp ):
-                with amp.scale_loss(loss_D, optimizer_D, loss_id=0) as loss_D_scaled:
-                    loss_D_scaled.backward()
-            else:
-                loss_D.backward()
-
-            optimizer_D.step()
-
-            """
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
-            """
-            #----------------------------------------------------
-            # 生成器の更新処理
-            #----------------------------------------------------
-            d_outputs_fake = model_D( output, output_res128 )
-            d_fake = d_outputs_fake["d_output"]
-
-            # 損失関数を計算する
-            loss_l1 = loss_l1_fn( image_t, output )
-            loss_vgg = loss_vgg_fn( image_t, output )
-            loss_adv = loss_adv_fn.forward_G( d_fake )
-            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-
-            # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            if( args.use_amp ):
-                with amp.scale_loss(loss_G, optimizer_G, loss_id=1) as loss_G_scaled:
-                    loss_G_scaled.backward()
-            else:
-                loss_G.backward()
-
-            optimizer_G.step()
-
-            #====================================================
-            # 学習過程の表示
-            #====================================================
-            if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
-                # lr
-                for param_group in optimizer_G.param_groups:
-                    lr = param_group['lr']
-
-                board_train.add_scalar('lr/learning rate', lr, step )
-
-                # loss
-                board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
-                board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
-                board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
-                board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
-                board_train.add_scalar('D/loss_D_rec_f1', loss_D_rec_f1.item(), step)
-                board_train.add_scalar('D/loss_D_rec_f2', loss_D_rec_f2.item(), step)
-                board_train.add_scalar('D/loss_D_rec_res128', loss_D_rec_res128.item(), step)
-                board_train.add_scalar('D/loss_D', loss_D.item(), step)
-                print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
-                print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}, loss_D_rec_f1={:.5f}, loss_D_rec_f2={:.5f}, loss_D_rec_res128={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item(), loss_D_rec_f1.item(), loss_D_rec_f2.item(), loss_D_rec_res128.item()) )
-
-                # visual images
-                visuals = [
-                    [ image_t.detach(), output.detach() ],
-                ]
-                board_add_images(board_train, 'train', visuals, step+1)
-
-                # scores
-                if( args.diaplay_scores ):
-                    score_fid = calculate_fretchet(image_t, output, inception)
-                    board_train.add_scalar('scores/FID', score_fid.item(), step)
-                    print( "step={}, FID={:.5f}".format(step, score_fid.item()) )
-
-            #====================================================
-            # valid データでの処理
-            #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total = 0, 0, 0, 0
-                loss_D_total, loss_D_real_total, loss_D_fake_total, loss_D_rec_f1_total, loss_D_rec_f2_total, loss_D_rec_res128_total = 0, 0, 0, 0, 0, 0
-                score_fid_total = 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()            
-                    model_D.eval()
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_t"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    latent_z = inputs["latent_z"].to(device)
-                    image_t = inputs["image_t"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output, output_res128 = model_G( latent_z )
+        # DataLoader のキューの深さの計測用にイテレーターを保持する（ループ変数 iter で組み込み関数 iter() が上書きされるため __iter__() を使う）
+        dloader_train_iter = dloader_train.__iter__()
 
-                    with torch.no_grad():
-                        d_outputs_real = model_D( image_t )
-                        d_outputs_fake = model_D( output.detach(), output_res128.detach() )
-                        d_real = d_outputs_real["d_output"]
-                        d_fake = d_outputs_fake["d_output"]
+        # 次のミニバッチを先読みして device に転送する（転送済みの Tensor の .to(device) は何もしない）
+        if( args.prefetch ):
+            inputs_iter = DevicePrefetcher( dloader_train_iter, device, channels_last = args.channels_last, dtype = prefetch_dtype )
+        else:
+            inputs_iter = dloader_train_iter
+
+        # break で最後のミニバッチを読み飛ばした場合や例外の発生時にも、先読み用のスレッドを終了させる
+        try:
+            for iter, inputs in enumerate( tqdm( inputs_iter, total = len(dloader_train), desc = "epoch={}".format(epoch) ) ):
+                step_timer.start( dloader_train_iter )
+                model_G.train()
+                model_D.train()
+
+                # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                if inputs["image_t"].shape[0] != args.batch_size * args.n_accum_steps:
+                    break
+
+                if( module_profiler is not None ):
+                    module_profiler.begin( step )
+
+                # ミニバッチデータを GPU へ転送し、n_accum_steps 個のマイクロバッチに分割する
+                image_t = inputs["image_t"].to(device)
+                if( args.channels_last ):
+                    image_t = image_t.contiguous( memory_format = torch.channels_last )
+                micro_batches = split_micro_batches( { "latent_z" : inputs["latent_z"].to(device), "image_t" : image_t }, args.n_accum_steps )
+                n_micro_batches = len(micro_batches)
+                step_timer.lap("h2d")
+
+                # マイクロバッチが複数の場合は、生成器の forward の計算グラフをマイクロバッチ間で保持しないように、
+                # 識別器の更新処理では勾配計算なしで forward し、生成器の更新処理で同じ乱数の状態（NoiseInjection のノイズ・DiffAugment）から再度 forward する
+                replay_G = ForwardReplay( model_G, device )
+
+                #----------------------------------------------------
+                # 識別器の更新処理
+                #----------------------------------------------------
+                # 無効化していた識別器 D のネットワークの勾配計算を有効化。
+                requires_grad_D.set(True)
+                optimizer_D.zero_grad()
+
+                losses_D = MicroBatchLosses( n_micro_batches )
+                for i, micro_batch in enumerate(micro_batches):
+                    latent_z = micro_batch["latent_z"]
+                    image_t = micro_batch["image_t"]
+                    if( args.debug and n_print > 0):
+                        print( "[latent_z] shape={}, dtype={}, min={}, max={}".format(latent_z.shape, latent_z.dtype, torch.min(latent_z), torch.max(latent_z)) )
+                        print( "[image_t] shape={}, dtype={}, min={}, max={}".format(image_t.shape, image_t.dtype, torch.min(image_t), torch.max(image_t)) )
+
+                    # 生成器 の forword 処理
+                    replay_G.record()
+                    with torch.set_grad_enabled( n_micro_batches == 1 ):
+                        output, output_res128 = model_G( latent_z )
+                    if( args.debug and n_print > 0 ):
+                        print( "output.shape : ", output.shape )
+                        print( "output_res128.shape : ", output_res128.shape )
+                    step_timer.lap("G_forward_backward")
+
+                    # 識別器・reconstruction loss で共通に使う画像ピラミッド
+                    pyramid_real = BatchImagePyramid( image_t )
+                    pyramid_fake = BatchImagePyramid( output, output_res128 )
+
+                    # Differentiable Augmentation for Data-Efficient GAN Training
+                    if( args.data_augument_type != "none" ):
+                        pyramid_real = pyramid_real.augment(args.data_augument_type)
+                        pyramid_fake = pyramid_fake.augment(args.data_augument_type)
+                        image_t = pyramid_real.image
+                        output = pyramid_fake.image
+
+                    # 学習用データをモデルに流し込む（本物画像・偽物画像の組はマイクロバッチ毎）
+                    d_outputs_real, d_outputs_fake = forward_D_real_fake( model_D, pyramid_real, pyramid_fake.detach(), args.d_concat_real_fake )
+                    d_real = d_outputs_real["d_output"]
+                    d_fake = d_outputs_fake["d_output"]
+                    if( args.debug and n_print > 0 ):
+                        print( "d_real.shape :", d_real.shape )
+                        print( "d_fake.shape :", d_fake.shape )
+                        for key, value in d_outputs_real.items():
+                            print('[d_outputs_real] {} : shape={}, dype={}'.format(str(key), value.shape, value.dtype) )
+                        for key, value in d_outputs_fake.items():
+                            print('[d_outputs_fake] {} : shape={}, dype={}'.format(str(key), value.shape, value.dtype) )
 
                     # 損失関数を計算する
-                    loss_l1 = loss_l1_fn( image_t, output )
-                    loss_vgg = loss_vgg_fn( image_t, output )
-                    loss_adv = loss_adv_fn.forward_G( d_fake )
-                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
-                    loss_adv_total += loss_adv
-                    loss_G_total += loss_G
-
-                    _, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+                    _, loss_D_real_micro, loss_D_fake_micro = loss_adv_fn.forward_D( d_real, d_fake )
+                    step_timer.lap("D_forward_backward")
                     if( args.rec_loss_type == "vgg" ):
-                        loss_D_rec_f1 = loss_rec_fn( F.interpolate(model_D.random_crop(image_t), d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] )
-                        loss_D_rec_f2 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] )
-                        loss_D_rec_res128 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] )
+                        loss_D_rec_f1_micro = loss_rec_fn( pyramid_real.resize_crop(d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] )
+                        loss_D_rec_f2_micro = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] )
+                        loss_D_rec_res128_micro = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] )
                     elif( args.rec_loss_type == "lpips" ):
-                        loss_D_rec_f1 = loss_rec_fn( F.interpolate(model_D.random_crop(image_t), d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] ).sum()
-                        loss_D_rec_f2 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] ).sum()
-                        loss_D_rec_res128 = loss_rec_fn( F.interpolate(image_t, d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] ).sum()
+                        loss_D_rec_f1_micro = loss_rec_fn( pyramid_real.resize_crop(d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] ).sum()
+                        loss_D_rec_f2_micro = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] ).sum()
+                        loss_D_rec_res128_micro = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] ).sum()
                     else:
                         NotImplementedError()
 
-                    loss_D = loss_D_real + loss_D_fake + loss_D_rec_f1 + loss_D_rec_f2 + loss_D_rec_res128
+                    step_timer.lap("perceptual_loss")
+                    loss_D_micro = loss_D_real_micro + loss_D_fake_micro + loss_D_rec_f1_micro + loss_D_rec_f2_micro + loss_D_rec_res128_micro
 
-                    loss_D_total += loss_D
-                    loss_D_real_total += loss_D_real
-                    loss_D_fake_total += loss_D_fake
-                    loss_D_rec_f1_total += loss_D_rec_f1
-                    loss_D_rec_f2_total += loss_D_rec_f2
-                    loss_D_rec_res128_total += loss_D_rec_res128
+                    # 勾配を累積する（AMP の場合は、最後のマイクロバッチでのみ勾配のスケールを戻す）
+                    if( args.use_amp ):
+                        with amp.scale_loss(loss_D_micro / n_micro_batches, optimizer_D, loss_id=0, delay_unscale = ( i < n_micro_batches - 1 )) as loss_D_scaled:
+                            loss_D_scaled.backward()
+                    else:
+                        ( loss_D_micro / n_micro_batches ).backward()
+
+                    loss_D, loss_D_real, loss_D_fake, loss_D_rec_f1, loss_D_rec_f2, loss_D_rec_res128 = losses_D.add( loss_D_micro, loss_D_real_micro, loss_D_fake_micro, loss_D_rec_f1_micro, loss_D_rec_f2_micro, loss_D_rec_res128_micro )
+                    step_timer.lap("D_forward_backward")
+
+                # ネットワークの更新処理
+                optimizer_D.step()
+                step_timer.lap("D_forward_backward")
+
+                # 識別器 D のネットワークの勾配計算を無効化（生成器の更新処理のマイクロバッチ全体で、識別器のパラメーターの勾配を計算しない）
+                requires_grad_D.set(False)
+                #----------------------------------------------------
+                # 生成器の更新処理
+                #----------------------------------------------------
+                optimizer_G.zero_grad()
+
+                losses_G = MicroBatchLosses( n_micro_batches )
+                for i, micro_batch in enumerate(micro_batches):
+                    if( n_micro_batches > 1 ):
+                        with replay_G.replay( i ):
+                            image_t = micro_batch["image_t"]
+                            output, output_res128 = model_G( micro_batch["latent_z"] )
+                            pyramid_real = BatchImagePyramid( image_t )
+                            pyramid_fake = BatchImagePyramid( output, output_res128 )
+                            if( args.data_augument_type != "none" ):
+                                pyramid_real = pyramid_real.augment(args.data_augument_type)
+                                pyramid_fake = pyramid_fake.augment(args.data_augument_type)
+                                image_t = pyramid_real.image
+                                output = pyramid_fake.image
+
+                    d_outputs_fake = model_D( pyramid_fake )
+                    d_fake = d_outputs_fake["d_output"]
+
+                    # 損失関数を計算する
+                    loss_l1_micro = loss_l1_fn( image_t, output )
+                    step_timer.lap("G_forward_backward")
+                    loss_vgg_micro = loss_vgg_fn( image_t, output )
+                    step_timer.lap("perceptual_loss")
+                    loss_adv_micro = loss_adv_fn.forward_G( d_fake )
+                    loss_G_micro =  args.lambda_l1 * loss_l1_micro + args.lambda_vgg * loss_vgg_micro + args.lambda_adv * loss_adv_micro
+
+                    # 勾配を累積する
+                    if( args.use_amp ):
+                        with amp.scale_loss(loss_G_micro / n_micro_batches, optimizer_G, loss_id=1, delay_unscale = ( i < n_micro_batches - 1 )) as loss_G_scaled:
+                            loss_G_scaled.backward()
+                    else:
+                        ( loss_G_micro / n_micro_batches ).backward()
+
+                    loss_G, loss_l1, loss_vgg, loss_adv = losses_G.add( loss_G_micro, loss_l1_micro, loss_vgg_micro, loss_adv_micro )
+                    step_timer.lap("G_forward_backward")
+
+                # ネットワークの更新処理
+                optimizer_G.step()
+                step_timer.lap("G_forward_backward")
+                if( module_profiler is not None ):
+                    module_profiler.end( step )
+
+                #====================================================
+                # 学習過程の表示
+                #====================================================
+                if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
+                    # lr
+                    for param_group in optimizer_G.param_groups:
+                        lr = param_group['lr']
+
+                    board_train.add_scalar('lr/learning rate', lr, step )
+
+                    # loss
+                    board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
+                    board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
+                    board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
+                    board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
+                    board_train.add_scalar('D/loss_D_rec_f1', loss_D_rec_f1.item(), step)
+                    board_train.add_scalar('D/loss_D_rec_f2', loss_D_rec_f2.item(), step)
+                    board_train.add_scalar('D/loss_D_rec_res128', loss_D_rec_res128.item(), step)
+                    board_train.add_scalar('D/loss_D', loss_D.item(), step)
+                    board_train.add_scalar('perf/effective_batch_size', args.batch_size * args.n_accum_steps, step)
+                    print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
+                    print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}, loss_D_rec_f1={:.5f}, loss_D_rec_f2={:.5f}, loss_D_rec_res128={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item(), loss_D_rec_f1.item(), loss_D_rec_f2.item(), loss_D_rec_res128.item()) )
+
+                    # visual images
+                    visuals = [
+                        [ image_t.detach(), output.detach() ],
+                    ]
+                    board_add_images(board_train, 'train', visuals, step+1)
+                    step_timer.lap("logging")
 
                     # scores
                     if( args.diaplay_scores ):
                         score_fid = calculate_fretchet(image_t, output, inception)
-                        score_fid_total += score_fid
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        visuals = [
-                            [ image_t.detach(), output.detach() ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-                # loss 値表示
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_rec_f1', loss_D_rec_f1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_rec_f2', loss_D_rec_f2_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_rec_res128', loss_D_rec_res128_total.item()/n_valid_loop, step)
-
-                # scores
-                if( args.diaplay_scores ):
-                    board_valid.add_scalar('scores/FID', score_fid_total.item()/n_valid_loop, step)
-
-            step += 1
-            n_print -= 1
+                        board_train.add_scalar('scores/FID', score_fid.item(), step)
+                        print( "step={}, FID={:.5f}".format(step, score_fid.item()) )
+                        step_timer.lap("metrics")
+
+                step_timer.lap("logging")
+
+                #====================================================
+                # valid データでの処理
+                #====================================================
+                if( step % args.n_display_valid_step == 0 ):
+                    loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total = 0, 0, 0, 0
+                    loss_D_total, loss_D_real_total, loss_D_fake_total, loss_D_rec_f1_total, loss_D_rec_f2_total, loss_D_rec_res128_total = 0, 0, 0, 0, 0, 0
+                    score_fid_total = 0
+                    n_valid_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
+                        model_G.eval()            
+                        model_D.eval()
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_t"].shape[0] != args.batch_size_valid:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        latent_z = inputs["latent_z"].to(device)
+                        image_t = inputs["image_t"].to(device)
+
+                        # 推論処理
+                        with torch.no_grad():
+                            output, output_res128 = model_G( latent_z )
+
+                        with torch.no_grad():
+                            pyramid_real = BatchImagePyramid( image_t )
+                            pyramid_fake = BatchImagePyramid( output, output_res128 )
+                            d_outputs_real, d_outputs_fake = forward_D_real_fake( model_D, pyramid_real, pyramid_fake, args.d_concat_real_fake )
+                            d_real = d_outputs_real["d_output"]
+                            d_fake = d_outputs_fake["d_output"]
+
+                        # 損失関数を計算する
+                        loss_l1 = loss_l1_fn( image_t, output )
+                        loss_vgg = loss_vgg_fn( image_t, output )
+                        loss_adv = loss_adv_fn.forward_G( d_fake )
+                        loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+
+                        loss_l1_total += loss_l1
+                        loss_vgg_total += loss_vgg
+                        loss_adv_total += loss_adv
+                        loss_G_total += loss_G
+
+                        _, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+                        if( args.rec_loss_type == "vgg" ):
+                            loss_D_rec_f1 = loss_rec_fn( pyramid_real.resize_crop(d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] )
+                            loss_D_rec_f2 = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] )
+                            loss_D_rec_res128 = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] )
+                        elif( args.rec_loss_type == "lpips" ):
+                            loss_D_rec_f1 = loss_rec_fn( pyramid_real.resize_crop(d_outputs_real["rec_img_f1"].shape[2]), d_outputs_real["rec_img_f1"] ).sum()
+                            loss_D_rec_f2 = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_f2"].shape[2]), d_outputs_real["rec_img_f2"] ).sum()
+                            loss_D_rec_res128 = loss_rec_fn( pyramid_real.resize(d_outputs_real["rec_img_res128"].shape[2]), d_outputs_real["rec_img_res128"] ).sum()
+                        else:
+                            NotImplementedError()
+
+                        loss_D = loss_D_real + loss_D_fake + loss_D_rec_f1 + loss_D_rec_f2 + loss_D_rec_res128
+
+                        loss_D_total += loss_D
+                        loss_D_real_total += loss_D_real
+                        loss_D_fake_total += loss_D_fake
+                        loss_D_rec_f1_total += loss_D_rec_f1
+                        loss_D_rec_f2_total += loss_D_rec_f2
+                        loss_D_rec_res128_total += loss_D_rec_res128
+
+                        # scores
+                        if( args.diaplay_scores ):
+                            score_fid = calculate_fretchet(image_t, output, inception)
+                            score_fid_total += score_fid
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            # visual images
+                            visuals = [
+                                [ image_t.detach(), output.detach() ],
+                            ]
+                            board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+
+                        n_valid_loop += 1
+
+                    # loss 値表示
+                    board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_rec_f1', loss_D_rec_f1_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_rec_f2', loss_D_rec_f2_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('D/loss_D_rec_res128', loss_D_rec_res128_total.item()/n_valid_loop, step)
+
+                    # scores
+                    if( args.diaplay_scores ):
+                        board_valid.add_scalar('scores/FID', score_fid_total.item()/n_valid_loop, step)
+
+                step_timer.lap("validation")
+                step_timer.end( step, args.batch_size * args.n_accum_steps )
+                step += 1
+                n_print -= 1
+        finally:
+            if( args.prefetch ):
+                inputs_iter.close()
 
         #====================================================
         # モデルの保存
@@ -459,6 +584,7 @@ if __name__ == '__main__':
             save_checkpoint( model_D, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_D_ep%03d.pth' % (epoch)) )
             save_checkpoint( model_D, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_D_final.pth') )
             print( "saved checkpoints" )
+            step_timer.lap("checkpoint")
 
     print("Finished Training Loop.")
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
@@ -0,0 +1,301 @@
+# -*- coding:utf-8 -*-
+import time
+import fnmatch
+from contextlib import contextmanager
+
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+
+#====================================================
+# activation checkpointing
+#====================================================
+WRAPPED_MODULE_PREFIX = "module."
+
+def snapshot_buffers( model ):
+    """
+    model 内の全ての buffer（BatchNorm の running stats・spectral norm の u / v など）の値のコピー
+    """
+    return [ ( module, name, buffer.clone() ) for module in model.modules() for name, buffer in module._buffers.items() if buffer is not None ]
+
+
+def restore_buffers( snapshot ):
+    with torch.no_grad():
+        for module, name, buffer in snapshot:
+            module._buffers[name].copy_( buffer )
+    return
+
+
+@contextmanager
+def freeze_buffers( model ):
+    """
+    with ブロック内での forward で更新された buffer を、with ブロックを抜けた時に元の値に戻す。
+    BatchNorm の running_mean / running_var / num_batches_tracked だけでなく、spectral norm の power iteration で更新される u / v も戻す
+    """
+    snapshot = snapshot_buffers( model )
+    try:
+        yield
+    finally:
+        restore_buffers( snapshot )
+
+
+class CheckpointWrapper(nn.Module):
+    """
+    module の forward で計算した活性化を保持せず、逆伝播時に forward を再計算するラッパー。
+    ・NoiseInjection などの乱数は、forward 時の乱数の状態を保存して再計算時に復元するため、同じノイズが使われる
+    ・再計算時の forward は、最初の forward 前の buffer の値から行う。spectral norm の power iteration が同じ u / v から行われるため、同じ重みで再計算される
+    ・再計算後は buffer を再計算前の値に戻す（BatchNorm の running stats や spectral norm の u / v が、1 回の学習ステップで 2 回更新されないように）
+    ・勾配計算が無効な場合（識別器の更新時の生成器の forward や推論時）は、通常の forward を行う
+    ・state_dict の key はラップする前と同じ（既存のチェックポイントをそのまま読み書きできる）
+    """
+    def __init__( self, module ):
+        super(CheckpointWrapper, self).__init__()
+        self.module = module
+        self._register_state_dict_hook( self._remove_prefix_hook )
+        self._register_load_state_dict_pre_hook( self._add_prefix_hook )
+        return
+
+    @staticmethod
+    def _remove_prefix_hook( module, state_dict, prefix, local_metadata ):
+        for key in [ key for key in state_dict.keys() if key.startswith(prefix + WRAPPED_MODULE_PREFIX) ]:
+            state_dict[prefix + key[len(prefix + WRAPPED_MODULE_PREFIX):]] = state_dict.pop(key)
+        return state_dict
+
+    @staticmethod
+    def _add_prefix_hook( state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs ):
+        for key in [ key for key in state_dict.keys() if key.startswith(prefix) and not key.startswith(prefix + WRAPPED_MODULE_PREFIX) ]:
+            state_dict[prefix + WRAPPED_MODULE_PREFIX + key[len(prefix):]] = state_dict.pop(key)
+        return
+
+    def forward( self, *inputs ):
+        if not( torch.is_grad_enabled() and self.training ):
+            return self.module( *inputs )
+
+        buffers = []
+        def run_module( *inputs ):
+            if( len(buffers) == 0 ):
+                buffers.append( snapshot_buffers(self.module) )
+                return self.module( *inputs )
+            # 逆伝播時の再計算
+            with freeze_buffers( self.module ):
+                restore_buffers( buffers[0] )
+                return self.module( *inputs )
+
+        return checkpoint( run_module, *inputs, use_reentrant = False, preserve_rng_state = True )
+
+
+def find_blocks( model, patterns ):
+    """
+    モジュール名（"model.10" など）かクラス名（"ResnetBlock" など）が patterns（ワイルドカード可）のいずれかに一致するモジュールの名前のリスト。
+    一致したモジュールの内部のモジュールは含めない
+    """
+    names = []
+    for name, module in model.named_modules():
+        if( name == "" or any( name.startswith(parent + ".") for parent in names ) ):
+            continue
+        if any( fnmatch.fnmatchcase(name, pattern) or fnmatch.fnmatchcase(type(module).__name__, pattern) for pattern in patterns ):
+            names.append(name)
+    return names
+
+
+def get_tensor_bytes( tensors ):
+    return sum( tensor.numel() * tensor.element_size() for tensor in tensors if isinstance(tensor, torch.Tensor) )
+
+
+def synchronize( device ):
+    if( device.type == "cuda" ):
+        torch.cuda.synchronize(device)
+    return
+
+
+def profile_blocks( model, inputs, names ):
+    """
+    1 回の forward / backward で、各ブロックが逆伝播用に保持する活性化のメモリ量 [bytes]・ブロックへの入力のメモリ量・forward の処理時間を計測する。
+    計測時の forward では buffer（BatchNorm の running stats・spectral norm の u / v）と乱数の状態を変更しない
+
+    [Returns]
+        profile : <dict> ブロック名 -> { "saved_bytes", "input_bytes", "forward_ms" } と、モデル全体の "total_saved_bytes", "forward_ms", "backward_ms"
+    """
+    device = next(model.parameters()).device
+    param_ptrs = set( param.untyped_storage().data_ptr() for param in model.parameters() )
+    blocks = { name : { "saved_bytes" : 0, "input_bytes" : 0, "forward_ms" : 0.0 } for name in names }
+    saved_ptrs = { name : set() for name in names }
+    total = { "saved_bytes" : 0, "ptrs" : set() }
+    active_names = []
+    start_times = {}
+
+    def pack_hook( tensor ):
+        # 同じメモリ領域を参照するテンソル（view など）は 1 回だけ数える
+        storage = tensor.untyped_storage()
+        ptr = storage.data_ptr()
+        if( ptr in param_ptrs ):
+            return tensor
+        n_bytes = storage.nbytes()
+        if( ptr not in total["ptrs"] ):
+            total["ptrs"].add(ptr)
+            total["saved_bytes"] += n_bytes
+        for name in active_names:
+            if( ptr not in saved_ptrs[name] ):
+                saved_ptrs[name].add(ptr)
+                blocks[name]["saved_bytes"] += n_bytes
+        return tensor
+
+    def make_pre_hook( name ):
+        def pre_hook( module, module_inputs ):
+            blocks[name]["input_bytes"] += get_tensor_bytes( module_inputs )
+            active_names.append(name)
+            synchronize(device)
+            start_times[name] = time.perf_counter()
+        return pre_hook
+
+    def make_hook( name ):
+        def hook( module, module_inputs, module_outputs ):
+            synchronize(device)
+            blocks[name]["forward_ms"] += ( time.perf_counter() - start_times[name] ) * 1000
+            active_names.remove(name)
+        return hook
+
+    handles = []
+    for name in names:
+        module = model.get_submodule(name)
+        handles.append( module.register_forward_pre_hook( make_pre_hook(name) ) )
+        handles.append( module.register_forward_hook( make_hook(name) ) )
+
+    devices = [device.index if device.index is not None else torch.cuda.current_device()] if device.type == "cuda" else []
+    try:
+        with torch.random.fork_rng( devices = devices ), freeze_buffers( model ):
+            synchronize(device)
+            start_time = time.perf_counter()
+            with torch.autograd.graph.saved_tensors_hooks( pack_hook, lambda tensor : tensor ):
+                outputs = model( *inputs )
+            synchronize(device)
+            forward_ms = ( time.perf_counter() - start_time ) * 1000
+
+            if isinstance(outputs, dict):
+                outputs = list(outputs.values())
+            outputs = outputs if isinstance(outputs, (tuple, list)) else [outputs]
+            loss = sum( output.float().mean() for output in outputs if isinstance(output, torch.Tensor) and output.requires_grad )
+            start_time = time.perf_counter()
+            loss.backward()
+            synchronize(device)
+            backward_ms = ( time.perf_counter() - start_time ) * 1000
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.zero_grad( set_to_none = True )
+
+    profile = { "blocks" : blocks, "total_saved_bytes" : total["saved_bytes"], "forward_ms" : forward_ms, "backward_ms" : backward_ms }
+    return profile
+
+
+def get_saving_bytes( block ):
+    # checkpoint したブロックも入力は保持するため、保持しなくてよくなるのは入力以外の活性化
+    return max( block["saved_bytes"] - block["input_bytes"], 0 )
+
+
+def select_blocks_by_memory_budget( profile, memory_budget_mb ):
+    """
+    逆伝播用に保持する活性化のメモリ量が memory_budget_mb 以下になるまで、削減量の大きいブロックから順に checkpoint するブロックを選ぶ
+    """
+    remaining_bytes = profile["total_saved_bytes"]
+    names = []
+    for name, block in sorted( profile["blocks"].items(), key = lambda item : get_saving_bytes(item[1]), reverse = True ):
+        if( remaining_bytes <= memory_budget_mb * 1024 ** 2 ):
+            break
+        names.append(name)
+        remaining_bytes -= get_saving_bytes(block)
+
+    return names
+
+
+def apply_activation_checkpointing( model, names ):
+    """
+    names のサブモジュールを CheckpointWrapper で置き換える
+    """
+    for name in names:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name != "" else model
+        setattr( parent, child_name, CheckpointWrapper( getattr(parent, child_name) ) )
+    return model
+
+
+def run_forward_backward( model, inputs ):
+    outputs = model( *inputs )
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    outputs = outputs if isinstance(outputs, (tuple, list)) else [outputs]
+    loss = sum( output.float().mean() for output in outputs if isinstance(output, torch.Tensor) and output.requires_grad )
+    loss.backward()
+    return
+
+
+def compute_gradients( model, inputs ):
+    """
+    1 回の forward / backward でのパラメーターの勾配のコピーのリスト。model の buffer・勾配と乱数の状態は変更しない
+    """
+    device = next(model.parameters()).device
+    devices = [device.index if device.index is not None else torch.cuda.current_device()] if device.type == "cuda" else []
+    try:
+        with torch.random.fork_rng( devices = devices ), freeze_buffers( model ):
+            run_forward_backward( model, inputs )
+        grads = [ param.grad.clone() if param.grad is not None else torch.zeros_like(param) for param in model.parameters() ]
+    finally:
+        model.zero_grad( set_to_none = True )
+    return grads
+
+
+def get_max_relative_diff( grads, grads_checkpointed ):
+    max_rel_diff = 0.0
+    for grad, grad_checkpointed in zip( grads, grads_checkpointed ):
+        diff = ( grad - grad_checkpointed ).abs().max().item()
+        max_rel_diff = max( max_rel_diff, diff / max( grad.abs().max().item(), 1e-12 ) )
+    return max_rel_diff
+
+
+def setup_activation_checkpointing( model, inputs, patterns, memory_budget_mb = 0, check_gradients = False ):
+    """
+    patterns に一致するブロック（memory_budget_mb > 0 の場合は、その中で予算内に収まるように選んだブロック）に activation checkpointing を適用し、
+    削減できる活性化のメモリ量と再計算で増える処理時間を返す
+
+    [Args]
+        inputs : <tuple> メモリ量の計測用の model への入力（学習時と同じバッチサイズ・解像度）
+        patterns : <list> checkpoint するブロックのモジュール名 / クラス名（ワイルドカード可）
+        memory_budget_mb : <float> 逆伝播用に保持する活性化のメモリ量の上限 [MB]（0 以下の場合は patterns に一致する全てのブロックを checkpoint する）
+        check_gradients : <bool> checkpoint する前後で、同じ乱数・buffer の状態からのパラメーターの勾配が一致するかを確認する
+    """
+    model.train()
+    candidate_names = find_blocks( model, patterns )
+    profile = profile_blocks( model, inputs, candidate_names )
+    if( memory_budget_mb > 0 ):
+        names = select_blocks_by_memory_budget( profile, memory_budget_mb )
+    else:
+        names = candidate_names
+
+    grads = compute_gradients( model, inputs ) if check_gradients else None
+    apply_activation_checkpointing( model, names )
+
+    saved_bytes = sum( get_saving_bytes(profile["blocks"][name]) for name in names )
+    recompute_ms = sum( profile["blocks"][name]["forward_ms"] for name in names )
+    report = {
+        "checkpointed_blocks" : names,
+        "activation_mb" : profile["total_saved_bytes"] / 1024 ** 2,
+        "activation_mb_after" : ( profile["total_saved_bytes"] - saved_bytes ) / 1024 ** 2,
+        "saved_mb" : saved_bytes / 1024 ** 2,
+        "step_ms" : profile["forward_ms"] + profile["backward_ms"],
+        "recompute_ms" : recompute_ms,
+        "extra_compute_ratio" : recompute_ms / max( profile["forward_ms"] + profile["backward_ms"], 1e-6 ),
+        "grad_max_rel_diff" : get_max_relative_diff( grads, compute_gradients( model, inputs ) ) if check_gradients else None,
+    }
+    return report
+
+
+def print_checkpointing_report( report ):
+    print( "----------------------------------------------" )
+    print( "activation checkpointing" )
+    print( "----------------------------------------------" )
+    print( "checkpointed blocks ({}) : {}".format( len(report["checkpointed_blocks"]), report["checkpointed_blocks"] ) )
+    print( "activation memory : {:.1f} MB -> {:.1f} MB (saved {:.1f} MB)".format( report["activation_mb"], report["activation_mb_after"], report["saved_mb"] ) )
+    print( "extra compute : +{:.1f} ms / step (+{:.1f} % of forward + backward {:.1f} ms)".format( report["recompute_ms"], report["extra_compute_ratio"] * 100, report["step_ms"] ) )
+    if( report["grad_max_rel_diff"] is not None ):
+        print( "gradient check : max relative diff = {:.3e} (vs. model without checkpointing)".format( report["grad_max_rel_diff"] ) )
+    return
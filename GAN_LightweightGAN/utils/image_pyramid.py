@@ -0,0 +1,111 @@
+# -*- coding:utf-8 -*-
+import torch
+import torch.nn.functional as F
+
+from data.transforms.diffaug import DiffAugment
+
+#====================================================
+# ミニバッチ単位の画像ピラミッド
+#====================================================
+class BatchImagePyramid(object):
+    """
+    1 step 内で識別器・DiffAugment・reconstruction loss が共通で使う、ミニバッチ画像の多解像度表現。
+    128 x 128 の入力・各 decoder 出力サイズへのリサイズ・random crop した画像を最初に必要になった時点で 1 度だけ計算してキャッシュする
+
+    [Args]
+        image : <Tensor> 最大解像度の画像 [B,C,H,W]
+        image_res128 : <Tensor> 識別器の 128 x 128 入力（生成器の出力など）。None の場合は image を interpolate_mode でリサイズする
+    """
+    def __init__( self, image, image_res128 = None, interpolate_mode = "bilinear" ):
+        self.image = image
+        self.image_res128 = image_res128
+        self.interpolate_mode = interpolate_mode
+        self.crop_rand_idx = 0      # 識別器の forward で選択された random crop の位置
+        self.cache = {}
+        return
+
+    def __len__( self ):
+        return self.image.shape[0]
+
+    @property
+    def res128( self ):
+        if( self.image_res128 is None ):
+            self.image_res128 = F.interpolate(self.image, size=128, mode = self.interpolate_mode)
+        return self.image_res128
+
+    def resize( self, size, mode = "nearest" ):
+        """
+        size x size にリサイズした画像（reconstruction loss の正解画像）
+        """
+        key = ("resize", size, mode)
+        if( key not in self.cache ):
+            self.cache[key] = F.interpolate(self.image, size, mode = mode)
+        return self.cache[key]
+
+    def crop( self ):
+        """
+        識別器の decoder_f1 に対応する 1/4 領域の画像
+        """
+        hw = self.image.shape[2]//2
+        if self.crop_rand_idx == 0 :
+            return self.image[:,:,:hw,:hw]
+        if self.crop_rand_idx == 1 :
+            return self.image[:,:,:hw,hw:]
+        if self.crop_rand_idx == 2 :
+            return self.image[:,:,hw:,:hw]
+        if self.crop_rand_idx == 3 :
+            return self.image[:,:,hw:,hw:]
+
+    def resize_crop( self, size, mode = "nearest" ):
+        key = ("resize_crop", self.crop_rand_idx, size, mode)
+        if( key not in self.cache ):
+            self.cache[key] = F.interpolate(self.crop(), size, mode = mode)
+        return self.cache[key]
+
+    def detach( self ):
+        pyramid = BatchImagePyramid( self.image.detach(), None if self.image_res128 is None else self.image_res128.detach(), self.interpolate_mode )
+        pyramid.crop_rand_idx = self.crop_rand_idx
+        pyramid.cache = { key : value.detach() for key, value in self.cache.items() }
+        return pyramid
+
+    def augment( self, policy ):
+        """
+        DiffAugment を適用した新しいピラミッドを返す。
+        image_res128 が与えられている場合（生成器の 128 x 128 出力）はそれにも個別に DiffAugment を適用する
+        """
+        if( policy == "none" ):
+            return self
+        image = DiffAugment(self.image, policy=policy)
+        image_res128 = None if self.image_res128 is None else DiffAugment(self.image_res128, policy=policy)
+        return BatchImagePyramid( image, image_res128, self.interpolate_mode )
+
+    @staticmethod
+    def cat( pyramids ):
+        """
+        複数のピラミッドをバッチ方向に結合する
+        """
+        image = torch.cat( [pyramid.image for pyramid in pyramids], dim = 0 )
+        image_res128 = torch.cat( [pyramid.res128 for pyramid in pyramids], dim = 0 )
+        return BatchImagePyramid( image, image_res128, pyramids[0].interpolate_mode )
+
+
+def forward_D_real_fake( model_D, pyramid_real, pyramid_fake, concat_real_fake = False ):
+    """
+    本物画像・偽物画像のピラミッドに対する識別器の出力 (d_outputs_real, d_outputs_fake) を返す。
+    concat_real_fake = True の場合は、本物画像と偽物画像を結合した 1 つのバッチとして 1 回の forward で処理する
+    （識別器の BatchNorm の統計量は本物画像と偽物画像を合わせたものになる）
+    """
+    if not( concat_real_fake ):
+        d_outputs_real = model_D( pyramid_real )
+        d_outputs_fake = model_D( pyramid_fake )
+        return d_outputs_real, d_outputs_fake
+
+    pyramid = BatchImagePyramid.cat( [pyramid_real, pyramid_fake] )
+    d_outputs = model_D( pyramid )
+    pyramid_real.crop_rand_idx = pyramid.crop_rand_idx
+    pyramid_fake.crop_rand_idx = pyramid.crop_rand_idx
+
+    n_real = len(pyramid_real)
+    d_outputs_real = { key : value[:n_real] for key, value in d_outputs.items() }
+    d_outputs_fake = { key : value[n_real:] for key, value in d_outputs.items() }
+    return d_outputs_real, d_outputs_fake
@@ -0,0 +1,281 @@
+# -*- coding:utf-8 -*-
+import os
+import time
+import json
+import argparse
+import numpy as np
+
+import torch
+import torch.nn as nn
+
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
+#====================================================
+# TorchScript / ONNX へのエクスポート
+#====================================================
+class ExportWrapper(nn.Module):
+    """
+    エクスポート用のラッパー。
+    Tensor 以外の引数（PGGAN の progress など）を定数として固定し、dict の出力を output_keys の順の tuple に変換する
+    """
+    def __init__( self, model, output_keys = None, **kwargs ):
+        super(ExportWrapper, self).__init__()
+        self.model = model
+        self.output_keys = output_keys
+        self.kwargs = kwargs
+        return
+
+    def forward( self, *inputs ):
+        outputs = self.model( *inputs, **self.kwargs )
+        if isinstance(outputs, dict):
+            keys = self.output_keys if self.output_keys is not None else list(outputs.keys())
+            return tuple( outputs[key] for key in keys )
+        return outputs
+
+
+def to_tuple( outputs ):
+    if isinstance(outputs, torch.Tensor):
+        return (outputs,)
+    if isinstance(outputs, dict):
+        return tuple(outputs.values())
+    return tuple(outputs)
+
+
+def load_state_dict_cpu( model, checkpoint_path ):
+    """
+    GPU で保存したチェックポイント（state_dict のみ / "model_state_dict" キーを持つ dict のどちらも可）を CPU 上のモデルに読み込む
+    """
+    checkpoint = torch.load( checkpoint_path, map_location = "cpu" )
+    if( "model_state_dict" in checkpoint ):
+        checkpoint = checkpoint["model_state_dict"]
+    model.load_state_dict( checkpoint )
+    return
+
+
+def get_dynamic_axes( names, tensors, dynamic_axes_type = "batch" ):
+    """
+    torch.onnx.export() の dynamic_axes
+        fixed : 全ての軸を固定 / batch : バッチ方向のみ可変 / batch_hw : バッチ方向と 4 次元テンソルの高さ・幅を可変
+    """
+    if( dynamic_axes_type == "fixed" ):
+        return None
+
+    dynamic_axes = {}
+    for name, tensor in zip(names, tensors):
+        dynamic_axes[name] = { 0 : "batch" }
+        if( dynamic_axes_type == "batch_hw" and tensor.dim() == 4 ):
+            dynamic_axes[name].update( { 2 : "{}_height".format(name), 3 : "{}_width".format(name) } )
+    return dynamic_axes
+
+
+def export_torchscript( model, example_inputs, save_path, method = "trace" ):
+    """
+    method = "trace" の場合は example_inputs で実行した処理を記録する（Python の制御フローは example_inputs で通った分岐に固定される）。
+    method = "script" の場合は forward のソースコードをコンパイルする
+    """
+    model.eval()
+    with torch.no_grad():
+        if( method == "script" ):
+            # ExportWrapper は可変長引数を使うためコンパイルできない。定数として固定する引数がない場合は中のモデルを直接コンパイルする
+            if isinstance(model, ExportWrapper):
+                if( len(model.kwargs) > 0 ):
+                    raise ValueError( "torchscript_method='script' does not support fixed arguments {}. use 'trace'".format(list(model.kwargs.keys())) )
+                model = model.model
+            model_ts = torch.jit.script( model )
+        else:
+            model_ts = torch.jit.trace( model, example_inputs, check_trace = False, strict = False )
+
+    model_ts.save( save_path )
+    return model_ts
+
+
+def export_onnx( model, example_inputs, save_path, input_names, output_names, dynamic_axes_type = "batch", opset_version = 11 ):
+    model.eval()
+    with torch.no_grad():
+        example_outputs = to_tuple( model(*example_inputs) )
+        torch.onnx.export(
+            model, tuple(example_inputs), save_path,
+            input_names = input_names, output_names = output_names,
+            dynamic_axes = get_dynamic_axes( list(input_names) + list(output_names), list(example_inputs) + list(example_outputs), dynamic_axes_type ),
+            opset_version = opset_version, do_constant_folding = True,
+        )
+    return
+
+
+#====================================================
+# エクスポートしたモデルの実行
+#====================================================
+def load_runtime( model_path, n_threads = 0 ):
+    """
+    エクスポートしたモデル（.pt : TorchScript / .onnx : ONNX）を CPU 上で読み込み、
+    numpy 配列を入力して numpy 配列の list を返す関数を返す（学習用のコードは不要）
+    """
+    if( model_path.endswith(".onnx") ):
+        if( onnxruntime is None ):
+            raise ImportError( "onnxruntime is required to run {}".format(model_path) )
+
+        options = onnxruntime.SessionOptions()
+        if( n_threads > 0 ):
+            options.intra_op_num_threads = n_threads
+        session = onnxruntime.InferenceSession( model_path, options, providers = ["CPUExecutionProvider"] )
+        input_names = [ input.name for input in session.get_inputs() ]
+
+        def run_onnx( *inputs ):
+            return session.run( None, { name : input for name, input in zip(input_names, inputs) } )
+        return run_onnx
+
+    if( n_threads > 0 ):
+        torch.set_num_threads( n_threads )
+    model_ts = torch.jit.load( model_path, map_location = "cpu" )
+    model_ts.eval()
+
+    def run_torchscript( *inputs ):
+        with torch.no_grad():
+            outputs = model_ts( *[ torch.from_numpy(input) for input in inputs ] )
+        return [ output.numpy() for output in to_tuple(outputs) ]
+    return run_torchscript
+
+
+def get_eager_runtime( model ):
+    """
+    エクスポート前のモデルを load_runtime() と同じ形式で実行する関数
+    """
+    model.eval()
+    def run_eager( *inputs ):
+        with torch.no_grad():
+            outputs = model( *[ torch.from_numpy(input) for input in inputs ] )
+        return [ output.numpy() for output in to_tuple(outputs) ]
+    return run_eager
+
+
+def check_parity( run_fn_ref, run_fn, inputs, seed = None ):
+    """
+    同じ入力に対する 2 つの実行関数の出力の最大絶対誤差（出力毎）を返す。
+    seed を指定した場合は、それぞれの実行前に乱数シードを固定する（ノイズを加える生成器用）
+    """
+    if( seed is not None ):
+        torch.manual_seed(seed)
+    outputs_ref = run_fn_ref( *inputs )
+    if( seed is not None ):
+        torch.manual_seed(seed)
+    outputs = run_fn( *inputs )
+    return [ float( np.abs(output_ref - output).max() ) for output_ref, output in zip(outputs_ref, outputs) ]
+
+
+def benchmark_runtime( run_fn, input_shapes, batch_sizes = [1, 4, 16], n_warmups = 3, n_iters = 20 ):
+    """
+    バッチサイズ毎のレイテンシー [ms]（中央値と 90 パーセンタイル）とスループット [samples/sec] を計測する
+
+    [Args]
+        input_shapes : <list> バッチ方向を除いた各入力の shape
+    """
+    results = []
+    for batch_size in batch_sizes:
+        inputs = [ np.random.randn( batch_size, *shape ).astype(np.float32) for shape in input_shapes ]
+        for _ in range(n_warmups):
+            run_fn( *inputs )
+
+        elapsed_times = []
+        for _ in range(n_iters):
+            start_time = time.perf_counter()
+            run_fn( *inputs )
+            elapsed_times.append( time.perf_counter() - start_time )
+
+        latency = float( np.median(elapsed_times) )
+        results.append( {
+            "batch_size" : batch_size,
+            "latency_ms" : latency * 1000,
+            "latency_p90_ms" : float( np.percentile(elapsed_times, 90) ) * 1000,
+            "throughput" : batch_size / latency,
+        } )
+    return results
+
+
+def export_model( model, example_inputs, export_dir, model_name, input_names = ["input"], output_names = ["output"], export_format = "both", torchscript_method = "trace", dynamic_axes_type = "batch", opset_version = 11, batch_sizes = [1, 4, 16], n_iters = 20, seed = None, check_onnx_parity = True ):
+    """
+    CPU 上のモデルを TorchScript / ONNX にエクスポートし、eager モードとの出力の一致と CPU での実行速度を確認する。
+    {model_name}.pt / {model_name}.onnx と、入出力の情報・確認結果を {model_name}.json に保存する
+
+    [Args]
+        seed : <int> ノイズを加える生成器の parity 確認時の乱数シード
+        check_onnx_parity : <bool> ONNX の parity を確認するか（ONNX ランタイムの乱数は PyTorch と一致しないため、ノイズを加える生成器では False にする）
+    """
+    if not os.path.isdir(export_dir):
+        os.makedirs(export_dir)
+
+    model = model.cpu().eval()
+    example_inputs = [ input.cpu() for input in example_inputs ]
+    input_shapes = [ list(input.shape[1:]) for input in example_inputs ]
+
+    # 固定 shape でエクスポートした場合は、エクスポート時のバッチサイズでのみ実行できる
+    if( dynamic_axes_type == "fixed" ):
+        batch_sizes = [ example_inputs[0].shape[0] ]
+
+    runtimes = { "eager" : get_eager_runtime(model) }
+    if( export_format in ["torchscript", "both"] ):
+        torchscript_path = os.path.join( export_dir, model_name + ".pt" )
+        export_torchscript( model, example_inputs, torchscript_path, method = torchscript_method )
+        runtimes["torchscript"] = load_runtime( torchscript_path )
+        print( "saved : ", torchscript_path )
+    if( export_format in ["onnx", "both"] ):
+        onnx_path = os.path.join( export_dir, model_name + ".onnx" )
+        export_onnx( model, example_inputs, onnx_path, input_names, output_names, dynamic_axes_type, opset_version )
+        print( "saved : ", onnx_path )
+        if( onnxruntime is not None ):
+            runtimes["onnx"] = load_runtime( onnx_path )
+        else:
+            print( "onnxruntime is not installed. skip the parity check and benchmark of onnx model." )
+
+    meta = {
+        "model_name" : model_name,
+        "input_names" : list(input_names),
+        "output_names" : list(output_names),
+        "input_shapes" : input_shapes,
+        "dynamic_axes_type" : dynamic_axes_type,
+        "parity" : {},
+        "benchmark" : {},
+    }
+
+    # eager モードとの出力の一致
+    inputs = [ input.numpy() for input in example_inputs ]
+    for name, run_fn in runtimes.items():
+        if( name == "eager" or ( name == "onnx" and not check_onnx_parity ) ):
+            continue
+        meta["parity"][name] = check_parity( runtimes["eager"], run_fn, inputs, seed )
+        print( "[parity] {} : max abs diff = {}".format(name, meta["parity"][name]) )
+
+    # CPU での実行速度
+    for name, run_fn in runtimes.items():
+        meta["benchmark"][name] = benchmark_runtime( run_fn, input_shapes, batch_sizes, n_iters = n_iters )
+        for result in meta["benchmark"][name]:
+            print( "[benchmark] {} : batch_size={batch_size}, latency={latency_ms:.2f}ms (p90={latency_p90_ms:.2f}ms), throughput={throughput:.1f} samples/sec".format(name, **result) )
+
+    with open( os.path.join(export_dir, model_name + ".json"), "w" ) as f:
+        json.dump( meta, f, indent = 4 )
+
+    return meta
+
+
+if __name__ == '__main__':
+    """
+    エクスポートしたモデルの CPU での実行速度の計測（学習用のコードは不要）
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model_path', type=str, required=True, help="エクスポートしたモデルのパス（.pt or .onnx）")
+    parser.add_argument('--meta_path', type=str, default="", help="エクスポート時に保存した json ファイルのパス（省略時は model_path の拡張子を .json に変えたもの）")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="計測の繰り返し回数")
+    parser.add_argument('--n_threads', type=int, default=0, help="CPU のスレッド数（0 でデフォルト）")
+    args = parser.parse_args()
+
+    meta_path = args.meta_path if args.meta_path != "" else os.path.splitext(args.model_path)[0] + ".json"
+    with open( meta_path, "r" ) as f:
+        meta = json.load(f)
+
+    batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ]
+    run_fn = load_runtime( args.model_path, args.n_threads )
+    for result in benchmark_runtime( run_fn, meta["input_shapes"], batch_sizes, n_iters = args.n_iters ):
+        print( "[benchmark] {} : batch_size={batch_size}, latency={latency_ms:.2f}ms (p90={latency_p90_ms:.2f}ms), throughput={throughput:.1f} samples/sec".format(args.model_path, **result) )
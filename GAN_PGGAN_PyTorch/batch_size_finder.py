@@ -0,0 +1,196 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+
+import torch
+
+#====================================================
+# 解像度毎の最大バッチサイズの探索
+#====================================================
+def is_out_of_memory( e ):
+    return isinstance(e, RuntimeError) and "out of memory" in str(e)
+
+
+def get_optimizer_state_bytes( optimizers ):
+    """
+    まだ確保されていない Adam の状態（exp_avg, exp_avg_sq）のメモリ量 [bytes]。
+    探索は最初の optimizer.step() の前に行われることがあるため、ピークメモリ使用量に加算する
+    """
+    n_bytes = 0
+    for optimizer in optimizers:
+        for param_group in optimizer.param_groups:
+            for param in param_group["params"]:
+                if( len(optimizer.state.get(param, {})) == 0 ):
+                    n_bytes += 2 * param.numel() * param.element_size()
+    return n_bytes
+
+
+@contextmanager
+def preserve_model_states( models, device ):
+    """
+    with ブロック内での探索用の forward / backward で、モデルの BatchNorm などのバッファ・勾配・requires_grad・乱数の状態を変更しない。
+    with ブロック内では全てのパラメーターの勾配を計算する
+    """
+    buffers = [ { name : buffer.clone() for name, buffer in model.named_buffers() } for model in models ]
+    requires_grads = [ [ param.requires_grad for param in model.parameters() ] for model in models ]
+    for model in models:
+        for param in model.parameters():
+            param.requires_grad_(True)
+
+    devices = [device.index if device.index is not None else torch.cuda.current_device()] if device.type == "cuda" else []
+    try:
+        with torch.random.fork_rng( devices = devices ):
+            yield
+    finally:
+        with torch.no_grad():
+            for model, model_buffers in zip(models, buffers):
+                for name, buffer in model.named_buffers():
+                    buffer.copy_( model_buffers[name] )
+        for model, model_requires_grads in zip(models, requires_grads):
+            model.zero_grad( set_to_none = True )
+            for param, requires_grad in zip(model.parameters(), model_requires_grads):
+                param.requires_grad_(requires_grad)
+        if( device.type == "cuda" ):
+            torch.cuda.empty_cache()
+
+
+def measure_peak_memory( step_fns, batch_size, device ):
+    """
+    各 step_fn( batch_size ) 実行時のピークメモリ使用量の最大値 [bytes]。メモリ不足の場合は None。
+    step_fn 毎に個別に計測するため、同時に確保される識別器・生成器のメモリ（保持した graph・勾配）は 1 つの step_fn 内で計測する
+    """
+    peak_bytes = 0
+    for step_fn in step_fns:
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        try:
+            step_fn( batch_size )
+            torch.cuda.synchronize(device)
+        except RuntimeError as e:
+            if not is_out_of_memory(e):
+                raise
+            torch.cuda.empty_cache()
+            return None
+        peak_bytes = max( peak_bytes, torch.cuda.max_memory_allocated(device) )
+
+    return peak_bytes
+
+
+def get_memory_budget_bytes( device, memory_budget_mb = 0, memory_fraction = 0.9 ):
+    """
+    memory_budget_mb <= 0 の場合は、GPU の全メモリの memory_fraction 倍
+    """
+    if( memory_budget_mb > 0 ):
+        return int(memory_budget_mb * 1024 ** 2)
+    return int( torch.cuda.get_device_properties(device).total_memory * memory_fraction )
+
+
+def find_max_batch_size( step_fns, models, optimizers, device, memory_budget_mb = 0, batch_size_min = 1, batch_size_max = 4096 ):
+    """
+    生成器・識別器の学習ステップ（step_fns）のピークメモリ使用量がメモリ予算に収まる最大のバッチサイズを、
+    バッチサイズを 2 倍ずつ増やした後に二分探索で求める。GPU 以外の場合は None を返す
+
+    [Args]
+        step_fns : <list> バッチサイズを引数に、ダミーデータで 1 step 分の forward / backward を行う関数のリスト（optimizer.step() は行わない）。
+                   識別器 → 生成器の更新を、学習ループと同じ graph の保持で 1 つの関数内で行う
+        models : <list> 探索前後で状態を戻すモデルのリスト
+        optimizers : <list> 未確保の状態のメモリ量を予算から差し引く optimizer のリスト
+    """
+    if( device.type != "cuda" ):
+        return None
+
+    budget_bytes = get_memory_budget_bytes( device, memory_budget_mb ) - get_optimizer_state_bytes( optimizers )
+    def fits( batch_size ):
+        with preserve_model_states( models, device ):
+            peak_bytes = measure_peak_memory( step_fns, batch_size, device )
+        return peak_bytes is not None and peak_bytes <= budget_bytes
+
+    if not fits( batch_size_min ):
+        return batch_size_min
+
+    # バッチサイズを 2 倍ずつ増やして、予算を超える範囲を見つける
+    low, high = batch_size_min, None
+    while( low * 2 <= batch_size_max ):
+        if not fits( low * 2 ):
+            high = low * 2
+            break
+        low = low * 2
+
+    if( high is None ):
+        return low
+
+    # 二分探索（low : 収まる, high : 収まらない）
+    while( high - low > 1 ):
+        mid = ( low + high ) // 2
+        if fits( mid ):
+            low = mid
+        else:
+            high = mid
+
+    return low
+
+
+def scale_lr( lr, batch_size_ref, batch_size, rule = "linear" ):
+    """
+    基準のバッチサイズ batch_size_ref での学習率 lr を、バッチサイズ batch_size での学習率に変換する
+    """
+    if( rule == "linear" ):
+        return lr * batch_size / batch_size_ref
+    elif( rule == "sqrt" ):
+        return lr * ( batch_size / batch_size_ref ) ** 0.5
+    return lr
+
+
+def get_model_config_key( models ):
+    """
+    モデルの構造・パラメーター数から計算した、キャッシュのキー用の文字列
+    """
+    config = "".join( [ str(model) + str(sum(param.numel() for param in model.parameters())) for model in models ] )
+    return hashlib.md5( config.encode("utf-8") ).hexdigest()
+
+
+class BatchSizeCache(object):
+    """
+    (モデルの構成, 解像度, デバイス, メモリ予算, 最大バッチサイズ) 毎に探索済みのバッチサイズを json ファイルに保存する
+    """
+    def __init__( self, cache_path ):
+        self.cache_path = cache_path
+        self.cache = {}
+        if( os.path.exists(cache_path) ):
+            with open(cache_path, "r") as f:
+                self.cache = json.load(f)
+        return
+
+    @staticmethod
+    def get_key( model_config_key, image_size, device, memory_budget_mb, batch_size_max ):
+        device_name = torch.cuda.get_device_name(device) if device.type == "cuda" else "cpu"
+        return "{}_{}_{}_{}_{}".format( model_config_key, image_size, device_name, memory_budget_mb, batch_size_max )
+
+    def get( self, key ):
+        return self.cache.get( key, None )
+
+    def set( self, key, batch_size ):
+        self.cache[key] = batch_size
+        if( os.path.dirname(self.cache_path) != "" and not os.path.isdir(os.path.dirname(self.cache_path)) ):
+            os.makedirs( os.path.dirname(self.cache_path) )
+        with open(self.cache_path, "w") as f:
+            json.dump( self.cache, f, indent = 4 )
+        return
+
+
+def find_batch_size_cached( cache, step_fns, models, optimizers, device, image_size, memory_budget_mb = 0, batch_size_max = 4096 ):
+    """
+    キャッシュにある場合はその値を、ない場合は find_max_batch_size() で探索してキャッシュに保存した値を返す（GPU 以外の場合は None）
+    """
+    if( device.type != "cuda" ):
+        return None
+
+    key = cache.get_key( get_model_config_key(models), image_size, device, memory_budget_mb, batch_size_max )
+    batch_size = cache.get(key)
+    if( batch_size is None ):
+        batch_size = find_max_batch_size( step_fns, models, optimizers, device, memory_budget_mb, batch_size_max = batch_size_max )
+        cache.set( key, batch_size )
+
+    return batch_size
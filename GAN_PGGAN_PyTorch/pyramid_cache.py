@@ -0,0 +1,140 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import numpy as np
+from math import ceil
+from tqdm import tqdm
+
+import torch
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+#====================================================
+# 多解像度（mip-pyramid）データセットキャッシュ
+#====================================================
+def get_pyramid_image_sizes( final_image_size ):
+    """
+    キャッシュする各レベルの画像サイズ 4, 8, ..., final_image_size
+    """
+    final_progress = int(np.log2(final_image_size)) - 2
+    return [ 4 * 2 ** level for level in range(final_progress+1) ]
+
+
+def build_pyramid_cache( dataset, cache_dir, final_image_size, cache_key = "", batch_size = 256, n_workers = 0 ):
+    """
+    dataset の全画像を 1 度だけ読み込み、2 の冪乗の各解像度に面積平均（avg_pool）でダウンサンプリングした画像を
+    cache_dir/level_{size}.npy にレベル毎に保存する。
+    cache_dir/meta.json の内容が一致する場合は既存のキャッシュを再利用する。
+
+    [Args]
+        dataset : <Dataset> (image, target) を返すデータセット。image は final_image_size に resize 済みの Tensor
+        cache_key : <str> データセット・前処理の設定を表す文字列。変更時はキャッシュを作り直す
+    """
+    image_sizes = get_pyramid_image_sizes(final_image_size)
+    meta = {
+        "cache_key" : cache_key,
+        "n_samples" : len(dataset),
+        "image_sizes" : image_sizes,
+    }
+
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if( os.path.exists(meta_path) ):
+        with open(meta_path, "r") as f:
+            if( json.load(f) == meta ):
+                return meta
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    dloader = DataLoader( dataset, batch_size = batch_size, shuffle = False, num_workers = n_workers )
+    levels_np = None
+    targets_np = np.zeros( (len(dataset),), dtype = np.int64 )
+    index = 0
+    for images, targets in tqdm( dloader, desc = "build pyramid cache" ):
+        n_batch, n_channels = images.shape[0], images.shape[1]
+        if( levels_np is None ):
+            levels_np = [
+                np.lib.format.open_memmap( os.path.join(cache_dir, "level_{}.npy".format(image_size)), mode = "w+", dtype = np.float32, shape = (len(dataset), n_channels, image_size, image_size) )
+                for image_size in image_sizes
+            ]
+
+        # 高解像度側から 1/2 ずつ面積平均でダウンサンプリング
+        images = F.adaptive_avg_pool2d(images, image_sizes[-1])
+        for level in reversed(range(len(image_sizes))):
+            levels_np[level][index:index+n_batch] = images.numpy()
+            images = F.avg_pool2d(images, 2)
+
+        targets_np[index:index+n_batch] = targets.numpy()
+        index += n_batch
+
+    for level_np in levels_np:
+        level_np.flush()
+    np.save( os.path.join(cache_dir, "targets.npy"), targets_np )
+
+    # meta.json はキャッシュが揃ってから最後に書き込む
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    return meta
+
+
+class PyramidBatch(object):
+    """
+    PyramidCacheLoader が返すミニバッチ。
+    load() を呼んだ時点で、必要なレベルの画像だけをキャッシュ（memmap）から読み込む
+    """
+    def __init__( self, loader, indices ):
+        self.loader = loader
+        self.indices = indices
+        return
+
+    def __len__(self):
+        return len(self.indices)
+
+    def load_level( self, level ):
+        images = self.loader.levels_np[level][self.indices]
+        return torch.from_numpy( np.ascontiguousarray(images) )
+
+    def load( self, progress ):
+        """
+        progress に対応した解像度 4 * 2 ** ceil(progress) の画像と target を返す
+        （F.adaptive_avg_pool2d(images, 4 * 2 ** int(ceil(progress))) の代わり）
+        """
+        images = self.load_level( int(ceil(progress)) )
+        targets = torch.from_numpy( self.loader.targets_np[self.indices] )
+        return images, targets
+
+
+class PyramidCacheLoader(object):
+    """
+    build_pyramid_cache() で作成したキャッシュからミニバッチを生成する DataLoader。
+    progress は学習ループの中で決まるため、画像の読み込みは PyramidBatch.load(progress) まで遅延させる
+    """
+    def __init__( self, cache_dir, batch_size = 64, shuffle = True, drop_last = False ):
+        self.cache_dir = cache_dir
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+        with open(os.path.join(cache_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+
+        self.n_samples = self.meta["n_samples"]
+        self.levels_np = [ np.load( os.path.join(cache_dir, "level_{}.npy".format(image_size)), mmap_mode = "r" ) for image_size in self.meta["image_sizes"] ]
+        self.targets_np = np.load( os.path.join(cache_dir, "targets.npy") )
+        return
+
+    def __len__(self):
+        if( self.drop_last ):
+            return self.n_samples // self.batch_size
+        return (self.n_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if( self.shuffle ):
+            indices = np.random.permutation(self.n_samples)
+        else:
+            indices = np.arange(self.n_samples)
+
+        for i in range(len(self)):
+            # memmap からの読み込みを連続アクセスにするため、バッチ内の index はソートしておく
+            yield PyramidBatch( self, np.sort(indices[i*self.batch_size:(i+1)*self.batch_size]) )
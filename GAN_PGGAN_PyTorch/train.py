@@ -24,6 +24,8 @@ from networks import ProgressiveGenerator, ProgressiveDiscriminator
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 from utils import save_image_historys_gif
+from pyramid_cache import build_pyramid_cache, PyramidCacheLoader
+from batch_size_finder import BatchSizeCache, find_batch_size_cached, scale_lr
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -49,6 +51,13 @@ if __name__ == '__main__':
     parser.add_argument('--n_display_step', type=int, default=50, help="tensorboard への表示間隔")
     parser.add_argument('--n_display_test_step', type=int, default=500, help="test データの tensorboard への表示間隔")
     parser.add_argument("--n_save_step", type=int, default=5000, help="モデルのチェックポイントの保存間隔")
+    parser.add_argument('--use_pyramid_cache', action='store_true', help="各解像度にダウンサンプリング済みの画像キャッシュから、現在の progress の解像度の画像のみを読み込む")
+    parser.add_argument('--pyramid_cache_dir', type=str, default="", help="画像キャッシュのディレクトリ（空の場合は dataset_dir/pyramid_cache）")
+    parser.add_argument('--auto_batch_size', action='store_true', help="解像度が変わる毎に、メモリ予算に収まる最大のバッチサイズを探索して使用する（batch_size・lr はその基準値）")
+    parser.add_argument('--memory_budget_mb', type=float, default=0, help="バッチサイズ探索時の GPU メモリ予算 [MB]（0 の場合は GPU の全メモリの 90%%）")
+    parser.add_argument('--batch_size_max', type=int, default=1024, help="バッチサイズ探索時の最大バッチサイズ")
+    parser.add_argument('--lr_scaling', choices=['linear', 'sqrt', 'none'], default="linear", help="探索したバッチサイズに合わせた学習率のスケーリング方法")
+    parser.add_argument('--batch_size_cache_path', type=str, default="checkpoints/batch_size_cache.json", help="探索済みのバッチサイズのキャッシュファイルのパス")
     parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
     parser.add_argument('--debug', action='store_true', help="デバッグモード有効化")
     args = parser.parse_args()
@@ -189,6 +198,17 @@ if __name__ == '__main__':
     else:
         raise NotImplementedError('dataset %s not implemented' % args.dataset)
 
+    # 多解像度の画像キャッシュ
+    if( args.use_pyramid_cache ):
+        if( args.pyramid_cache_dir == "" ):
+            args.pyramid_cache_dir = os.path.join( args.dataset_dir, "pyramid_cache" )
+
+        cache_key = "{}_{}".format(args.dataset, transform)
+        build_pyramid_cache( ds_train, os.path.join(args.pyramid_cache_dir, args.dataset, "train"), args.final_image_size, cache_key = cache_key )
+        build_pyramid_cache( ds_test, os.path.join(args.pyramid_cache_dir, args.dataset, "test"), args.final_image_size, cache_key = cache_key )
+        dloader_train = PyramidCacheLoader( os.path.join(args.pyramid_cache_dir, args.dataset, "train"), batch_size = args.batch_size, shuffle = True )
+        dloader_test = PyramidCacheLoader( os.path.join(args.pyramid_cache_dir, args.dataset, "test"), batch_size = args.batch_size_test, shuffle = False )
+
     if( args.debug ):
         print( "ds_train :\n", ds_train )
         print( "ds_test :\n", ds_test )
@@ -273,6 +293,38 @@ if __name__ == '__main__':
     init_progress = float(np.log2(args.init_image_size)) - 2
     final_progress = float(np.log2(args.final_image_size)) -2
 
+    # バッチサイズの探索用に、ダミーデータで識別器 → 生成器の 1 step 分の forward / backward を行う関数
+    # 学習ループと同じく loss_D.backward(retain_graph=True) で識別器の graph を保持したまま生成器の forward / backward を行い、1 回の計測でピークメモリを測る
+    n_rgb = 1 if args.dataset == "mnist" else 3
+    def step_dummy( n_batch, progress ):
+        image_size = 4 * 2 ** int(ceil(progress))
+        images = torch.randn( size = (n_batch, n_rgb, image_size, image_size) ).to( device )
+
+        # 識別器
+        input_noize_z = torch.randn( size = (n_batch, args.n_input_noize_z,1,1) ).to( device )
+        D_x = model_D( images, progress=progress )
+        with torch.no_grad():
+            G_z = model_G( input_noize_z, progress=progress )
+        D_G_z = model_D( G_z.detach(), progress=progress )
+        real_ones_tsr =  torch.ones( D_x.shape ).to( device )
+        fake_zeros_tsr =  torch.zeros( D_x.shape ).to( device )
+        loss_D = loss_fn( D_x, real_ones_tsr ) + loss_fn( D_G_z, fake_zeros_tsr )
+        loss_D.backward(retain_graph=True)
+
+        # 生成器
+        for param in model_D.parameters():
+            param.requires_grad = False
+        input_noize_z = torch.randn( size = (n_batch, args.n_input_noize_z,1,1) ).to( device )
+        G_z = model_G( input_noize_z, progress=progress )
+        D_G_z = model_D( G_z, progress=progress )
+        loss_G = loss_fn( D_G_z, real_ones_tsr )
+        loss_G.backward()
+        return
+
+    batch_size_cache = BatchSizeCache( args.batch_size_cache_path )
+    batch_size = args.batch_size
+    image_size_epoch = None
+
     print("Starting Training Loop...")
     iterations = 0      # 学習処理のイテレーション回数
     n_print = 1
@@ -280,30 +332,61 @@ if __name__ == '__main__':
     # エポック数分トレーニング
     #-----------------------------
     for epoch in tqdm( range(args.n_epoches), desc = "Epoches" ):
+        #----------------------------------------------------
+        # 解像度が変わる場合は、最大のバッチサイズを探索し、DataLoader と学習率を更新
+        #----------------------------------------------------
+        # この epoch 内での最大の progress（1 つの epoch 内では解像度 4 * 2 ** ceil(progress) は変わらない）
+        x = epoch + 1 - 1e-6
+        progress_epoch = min(max(int(x / 2), x - ceil(x / 2), 0), final_progress)
+        if( args.auto_batch_size and image_size_epoch != 4 * 2 ** int(ceil(progress_epoch)) ):
+            image_size_epoch = 4 * 2 ** int(ceil(progress_epoch))
+            batch_size_found = find_batch_size_cached(
+                batch_size_cache, [ lambda n_batch : step_dummy(n_batch, progress_epoch) ],
+                [ model_G, model_D ], [ optimizer_G, optimizer_D ], device, image_size_epoch, args.memory_budget_mb, args.batch_size_max,
+            )
+            if( batch_size_found is not None ):
+                batch_size = min( batch_size_found, len(ds_train) )
+                if( args.use_pyramid_cache ):
+                    dloader_train = PyramidCacheLoader( os.path.join(args.pyramid_cache_dir, args.dataset, "train"), batch_size = batch_size, shuffle = True )
+                else:
+                    dloader_train = DataLoader( dataset = ds_train, batch_size = batch_size, shuffle = True )
+
+                lr = scale_lr( args.lr, args.batch_size, batch_size, args.lr_scaling )
+                for param_group in optimizer_G.param_groups + optimizer_D.param_groups:
+                    param_group['lr'] = lr
+
+                board_train.add_scalar('batch_size', batch_size, iterations)
+                board_train.add_scalar('lr', lr, iterations)
+                print( "image_size={}, batch_size={}, lr={}".format(image_size_epoch, batch_size, lr) )
+
         # DataLoader から 1minibatch 分取り出し、ミニバッチ処理
-        for step, (images,targets) in enumerate( tqdm( dloader_train, desc = "minbatch iters" ) ):
+        for step, inputs in enumerate( tqdm( dloader_train, desc = "minbatch iters" ) ):
             model_G.train()
             model_D.train()
 
             # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する
             # （後の計算で、shape の不一致をおこすため）
-            if images.size()[0] != args.batch_size:
+            if len(inputs[0] if not args.use_pyramid_cache else inputs) != batch_size:
                 break
 
-            iterations += args.batch_size
+            iterations += batch_size
 
             x = (epoch + step / len(dloader_train))
             progress = min(max(int(x / 2), x - ceil(x / 2), 0), final_progress)
             
-            # ミニバッチデータを GPU へ転送
-            images = images.to( device )
-
             # 元の画像ピクセル数を、Training Progresses 用にダウンサンプリング
             # progress = 0.0 ⇒ 32 × 32 → 4 × 4, 
             # 0.00 < progress < 1.00 ⇒ 32 × 32 → 8 × 8,
             # 1.00 < progress < 2.00 ⇒ 32 × 32 → 16 × 16,
             # ...
-            images = F.adaptive_avg_pool2d(images, 4 * 2 ** int(ceil(progress)) )
+            if( args.use_pyramid_cache ):
+                # キャッシュから現在の progress の解像度の画像のみを読み込む
+                images, targets = inputs.load(progress)
+                images = images.to( device )
+            else:
+                images, targets = inputs
+                images = images.to( device )
+                images = F.adaptive_avg_pool2d(images, 4 * 2 ** int(ceil(progress)) )
 
             #====================================================
             # 識別器 D の fitting 処理
@@ -317,7 +400,7 @@ if __name__ == '__main__':
             # model(引数) で呼び出せるのは、__call__ をオーバライトしているため
             #----------------------------------------------------
             # 入力ノイズを再生成 
-            input_noize_z = torch.randn( size = (args.batch_size, args.n_input_noize_z,1,1) ).to( device )
+            input_noize_z = torch.randn( size = (batch_size, args.n_input_noize_z,1,1) ).to( device )
 
             # D(x) : 本物画像 x = image を入力したときの識別器の出力
             D_x = model_D( images, progress=progress )
@@ -370,7 +453,7 @@ if __name__ == '__main__':
             # 学習用データをモデルに流し込む
             # model(引数) で呼び出せるのは、__call__ をオーバライトしているため
             #----------------------------------------------------
-            input_noize_z = torch.randn( size = (args.batch_size, args.n_input_noize_z,1,1) ).to( device )
+            input_noize_z = torch.randn( size = (batch_size, args.n_input_noize_z,1,1) ).to( device )
 
             # G(z) : 生成器から出力される偽物画像
             G_z = model_G( input_noize_z, progress=progress )
@@ -420,8 +503,8 @@ if __name__ == '__main__':
                 test_iterations = 0
                 loss_D_total = 0
                 loss_G_total = 0
-                for (test_images,test_targets) in dloader_test :
-                    if test_images.size()[0] != args.batch_size_test:
+                for test_inputs in dloader_test :
+                    if len(test_inputs[0] if not args.use_pyramid_cache else test_inputs) != args.batch_size_test:
                         break
 
                     test_iterations += args.batch_size_test
@@ -430,14 +513,18 @@ if __name__ == '__main__':
                     #----------------------------------------------------
                     # 入力データをセット
                     #----------------------------------------------------
-                    test_images = test_images.to( device )
-                    
                     # 元の画像ピクセル数を、Training Progresses 用にダウンサンプリング
                     # progress = 0.0 ⇒ 32 × 32 → 4 × 4, 
                     # 0.00 < progress < 1.00 ⇒ 32 × 32 → 8 × 8,
                     # 1.00 < progress < 2.00 ⇒ 32 × 32 → 16 × 16,
                     # ...
-                    test_images = F.adaptive_avg_pool2d(test_images, 4 * 2 ** int(ceil(progress)) )
+                    if( args.use_pyramid_cache ):
+                        test_images, test_targets = test_inputs.load(progress)
+                        test_images = test_images.to( device )
+                    else:
+                        test_images, test_targets = test_inputs
+                        test_images = test_images.to( device )
+                        test_images = F.adaptive_avg_pool2d(test_images, 4 * 2 ** int(ceil(progress)) )
 
                     #----------------------------------------------------
                     # テスト用データをモデルに流し込む
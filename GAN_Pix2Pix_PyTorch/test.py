@@ -20,6 +20,8 @@ from tensorboardX import SummaryWriter
 # 自作クラス
 from networks import Pix2PixUNetGenerator, Pix2PixDiscriminator, Pix2PixPatchGANDiscriminator
 from map2aerial_dataset import Map2AerialDataset, Map2AerialDataLoader
+from tiled_inference import TiledInference
+from video_inference import VideoInference
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 from utils import save_image_historys_gif
@@ -41,6 +43,14 @@ if __name__ == '__main__':
     parser.add_argument('--unetG_dropout', type=float, default=0.5, help="生成器への入力ノイズとしての Dropout 率")
     parser.add_argument('--n_fmaps', type=int, default=64, help="特徴マップの枚数")
     parser.add_argument('--networkD_type', choices=['vanilla','PatchGAN' ], default="PatchGAN", help="GAN の識別器の種類")
+    parser.add_argument('--tiled_inference', action='store_true', help="元の解像度の画像をタイル分割して推論する（resize しない）")
+    parser.add_argument('--tile_size', type=int, default=512, help="タイル分割推論時のタイルの大きさ（pixel単位）。受容野の直径より十分大きくする")
+    parser.add_argument('--tile_overlap', type=int, default=-1, help="タイル分割推論時のタイルの重なり幅（pixel単位）。負の値の場合は受容野の半径から自動で決める")
+    parser.add_argument('--tile_batch_size', type=int, default=4, help="タイル分割推論時に 1 度に推論するタイル数")
+    parser.add_argument('--input_video', type=str, default="", help="推論する動画ファイルのパス（指定時は動画モードで推論する）")
+    parser.add_argument('--output_video', type=str, default="output.mp4", help="動画モードでの出力動画のファイル名")
+    parser.add_argument('--video_batch_size', type=int, default=8, help="動画モードで 1 度に推論するフレーム数")
+    parser.add_argument('--video_queue_size', type=int, default=4, help="動画モードでの decode / encode スレッドとのキューのサイズ上限（ミニバッチ数）")
     parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
     parser.add_argument('--debug', action='store_true', help="デバッグモード有効化")
     args = parser.parse_args()
@@ -133,6 +143,39 @@ if __name__ == '__main__':
     n_print = 1
     model_G.eval()
     model_D.eval()
+    if( args.input_video != "" ):
+        # decode・推論・encode を並行して行うパイプラインで動画を変換する
+        video_inference = VideoInference(
+            model_G, image_height = args.image_size, image_width = args.image_size,
+            batch_size = args.video_batch_size, max_queue_size = args.video_queue_size,
+            value_range = (0.0, 1.0), preprocess_fn = lambda frame : frame / 255.0,   # transforms.ToTensor() と save_image() に合わせる
+            device = device,
+        )
+        stats = video_inference( args.input_video, os.path.join(args.results_dir, args.exper_name, args.output_video) )
+        for key, value in stats.items():
+            print( "{} : {:.3f}".format(key, value) )
+
+        print("Finished Test Loop.")
+        exit()
+
+    if( args.tiled_inference ):
+        # 学習時の解像度に resize せずに、元の解像度の画像をタイル分割して推論する
+        # 全層畳み込みのネットワークなので、タイルの大きさは 2^(ダウンサンプリング回数) = 16 の倍数であればよい
+        tiled_inference = TiledInference(
+            model_G, n_in_channels = 3,
+            tile_size = args.tile_size, overlap = args.tile_overlap, tile_batch_size = args.tile_batch_size, size_multiple = 16,
+            value_range = (0.0, 1.0), preprocess_fn = lambda tile : tile / 255.0,   # transforms.ToTensor() と save_image() に合わせる
+            device = device, debug = args.debug,
+        )
+        for step, image_name in enumerate( tqdm( ds_test.image_names[:args.n_samplings], desc = "Samplings" ) ):
+            # 学習用データには、左側に衛星画像、右側に地図画像が入っているので、chunk で切り分ける
+            raw_image = torch.from_numpy( np.array( Image.open(os.path.join(ds_test.dataset_dir, image_name)).convert('RGB') ) ).permute(2,0,1)
+            input_image = torch.chunk( raw_image, chunks=2, dim=2 )[1]
+            tiled_inference( input_image, os.path.join(args.results_dir, args.exper_name, "fake_image_tiled_" + os.path.splitext(image_name)[0] + ".png") )
+
+        print("Finished Test Loop.")
+        exit()
+
     # DataLoader から 1minibatch 分取り出し、ミニバッチ処理
     for step, inputs in enumerate( tqdm( dloader_test, desc = "Samplings" ) ):
         # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する
@@ -0,0 +1,261 @@
+# -*- coding:utf-8 -*-
+import os
+import zlib
+import struct
+import numpy as np
+from tqdm import tqdm
+
+import torch
+import torch.nn.functional as F
+
+#====================================================
+# 大きな画像のタイル分割推論
+#====================================================
+def estimate_receptive_field( forward_fn, n_in_channels, tile_size, device, size_multiple = 1 ):
+    """
+    出力の中心の size_multiple x size_multiple pixel に対する入力の勾配が非ゼロとなる範囲から、ネットワークの受容野の半径 [pixel] を推定する。
+    ダウンサンプリングがある場合は出力の位置（ダウンサンプリングの格子に対する位相）毎に受容野が異なるため、格子 1 つ分の全ての位置での最大値とする。
+    受容野が tile_size を超える場合は tile_size // 2 程度となる
+    """
+    input = torch.randn( 1, n_in_channels, tile_size, tile_size, device = device, requires_grad = True )
+    center = tile_size // 2 // size_multiple * size_multiple
+    with torch.enable_grad():
+        output = forward_fn(input)
+        grad, = torch.autograd.grad( output[:, :, center:center+size_multiple, center:center+size_multiple].sum(), input )
+
+    ys, xs = torch.nonzero( grad.abs().sum(dim=(0,1)) > 0, as_tuple = True )
+    if( len(ys) == 0 ):
+        return 0
+
+    last = center + size_multiple - 1
+    return int( max( center - ys.min().item(), ys.max().item() - last, center - xs.min().item(), xs.max().item() - last ) )
+
+
+def get_tile_starts( size, tile_size, stride, size_multiple = 1 ):
+    """
+    長さ size の軸を tile_size のタイルで stride 間隔に分割した時の各タイルの開始位置。
+    最後のタイルは端に揃えるが、ダウンサンプリングの格子がずれないように開始位置を size_multiple の倍数に切り上げる（はみ出した部分は padding する）
+    """
+    if( size <= tile_size ):
+        return [0]
+    last = ( size - tile_size + size_multiple - 1 ) // size_multiple * size_multiple
+    return list(range(0, size - tile_size, stride)) + [last]
+
+
+def get_blend_window( tile_size, margin, overlap, at_start, at_end ):
+    """
+    タイルの 1 軸方向の重み [tile_size]。
+    画像内部側のタイル端から margin pixel（受容野の半径）は、ネットワークの padding の影響を受けるため重み 0 とし、
+    その内側の overlap - 2 * margin pixel で線形に増加させる。隣接タイルの重みの和は重なり部分で常に 1 になる。
+    画像端側のタイル端（at_start / at_end）は padding の影響が画像全体での推論と同じなので、重み 1 とする
+    """
+    window = torch.ones(tile_size)
+    blend = overlap - 2 * margin
+    ramp = torch.cat( [ torch.zeros(margin), ( torch.arange(blend).float() + 0.5 ) / blend ] )
+    if not( at_start ):
+        window[:len(ramp)] = torch.min( window[:len(ramp)], ramp )
+    if not( at_end ):
+        window[-len(ramp):] = torch.min( window[-len(ramp):], ramp.flip(0) )
+    return window
+
+
+class PNGBandWriter(object):
+    """
+    uint8 の画像を上の行から順に PNG ファイルに書き出す（行毎のフィルタは None）。
+    書き出し済みの行は保持しないため、メモリ使用量は write() に渡す行数分のみ
+    """
+    COLOR_TYPES = { 1 : 0, 3 : 2, 4 : 6 }     # グレースケール / RGB / RGBA
+
+    def __init__( self, save_path, height, width, n_channels, compress_level = 6 ):
+        if not( n_channels in self.COLOR_TYPES ):
+            raise ValueError( "n_channels={} is not supported in PNG".format(n_channels) )
+
+        self.file = open( save_path, "wb" )
+        self.compressor = zlib.compressobj( compress_level )
+        self.file.write( b"\x89PNG\r\n\x1a\n" )
+        self.write_chunk( b"IHDR", struct.pack( ">IIBBBBB", width, height, 8, self.COLOR_TYPES[n_channels], 0, 0, 0 ) )
+        return
+
+    def write_chunk( self, chunk_type, data ):
+        self.file.write( struct.pack( ">I", len(data) ) )
+        self.file.write( chunk_type + data )
+        self.file.write( struct.pack( ">I", zlib.crc32( chunk_type + data ) & 0xffffffff ) )
+        return
+
+    def write( self, rows ):
+        """
+        [N,W,C] の uint8 の numpy 配列（N 行分）を書き出す
+        """
+        rows = np.ascontiguousarray(rows).reshape( rows.shape[0], -1 )
+        # 各行の先頭にフィルタの種類（0 : None）を付ける
+        data = np.concatenate( [ np.zeros( (rows.shape[0], 1), dtype = np.uint8 ), rows ], axis = 1 ).tobytes()
+        compressed = self.compressor.compress( data )
+        if( len(compressed) > 0 ):
+            self.write_chunk( b"IDAT", compressed )
+        return
+
+    def close( self ):
+        self.write_chunk( b"IDAT", self.compressor.flush() )
+        self.write_chunk( b"IEND", b"" )
+        self.file.close()
+        return
+
+
+class NpyBandWriter(object):
+    """
+    uint8 の画像 [H,W,C] を上の行から順に .npy ファイル（memmap）に書き出す
+    """
+    def __init__( self, save_path, height, width, n_channels ):
+        self.output_np = np.lib.format.open_memmap( save_path, mode = "w+", dtype = np.uint8, shape = (height, width, n_channels) )
+        self.row = 0
+        return
+
+    def write( self, rows ):
+        self.output_np[self.row:self.row+rows.shape[0]] = rows
+        self.row += rows.shape[0]
+        return
+
+    def close( self ):
+        self.output_np.flush()
+        del self.output_np
+        return
+
+
+class TiledInference(object):
+    """
+    全層畳み込みの生成器で、任意サイズの画像を重なりのあるタイルに分割して推論する。
+    タイルはミニバッチ単位で推論し、重なり部分は feather 窓で重み付け平均して継ぎ目を消す。
+    タイル端から受容野の半径（margin）以内の出力は重み 0 とするため、受容野がタイルに収まるネットワーク（推論時の BatchNorm など局所的な処理のみ）では、
+    画像全体を 1 度に推論した場合と同じ出力になる。
+    出力画像はタイル行毎に確定した行から順にファイル（PNG or .npy）に書き出すため、
+    デバイス・ホストのメモリ使用量は画像全体ではなく、タイルのミニバッチと 1 タイル行分（tile_size x 画像幅）の蓄積バッファで決まる
+
+    [Args]
+        forward_fn : <callable> [N,C,tile_size,tile_size] のタイルから同じ解像度の出力を返す関数（model など）
+        tile_size : <int> タイルの 1 辺の大きさ。size_multiple の倍数
+        overlap : <int> 隣接タイルとの重なり幅 [pixel]。2 * margin より大きい値。負の値の場合は margin から自動で決める
+        margin : <int> タイル端で重みを 0 にする幅 [pixel]。負の値の場合は受容野の半径を推定して使う
+        size_multiple : <int> ネットワークの入力サイズの制約（2 ** ダウンサンプリング回数）
+        value_range : <tuple> 出力値の範囲。画像として保存する際に [0,255] へ変換する
+        preprocess_fn : <callable> デバイスに転送したタイル（float）への前処理。None の場合は何もしない
+    """
+    def __init__( self, forward_fn, n_in_channels = 3, tile_size = 256, overlap = -1, margin = -1, tile_batch_size = 4, size_multiple = 1, value_range = (-1.0, 1.0), preprocess_fn = None, device = torch.device("cpu"), debug = False ):
+        if( tile_size % size_multiple != 0 ):
+            raise ValueError( "tile_size={} must be a multiple of {}".format(tile_size, size_multiple) )
+
+        self.forward_fn = forward_fn
+        self.tile_size = tile_size
+        self.tile_batch_size = tile_batch_size
+        self.size_multiple = size_multiple
+        self.value_range = value_range
+        self.preprocess_fn = preprocess_fn
+        self.device = device
+        self.debug = debug
+
+        if( margin < 0 ):
+            margin = estimate_receptive_field( forward_fn, n_in_channels, tile_size, device, size_multiple )
+
+        # 重なり幅は、両側のタイルの margin と 1 pixel 以上の重み付け平均の範囲を含み、タイルの間隔がダウンサンプリングの格子に揃う最小の値とする
+        if( overlap < 0 ):
+            overlap = tile_size - ( tile_size - 2 * margin - 1 ) // size_multiple * size_multiple
+        if( overlap <= 2 * margin or overlap >= tile_size or ( tile_size - overlap ) % size_multiple != 0 ):
+            raise ValueError(
+                "invalid overlap={} for tile_size={}, margin={} : overlap must be > 2 * margin and < tile_size, and tile_size - overlap must be a multiple of {} (use a larger tile_size)".format(overlap, tile_size, margin, size_multiple)
+            )
+        if( self.debug ):
+            print( "margin={}, overlap={}, stride={}".format(margin, overlap, tile_size - overlap) )
+
+        self.margin = margin
+        self.overlap = overlap
+        self.stride = tile_size - overlap
+        self.windows = {}
+        return
+
+    def get_window( self, at_top, at_bottom, at_left, at_right ):
+        """
+        タイルの位置（画像端に接しているか）に応じた 2 次元の重み [tile_size, tile_size]
+        """
+        key = ( at_top, at_bottom, at_left, at_right )
+        if not( key in self.windows ):
+            window_y = get_blend_window( self.tile_size, self.margin, self.overlap, at_top, at_bottom )
+            window_x = get_blend_window( self.tile_size, self.margin, self.overlap, at_left, at_right )
+            self.windows[key] = ( window_y[:, None] * window_x[None, :] ).to(self.device)
+        return self.windows[key]
+
+    def load_tile( self, image, y0, x0 ):
+        """
+        (y0,x0) から始まるタイルをデバイスに転送し、画像端で tile_size に満たない場合は端の値で padding する
+        """
+        tile = image[:, y0:y0+self.tile_size, x0:x0+self.tile_size].to(self.device, non_blocking = True).float()
+        if( self.preprocess_fn is not None ):
+            tile = self.preprocess_fn(tile)
+
+        pad_h = self.tile_size - tile.shape[1]
+        pad_w = self.tile_size - tile.shape[2]
+        if( pad_h > 0 or pad_w > 0 ):
+            tile = F.pad( tile.unsqueeze(0), (0, pad_w, 0, pad_h), mode = "replicate" ).squeeze(0)
+        return tile
+
+    def to_uint8( self, output ):
+        """
+        [C,H,W] の出力を [H,W,C] の uint8 の numpy 配列に変換する
+        """
+        low, high = self.value_range
+        output = ( output - low ) / ( high - low ) * 255
+        return output.clamp(0,255).round().byte().permute(1,2,0).cpu().numpy()
+
+    @torch.no_grad()
+    def __call__( self, image, save_path ):
+        """
+        image を推論した出力画像を save_path に保存する
+
+        [Args]
+            image : <Tensor> CPU 上の入力画像 [C,H,W]（uint8 のままでよい）
+            save_path : <str> 出力画像のパス。拡張子が .png の場合は PNG 画像、.npy の場合は uint8 の [H,W,C] の配列
+        """
+        ext = os.path.splitext(save_path)[1].lower()
+        if not( ext in [".png", ".npy"] ):
+            raise ValueError( "save_path must be .png or .npy : {}".format(save_path) )
+
+        _, height, width = image.shape
+        ys = get_tile_starts( height, self.tile_size, self.stride, self.size_multiple )
+        xs = get_tile_starts( width, self.tile_size, self.stride, self.size_multiple )
+        band_height = min( self.tile_size, height )
+
+        writer = None
+        output_band, weight_band = None, None
+        band_top = 0
+        for y0 in tqdm( ys, desc = "tiled inference" ):
+            # y0 より上の行は以降のタイルに含まれないため確定し、蓄積バッファをずらす
+            if( output_band is not None and y0 > band_top ):
+                n_rows = y0 - band_top
+                writer.write( self.to_uint8( output_band[:, :n_rows] / weight_band[:, :n_rows] ) )
+                output_band = torch.cat( [ output_band[:, n_rows:], torch.zeros_like(output_band[:, :n_rows]) ], dim = 1 )
+                weight_band = torch.cat( [ weight_band[:, n_rows:], torch.zeros_like(weight_band[:, :n_rows]) ], dim = 1 )
+                band_top = y0
+
+            # 1 タイル行分のタイルをミニバッチ単位で推論する
+            for i in range(0, len(xs), self.tile_batch_size):
+                x0s = xs[i:i+self.tile_batch_size]
+                tiles = torch.stack( [ self.load_tile(image, y0, x0) for x0 in x0s ], dim = 0 )
+                outputs = self.forward_fn(tiles).float()
+                if( output_band is None ):
+                    output_band = torch.zeros( (outputs.shape[1], band_height, width), device = self.device )
+                    weight_band = torch.zeros( (1, band_height, width), device = self.device )
+                    if( ext == ".png" ):
+                        writer = PNGBandWriter( save_path, height, width, outputs.shape[1] )
+                    else:
+                        writer = NpyBandWriter( save_path, height, width, outputs.shape[1] )
+
+                for output, x0 in zip(outputs, x0s):
+                    h = min( self.tile_size, height - y0 )
+                    w = min( self.tile_size, width - x0 )
+                    window = self.get_window( y0 == ys[0], y0 == ys[-1], x0 == xs[0], x0 == xs[-1] )[:h, :w]
+                    output_band[:, :h, x0:x0+w] += output[:, :h, :w] * window
+                    weight_band[:, :h, x0:x0+w] += window
+
+        # 残りの行を確定する
+        n_rows = height - band_top
+        writer.write( self.to_uint8( output_band[:, :n_rows] / weight_band[:, :n_rows] ) )
+        writer.close()
+        return
@@ -0,0 +1,210 @@
+# -*- coding:utf-8 -*-
+import time
+import queue
+import threading
+import numpy as np
+import cv2
+from tqdm import tqdm
+
+import torch
+
+#====================================================
+# 動画のストリーミング推論
+#====================================================
+class StageTimer(object):
+    """
+    パイプラインの各ステージ（decode / inference / encode）の処理時間を集計する
+    """
+    def __init__( self ):
+        self.total_time = 0.0
+        self.n_batches = 0
+        self.n_frames = 0
+        return
+
+    def update( self, elapsed, n_frames ):
+        self.total_time += elapsed
+        self.n_batches += 1
+        self.n_frames += n_frames
+        return
+
+    def report( self ):
+        """
+        1 ミニバッチあたりと 1 フレームあたりの平均処理時間 [ms]
+        """
+        return {
+            "ms_per_batch" : self.total_time / max(self.n_batches, 1) * 1000,
+            "ms_per_frame" : self.total_time / max(self.n_frames, 1) * 1000,
+        }
+
+
+class VideoInference(object):
+    """
+    画像から画像への生成器で動画をフレーム毎に変換する、3 ステージのパイプライン。
+    decode（cv2.VideoCapture）と encode（cv2.VideoWriter）はそれぞれ別スレッドで行い、サイズ上限付きのキューで推論（メインスレッド）と繋ぐことで、
+    decode・推論・encode を並行して行う。cv2 の decode / encode と GPU での推論は GIL を解放するため、スレッドでも重なる
+
+    [Args]
+        forward_fn : <callable> [N,C,image_height,image_width] の入力から同じ解像度の出力を返す関数（model など）
+        batch_size : <int> 1 度に推論するフレーム数
+        max_queue_size : <int> 各キューに溜めるミニバッチ数の上限（メモリ使用量の上限）
+        value_range : <tuple> 出力値の範囲。[0,255] の画素値へ変換する
+        preprocess_fn : <callable> デバイスに転送したフレーム（float, RGB, [0,255]）への前処理
+    """
+    def __init__( self, forward_fn, image_height, image_width, batch_size = 8, max_queue_size = 4, value_range = (-1.0, 1.0), preprocess_fn = None, device = torch.device("cpu") ):
+        self.forward_fn = forward_fn
+        self.image_height = image_height
+        self.image_width = image_width
+        self.batch_size = batch_size
+        self.max_queue_size = max_queue_size
+        self.value_range = value_range
+        self.preprocess_fn = preprocess_fn
+        self.device = device
+        return
+
+    def put( self, q, item ):
+        """
+        他のステージでエラーが起きた場合に、キューの空き待ちで止まらないようにタイムアウト付きで put する
+        """
+        while True:
+            if( self.stop_event.is_set() ):
+                return False
+            try:
+                q.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                continue
+
+    def get( self, q ):
+        while True:
+            if( self.stop_event.is_set() ):
+                return None
+            try:
+                return q.get(timeout = 0.1)
+            except queue.Empty:
+                continue
+
+    def reader_loop( self, capture ):
+        """
+        動画をデコードして、ネットワークの入力サイズに resize した RGB フレームのミニバッチをキューに入れる
+        """
+        try:
+            while True:
+                start_time = time.time()
+                frames = []
+                for _ in range(self.batch_size):
+                    ret, frame = capture.read()
+                    if not( ret ):
+                        break
+                    frame = cv2.resize( frame, (self.image_width, self.image_height), interpolation = cv2.INTER_AREA )
+                    frames.append( cv2.cvtColor(frame, cv2.COLOR_BGR2RGB) )
+
+                if( len(frames) == 0 ):
+                    break
+
+                self.timers["decode"].update( time.time() - start_time, len(frames) )
+                if not( self.put( self.input_queue, np.stack(frames, axis = 0) ) ):
+                    return
+
+            self.put( self.input_queue, None )
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        return
+
+    def writer_loop( self, writer, frame_size ):
+        """
+        推論結果のミニバッチを元の動画サイズに resize してエンコードする
+        """
+        try:
+            while True:
+                frames = self.get( self.output_queue )
+                if( frames is None ):
+                    break
+
+                start_time = time.time()
+                for frame in frames:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+                    writer.write( cv2.resize( frame, frame_size, interpolation = cv2.INTER_CUBIC ) )
+
+                self.timers["encode"].update( time.time() - start_time, len(frames) )
+        except Exception as e:
+            self.errors.append(e)
+            self.stop_event.set()
+        return
+
+    @torch.no_grad()
+    def inference( self, frames ):
+        """
+        [N,H,W,C] の uint8 のフレームを推論し、[N,H,W,C] の uint8 のフレームを返す
+        """
+        input = torch.from_numpy(frames).to(self.device, non_blocking = True).permute(0,3,1,2).float()
+        if( self.preprocess_fn is not None ):
+            input = self.preprocess_fn(input)
+
+        output = self.forward_fn(input).float()
+        low, high = self.value_range
+        output = ( output - low ) / ( high - low ) * 255
+        return output.clamp(0,255).round().byte().permute(0,2,3,1).cpu().numpy()
+
+    def __call__( self, input_path, output_path, fps = None ):
+        """
+        input_path の動画を変換して output_path に保存し、スループット [fps] と各ステージの処理時間を返す
+        """
+        capture = cv2.VideoCapture( input_path )
+        if not( capture.isOpened() ):
+            raise IOError( "can't open video : {}".format(input_path) )
+
+        n_frames = int( capture.get(cv2.CAP_PROP_FRAME_COUNT) )
+        frame_size = ( int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)) )
+        if( fps is None ):
+            fps = capture.get(cv2.CAP_PROP_FPS)
+
+        fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+        writer = cv2.VideoWriter( output_path, fourcc, fps, frame_size )
+
+        self.input_queue = queue.Queue( self.max_queue_size )
+        self.output_queue = queue.Queue( self.max_queue_size )
+        self.stop_event = threading.Event()
+        self.errors = []
+        self.timers = { "decode" : StageTimer(), "inference" : StageTimer(), "encode" : StageTimer() }
+
+        reader_thread = threading.Thread( target = self.reader_loop, args = (capture,), daemon = True )
+        writer_thread = threading.Thread( target = self.writer_loop, args = (writer, frame_size), daemon = True )
+
+        start_time = time.time()
+        reader_thread.start()
+        writer_thread.start()
+        try:
+            with tqdm( total = n_frames, desc = "video inference" ) as pbar:
+                while True:
+                    frames = self.get( self.input_queue )
+                    if( frames is None ):
+                        break
+
+                    inference_start_time = time.time()
+                    outputs = self.inference( frames )
+                    self.timers["inference"].update( time.time() - inference_start_time, len(frames) )
+
+                    if not( self.put( self.output_queue, outputs ) ):
+                        break
+                    pbar.update( len(frames) )
+
+            self.put( self.output_queue, None )
+            writer_thread.join()
+        finally:
+            self.stop_event.set()
+            reader_thread.join()
+            writer_thread.join()
+            capture.release()
+            writer.release()
+
+        if( len(self.errors) > 0 ):
+            raise self.errors[0]
+
+        elapsed = time.time() - start_time
+        stats = { "n_frames" : self.timers["encode"].n_frames, "fps" : self.timers["encode"].n_frames / max(elapsed, 1e-8) }
+        for name, timer in self.timers.items():
+            for key, value in timer.report().items():
+                stats["{}_{}".format(name, key)] = value
+
+        return stats
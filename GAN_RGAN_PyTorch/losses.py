@@ -1,3 +1,5 @@
+import time
+
 import torch
 import torch.nn as nn
 
@@ -50,3 +52,87 @@ def calc_gradient_penalty(netD, real_data, fake_data, device, type='mixed', cons
     """
     
     return gradient_penalty_loss
+
+
+def calc_r1_penalty(netD, real_data, device, lambda_r1=10.0):
+    """Calculate the R1 regularization loss on real images https://arxiv.org/abs/1801.04406
+    Arguments:
+        netD (network)              -- discriminator network
+        real_data (tensor array)    -- real images
+        device (str)                -- GPU / CPU
+        lambda_r1 (float)           -- weight for this loss ( lambda_r1 / 2 * E[ ||grad D(x)||_2^2 ] )
+    Returns the R1 penalty loss
+    """
+    real_data = real_data.detach().requires_grad_(True)
+    disc_real = netD(real_data)
+
+    gradients = torch.autograd.grad(
+        outputs=disc_real.sum(), inputs=real_data,
+        create_graph=True, retain_graph=True, only_inputs=True
+    )
+    gradients = gradients[0].view(real_data.size(0), -1)  # flat the data
+    r1_penalty_loss = gradients.pow(2).sum(dim=1).mean() * lambda_r1 * 0.5
+    return r1_penalty_loss
+
+
+class LazyGradientPenalty(object):
+    """
+    勾配ペナルティー（WGAN-GP の GP / 本物画像に対する R1）を reg_interval 回のクリティック更新毎にのみ計算する lazy regularization。
+    StyleGAN2 と同様に、ペナルティーを計算するステップでは係数を reg_interval 倍して、平均的な正則化の強さを保つ。
+    measure_interval > 0 の場合は、ペナルティーの計算 measure_interval 回毎に、ペナルティーの計算処理のみの時間を計測する
+    （計測する回のみ前後で GPU の同期をとるため、計測しない回の学習速度には影響しない）
+    """
+    def __init__(self, device, penalty_type='gp', lambda_gp=10.0, reg_interval=1, constant=1.0, measure_interval=0):
+        self.device = device
+        self.penalty_type = penalty_type
+        self.lambda_gp = lambda_gp
+        self.reg_interval = max(reg_interval, 1)
+        self.constant = constant
+        self.measure_interval = measure_interval
+
+        self.n_calls = 0
+        self.n_reg_calls = 0
+        self.last_penalty = 0.0             # 最後に計算したペナルティーの値
+        self.time_penalty, self.n_measured = 0.0, 0
+        return
+
+    def synchronize(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+        return
+
+    def __call__(self, netD, real_data, fake_data):
+        reg_step = ( self.n_calls % self.reg_interval == 0 )
+        self.n_calls += 1
+        if not reg_step:
+            return torch.zeros((), device=self.device)
+
+        measure = ( self.measure_interval > 0 and self.n_reg_calls % self.measure_interval == 0 )
+        self.n_reg_calls += 1
+        if measure:
+            self.synchronize()
+            start_time = time.time()
+
+        if self.penalty_type == 'gp':
+            penalty_loss = calc_gradient_penalty(netD, real_data, fake_data, self.device, 'mixed', self.constant, self.lambda_gp * self.reg_interval)
+        elif self.penalty_type == 'r1':
+            penalty_loss = calc_r1_penalty(netD, real_data, self.device, self.lambda_gp * self.reg_interval)
+        else:
+            raise NotImplementedError('{} not implemented'.format(self.penalty_type))
+
+        if measure:
+            self.synchronize()
+            self.time_penalty += time.time() - start_time
+            self.n_measured += 1
+
+        self.last_penalty = penalty_loss.detach() / self.reg_interval
+        return penalty_loss
+
+    def penalty_cost(self):
+        """
+        ペナルティー 1 回あたりの計算時間（秒）と、クリティック更新 1 回あたりに換算した時間（秒）。計測していない場合は None
+        """
+        if self.n_measured == 0:
+            return None
+        cost = self.time_penalty / self.n_measured
+        return cost, cost / self.reg_interval
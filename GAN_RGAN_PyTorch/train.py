@@ -19,6 +19,7 @@ from tensorboardX import SummaryWriter
 
 # 自作クラス
 from networks import Generator, Discriminator, PatchGANDiscriminator
+from losses import LazyGradientPenalty
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 from utils import save_image_historys_gif
@@ -49,7 +50,10 @@ if __name__ == '__main__':
     parser.add_argument('--n_input_noize_z', type=int, default=100, help="生成器に入力するノイズ z の次数")
     parser.add_argument('--gan_type', choices=['RSGAN','RaSGAN','RaLSGAN',], default="RSGAN", help="GAN の種類")
     #parser.add_argument('--gan_type', choices=['RSGAN','RSGAN-GP','RaSGAN','RaLSGAN','RaSGAN-GP' ], default="RSGAN", help="GAN の種類")
-    #parser.add_argument('--lambda_wgangp', type=float, default=10.0, help="WAGAN-GP の勾配ペナルティー係数")
+    parser.add_argument('--gp_type', choices=['none','gp','r1'], default="none", help="識別器の勾配ペナルティーの種類（gp : WGAN-GP / r1 : 本物画像に対する R1）")
+    parser.add_argument('--lambda_wgangp', type=float, default=10.0, help="勾配ペナルティー係数")
+    parser.add_argument('--gp_interval', type=int, default=1, help="勾配ペナルティーを計算する識別器の更新間隔（lazy regularization / 1 で毎回計算）")
+    parser.add_argument('--gp_cost_interval', type=int, default=0, help="勾配ペナルティーの計算時間を計測する間隔（ペナルティーの計算 N 回毎 / 0 で計測しない）")
     parser.add_argument('--networkD_type', choices=['vanilla','PatchGAN' ], default="vanilla", help="GAN の識別器の種類")
     parser.add_argument('--n_critic', type=int, default=1, help="クリティックの更新回数")
     parser.add_argument('--n_display_step', type=int, default=50, help="tensorboard への表示間隔")
@@ -310,6 +314,9 @@ if __name__ == '__main__':
         # vanilla GAN
         loss_fn = nn.BCEWithLogitsLoss()
 
+    if( args.gp_type != "none" ):
+        loss_gp_fn = LazyGradientPenalty( device, penalty_type = args.gp_type, lambda_gp = args.lambda_wgangp, reg_interval = args.gp_interval, measure_interval = args.gp_cost_interval )
+
     #======================================================================
     # モデルの学習処理
     #======================================================================
@@ -396,6 +403,11 @@ if __name__ == '__main__':
                     # vanilla GAN
                     loss_D = loss_fn( D_x, real_ones_tsr ) + loss_fn( D_G_z, fake_zeros_tsr )
 
+                # 勾配ペナルティー / gp_interval 回毎にのみ計算
+                if( args.gp_type != "none" ):
+                    gradient_penalty_loss = loss_gp_fn( model_D, images, G_z )
+                    loss_D = loss_D + gradient_penalty_loss
+
                 #----------------------------------------------------
                 # ネットワークの更新処理
                 #----------------------------------------------------
@@ -466,6 +478,18 @@ if __name__ == '__main__':
                 board_train.add_scalar('Discriminator/loss_D', loss_D.item(), iterations)
                 board_add_image(board_train, 'fake image', G_z, iterations)
                 print( "epoch={}, iters={}, loss_G={:.5f}, loss_D={:.5f}".format(epoch, iterations, loss_G, loss_D) )
+                if( args.gp_type != "none" ):
+                    board_train.add_scalar('Discriminator/gradient_penalty', float(loss_gp_fn.last_penalty), iterations)
+                    board_train.add_scalar('Discriminator/gradient_penalty_interval', args.gp_interval, iterations)
+                    print( "epoch={}, iters={}, gradient_penalty={:.5f} ({}, interval={})".format(epoch, iterations, float(loss_gp_fn.last_penalty), args.gp_type, args.gp_interval) )
+
+                    # 勾配ペナルティーの計算時間（--gp_cost_interval で計測した場合のみ）
+                    gp_cost = loss_gp_fn.penalty_cost()
+                    if( gp_cost is not None ):
+                        gp_cost, gp_cost_per_step = gp_cost
+                        board_train.add_scalar('Discriminator/gradient_penalty_cost_ms', gp_cost * 1000, iterations)
+                        board_train.add_scalar('Discriminator/gradient_penalty_cost_per_step_ms', gp_cost_per_step * 1000, iterations)
+                        print( "epoch={}, iters={}, gp_cost={:.3f}ms, gp_cost_per_step={:.3f}ms".format(epoch, iterations, gp_cost * 1000, gp_cost_per_step * 1000) )
 
             #====================================================
             # test loss の表示
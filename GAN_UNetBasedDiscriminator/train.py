@@ -23,11 +23,13 @@ from tensorboardX import SummaryWriter
 # 自作モジュール
 from data.zalando_dataset import ZalandoDataset
 from data.transforms.cutmix import CutMix
+from data.prefetcher import DevicePrefetcher
 from models.generators import Pix2PixHDGenerator, UNetGenerator
 from models.discriminators import PatchGANDiscriminator, UNetDiscriminator
 from models.losses import VGGLoss, LSGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.gan_step import RequiresGradSwitch, forward_D_fused, StepPerfMeter
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -50,6 +52,8 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_l1', type=float, default=10.0, help="L1損失関数の係数値")
     parser.add_argument('--lambda_vgg', type=float, default=10.0, help="VGG perceptual loss の係数値")
     parser.add_argument('--lambda_adv', type=float, default=1.0, help="Adv loss の係数値")
+    parser.add_argument('--d_forward_type', choices=['fused','separate'], default="fused", help="識別器の本物画像・偽物画像の forward 方法（fused : 結合した 1 つのバッチで forward）")
+    parser.add_argument('--d_bn_mode', choices=['per_half','joint'], default="per_half", help="fused 時の識別器内の BatchNorm の正規化方法（per_half : 本物画像・偽物画像毎に正規化）")
     parser.add_argument("--n_diaplay_step", type=int, default=100,)
     parser.add_argument('--n_display_valid_step', type=int, default=500, help="valid データの tensorboard への表示間隔")
     parser.add_argument("--n_save_epoches", type=int, default=1000,)
@@ -59,6 +63,8 @@ if __name__ == '__main__':
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
+    parser.add_argument('--prefetch', action='store_true', help="次のミニバッチの device への転送を学習ステップの計算と並行して行う（GPU : 別の CUDA stream, CPU : バックグラウンドのスレッド）")
+    parser.add_argument('--channels_last', action='store_true', help="モデルと入力画像を channels_last のメモリ配置にする")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
@@ -145,6 +151,10 @@ if __name__ == '__main__':
     if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
         load_checkpoint(model_G, device, args.load_checkpoints_path )
 
+    if( args.channels_last ):
+        model_G = model_G.to( memory_format = torch.channels_last )
+        model_D = model_D.to( memory_format = torch.channels_last )
+
     if( args.debug ):
         print( "model_G\n", model_G )
         print( "model_D\n", model_D )
@@ -155,6 +165,10 @@ if __name__ == '__main__':
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # 識別器のパラメーターの勾配計算の切り替え / 学習ステップの処理時間・メモリ使用量の計測
+    requires_grad_D = RequiresGradSwitch( model_D )
+    perf_meter = StepPerfMeter( device )
+
     #================================
     # loss 関数の設定
     #================================
@@ -173,299 +187,331 @@ if __name__ == '__main__':
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
-            model_G.train()
-            model_D.train()
-
-            # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["image_s"].shape[0] != args.batch_size:
-                break
-
-            # ミニバッチデータを GPU へ転送
-            image_s = inputs["image_s"].to(device)
-            image_t_gt = inputs["image_t_gt"].to(device)
-            if( args.debug and n_print > 0):
-                print( "[image_s] shape={}, dtype={}, min={}, max={}".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s)) )
-                print( "[image_t_gt] shape={}, dtype={}, min={}, max={}".format(image_t_gt.shape, image_t_gt.dtype, torch.min(image_t_gt), torch.max(image_t_gt)) )
-
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            output = model_G( image_s )
-            if( args.debug and n_print > 0 ):
-                print( "output.shape : ", output.shape )
-
-            # cutmix
-            seed_cutmix = random.randint(0,10000)
-            cutmix_fn.set_seed(seed_cutmix)
-            output_mix, _ = cutmix_fn(output, image_t_gt)
-
-            #----------------------------------------------------
-            # 識別器の更新処理
-            #----------------------------------------------------
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
-
-            # 学習用データをモデルに流し込む
-            if( args.net_D_type == "patchgan" ):
-                d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
+        # 次のミニバッチを先読みして device に転送する（転送済みの Tensor の .to(device) は何もしない）
+        if( args.prefetch ):
+            dloader_train_iter = DevicePrefetcher( dloader_train, device, channels_last = args.channels_last )
+        else:
+            dloader_train_iter = dloader_train
+
+        # break で最後のミニバッチを読み飛ばした場合や例外の発生時にも、先読み用のスレッドを終了させる
+        try:
+            for iter, inputs in enumerate( tqdm( dloader_train_iter, desc = "epoch={}".format(epoch) ) ):
+                model_G.train()
+                model_D.train()
+
+                # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                if inputs["image_s"].shape[0] != args.batch_size:
+                    break
+
+                # ミニバッチデータを GPU へ転送
+                image_s = inputs["image_s"].to(device)
+                image_t_gt = inputs["image_t_gt"].to(device)
+                if( args.channels_last ):
+                    image_s = image_s.contiguous( memory_format = torch.channels_last )
+                    image_t_gt = image_t_gt.contiguous( memory_format = torch.channels_last )
+                if( args.debug and n_print > 0):
+                    print( "[image_s] shape={}, dtype={}, min={}, max={}".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s)) )
+                    print( "[image_t_gt] shape={}, dtype={}, min={}, max={}".format(image_t_gt.shape, image_t_gt.dtype, torch.min(image_t_gt), torch.max(image_t_gt)) )
+
+                #----------------------------------------------------
+                # 生成器 の forword 処理
+                #----------------------------------------------------
+                output = model_G( image_s )
                 if( args.debug and n_print > 0 ):
-                    print( "d_real.shape :", d_real.shape )
-                    print( "d_real.shape :", d_real.shape )
-            elif( args.net_D_type == "unet" ):
-                d_real_encode, d_real_decode = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                d_fake_encode, d_fake_decode = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                d_mix_encode, d_mix_decode = model_D( torch.cat([image_s, output_mix.detach()], dim=1) )
+                    print( "output.shape : ", output.shape )
 
                 # cutmix
+                seed_cutmix = random.randint(0,10000)
                 cutmix_fn.set_seed(seed_cutmix)
-                d_fake_decode_mix, _ = cutmix_fn(d_fake_decode, d_real_decode)
-                if( args.debug and n_print > 0 ):
-                    print( "d_real_encode.shape :", d_real_encode.shape )
-                    print( "d_real_decode.shape :", d_real_decode.shape )
-                    print( "d_fake_encode.shape :", d_fake_encode.shape )
-                    print( "d_fake_decode.shape :", d_fake_decode.shape )
-                    print( "d_mix_encode.shape :", d_mix_encode.shape )
-                    print( "d_mix_decode.shape :", d_mix_decode.shape )
-            else:
-                NotImplementedError()
+                output_mix, _ = cutmix_fn(output, image_t_gt)
+
+                #----------------------------------------------------
+                # 識別器の更新処理
+                #----------------------------------------------------
+                # 無効化していた識別器 D のネットワークの勾配計算を有効化。
+                requires_grad_D.set(True)
+
+                # 学習用データをモデルに流し込む
+                # （識別器への入力を結合した 1 つのバッチで forward）
+                if( args.net_D_type == "patchgan" ):
+                    d_real, d_fake = forward_D_fused(
+                        model_D, [ torch.cat([image_s, image_t_gt], dim=1), torch.cat([image_s, output.detach()], dim=1) ],
+                        fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                    )
+                    if( args.debug and n_print > 0 ):
+                        print( "d_real.shape :", d_real.shape )
+                        print( "d_real.shape :", d_real.shape )
+                elif( args.net_D_type == "unet" ):
+                    (d_real_encode, d_real_decode), (d_fake_encode, d_fake_decode), (d_mix_encode, d_mix_decode) = forward_D_fused(
+                        model_D, [ torch.cat([image_s, image_t_gt], dim=1), torch.cat([image_s, output.detach()], dim=1), torch.cat([image_s, output_mix.detach()], dim=1) ],
+                        fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                    )
+
+                    # cutmix
+                    cutmix_fn.set_seed(seed_cutmix)
+                    d_fake_decode_mix, _ = cutmix_fn(d_fake_decode, d_real_decode)
+                    if( args.debug and n_print > 0 ):
+                        print( "d_real_encode.shape :", d_real_encode.shape )
+                        print( "d_real_decode.shape :", d_real_decode.shape )
+                        print( "d_fake_encode.shape :", d_fake_encode.shape )
+                        print( "d_fake_decode.shape :", d_fake_decode.shape )
+                        print( "d_mix_encode.shape :", d_mix_encode.shape )
+                        print( "d_mix_decode.shape :", d_mix_decode.shape )
+                else:
+                    NotImplementedError()
             
-            # 損失関数を計算する
-            if( args.net_D_type == "patchgan" ):
-                loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-            elif( args.net_D_type == "unet" ):
-                loss_D_encode, loss_D_real_encode, loss_D_fake_encode = loss_adv_fn.forward_D( d_real_encode, d_fake_encode )
-                loss_D_decode, loss_D_real_decode, loss_D_fake_decode = loss_adv_fn.forward_D( d_fake_encode, d_fake_decode )
-                loss_D_const = loss_const_fn( d_mix_decode, d_fake_decode_mix )
-                loss_D = loss_D_encode + loss_D_decode + loss_D_const
-            else:
-                NotImplementedError()
-
-            # ネットワークの更新処理
-            optimizer_D.zero_grad()
-            loss_D.backward(retain_graph=True)
-            optimizer_D.step()
-
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
-
-            #----------------------------------------------------
-            # 生成器の更新処理
-            #----------------------------------------------------
-            # 損失関数を計算する
-            loss_l1 = loss_l1_fn( image_t_gt, output )
-            loss_vgg = loss_vgg_fn( image_t_gt, output )
-            if( args.net_D_type == "patchgan" ):
-                loss_adv = loss_adv_fn.forward_G( d_fake )
-            elif( args.net_D_type == "unet" ):
-                loss_adv_encode = loss_adv_fn.forward_G( d_fake_encode )
-                loss_adv_decode = loss_adv_fn.forward_G( d_fake_decode )
-            else:
-                NotImplementedError()
-
-            if( args.net_D_type == "patchgan" ):
-                loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-            elif( args.net_D_type == "unet" ):
-                loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * ( loss_adv_encode + loss_adv_decode )
-            else:
-                NotImplementedError()
-
-            # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            loss_G.backward()
-            optimizer_G.step()
-
-            #====================================================
-            # 学習過程の表示
-            #====================================================
-            if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
-                # lr
-                for param_group in optimizer_G.param_groups:
-                    lr = param_group['lr']
-
-                board_train.add_scalar('lr/learning rate', lr, step )
-
-                # loss
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
-                board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
+                # 損失関数を計算する
                 if( args.net_D_type == "patchgan" ):
-                    board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
+                    loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
                 elif( args.net_D_type == "unet" ):
-                    board_train.add_scalar('G/loss_adv_encode', loss_adv_encode.item(), step)
-                    board_train.add_scalar('G/loss_adv_decode', loss_adv_decode.item(), step)
-
+                    loss_D_encode, loss_D_real_encode, loss_D_fake_encode = loss_adv_fn.forward_D( d_real_encode, d_fake_encode )
+                    loss_D_decode, loss_D_real_decode, loss_D_fake_decode = loss_adv_fn.forward_D( d_fake_encode, d_fake_decode )
+                    loss_D_const = loss_const_fn( d_mix_decode, d_fake_decode_mix )
+                    loss_D = loss_D_encode + loss_D_decode + loss_D_const
+                else:
+                    NotImplementedError()
+
+                # ネットワークの更新処理
+                optimizer_D.zero_grad()
+                loss_D.backward()
+                optimizer_D.step()
+
+                # 識別器 D のネットワークの勾配計算を無効化。
+                requires_grad_D.set(False)
+
+                #----------------------------------------------------
+                # 生成器の更新処理
+                #----------------------------------------------------
+                # 更新後の識別器での偽物画像の出力（生成器へ勾配を伝搬させるため、output は detach しない）
                 if( args.net_D_type == "patchgan" ):
-                    board_train.add_scalar('D/loss_D', loss_D.item(), step)
-                    board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
-                    board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
+                    d_fake = model_D( torch.cat([image_s, output], dim=1) )
                 elif( args.net_D_type == "unet" ):
-                    board_train.add_scalar('D/loss_D', loss_D.item(), step)
-                    board_train.add_scalar('D/loss_D_encode', loss_D_encode.item(), step)
-                    board_train.add_scalar('D/loss_D_real_encode', loss_D_real_encode.item(), step)
-                    board_train.add_scalar('D/loss_D_fake_encode', loss_D_fake_encode.item(), step)
-                    board_train.add_scalar('D/loss_D_decode', loss_D_decode.item(), step)
-                    board_train.add_scalar('D/loss_D_real_decode', loss_D_real_decode.item(), step)
-                    board_train.add_scalar('D/loss_D_fake_decode', loss_D_fake_decode.item(), step)
-                    board_train.add_scalar('D/loss_D_const', loss_D_const.item(), step)
+                    d_fake_encode, d_fake_decode = model_D( torch.cat([image_s, output], dim=1) )
+                else:
+                    NotImplementedError()
 
+                # 損失関数を計算する
+                loss_l1 = loss_l1_fn( image_t_gt, output )
+                loss_vgg = loss_vgg_fn( image_t_gt, output )
                 if( args.net_D_type == "patchgan" ):
-                    print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
-                    print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item(),) )
+                    loss_adv = loss_adv_fn.forward_G( d_fake )
                 elif( args.net_D_type == "unet" ):
-                    print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv_encode={:.5f}, loss_adv_decode={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv_encode.item(), loss_adv_decode.item()) )
-                    print( "step={}, loss_D={:.5f}, loss_D_encode={:.5f}, loss_D_real_encode={:.5f}, loss_D_fake_encode={:.5f}, loss_D_const={:.5f}".format(step, loss_D.item(), loss_D_encode.item(), loss_D_real_encode.item(), loss_D_fake_encode.item(), loss_D_decode.item(), loss_D_real_decode.item(), loss_D_fake_decode.item(), loss_D_const.item()) )
+                    loss_adv_encode = loss_adv_fn.forward_G( d_fake_encode )
+                    loss_adv_decode = loss_adv_fn.forward_G( d_fake_decode )
+                else:
+                    NotImplementedError()
 
-                # visual images
                 if( args.net_D_type == "patchgan" ):
-                    visuals = [
-                        [ image_s.detach(), image_t_gt.detach(), output.detach() ],
-                    ]
+                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
                 elif( args.net_D_type == "unet" ):
-                    zeros_tsr = torch.zeros( (1, 1, args.image_height, args.image_width) ).to(device)
-                    visuals = [
-                        [ image_s.detach(), image_t_gt.detach(), output.detach(),       d_real_decode.detach(), d_fake_decode.detach()      ],
-                        [ zeros_tsr,        zeros_tsr,           output_mix.detach(),   d_mix_decode.detach(),  d_fake_decode_mix.detach()  ]
-                    ]
-
-                board_add_images(board_train, 'train', visuals, step+1)
-
-            #====================================================
-            # valid データでの処理
-            #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total, loss_adv_encode_total, loss_adv_decode_total = 0, 0, 0, 0, 0, 0
-                loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
-                loss_D_encode_total, loss_D_real_encode_total, loss_D_fake_encode_total, loss_D_decode_total, loss_D_real_decode_total, loss_D_fake_decode_total, loss_D_const_total = 0, 0, 0, 0, 0, 0, 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()            
-                    model_D.eval()
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s = inputs["image_s"].to(device)
-                    image_t_gt = inputs["image_t_gt"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output = model_G( image_s )
-
-                        # cutmix
-                        seed_cutmix = random.randint(0,10000)
-                        cutmix_fn.set_seed(seed_cutmix)
-                        output_mix, _ = cutmix_fn(output, image_t_gt)
-
-                    with torch.no_grad():
-                        if( args.net_D_type == "patchgan" ):
-                            d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                            d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                        elif( args.net_D_type == "unet" ):
-                            d_real_encode, d_real_decode = model_D( torch.cat([image_s, image_t_gt], dim=1) )
-                            d_fake_encode, d_fake_decode = model_D( torch.cat([image_s, output.detach()], dim=1) )
-                            d_mix_encode, d_mix_decode = model_D( torch.cat([image_s, output_mix.detach()], dim=1) )
-
-                            # cutmix
-                            cutmix_fn.set_seed(seed_cutmix)
-                            d_fake_decode_mix, _ = cutmix_fn(d_fake_decode, d_real_decode)
-                        else:
-                            NotImplementedError()
-
-                    # 損失関数を計算する
-                    loss_l1 = loss_l1_fn( image_t_gt, output )
-                    loss_vgg = loss_vgg_fn( image_t_gt, output )
+                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * ( loss_adv_encode + loss_adv_decode )
+                else:
+                    NotImplementedError()
+
+                # ネットワークの更新処理
+                optimizer_G.zero_grad()
+                loss_G.backward()
+                optimizer_G.step()
+                perf_meter.update()
+
+                #====================================================
+                # 学習過程の表示
+                #====================================================
+                if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
+                    # lr
+                    for param_group in optimizer_G.param_groups:
+                        lr = param_group['lr']
+
+                    board_train.add_scalar('lr/learning rate', lr, step )
+
+                    # loss
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
+                    board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
                     if( args.net_D_type == "patchgan" ):
-                        loss_adv = loss_adv_fn.forward_G( d_fake )
+                        board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
                     elif( args.net_D_type == "unet" ):
-                        loss_adv_encode = loss_adv_fn.forward_G( d_fake_encode )
-                        loss_adv_decode = loss_adv_fn.forward_G( d_fake_decode )
+                        board_train.add_scalar('G/loss_adv_encode', loss_adv_encode.item(), step)
+                        board_train.add_scalar('G/loss_adv_decode', loss_adv_decode.item(), step)
 
                     if( args.net_D_type == "patchgan" ):
-                        loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+                        board_train.add_scalar('D/loss_D', loss_D.item(), step)
+                        board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
+                        board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
                     elif( args.net_D_type == "unet" ):
-                        loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * (loss_adv_encode + loss_adv_decode)
+                        board_train.add_scalar('D/loss_D', loss_D.item(), step)
+                        board_train.add_scalar('D/loss_D_encode', loss_D_encode.item(), step)
+                        board_train.add_scalar('D/loss_D_real_encode', loss_D_real_encode.item(), step)
+                        board_train.add_scalar('D/loss_D_fake_encode', loss_D_fake_encode.item(), step)
+                        board_train.add_scalar('D/loss_D_decode', loss_D_decode.item(), step)
+                        board_train.add_scalar('D/loss_D_real_decode', loss_D_real_decode.item(), step)
+                        board_train.add_scalar('D/loss_D_fake_decode', loss_D_fake_decode.item(), step)
+                        board_train.add_scalar('D/loss_D_const', loss_D_const.item(), step)
+
+                    # 学習ステップの処理時間・ピークメモリ使用量
+                    step_time, max_memory = perf_meter.report()
+                    board_train.add_scalar('perf/step_time_ms', step_time, step)
+                    board_train.add_scalar('perf/max_memory_allocated_MB', max_memory, step)
 
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
                     if( args.net_D_type == "patchgan" ):
-                        loss_adv_total += loss_adv
+                        print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
+                        print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item(),) )
                     elif( args.net_D_type == "unet" ):
-                        loss_adv_encode_total += loss_adv_encode
-                        loss_adv_decode_total += loss_adv_decode
-                    loss_G_total += loss_G
+                        print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv_encode={:.5f}, loss_adv_decode={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv_encode.item(), loss_adv_decode.item()) )
+                        print( "step={}, loss_D={:.5f}, loss_D_encode={:.5f}, loss_D_real_encode={:.5f}, loss_D_fake_encode={:.5f}, loss_D_const={:.5f}".format(step, loss_D.item(), loss_D_encode.item(), loss_D_real_encode.item(), loss_D_fake_encode.item(), loss_D_decode.item(), loss_D_real_decode.item(), loss_D_fake_decode.item(), loss_D_const.item()) )
 
-                    if( args.net_D_type == "patchgan" ):
-                        loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-                    elif( args.net_D_type == "unet" ):
-                        loss_D_encode, loss_D_real_encode, loss_D_fake_encode = loss_adv_fn.forward_D( d_real_encode, d_fake_encode )
-                        loss_D_decode, loss_D_real_decode, loss_D_fake_decode = loss_adv_fn.forward_D( d_fake_encode, d_fake_decode )
-                        loss_D_const = loss_const_fn( d_mix_decode, d_fake_decode_mix )
-                        loss_D = loss_D_encode + loss_D_decode + loss_D_const
+                    print( "step={}, step_time={:.2f}ms, max_memory_allocated={:.1f}MB".format(step, step_time, max_memory) )
 
+                    # visual images
                     if( args.net_D_type == "patchgan" ):
-                        loss_D_total += loss_D
-                        loss_D_real_total += loss_D_real
-                        loss_D_fake_total += loss_D_fake
+                        visuals = [
+                            [ image_s.detach(), image_t_gt.detach(), output.detach() ],
+                        ]
                     elif( args.net_D_type == "unet" ):
-                        loss_D_total += loss_D
-                        loss_D_encode_total += loss_D_encode
-                        loss_D_real_encode_total += loss_D_real_encode
-                        loss_D_fake_encode_total += loss_D_fake_encode
-                        loss_D_decode_total += loss_D_decode
-                        loss_D_real_decode_total += loss_D_real_decode
-                        loss_D_fake_decode_total += loss_D_fake_decode
-                        loss_D_const_total += loss_D_const
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
+                        zeros_tsr = torch.zeros( (1, 1, args.image_height, args.image_width) ).to(device)
+                        visuals = [
+                            [ image_s.detach(), image_t_gt.detach(), output.detach(),       d_real_decode.detach(), d_fake_decode.detach()      ],
+                            [ zeros_tsr,        zeros_tsr,           output_mix.detach(),   d_mix_decode.detach(),  d_fake_decode_mix.detach()  ]
+                        ]
+
+                    board_add_images(board_train, 'train', visuals, step+1)
+
+                #====================================================
+                # valid データでの処理
+                #====================================================
+                if( step % args.n_display_valid_step == 0 ):
+                    loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total, loss_adv_encode_total, loss_adv_decode_total = 0, 0, 0, 0, 0, 0
+                    loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
+                    loss_D_encode_total, loss_D_real_encode_total, loss_D_fake_encode_total, loss_D_decode_total, loss_D_real_decode_total, loss_D_fake_decode_total, loss_D_const_total = 0, 0, 0, 0, 0, 0, 0
+                    n_valid_loop = 0
+                    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
+                        model_G.eval()            
+                        model_D.eval()
+
+                        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                        if inputs["image_s"].shape[0] != args.batch_size_valid:
+                            break
+
+                        # ミニバッチデータを GPU へ転送
+                        image_s = inputs["image_s"].to(device)
+                        image_t_gt = inputs["image_t_gt"].to(device)
+
+                        # 推論処理
+                        with torch.no_grad():
+                            output = model_G( image_s )
+
+                            # cutmix
+                            seed_cutmix = random.randint(0,10000)
+                            cutmix_fn.set_seed(seed_cutmix)
+                            output_mix, _ = cutmix_fn(output, image_t_gt)
+
+                        with torch.no_grad():
+                            if( args.net_D_type == "patchgan" ):
+                                d_real = model_D( torch.cat([image_s, image_t_gt], dim=1) )
+                                d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
+                            elif( args.net_D_type == "unet" ):
+                                d_real_encode, d_real_decode = model_D( torch.cat([image_s, image_t_gt], dim=1) )
+                                d_fake_encode, d_fake_decode = model_D( torch.cat([image_s, output.detach()], dim=1) )
+                                d_mix_encode, d_mix_decode = model_D( torch.cat([image_s, output_mix.detach()], dim=1) )
+
+                                # cutmix
+                                cutmix_fn.set_seed(seed_cutmix)
+                                d_fake_decode_mix, _ = cutmix_fn(d_fake_decode, d_real_decode)
+                            else:
+                                NotImplementedError()
+
+                        # 損失関数を計算する
+                        loss_l1 = loss_l1_fn( image_t_gt, output )
+                        loss_vgg = loss_vgg_fn( image_t_gt, output )
                         if( args.net_D_type == "patchgan" ):
-                            visuals = [
-                                [ image_s.detach(), image_t_gt.detach(), output.detach() ],
-                            ]
+                            loss_adv = loss_adv_fn.forward_G( d_fake )
                         elif( args.net_D_type == "unet" ):
-                            zeros_tsr = torch.zeros( (1, 1, args.image_height, args.image_width) ).to(device)
-                            visuals = [
-                                [ image_s.detach(), image_t_gt.detach(), output.detach(),       d_real_decode.detach(), d_fake_decode.detach()      ],
-                                [ zeros_tsr,        zeros_tsr,           output_mix.detach(),   d_mix_decode.detach(),  d_fake_decode_mix.detach()  ]
-                            ]
+                            loss_adv_encode = loss_adv_fn.forward_G( d_fake_encode )
+                            loss_adv_decode = loss_adv_fn.forward_G( d_fake_decode )
 
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+                        if( args.net_D_type == "patchgan" ):
+                            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+                        elif( args.net_D_type == "unet" ):
+                            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * (loss_adv_encode + loss_adv_decode)
 
-                    n_valid_loop += 1
+                        loss_l1_total += loss_l1
+                        loss_vgg_total += loss_vgg
+                        if( args.net_D_type == "patchgan" ):
+                            loss_adv_total += loss_adv
+                        elif( args.net_D_type == "unet" ):
+                            loss_adv_encode_total += loss_adv_encode
+                            loss_adv_decode_total += loss_adv_decode
+                        loss_G_total += loss_G
 
-                # loss 値表示
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-                if( args.net_D_type == "patchgan" ):
-                    board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
-                elif( args.net_D_type == "unet" ):
-                    board_valid.add_scalar('G/loss_adv_encode', loss_adv_encode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('G/loss_adv_decode', loss_adv_decode_total.item()/n_valid_loop, step)
+                        if( args.net_D_type == "patchgan" ):
+                            loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+                        elif( args.net_D_type == "unet" ):
+                            loss_D_encode, loss_D_real_encode, loss_D_fake_encode = loss_adv_fn.forward_D( d_real_encode, d_fake_encode )
+                            loss_D_decode, loss_D_real_decode, loss_D_fake_decode = loss_adv_fn.forward_D( d_fake_encode, d_fake_decode )
+                            loss_D_const = loss_const_fn( d_mix_decode, d_fake_decode_mix )
+                            loss_D = loss_D_encode + loss_D_decode + loss_D_const
 
-                if( args.net_D_type == "patchgan" ):
-                    board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
-                elif( args.net_D_type == "unet" ):
-                    board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_encode', loss_D_encode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_real_encode', loss_D_real_encode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_fake_encode', loss_D_fake_encode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_decode', loss_D_decode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_real_decode', loss_D_real_decode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_fake_decode', loss_D_fake_decode_total.item()/n_valid_loop, step)
-                    board_valid.add_scalar('D/loss_D_const', loss_D_const_total.item()/n_valid_loop, step)
-
-            step += 1
-            n_print -= 1
+                        if( args.net_D_type == "patchgan" ):
+                            loss_D_total += loss_D
+                            loss_D_real_total += loss_D_real
+                            loss_D_fake_total += loss_D_fake
+                        elif( args.net_D_type == "unet" ):
+                            loss_D_total += loss_D
+                            loss_D_encode_total += loss_D_encode
+                            loss_D_real_encode_total += loss_D_real_encode
+                            loss_D_fake_encode_total += loss_D_fake_encode
+                            loss_D_decode_total += loss_D_decode
+                            loss_D_real_decode_total += loss_D_real_decode
+                            loss_D_fake_decode_total += loss_D_fake_decode
+                            loss_D_const_total += loss_D_const
+
+                        # 生成画像表示
+                        if( iter <= args.n_display_valid ):
+                            # visual images
+                            if( args.net_D_type == "patchgan" ):
+                                visuals = [
+                                    [ image_s.detach(), image_t_gt.detach(), output.detach() ],
+                                ]
+                            elif( args.net_D_type == "unet" ):
+                                zeros_tsr = torch.zeros( (1, 1, args.image_height, args.image_width) ).to(device)
+                                visuals = [
+                                    [ image_s.detach(), image_t_gt.detach(), output.detach(),       d_real_decode.detach(), d_fake_decode.detach()      ],
+                                    [ zeros_tsr,        zeros_tsr,           output_mix.detach(),   d_mix_decode.detach(),  d_fake_decode_mix.detach()  ]
+                                ]
+
+                            board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
+
+                        n_valid_loop += 1
+
+                    # loss 値表示
+                    board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
+                    board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
+                    if( args.net_D_type == "patchgan" ):
+                        board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
+                    elif( args.net_D_type == "unet" ):
+                        board_valid.add_scalar('G/loss_adv_encode', loss_adv_encode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('G/loss_adv_decode', loss_adv_decode_total.item()/n_valid_loop, step)
+
+                    if( args.net_D_type == "patchgan" ):
+                        board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
+                    elif( args.net_D_type == "unet" ):
+                        board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_encode', loss_D_encode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_real_encode', loss_D_real_encode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_fake_encode', loss_D_fake_encode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_decode', loss_D_decode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_real_decode', loss_D_real_decode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_fake_decode', loss_D_fake_decode_total.item()/n_valid_loop, step)
+                        board_valid.add_scalar('D/loss_D_const', loss_D_const_total.item()/n_valid_loop, step)
+
+                step += 1
+                n_print -= 1
+        finally:
+            if( args.prefetch ):
+                dloader_train_iter.close()
 
         #====================================================
         # モデルの保存
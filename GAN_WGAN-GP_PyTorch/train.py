@@ -19,7 +19,7 @@ from tensorboardX import SummaryWriter
 
 # 自作クラス
 from networks import Generator, Discriminator, NonBatchNormDiscriminator, PatchGANDiscriminator
-from losses import calc_gradient_penalty
+from losses import calc_gradient_penalty, LazyGradientPenalty
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 from utils import save_image_historys_gif
@@ -51,6 +51,9 @@ if __name__ == '__main__':
     parser.add_argument('--networkD_type', choices=['vanilla','NonBatchNorm', 'PatchGAN' ], default="NonBatchNorm", help="GAN の識別器の種類")
     parser.add_argument('--n_critic', type=int, default=5, help="クリティックの更新回数")
     parser.add_argument('--lambda_wgangp', type=float, default=10.0, help="WAGAN-GP の勾配ペナルティー係数")
+    parser.add_argument('--gp_type', choices=['gp','r1'], default="gp", help="勾配ペナルティーの種類（gp : WGAN-GP / r1 : 本物画像に対する R1）")
+    parser.add_argument('--gp_interval', type=int, default=1, help="勾配ペナルティーを計算するクリティックの更新間隔（lazy regularization / 1 で毎回計算）")
+    parser.add_argument('--gp_cost_interval', type=int, default=0, help="勾配ペナルティーの計算時間を計測する間隔（ペナルティーの計算 N 回毎 / 0 で計測しない）")
     parser.add_argument('--n_display_step', type=int, default=100, help="tensorboard への表示間隔")
     parser.add_argument('--n_display_test_step', type=int, default=1000, help="test データの tensorboard への表示間隔")
     parser.add_argument("--n_save_step", type=int, default=5000, help="モデルのチェックポイントの保存間隔")
@@ -260,7 +263,7 @@ if __name__ == '__main__':
     #======================================================================
     # loss 関数の設定
     #======================================================================
-    pass
+    loss_gp_fn = LazyGradientPenalty( device, penalty_type = args.gp_type, lambda_gp = args.lambda_wgangp, reg_interval = args.gp_interval, measure_interval = args.gp_cost_interval )
 
     #======================================================================
     # モデルの学習処理
@@ -342,10 +345,8 @@ if __name__ == '__main__':
                 # E_z[ C(G(z) ]
                 loss_C_fake = torch.mean( C_G_z )
 
-                # WGAN-GP の勾配項（制約項）
-                gradient_penalty_loss = calc_gradient_penalty(
-                    model_D, images, G_z, device, 'mixed', 1.0, args.lambda_wgangp
-                )
+                # WGAN-GP の勾配項（制約項）/ gp_interval 回毎にのみ計算
+                gradient_penalty_loss = loss_gp_fn( model_D, images, G_z )
 
                 # クリティック C の損失関数
                 loss_C = - loss_C_real + loss_C_fake + gradient_penalty_loss
@@ -415,10 +416,20 @@ if __name__ == '__main__':
                 board_train.add_scalar('Discriminator/loss_D', loss_C.item(), iterations)
                 board_train.add_scalar('Discriminator/loss_D_real', loss_C_real.item(), iterations)
                 board_train.add_scalar('Discriminator/loss_D_fake', loss_C_fake.item(), iterations)
-                board_train.add_scalar('Discriminator/gradient_penalty', gradient_penalty_loss.item(), iterations)
+                board_train.add_scalar('Discriminator/gradient_penalty', float(loss_gp_fn.last_penalty), iterations)
+                board_train.add_scalar('Discriminator/gradient_penalty_interval', args.gp_interval, iterations)
 
                 board_add_image(board_train, 'fake image', G_z, iterations)
                 print( "epoch={}, iters={}, loss_G={:.5f}, loss_C={:.5f}".format(epoch, iterations, loss_G, loss_C) )
+                print( "epoch={}, iters={}, gradient_penalty={:.5f} ({}, interval={})".format(epoch, iterations, float(loss_gp_fn.last_penalty), args.gp_type, args.gp_interval) )
+
+                # 勾配ペナルティーの計算時間（--gp_cost_interval で計測した場合のみ）
+                gp_cost = loss_gp_fn.penalty_cost()
+                if( gp_cost is not None ):
+                    gp_cost, gp_cost_per_step = gp_cost
+                    board_train.add_scalar('Discriminator/gradient_penalty_cost_ms', gp_cost * 1000, iterations)
+                    board_train.add_scalar('Discriminator/gradient_penalty_cost_per_step_ms', gp_cost_per_step * 1000, iterations)
+                    print( "epoch={}, iters={}, gp_cost={:.3f}ms, gp_cost_per_step={:.3f}ms".format(epoch, iterations, gp_cost * 1000, gp_cost_per_step * 1000) )
 
             #====================================================
             # test loss の表示
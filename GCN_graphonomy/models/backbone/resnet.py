@@ -37,7 +37,8 @@ class Bottleneck(nn.Module):
         if self.downsample is not None:
             residual = self.downsample(x)
 
-        out += residual
+        # FX graph mode での量子化で加算を int8 にできるように in-place にはしない
+        out = out + residual
         out = self.relu(out)
 
         return out
@@ -0,0 +1,130 @@
+import os
+import argparse
+import json
+import numpy as np
+import random
+from tqdm import tqdm
+
+# sklearn
+from sklearn.model_selection import train_test_split
+
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Subset
+
+# 自作モジュール
+from dataset import CIHPDataset
+from models.graphonomy import Graphonomy
+from models.graph_params import get_graph_adj_matrix
+from utils.model_quantization import build_quantized_model, save_quantized_checkpoint, benchmark_latency, calc_confusion_matrix, calc_miou, print_quantization_report
+
+# int8 に量子化する DeepLab v3+ 部分のサブモジュール。
+# ASPP 全体は forward 内にバッチサイズでの分岐があり FX でトレースできないため、各 atrous 畳み込みの分岐を個別に量子化する。
+# グラフ畳み込み部分（GCN）は fp32 のまま
+QUANTIZED_SUBMODULE_NAMES = [ "backbone", "aspp.aspp1", "aspp.aspp2", "aspp.aspp3", "aspp.aspp4", "decoder" ]
+
+def sample_calibration_index( dataset, candidate_index, n_classes, n_per_class ):
+    """
+    各クラスが少なくとも n_per_class 枚の画像に含まれるように、キャリブレーション用の画像を選ぶ
+    """
+    n_images_per_class = np.zeros( n_classes, dtype = np.int64 )
+    calibration_index = []
+    for index in candidate_index:
+        labels = np.unique( dataset[index]["target"].long().numpy() )
+        labels = labels[ (labels >= 0) & (labels < n_classes) ]
+        if( np.any( n_images_per_class[labels] < n_per_class ) ):
+            calibration_index.append( index )
+            n_images_per_class[labels] += 1
+        if( np.all( n_images_per_class >= n_per_class ) ):
+            break
+
+    return calibration_index
+
+
+if __name__ == '__main__':
+    """
+    Graphonomy の DeepLab v3+ 部分の int8 静的量子化と、fp32 とのレイテンシー・mIoU の比較
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset_dir", type=str, default="../dataset/CIHP_4w")
+    parser.add_argument('--load_checkpoints_path', type=str, default="", help="fp32 モデルの読み込みファイルのパス")
+    parser.add_argument('--save_quantized_path', type=str, default="checkpoints/graphonomy_int8.pth", help="量子化済みモデルの保存ファイルのパス")
+    parser.add_argument('--batch_size', type=int, default=1, help="バッチサイズ")
+    parser.add_argument('--image_height', type=int, default=512, help="入力画像の高さ（pixel単位）")
+    parser.add_argument('--image_width', type=int, default=512, help="入力画像の幅（pixel単位）")
+    parser.add_argument("--n_classes_source", type=int, default=7, help="変換元のグラフ構造のクラス数")
+    parser.add_argument("--n_classes_target", type=int, default=20, help="変換先のグラフ構造のクラス数")
+    parser.add_argument("--n_node_features", type=int, default=128, help="グラフの各頂点の特徴次元")
+    parser.add_argument("--n_output_channels", type=int, default=20, help="出力データのチャンネル次元（通常クラス数）")
+    parser.add_argument("--val_rate", type=float, default=0.01)
+    parser.add_argument('--n_calibrations_per_class', type=int, default=4, help="キャリブレーションに使う画像のクラス毎の最低枚数")
+    parser.add_argument('--n_calibration_candidates', type=int, default=1000, help="キャリブレーション用の画像を選ぶ学習用データの枚数")
+    parser.add_argument('--n_evals', type=int, default=100, help="mIoU の評価に使う valid データの枚数")
+    parser.add_argument('--per_tensor', action='store_true', help="重みを per-tensor で量子化する（デフォルトは出力チャンネル毎）")
+    parser.add_argument("--seed", type=int, default=71)
+    parser.add_argument('--debug', action='store_true')
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # データセット（学習時と同じ train / valid の分割）
+    ds_train = CIHPDataset( args, args.dataset_dir, datamode = "train", flip = False, data_augument = False, debug = args.debug )
+    index = np.arange(len(ds_train))
+    train_index, valid_index = train_test_split( index, test_size=args.val_rate, random_state=args.seed )
+
+    candidate_index = np.random.permutation(train_index)[:args.n_calibration_candidates]
+    calibration_index = sample_calibration_index( ds_train, candidate_index, args.n_output_channels, args.n_calibrations_per_class )
+    print( "n_calibrations : ", len(calibration_index) )
+    dloader_calibration = DataLoader( Subset(ds_train, calibration_index), batch_size = args.batch_size, shuffle = False )
+    dloader_eval = DataLoader( Subset(ds_train, valid_index[:args.n_evals]), batch_size = args.batch_size, shuffle = False )
+
+    # fp32 のモデル
+    model_G = Graphonomy( n_in_channels = 3, n_classes_source = args.n_classes_source, n_classes_target = args.n_classes_target, n_node_features = args.n_node_features, n_output_channels = args.n_output_channels )
+    if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
+        model_G.load_state_dict( torch.load(args.load_checkpoints_path, map_location = "cpu") )
+    model_G.eval()
+
+    # 定義済みグラフ構造の取得
+    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = get_graph_adj_matrix()
+    adj_matrix_pascal_to_cihp = adj_matrix_cihp_to_pascal.transpose(2,3)
+    adj_matrixes = ( adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_cihp, adj_matrix_cihp_to_pascal, adj_matrix_pascal_to_cihp )
+
+    # 量子化
+    quant_config = { "submodule_names" : QUANTIZED_SUBMODULE_NAMES, "per_channel" : not args.per_tensor, "fp32_modules" : [] }
+    example_inputs = ( torch.zeros(1, 3, args.image_height, args.image_width), ) + adj_matrixes
+    calibration_inputs = [ (inputs["image"],) + adj_matrixes for inputs in tqdm(dloader_calibration, desc = "calibration") ]
+    model_G_q = build_quantized_model( model_G, example_inputs, calibration_inputs, **quant_config )
+    if( os.path.dirname(args.save_quantized_path) != "" and not os.path.isdir(os.path.dirname(args.save_quantized_path)) ):
+        os.makedirs( os.path.dirname(args.save_quantized_path) )
+    save_quantized_checkpoint( model_G_q, args.save_quantized_path, **quant_config )
+
+    # fp32 との比較
+    confusion_matrix = torch.zeros( args.n_output_channels, args.n_output_channels, dtype = torch.int64 )
+    confusion_matrix_q = torch.zeros( args.n_output_channels, args.n_output_channels, dtype = torch.int64 )
+    confusion_matrix_agree = torch.zeros( args.n_output_channels, args.n_output_channels, dtype = torch.int64 )
+    with torch.no_grad():
+        for inputs in tqdm( dloader_eval, desc = "eval" ):
+            target = inputs["target"].squeeze(1).long()
+            output, _, _ = model_G( inputs["image"], *adj_matrixes )
+            output_q, _, _ = model_G_q( inputs["image"], *adj_matrixes )
+            _, predict = torch.max( output, 1 )
+            _, predict_q = torch.max( output_q, 1 )
+            confusion_matrix += calc_confusion_matrix( predict, target, args.n_output_channels )
+            confusion_matrix_q += calc_confusion_matrix( predict_q, target, args.n_output_channels )
+            confusion_matrix_agree += calc_confusion_matrix( predict_q, predict, args.n_output_channels )
+
+    inputs = ( next(iter(dloader_eval))["image"], ) + adj_matrixes
+    report = {
+        "latency_fp32_ms" : benchmark_latency( model_G, inputs ),
+        "latency_int8_ms" : benchmark_latency( model_G_q, inputs ),
+        "miou_fp32" : calc_miou( confusion_matrix ),
+        "miou_int8" : calc_miou( confusion_matrix_q ),
+        "miou_fp32_vs_int8" : calc_miou( confusion_matrix_agree ),
+    }
+    print_quantization_report( report )
+    with open( os.path.splitext(args.save_quantized_path)[0] + "_report.json", "w" ) as f:
+        json.dump( report, f, indent = 4 )
@@ -29,6 +29,9 @@ from models.losses import ParsingCrossEntropyLoss, CrossEntropy2DLoss, VGGLoss,
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
 from utils.decode_labels import decode_labels_tsr
+from utils.activation_checkpointing import setup_activation_checkpointing, print_checkpointing_report
+from utils.module_profiler import ModuleProfiler
+from utils.step_timer import StepPhaseTimer
 
 if __name__ == '__main__':
     """
@@ -72,7 +75,16 @@ if __name__ == '__main__':
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
+    parser.add_argument('--checkpoint_blocks', type=str, default="", help="生成器で activation checkpointing するブロックのモジュール名 or クラス名（カンマ区切り・ワイルドカード可。例 : Bottleneck, backbone.layer3）")
+    parser.add_argument('--checkpoint_memory_budget', type=float, default=0, help="activation checkpointing 後の生成器の活性化のメモリ量の上限 [MB]（0 の場合は checkpoint_blocks に一致する全てのブロックを checkpoint する）")
+    parser.add_argument('--checkpoint_check_grads', action='store_true', help="activation checkpointing 前後の生成器で、パラメーターの勾配が一致するかを確認する")
     parser.add_argument('--detect_nan', action='store_true')
+    parser.add_argument('--n_timing_log_steps', type=int, default=0, help="学習ステップのフェーズ毎の処理時間・スループットを出力する間隔（0 の場合は計測しない）")
+    parser.add_argument('--data_wait_alert', type=float, default=0.3, help="データ待ちの時間が学習ステップの時間のこの割合を超えた場合に警告を表示する")
+    parser.add_argument('--profile_every_n_steps', type=int, default=0, help="モジュール単位のプロファイルを行う学習ステップの間隔（0 の場合はプロファイルしない）")
+    parser.add_argument('--profile_max_depth', type=int, default=2, help="プロファイル対象のサブモジュールの階層の深さ")
+    parser.add_argument('--profile_modules', type=str, default="", help="プロファイル対象のサブモジュール名 or クラス名（カンマ区切り・ワイルドカード可。指定した場合は profile_max_depth は無視）")
+    parser.add_argument('--profile_trace', action='store_true', help="プロファイルするステップで torch.profiler の Chrome trace / TensorBoard プロファイルを出力する")
     parser.add_argument('--debug', action='store_true')
 
     args = parser.parse_args()
@@ -156,13 +168,42 @@ if __name__ == '__main__':
     # モデルを読み込む
     if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
         load_checkpoint(model_G, device, args.load_checkpoints_path )
-        
+
+    #================================
+    # 定義済みグラフ構造の取得
+    #================================
+    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = get_graph_adj_matrix()
+    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = adj_matrix_cihp_to_cihp.to(device), adj_matrix_pascal_to_pascal.to(device), adj_matrix_cihp_to_pascal.to(device)
+    adj_matrix_pascal_to_cihp = adj_matrix_cihp_to_pascal.transpose(2,3)
+
+    # 生成器の activation checkpointing（逆伝播時に活性化を再計算して、学習時のメモリ使用量を削減する）
+    if( args.checkpoint_blocks != "" ):
+        checkpointing_inputs = ( torch.randn( args.batch_size, 3, args.image_height, args.image_width ).to(device), adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_cihp, adj_matrix_cihp_to_pascal, adj_matrix_pascal_to_cihp )
+        checkpointing_report = setup_activation_checkpointing( model_G, checkpointing_inputs, args.checkpoint_blocks.split(","), args.checkpoint_memory_budget, check_gradients = args.checkpoint_check_grads )
+        print_checkpointing_report( checkpointing_report )
+
     #================================
     # optimizer_G の設定
     #================================
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # モジュール単位の forward / backward のプロファイラー
+    if( args.profile_every_n_steps > 0 ):
+        module_profiler = ModuleProfiler(
+            { "G" : model_G, "D" : model_D }, device, every_n_steps = args.profile_every_n_steps, max_depth = args.profile_max_depth,
+            patterns = [ pattern for pattern in args.profile_modules.split(",") if pattern != "" ],
+            log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_profile"), board = board_train, trace = args.profile_trace,
+        )
+    else:
+        module_profiler = None
+
+    # 学習ステップのフェーズ毎の処理時間の計測
+    step_timer = StepPhaseTimer(
+        device, log_path = os.path.join(args.tensorboard_dir, args.exper_name + "_timing.jsonl"), board = board_train,
+        n_log_steps = max(args.n_timing_log_steps, 1), data_wait_alert = args.data_wait_alert, enabled = args.n_timing_log_steps > 0,
+    )
+
     #================================
     # loss 関数の設定
     #================================
@@ -174,13 +215,6 @@ if __name__ == '__main__':
         #loss_entropy_fn = ParsingCrossEntropyLoss()
         loss_entropy_fn = CrossEntropy2DLoss(device)
 
-    #================================
-    # 定義済みグラフ構造の取得
-    #================================
-    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = get_graph_adj_matrix()
-    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = adj_matrix_cihp_to_cihp.to(device), adj_matrix_pascal_to_pascal.to(device), adj_matrix_cihp_to_pascal.to(device)
-    adj_matrix_pascal_to_cihp = adj_matrix_cihp_to_pascal.transpose(2,3)
-
     #================================
     # モデルの学習
     #================================    
@@ -188,7 +222,10 @@ if __name__ == '__main__':
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "minbatch iters" ) ):
+        # DataLoader のキューの深さの計測用にイテレーターを保持する（ループ変数 iter で組み込み関数 iter() が上書きされるため __iter__() を使う）
+        dloader_train_iter = dloader_train.__iter__()
+        for iter, inputs in enumerate( tqdm( dloader_train_iter, total = len(dloader_train), desc = "minbatch iters" ) ):
+            step_timer.start( dloader_train_iter )
             model_G.train()
             model_D.train()
 
@@ -196,10 +233,14 @@ if __name__ == '__main__':
             if inputs["image"].shape[0] != args.batch_size:
                 break
 
+            if( module_profiler is not None ):
+                module_profiler.begin( step )
+
             # ミニバッチデータを GPU へ転送
             image = inputs["image"].to(device)
             target = inputs["target"].to(device)
             target_rgb = decode_labels_tsr(target)
+            step_timer.lap("h2d")
             if( args.debug and n_print > 0):
                 print( "image.shape : ", image.shape )
                 print( "target.shape : ", target.shape )
@@ -226,6 +267,7 @@ if __name__ == '__main__':
                 print( "output_vis_rgb.shape : ", output_vis_rgb.shape )
                 print( "embedded.shape : ", embedded.shape )
                 print( "target_graph.shape : ", target_graph.shape )
+            step_timer.lap("G_forward_backward")
 
             #print( "torch.isnan(output).any() : ", torch.isnan(output).any() )
 
@@ -255,6 +297,7 @@ if __name__ == '__main__':
                 # 無効化していた識別器 D のネットワークの勾配計算を有効化。
                 for param in model_D.parameters():
                     param.requires_grad = False
+                step_timer.lap("D_forward_backward")
 
             #----------------------------------------------------
             # 生成器の更新処理
@@ -262,7 +305,9 @@ if __name__ == '__main__':
             # 損失関数を計算する
             if( args.n_output_channels == 1 ):
                 loss_l1 = loss_l1_fn( output, target )
+                step_timer.lap("G_forward_backward")
                 loss_vgg = loss_vgg_fn( output, target )
+                step_timer.lap("perceptual_loss")
                 loss_adv = loss_adv_fn.forward_G( d_fake )
                 loss_G = args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
             else:
@@ -272,6 +317,9 @@ if __name__ == '__main__':
             optimizer_G.zero_grad()
             loss_G.backward()
             optimizer_G.step()
+            if( module_profiler is not None ):
+                module_profiler.end( step )
+            step_timer.lap("G_forward_backward")
 
             #====================================================
             # 学習過程の表示
@@ -318,6 +366,8 @@ if __name__ == '__main__':
                 ]
                 board_add_images(board_train, 'train_graph/target', visuals, step+1)
 
+            step_timer.lap("logging")
+
             #====================================================
             # valid データでの処理
             #====================================================
@@ -413,7 +463,9 @@ if __name__ == '__main__':
                     board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
                 else:
                     board_valid.add_scalar('G/loss', loss_G_total.item()/n_valid_loop, step)
-                
+
+            step_timer.lap("validation")
+            step_timer.end( step, args.batch_size )
             step += 1
             n_print -= 1
 
@@ -424,6 +476,7 @@ if __name__ == '__main__':
             save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_ep%03d.pth' % (epoch)) )
             save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
             print( "saved checkpoints" )
+            step_timer.lap("checkpoint")
 
     print("Finished Training Loop.")
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
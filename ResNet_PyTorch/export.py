@@ -0,0 +1,55 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from networks import ResNet18
+from model_export import export_model, load_state_dict_cpu
+
+if __name__ == '__main__':
+    """
+    ResNet-18 を TorchScript / ONNX にエクスポートし、eager モードとの出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exper_name", default="ResNet18", help="実験名（エクスポートするファイル名）")
+    parser.add_argument('--dataset', choices=['mnist', 'cifar-10'], default="mnist", help="データセットの種類")
+    parser.add_argument('--load_checkpoints_dir', type=str, default="", help="モデルの読み込みディレクトリ")
+    parser.add_argument('--image_size', type=int, default=224, help="入力画像のサイズ（pixel単位）")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="１層目の特徴マップの枚数")
+    parser.add_argument("--n_classes", type = int, default = 10 )
+    parser.add_argument('--export_dir', type=str, default="exports", help="エクスポートしたモデルの出力ディレクトリ")
+    parser.add_argument('--export_format', choices=['torchscript','onnx','both'], default="both", help="エクスポート形式")
+    parser.add_argument('--torchscript_method', choices=['trace','script'], default="trace", help="TorchScript への変換方法")
+    parser.add_argument('--dynamic_axes', choices=['fixed','batch','batch_hw'], default="batch", help="ONNX で可変にする軸")
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX の opset version")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    n_in_channels = 1 if args.dataset == "mnist" else 3
+    model = ResNet18( n_in_channels = n_in_channels, n_fmaps = args.n_fmaps, n_classes = args.n_classes )
+
+    # モデルを読み込む
+    if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
+        load_state_dict_cpu( model, os.path.join(args.load_checkpoints_dir, "model_final.pth") )
+
+    example_input = torch.randn( size = (1, n_in_channels, args.image_size, args.image_size) )
+    # エクスポート
+    export_model(
+        model, [example_input], args.export_dir, args.exper_name,
+        input_names = ["input"], output_names = ["logits"],
+        export_format = args.export_format, torchscript_method = args.torchscript_method,
+        dynamic_axes_type = args.dynamic_axes, opset_version = args.opset_version,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
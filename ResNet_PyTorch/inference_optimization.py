@@ -0,0 +1,189 @@
+# -*- coding:utf-8 -*-
+import copy
+
+import torch
+import torch.nn as nn
+
+from model_export import to_tuple, check_parity, benchmark_runtime
+
+#====================================================
+# 推論用のモデルの最適化
+#====================================================
+# 直後の正規化層を畳み込める層と、畳み込める正規化層
+FOLDABLE_LAYER_TYPES = (nn.Conv2d, nn.ConvTranspose2d, nn.Linear)
+FOLDABLE_NORM_TYPES = (nn.BatchNorm2d, nn.BatchNorm1d)
+
+# in-place で実行できる活性化関数
+INPLACE_ACTIVATION_TYPES = (nn.ReLU, nn.LeakyReLU, nn.ReLU6, nn.ELU, nn.SiLU)
+
+def fold_batch_norm( layer, bn ):
+    """
+    推論時（running_mean / running_var を使う）の BatchNorm を、直前の Conv2d / ConvTranspose2d / Linear の重みとバイアスに畳み込んだ層を返す。
+    y = ( W x + b - mean ) / sqrt( var + eps ) * gamma + beta = ( W * scale ) x + ( b - mean ) * scale + beta
+    """
+    scale = 1.0 / torch.sqrt( bn.running_var + bn.eps )
+    if( bn.affine ):
+        scale = scale * bn.weight
+    shift = - bn.running_mean * scale
+    if( bn.affine ):
+        shift = shift + bn.bias
+
+    folded_layer = copy.deepcopy(layer)
+    with torch.no_grad():
+        # ConvTranspose2d の重みの shape は [in_channels, out_channels, kH, kW]（出力チャンネルが 1 次元目）
+        if isinstance(layer, nn.ConvTranspose2d):
+            folded_layer.weight.mul_( scale.view(1, -1, *([1] * (layer.weight.dim() - 2))) )
+        else:
+            folded_layer.weight.mul_( scale.view(-1, *([1] * (layer.weight.dim() - 1))) )
+
+        bias = layer.bias * scale + shift if layer.bias is not None else shift
+        folded_layer.bias = nn.Parameter( bias.detach().clone() )
+
+    return folded_layer
+
+
+def is_foldable( layer, bn ):
+    if not( isinstance(layer, FOLDABLE_LAYER_TYPES) and isinstance(bn, FOLDABLE_NORM_TYPES) ):
+        return False
+    if( bn.running_mean is None or bn.training ):
+        return False
+    # グループ化された ConvTranspose2d は出力チャンネル毎の重みの並びが異なるため対象外
+    if( isinstance(layer, nn.ConvTranspose2d) and layer.groups != 1 ):
+        return False
+    out_features = layer.out_features if isinstance(layer, nn.Linear) else layer.out_channels
+    return out_features == bn.num_features
+
+
+def fold_reflection_pad( pad, conv ):
+    """
+    ReflectionPad2d + padding なしの Conv2d を、padding_mode = "reflect" の Conv2d に置き換える（上下・左右の padding 幅が等しい場合のみ。計算結果は同じ）
+    """
+    left, right, top, bottom = pad.padding
+    if not( isinstance(conv, nn.Conv2d) and conv.padding_mode == "zeros" and tuple(conv.padding) == (0, 0) and left == right and top == bottom ):
+        return None
+
+    padded_conv = copy.deepcopy(conv)
+    padded_conv.padding = (top, left)
+    padded_conv.padding_mode = "reflect"
+    padded_conv._reversed_padding_repeated_twice = [left, right, top, bottom]
+    return padded_conv
+
+
+def optimize_sequential( sequential, fold_bn = True, fuse_activations = True, fold_pad = True ):
+    """
+    nn.Sequential 内で隣り合う層を最適化する。置き換えた層は nn.Identity にする（インデックスでの参照が変わらないように削除はしない）。
+    同じインスタンスの層（共有している活性化関数など）が複数の位置にある場合も位置毎に扱い、変更する場合はコピーしてから変更する
+    """
+    # children() は同じインスタンスを 1 つにまとめてしまい、位置がずれるため _modules の全ての位置を使う
+    names = list(sequential._modules.keys())
+    modules = list(sequential._modules.values())
+    for i in range( len(modules) - 1 ):
+        if( fold_bn and is_foldable(modules[i], modules[i+1]) ):
+            modules[i], modules[i+1] = fold_batch_norm(modules[i], modules[i+1]), nn.Identity()
+        elif( fold_pad and isinstance(modules[i], nn.ReflectionPad2d) ):
+            padded_conv = fold_reflection_pad(modules[i], modules[i+1])
+            if( padded_conv is not None ):
+                modules[i], modules[i+1] = nn.Identity(), padded_conv
+
+    # 畳み込み（+ 畳み込み済みの正規化層）の直後の活性化関数は、中間出力を上書きする in-place の処理にして、出力用のメモリ確保を省く。
+    # nn.Sequential への入力をそのまま受け取る活性化関数は、呼び出し元のテンソルを書き換えてしまうため対象外
+    if( fuse_activations ):
+        for i in range( 1, len(modules) ):
+            j = i - 1
+            while( j >= 0 and isinstance(modules[j], nn.Identity) ):
+                j -= 1
+            if( isinstance(modules[i], INPLACE_ACTIVATION_TYPES) and j >= 0 and isinstance(modules[j], FOLDABLE_LAYER_TYPES + FOLDABLE_NORM_TYPES) ):
+                modules[i] = copy.deepcopy(modules[i])
+                modules[i].inplace = True
+
+    for name, module in zip( names, modules ):
+        sequential._modules[name] = module
+    return
+
+
+def optimize_for_inference( model, fold_bn = True, fuse_activations = True, fold_pad = True, channels_last = True, example_inputs = None ):
+    """
+    推論用に最適化したモデルのコピーを返す（元のモデルは変更しない）
+
+    [Args]
+        fold_bn : <bool> BatchNorm を直前の Conv2d / ConvTranspose2d / Linear に畳み込む
+        fuse_activations : <bool> 活性化関数を in-place にする。example_inputs を指定した場合は、さらに TorchScript の freeze で畳み込みと活性化関数を融合する
+        fold_pad : <bool> ReflectionPad2d + Conv2d を padding_mode = "reflect" の Conv2d に置き換える
+        channels_last : <bool> 重みを channels last（NHWC）のメモリ配置にする。入力も channels last にすると CPU での畳み込みが速くなる
+        example_inputs : <list> TorchScript でトレースする場合の入力の例（None の場合は eager モードのモデルを返す）
+    """
+    model = copy.deepcopy(model).cpu().eval()
+    for module in model.modules():
+        if isinstance(module, nn.Sequential):
+            optimize_sequential( module, fold_bn, fuse_activations, fold_pad )
+
+    if( channels_last ):
+        model = model.to( memory_format = torch.channels_last )
+
+    # eager モードの fp32 では畳み込みと活性化関数を融合したカーネルは呼べないため、TorchScript の freeze 後の最適化（oneDNN での融合）を使う
+    if( fuse_activations and example_inputs is not None ):
+        with torch.no_grad():
+            example_inputs = [ to_channels_last(input) if channels_last else input for input in example_inputs ]
+            model = torch.jit.optimize_for_inference( torch.jit.freeze( torch.jit.trace(model, example_inputs, check_trace = False) ) )
+
+    return model
+
+
+def randomize_batch_norm_stats( model, seed = 0 ):
+    """
+    BatchNorm の running_mean / running_var と affine パラメーターをデフォルト値（0 / 1）以外の乱数にする。
+    学習済みの重みを読み込まずに最適化前後の出力の一致を確認する場合に、BatchNorm の畳み込みの誤りが出力に現れるようにするため
+    """
+    generator = torch.Generator().manual_seed(seed)
+    with torch.no_grad():
+        for module in model.modules():
+            if not isinstance(module, nn.modules.batchnorm._BatchNorm) or module.running_mean is None:
+                continue
+            module.running_mean.copy_( torch.randn(module.num_features, generator = generator) * 0.5 )
+            module.running_var.copy_( torch.rand(module.num_features, generator = generator) * 1.5 + 0.5 )
+            if( module.affine ):
+                module.weight.copy_( torch.rand(module.num_features, generator = generator) * 1.5 + 0.5 )
+                module.bias.copy_( torch.randn(module.num_features, generator = generator) * 0.5 )
+    return
+
+
+def to_channels_last( input ):
+    if( input.dim() == 4 ):
+        return input.contiguous( memory_format = torch.channels_last )
+    return input
+
+
+#====================================================
+# 最適化前後のモデルの比較
+#====================================================
+def get_inference_runtime( model, channels_last = False ):
+    """
+    モデルを model_export.load_runtime() と同じ形式（numpy 配列の入出力）で実行する関数
+    """
+    model.eval()
+    def run_inference( *inputs ):
+        inputs = [ torch.from_numpy(input) for input in inputs ]
+        if( channels_last ):
+            inputs = [ to_channels_last(input) for input in inputs ]
+        with torch.no_grad():
+            outputs = model( *inputs )
+        return [ output.contiguous().numpy() for output in to_tuple(outputs) ]
+    return run_inference
+
+
+def check_inference_optimization( model, model_opt, example_inputs, channels_last = True, batch_sizes = [1, 4, 16], n_iters = 20 ):
+    """
+    最適化前後のモデルの出力の最大絶対誤差と、CPU でのバッチサイズ毎のレイテンシーを比較する
+    """
+    run_fn = get_inference_runtime( model.cpu().eval() )
+    run_fn_opt = get_inference_runtime( model_opt, channels_last )
+    input_shapes = [ list(input.shape[1:]) for input in example_inputs ]
+
+    results = { "parity" : check_parity( run_fn, run_fn_opt, [ input.cpu().numpy() for input in example_inputs ] ), "benchmark" : {} }
+    print( "[parity] optimized : max abs diff = {}".format(results["parity"]) )
+    for name, fn in [ ("original", run_fn), ("optimized", run_fn_opt) ]:
+        results["benchmark"][name] = benchmark_runtime( fn, input_shapes, batch_sizes, n_iters = n_iters )
+        for result in results["benchmark"][name]:
+            print( "[benchmark] {} : batch_size={batch_size}, latency={latency_ms:.2f}ms (p90={latency_p90_ms:.2f}ms), throughput={throughput:.1f} samples/sec".format(name, **result) )
+
+    return results
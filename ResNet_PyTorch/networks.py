@@ -49,8 +49,8 @@ class BasicBlock( nn.Module ):
         out = self.layer1(x)
         out = self.layer2(out)
 
-        # shortcut connection からの経路を加算
-        out += self.shortcut_connections(x)
+        # shortcut connection からの経路を加算（FX graph mode での量子化で加算を int8 にできるように in-place にはしない）
+        out = out + self.shortcut_connections(x)
         return out
 
 
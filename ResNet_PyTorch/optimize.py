@@ -0,0 +1,54 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from networks import ResNet18
+from model_export import load_state_dict_cpu
+from inference_optimization import optimize_for_inference, check_inference_optimization, randomize_batch_norm_stats
+
+if __name__ == '__main__':
+    """
+    ResNet-18 を推論用に最適化（BatchNorm の畳み込み・活性化関数の融合・channels last）し、最適化前との出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', choices=['mnist', 'cifar-10'], default="mnist", help="データセットの種類")
+    parser.add_argument('--load_checkpoints_dir', type=str, default="", help="モデルの読み込みディレクトリ")
+    parser.add_argument('--image_size', type=int, default=224, help="入力画像のサイズ（pixel単位）")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="１層目の特徴マップの枚数")
+    parser.add_argument("--n_classes", type = int, default = 10 )
+    parser.add_argument('--no_channels_last', action='store_true', help="channels last への変換を行わない")
+    parser.add_argument('--torchscript', action='store_true', help="TorchScript の freeze で畳み込みと活性化関数を融合する")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    n_in_channels = 1 if args.dataset == "mnist" else 3
+    model = ResNet18( n_in_channels = n_in_channels, n_fmaps = args.n_fmaps, n_classes = args.n_classes )
+
+    # モデルを読み込む
+    if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
+        load_state_dict_cpu( model, os.path.join(args.load_checkpoints_dir, "model_final.pth") )
+    else:
+        # 学習済みの重みがない場合は、BatchNorm の畳み込みの誤りが出力の一致の確認で検出されるように、running stats をデフォルト値以外にする
+        randomize_batch_norm_stats( model, seed = args.seed )
+    model.eval()
+
+    # 推論用の最適化
+    example_input = torch.randn( 1, n_in_channels, args.image_size, args.image_size )
+    model_opt = optimize_for_inference( model, channels_last = not args.no_channels_last, example_inputs = [example_input] if args.torchscript else None )
+    check_inference_optimization(
+        model, model_opt, [example_input], channels_last = not args.no_channels_last,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
@@ -0,0 +1,99 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Subset
+import torchvision
+import torchvision.transforms as transforms
+
+# 自作クラス
+from networks import ResNet18
+from model_export import load_state_dict_cpu
+from model_quantization import build_quantized_model, save_quantized_checkpoint, benchmark_latency, print_quantization_report
+
+if __name__ == '__main__':
+    """
+    ResNet-18 の int8 静的量子化と、fp32 とのレイテンシー・正解率の比較
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset', choices=['mnist', 'cifar-10'], default="mnist", help="データセットの種類")
+    parser.add_argument('--dataset_dir', type=str, default="dataset", help="データセットのディレクトリ")
+    parser.add_argument('--load_checkpoints_dir', type=str, default="", help="fp32 モデルの読み込みディレクトリ")
+    parser.add_argument('--save_quantized_path', type=str, default="checkpoints/model_int8.pth", help="量子化済みモデルの保存ファイルのパス")
+    parser.add_argument('--image_size', type=int, default=224, help="入力画像のサイズ（pixel単位）")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="１層目の特徴マップの枚数")
+    parser.add_argument("--n_classes", type = int, default = 10 )
+    parser.add_argument('--batch_size', type=int, default=32, help="バッチサイズ")
+    parser.add_argument('--n_calibrations_per_class', type=int, default=16, help="キャリブレーションに使う学習用データのクラス毎の枚数")
+    parser.add_argument('--n_evals', type=int, default=1000, help="正解率の評価に使うテスト用データの枚数")
+    parser.add_argument('--per_tensor', action='store_true', help="重みを per-tensor で量子化する（デフォルトは出力チャンネル毎）")
+    parser.add_argument('--fp32_modules', type=str, default="reflection_pad,instance_norm", help="量子化せずに fp32 で実行するモジュールの種類（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # データセット
+    if( args.dataset == "mnist" ):
+        n_in_channels = 1
+        transform = transforms.Compose( [ transforms.Resize(args.image_size, interpolation=Image.LANCZOS ), transforms.ToTensor(), transforms.Normalize((0.5,), (0.5,)) ] )
+        ds_train = torchvision.datasets.MNIST( root = args.dataset_dir, train = True, transform = transform, download = True )
+        ds_test = torchvision.datasets.MNIST( root = args.dataset_dir, train = False, transform = transform, download = True )
+    else:
+        n_in_channels = 3
+        transform = transforms.Compose( [ transforms.Resize(args.image_size, interpolation=Image.LANCZOS ), transforms.ToTensor(), transforms.Normalize(mean=(0.5, 0.5, 0.5), std=(0.5, 0.5, 0.5)) ] )
+        ds_train = torchvision.datasets.CIFAR10( root = args.dataset_dir, train = True, transform = transform, download = True )
+        ds_test = torchvision.datasets.CIFAR10( root = args.dataset_dir, train = False, transform = transform, download = True )
+
+    # キャリブレーション用データは、活性化の範囲が特定のクラスに偏らないように各クラスから同じ枚数ずつ選ぶ
+    targets = np.asarray( ds_train.targets )
+    calibration_index = np.concatenate( [ np.random.permutation( np.where(targets == label)[0] )[:args.n_calibrations_per_class] for label in np.unique(targets) ] )
+    dloader_calibration = DataLoader( Subset(ds_train, calibration_index), batch_size = args.batch_size, shuffle = True )
+    dloader_eval = DataLoader( Subset(ds_test, np.arange(min(args.n_evals, len(ds_test)))), batch_size = args.batch_size, shuffle = False )
+
+    # fp32 のモデル
+    model = ResNet18( n_in_channels = n_in_channels, n_fmaps = args.n_fmaps, n_classes = args.n_classes )
+    if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
+        load_state_dict_cpu( model, os.path.join(args.load_checkpoints_dir, "model_final.pth") )
+    model.eval()
+
+    # 量子化
+    quant_config = { "per_channel" : not args.per_tensor, "fp32_modules" : [ name for name in args.fp32_modules.split(",") if name != "" ] }
+    example_inputs = ( torch.zeros(1, n_in_channels, args.image_size, args.image_size), )
+    calibration_inputs = [ (images,) for images, _ in tqdm(dloader_calibration, desc = "calibration") ]
+    model_q = build_quantized_model( model, example_inputs, calibration_inputs, **quant_config )
+    if( os.path.dirname(args.save_quantized_path) != "" and not os.path.isdir(os.path.dirname(args.save_quantized_path)) ):
+        os.makedirs( os.path.dirname(args.save_quantized_path) )
+    save_quantized_checkpoint( model_q, args.save_quantized_path, **quant_config )
+
+    # fp32 との比較
+    n_correct, n_correct_q, n_agree, n_tests = 0, 0, 0, 0
+    with torch.no_grad():
+        for images, targets in tqdm( dloader_eval, desc = "eval" ):
+            _, predicts = torch.max( model(images), dim = 1 )
+            _, predicts_q = torch.max( model_q(images), dim = 1 )
+            n_correct += ( predicts == targets ).sum().item()
+            n_correct_q += ( predicts_q == targets ).sum().item()
+            n_agree += ( predicts == predicts_q ).sum().item()
+            n_tests += targets.size(0)
+
+    images, _ = next(iter(dloader_eval))
+    report = {
+        "latency_fp32_ms" : benchmark_latency( model, (images,) ),
+        "latency_int8_ms" : benchmark_latency( model_q, (images,) ),
+        "accuracy_fp32" : n_correct / max(n_tests, 1),
+        "accuracy_int8" : n_correct_q / max(n_tests, 1),
+        "agreement_fp32_vs_int8" : n_agree / max(n_tests, 1),
+    }
+    print_quantization_report( report )
+    with open( os.path.splitext(args.save_quantized_path)[0] + "_report.json", "w" ) as f:
+        json.dump( report, f, indent = 4 )
@@ -19,6 +19,7 @@ from tensorboardX import SummaryWriter
 
 # 自作クラス
 from networks import ResNet18
+from model_quantization import load_quantized_checkpoint
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 
@@ -34,6 +35,7 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_dir', type=str, default="dataset", help="データセットのディレクトリ")
     parser.add_argument('--results_dir', type=str, default="results", help="生成画像の出力ディレクトリ")
     parser.add_argument('--load_checkpoints_dir', type=str, default="", help="モデルの読み込みディレクトリ")
+    parser.add_argument('--load_quantized_path', type=str, default="", help="quantize.py で保存した int8 量子化済みモデルのパス（指定時は CPU で推論する）")
     parser.add_argument('--n_samplings', type=int, default=100, help="サンプリング数")
     parser.add_argument('--batch_size', type=int, default=64, help="バッチサイズ")
     parser.add_argument('--image_size', type=int, default=224, help="入力画像のサイズ（pixel単位）")
@@ -153,6 +155,12 @@ if __name__ == '__main__':
     if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
         init_step = load_checkpoint(model, device, os.path.join(args.load_checkpoints_dir, "model_final.pth") )
 
+    # int8 量子化済みモデルを読み込む（量子化済みモデルは CPU でのみ実行できる）
+    if not args.load_quantized_path == '':
+        device = torch.device( "cpu" )
+        n_in_channels = 1 if args.dataset == "mnist" else 3
+        model = load_quantized_checkpoint( model.cpu(), args.load_quantized_path, (torch.zeros(1, n_in_channels, args.image_size, args.image_size),) )
+
     #======================================================================
     # モデルの推論処理
     #======================================================================
@@ -0,0 +1,57 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import numpy as np
+
+# PyTorch
+import torch
+
+# 自作クラス
+from networks import UNet4Generator, UNetGenerator
+from model_export import export_model, load_state_dict_cpu
+
+if __name__ == '__main__':
+    """
+    UNet を TorchScript / ONNX にエクスポートし、eager モードとの出力の一致と CPU での実行速度を確認する
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exper_name", default="UNet", help="実験名（エクスポートするファイル名）")
+    parser.add_argument('--load_checkpoints_path', type=str, default="", help="モデルの読み込みファイルのパス")
+    parser.add_argument('--export_dir', type=str, default="exports", help="エクスポートしたモデルの出力ディレクトリ")
+    parser.add_argument('--network_type', choices=['unet4','unet'], default="unet4", help="ネットワークの種類（unet4 : UNet4Generator, unet : UNetGenerator）")
+    parser.add_argument('--image_size', type=int, default=64, help="入力画像のサイズ（pixel単位）")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="特徴マップの枚数")
+    parser.add_argument('--n_downsampling', type=int, default=4, help="UNetGenerator のダウンサンプリング数")
+    parser.add_argument('--export_format', choices=['torchscript','onnx','both'], default="both", help="エクスポート形式")
+    parser.add_argument('--torchscript_method', choices=['trace','script'], default="trace", help="TorchScript への変換方法")
+    parser.add_argument('--dynamic_axes', choices=['fixed','batch','batch_hw'], default="batch_hw", help="ONNX で可変にする軸")
+    parser.add_argument('--opset_version', type=int, default=11, help="ONNX の opset version")
+    parser.add_argument('--batch_sizes', type=str, default="1,4,16", help="実行速度を計測するバッチサイズ（カンマ区切り）")
+    parser.add_argument('--n_iters', type=int, default=20, help="実行速度の計測の繰り返し回数")
+    parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # モデルの構造を定義する。
+    if( args.network_type == "unet4" ):
+        model = UNet4Generator( n_in_channels = 3, n_out_channels = 3, n_fmaps = args.n_fmaps )
+    else:
+        model = UNetGenerator( n_in_channels = 3, n_out_channels = 3, n_fmaps = args.n_fmaps, n_downsampling = args.n_downsampling )
+
+    # モデルを読み込む
+    if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
+        load_state_dict_cpu( model, args.load_checkpoints_path )
+
+    # エクスポート
+    example_input = torch.randn( 1, 3, args.image_size, args.image_size )
+    export_model(
+        model, [example_input], args.export_dir, args.exper_name,
+        input_names = ["input"], output_names = ["output"],
+        export_format = args.export_format, torchscript_method = args.torchscript_method,
+        dynamic_axes_type = args.dynamic_axes, opset_version = args.opset_version,
+        batch_sizes = [ int(batch_size) for batch_size in args.batch_sizes.split(",") ], n_iters = args.n_iters,
+    )
@@ -1,5 +1,6 @@
 # -*- coding:utf-8 -*-
 import os
+import functools
 import torch
 import torch.nn as nn
 
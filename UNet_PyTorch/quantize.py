@@ -0,0 +1,87 @@
+# -*- coding:utf-8 -*-
+import argparse
+import os
+import json
+import numpy as np
+from tqdm import tqdm
+
+# PyTorch
+import torch
+from torch.utils.data import DataLoader, Subset
+
+# 自作クラス
+from networks import UNet4Generator, UNetGenerator
+from map2aerial_dataset import Map2AerialDataset
+from model_export import load_state_dict_cpu
+from model_quantization import build_quantized_model, save_quantized_checkpoint, benchmark_latency, calc_l1, calc_psnr, print_quantization_report
+
+if __name__ == '__main__':
+    """
+    UNet の int8 静的量子化と、fp32 とのレイテンシー・出力の劣化（L1 / PSNR）の比較
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dataset_dir', type=str, default="dataset/maps", help="データセットのディレクトリ")
+    parser.add_argument('--load_checkpoints_path', type=str, default="", help="fp32 モデルの読み込みファイルのパス")
+    parser.add_argument('--save_quantized_path', type=str, default="checkpoints/model_int8.pth", help="量子化済みモデルの保存ファイルのパス")
+    parser.add_argument('--network_type', choices=['unet4','unet'], default="unet4", help="ネットワークの種類（unet4 : UNet4Generator, unet : UNetGenerator）")
+    parser.add_argument('--image_size', type=int, default=64, help="入力画像のサイズ（pixel単位）")
+    parser.add_argument('--n_fmaps', type=int, default=64, help="特徴マップの枚数")
+    parser.add_argument('--n_downsampling', type=int, default=4, help="UNetGenerator のダウンサンプリング数")
+    parser.add_argument('--batch_size', type=int, default=8, help="バッチサイズ")
+    parser.add_argument('--n_calibrations', type=int, default=128, help="キャリブレーションに使う学習用データの枚数")
+    parser.add_argument('--n_evals', type=int, default=128, help="出力の劣化の評価に使うテスト用データの枚数")
+    parser.add_argument('--per_tensor', action='store_true', help="重みを per-tensor で量子化する（デフォルトは出力チャンネル毎）")
+    parser.add_argument('--fp32_modules', type=str, default="reflection_pad,instance_norm", help="量子化せずに fp32 で実行するモジュールの種類（カンマ区切り）")
+    parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
+    args = parser.parse_args()
+    for key, value in vars(args).items():
+        print('%s: %s' % (str(key), str(value)))
+
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    # データセット
+    ds_train = Map2AerialDataset( args.dataset_dir, "train", args.image_size, args.image_size )
+    ds_test = Map2AerialDataset( args.dataset_dir, "val", args.image_size, args.image_size )
+    calibration_index = np.random.permutation(len(ds_train))[:args.n_calibrations]
+    dloader_calibration = DataLoader( Subset(ds_train, calibration_index), batch_size = args.batch_size, shuffle = False )
+    dloader_eval = DataLoader( Subset(ds_test, np.arange(min(args.n_evals, len(ds_test)))), batch_size = args.batch_size, shuffle = False )
+
+    # fp32 のモデル
+    if( args.network_type == "unet4" ):
+        model = UNet4Generator( n_in_channels = 3, n_out_channels = 3, n_fmaps = args.n_fmaps )
+    else:
+        model = UNetGenerator( n_in_channels = 3, n_out_channels = 3, n_fmaps = args.n_fmaps, n_downsampling = args.n_downsampling )
+    if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
+        load_state_dict_cpu( model, args.load_checkpoints_path )
+    model.eval()
+
+    # 量子化
+    quant_config = { "per_channel" : not args.per_tensor, "fp32_modules" : [ name for name in args.fp32_modules.split(",") if name != "" ] }
+    example_inputs = ( torch.zeros(1, 3, args.image_size, args.image_size), )
+    calibration_inputs = [ (inputs["aerial_image_tsr"],) for inputs in tqdm(dloader_calibration, desc = "calibration") ]
+    model_q = build_quantized_model( model, example_inputs, calibration_inputs, **quant_config )
+    if( os.path.dirname(args.save_quantized_path) != "" and not os.path.isdir(os.path.dirname(args.save_quantized_path)) ):
+        os.makedirs( os.path.dirname(args.save_quantized_path) )
+    save_quantized_checkpoint( model_q, args.save_quantized_path, **quant_config )
+
+    # fp32 との比較
+    l1_total, psnr_total, n_evals = 0, 0, 0
+    with torch.no_grad():
+        for inputs in tqdm( dloader_eval, desc = "eval" ):
+            output = model( inputs["aerial_image_tsr"] )
+            output_q = model_q( inputs["aerial_image_tsr"] )
+            l1_total += calc_l1( output, output_q )
+            psnr_total += calc_psnr( output, output_q, data_range = 2.0 )
+            n_evals += 1
+
+    inputs = ( next(iter(dloader_eval))["aerial_image_tsr"], )
+    report = {
+        "latency_fp32_ms" : benchmark_latency( model, inputs ),
+        "latency_int8_ms" : benchmark_latency( model_q, inputs ),
+        "l1_fp32_vs_int8" : l1_total / max(n_evals, 1),
+        "psnr_fp32_vs_int8" : psnr_total / max(n_evals, 1),
+    }
+    print_quantization_report( report )
+    with open( os.path.splitext(args.save_quantized_path)[0] + "_report.json", "w" ) as f:
+        json.dump( report, f, indent = 4 )
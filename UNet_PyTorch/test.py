@@ -18,8 +18,11 @@ from torchvision.utils import save_image
 from tensorboardX import SummaryWriter
 
 # 自作クラス
-from networks import UNet
+from networks import UNet4Generator
 from map2aerial_dataset import Map2AerialDataset, Map2AerialDataLoader
+from tiled_inference import TiledInference
+from video_inference import VideoInference
+from model_quantization import load_quantized_checkpoint
 from utils import save_checkpoint, load_checkpoint
 from utils import board_add_image, board_add_images
 
@@ -31,6 +34,7 @@ if __name__ == '__main__':
     parser.add_argument('--dataset_dir', type=str, default="dataset/maps", help="データセットのディレクトリ")
     parser.add_argument('--results_dir', type=str, default="results", help="生成画像の出力ディレクトリ")
     parser.add_argument('--load_checkpoints_dir', type=str, default="", help="モデルの読み込みディレクトリ")
+    parser.add_argument('--load_quantized_path', type=str, default="", help="quantize.py で保存した int8 量子化済みモデルのパス（指定時は CPU で推論する）")
     parser.add_argument('--n_samplings', type=int, default=100, help="サンプリング数")
     parser.add_argument('--batch_size', type=int, default=32, help="バッチサイズ")
     parser.add_argument('--image_size', type=int, default=64, help="入力画像のサイズ（pixel単位）")
@@ -38,6 +42,14 @@ if __name__ == '__main__':
     parser.add_argument('--n_display_step', type=int, default=50, help="tensorboard への表示間隔")
     parser.add_argument('--n_display_test_step', type=int, default=500, help="test データの tensorboard への表示間隔")
     parser.add_argument("--n_save_step", type=int, default=5000, help="モデルのチェックポイントの保存間隔")
+    parser.add_argument('--tiled_inference', action='store_true', help="元の解像度の画像をタイル分割して推論する（resize しない）")
+    parser.add_argument('--tile_size', type=int, default=512, help="タイル分割推論時のタイルの大きさ（pixel単位）。受容野の直径より十分大きくする")
+    parser.add_argument('--tile_overlap', type=int, default=-1, help="タイル分割推論時のタイルの重なり幅（pixel単位）。負の値の場合は受容野の半径から自動で決める")
+    parser.add_argument('--tile_batch_size', type=int, default=4, help="タイル分割推論時に 1 度に推論するタイル数")
+    parser.add_argument('--input_video', type=str, default="", help="推論する動画ファイルのパス（指定時は動画モードで推論する）")
+    parser.add_argument('--output_video', type=str, default="output.mp4", help="動画モードでの出力動画のファイル名")
+    parser.add_argument('--video_batch_size', type=int, default=8, help="動画モードで 1 度に推論するフレーム数")
+    parser.add_argument('--video_queue_size', type=int, default=4, help="動画モードでの decode / encode スレッドとのキューのサイズ上限（ミニバッチ数）")
     parser.add_argument("--seed", type=int, default=8, help="乱数シード値")
     parser.add_argument('--debug', action='store_true', help="デバッグモード有効化")
     args = parser.parse_args()
@@ -90,7 +102,7 @@ if __name__ == '__main__':
     #======================================================================
     # モデルの構造を定義する。
     #======================================================================
-    model = UNet( 
+    model = UNet4Generator( 
         n_in_channels = 3, n_out_channels = 3,
         n_fmaps = args.n_fmaps,
     ).to( device )
@@ -101,6 +113,11 @@ if __name__ == '__main__':
     # モデルを読み込む
     if not args.load_checkpoints_dir == '' and os.path.exists(args.load_checkpoints_dir):
         init_step = load_checkpoint(model, device, os.path.join(args.load_checkpoints_dir, "model_final.pth") )
+
+    # int8 量子化済みモデルを読み込む（量子化済みモデルは CPU でのみ実行できる）
+    if not args.load_quantized_path == '':
+        device = torch.device( "cpu" )
+        model = load_quantized_checkpoint( model.cpu(), args.load_quantized_path, (torch.zeros(1, 3, args.image_size, args.image_size),) )
     
     #======================================================================
     # モデルの推論処理
@@ -108,6 +125,39 @@ if __name__ == '__main__':
     print("Starting Test Loop...")
     n_print = 1
     model.eval()
+    if( args.input_video != "" ):
+        # decode・推論・encode を並行して行うパイプラインで動画を変換する
+        video_inference = VideoInference(
+            model, image_height = args.image_size, image_width = args.image_size,
+            batch_size = args.video_batch_size, max_queue_size = args.video_queue_size,
+            value_range = (0.0, 1.0), preprocess_fn = lambda frame : frame / 255.0,   # transforms.ToTensor() と save_image() に合わせる
+            device = device,
+        )
+        stats = video_inference( args.input_video, os.path.join(args.results_dir, args.exper_name, args.output_video) )
+        for key, value in stats.items():
+            print( "{} : {:.3f}".format(key, value) )
+
+        print("Finished Test Loop.")
+        exit()
+
+    if( args.tiled_inference ):
+        # 学習時の解像度に resize せずに、元の解像度の画像をタイル分割して推論する
+        # 全層畳み込みのネットワークなので、タイルの大きさは 2^(ダウンサンプリング回数) = 16 の倍数であればよい
+        tiled_inference = TiledInference(
+            model, n_in_channels = 3,
+            tile_size = args.tile_size, overlap = args.tile_overlap, tile_batch_size = args.tile_batch_size, size_multiple = 16,
+            value_range = (0.0, 1.0), preprocess_fn = lambda tile : tile / 255.0,   # transforms.ToTensor() と save_image() に合わせる
+            device = device, debug = args.debug,
+        )
+        for step, image_name in enumerate( tqdm( ds_test.image_names[:args.n_samplings], desc = "Samplings" ) ):
+            # 学習用データには、左側に衛星画像、右側に地図画像が入っているので、chunk で切り分ける
+            raw_image = torch.from_numpy( np.array( Image.open(os.path.join(ds_test.dataset_dir, image_name)).convert('RGB') ) ).permute(2,0,1)
+            input_image = torch.chunk( raw_image, chunks=2, dim=2 )[0]
+            tiled_inference( input_image, os.path.join(args.results_dir, args.exper_name, "fake_image_tiled_" + os.path.splitext(image_name)[0] + ".png") )
+
+        print("Finished Test Loop.")
+        exit()
+
     # DataLoader から 1minibatch 分取り出し、ミニバッチ処理
     for step, inputs in enumerate( tqdm( dloader_test, desc = "Samplings" ) ):
         # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する
@@ -163,16 +163,27 @@ class PatchGANGenerator(nn.Module):
 
 
 class SinGANGANGenerator(nn.Module):
+    """
+    SinGAN の多段（ピラミッド）生成器。
+    学習済みのスケールは freeze_scale() で 1 度だけ固定し、以下のように固定スケールの計算を使い回す。
+    ・固定ノイズ（reconstruction loss 用）に対する固定スケールの出力は決定論的なので、スケール毎に 1 度だけ計算してキャッシュする
+    ・ランダムノイズに対する固定スケールの出力は 1 step につき 1 回だけ計算する
+    ・noize_bank_size > 0 の場合は、固定スケールの出力を noize_bank_size 枚だけ事前に生成しておき、各 step ではそこからサンプリングする
+      （1 step あたりの計算量が下位スケールの数に依存しなくなる）
+    """
     def __init__( 
         self, 
         input_nc=3, output_nc=3,
         n_fmaps=32, n_layers=5, kernel_size=3, stride=1, padding=0,
         norm_type='batch',
         train_progress_init = 0, train_progress_max = 8, 
+        noize_bank_size = 0,
     ):
         super(SinGANGANGenerator, self).__init__()
         self.train_progress_init = train_progress_init
         self.train_progress_max = train_progress_max
+        self.noize_padding = int(((kernel_size - 1) * n_layers) / 2)
+        self.noize_bank_size = noize_bank_size
 
         self.generators = nn.ModuleDict(
             { "generator_{}".format(i) : 
@@ -180,48 +191,119 @@ class SinGANGANGenerator(nn.Module):
                 for i in range(train_progress_max)
             }
         )
+
+        self.frozen_progress = train_progress_init - 1      # 固定済みの最上位スケール
+        self.reset_cache()
+        return
+
+    def reset_cache( self ):
+        """
+        固定スケールの出力キャッシュを破棄する（学習済みモデルの読み込み後などに呼ぶ）
+        """
+        self.rec_output_list = []           # 固定ノイズに対する固定スケールの出力
+        self.rec_noize_image_z_list = None
+        self.noize_bank_list = []           # ランダムノイズに対する固定スケールの出力（noize_bank_size 枚）
         return
 
     def freeze_grads( self, train_progress ):
         for param in self.generators["generator_{}".format(train_progress)].parameters():
             param.requires_grad_(False)
+            param.grad = None       # optimizer で更新されないようにする
         return
 
-    def forward(self, noize_image_z_list, train_progress = 0):
-        if( train_progress == 0 ):
-            output = self.generators["generator_{}".format(train_progress)](noize_image_z_list[train_progress], output_upsampling=None)
-            output_list = [output]
+    def freeze_scale( self, train_progress ):
+        """
+        学習が完了したスケール train_progress 以下を固定する。固定済みのスケールに対しては何もしない
+        """
+        for i in range(self.frozen_progress+1, train_progress+1):
+            self.freeze_grads(i)
+            self.generators["generator_{}".format(i)].eval()
+
+        self.frozen_progress = max(self.frozen_progress, train_progress)
+        return
+
+    def train( self, mode = True ):
+        super(SinGANGANGenerator, self).train(mode)
+        # 固定済みのスケールは常に eval モードにする
+        for i in range(self.train_progress_init, self.frozen_progress+1):
+            self.generators["generator_{}".format(i)].eval()
+        return self
+
+    def forward_scale( self, i, noize_image_z, output_prev = None ):
+        """
+        スケール i の生成器での出力。output_prev は 1 つ下のスケールでの出力
+        """
+        if( output_prev is None ):
+            output_upsampling = None
         else:
-            output_list = []
+            output_upsampling = F.interpolate(output_prev, size=(noize_image_z.shape[2],noize_image_z.shape[3]), mode='bilinear', align_corners=True)
+
+        return self.generators["generator_{}".format(i)](noize_image_z, output_upsampling)
 
-            # １段目
-            self.freeze_grads(self.train_progress_init)
-            self.generators["generator_{}".format(self.train_progress_init)].eval()
-            with torch.no_grad():
-                output = self.generators["generator_{}".format(self.train_progress_init)](noize_image_z_list[self.train_progress_init], output_upsampling=None)
+    def update_noize_bank( self, noize_image_z_list, train_progress ):
+        """
+        ランダムノイズに対する固定スケール train_progress_init ~ train_progress-1 の出力を noize_bank_size 枚分生成する。
+        下位スケールの出力は生成済みのものを使うので、各スケールの生成はスケールが切り替わる時に 1 度だけ行われる
+        """
+        with torch.no_grad():
+            for i in range(self.train_progress_init + len(self.noize_bank_list), train_progress):
+                b, c, h, w = noize_image_z_list[i].shape
+                outputs = []
+                for j in range(0, self.noize_bank_size, b):
+                    n_batch = min(b, self.noize_bank_size - j)
+                    noize_image_z = torch.randn( size = (n_batch,1,h-2*self.noize_padding,w-2*self.noize_padding), device = noize_image_z_list[i].device )
+                    noize_image_z = F.pad( noize_image_z.expand(n_batch,c,h-2*self.noize_padding,w-2*self.noize_padding), [self.noize_padding]*4 )
+                    output_prev = self.noize_bank_list[-1][j:j+n_batch] if len(self.noize_bank_list) > 0 else None
+                    outputs.append( self.forward_scale(i, noize_image_z, output_prev) )
+
+                self.noize_bank_list.append( torch.cat(outputs, 0) )
+
+        return
+
+    def forward_frozen( self, noize_image_z_list, train_progress ):
+        """
+        ランダムノイズに対する固定スケール train_progress_init ~ train_progress-1 の出力のリスト（勾配計算なし）
+        """
+        self.freeze_scale(train_progress-1)
+        if( train_progress <= self.train_progress_init ):
+            return []
+
+        if( self.noize_bank_size > 0 ):
+            self.update_noize_bank(noize_image_z_list, train_progress)
+            index = torch.randint( self.noize_bank_size, size = (noize_image_z_list[train_progress].shape[0],), device = self.noize_bank_list[0].device )
+            return [ noize_bank[index] for noize_bank in self.noize_bank_list[:train_progress-self.train_progress_init] ]
+
+        output_list = []
+        output = None
+        with torch.no_grad():
+            for i in range(self.train_progress_init, train_progress):
+                output = self.forward_scale(i, noize_image_z_list[i], output)
                 output_list.append(output)
 
-            # ２段目以降
-            for i in range(self.train_progress_init+1, train_progress+1):
-                #print( "\ni : ", i )
-                if( i >= train_progress ):
-                    # 学習した低解像度での出力をアップサンプリング
-                    output_upsampling = F.interpolate(output_list[-1], size=(noize_image_z_list[i].shape[2],noize_image_z_list[i].shape[3]), mode='bilinear', align_corners=True)
-
-                    # 今回の解像度での出力
-                    self.generators["generator_{}".format(i)].train()
-                    output = self.generators["generator_{}".format(i)](noize_image_z_list[i], output_upsampling)
-                    output_list.append(output)
-                    break
-                else:
-                    # 前回の train_progress に対しての低解像度での出力して、
-                    self.freeze_grads(i)
-                    self.generators["generator_{}".format(i)].eval()
-                    output_upsampling = F.interpolate(output_list[-1], size=(noize_image_z_list[i].shape[2],noize_image_z_list[i].shape[3]), mode='bilinear', align_corners=True)
-                    with torch.no_grad():
-                        output = self.generators["generator_{}".format(i-1)](noize_image_z_list[i], output_upsampling)
-                        output_list.append(output)
-                    continue
+        return output_list
 
-        return output, output_list
+    def forward_rec( self, fix_noize_image_z_list, train_progress = 0 ):
+        """
+        固定ノイズ（reconstruction loss 用）に対する出力。固定スケールの出力はキャッシュしたものを使う
+        """
+        self.freeze_scale(train_progress-1)
+        if( self.rec_noize_image_z_list is not fix_noize_image_z_list ):
+            self.rec_output_list = []
+            self.rec_noize_image_z_list = fix_noize_image_z_list
+
+        with torch.no_grad():
+            for i in range(self.train_progress_init + len(self.rec_output_list), train_progress):
+                output_prev = self.rec_output_list[-1] if len(self.rec_output_list) > 0 else None
+                self.rec_output_list.append( self.forward_scale(i, fix_noize_image_z_list[i], output_prev) )
+
+        output_prev = self.rec_output_list[train_progress-self.train_progress_init-1] if train_progress > self.train_progress_init else None
+        return self.forward_scale(train_progress, fix_noize_image_z_list[train_progress], output_prev)
 
+    def forward(self, noize_image_z_list, train_progress = 0):
+        output_list = self.forward_frozen(noize_image_z_list, train_progress)
+        output_prev = output_list[-1] if len(output_list) > 0 else None
+
+        # 今回の解像度での出力（勾配計算あり）
+        output = self.forward_scale(train_progress, noize_image_z_list[train_progress], output_prev)
+        output_list.append(output)
+        return output, output_list
@@ -303,33 +303,7 @@ class SinGANRecLoss(nn.Module):
         return noize_z
 
     def forward(self, model_G, image_gt, train_progress = 0):
-        if( train_progress == 0 ):
-            output = model_G.generators["generator_{}".format(train_progress)](self.fix_noize_image_z_list[train_progress], output_upsampling=None)
-            loss = self.loss_fn( output, image_gt )
-        else:
-            output_list = []
-            model_G.generators["generator_{}".format(self.train_progress_init)].eval()
-            with torch.no_grad():
-                output = model_G.generators["generator_{}".format(self.train_progress_init)](self.fix_noize_image_z_list[self.train_progress_init], output_upsampling=None)
-                output_list.append(output)
-
-            for i in range(self.train_progress_init+1, train_progress+1):
-                if( i >= train_progress ):
-                    output_upsampling = F.interpolate(output_list[-1], size=(self.fix_noize_image_z_list[i].shape[2],self.fix_noize_image_z_list[i].shape[3]), mode='bilinear', align_corners=True)
-                    model_G.generators["generator_{}".format(i)].train()
-                    output = model_G.generators["generator_{}".format(i)](self.fix_noize_image_z_list[i], output_upsampling)
-                    output_list.append(output)
-                    break
-                else:
-                    model_G.generators["generator_{}".format(i)].eval()
-                    output_upsampling = F.interpolate(output_list[-1], size=(self.fix_noize_image_z_list[i].shape[2],self.fix_noize_image_z_list[i].shape[3]), mode='bilinear', align_corners=True)
-                    with torch.no_grad():
-                        output = model_G.generators["generator_{}".format(i-1)](self.fix_noize_image_z_list[i], output_upsampling)
-                        output_list.append(output)
-                    continue
-
-            #print( "output_list[-1].shape : ", output_list[-1].shape )            
-            #print( "image_gt.shape : ", image_gt.shape )
-            loss = self.loss_fn( output_list[-1], image_gt )
-
-        return loss
\ No newline at end of file
+        # 学習済みの低解像度スケールの出力は model_G 側でキャッシュされ、今回のスケールの生成器のみが実行される
+        output = model_G.forward_rec( self.fix_noize_image_z_list, train_progress )
+        loss = self.loss_fn( output, image_gt )
+        return loss
@@ -51,6 +51,7 @@ if __name__ == '__main__':
     parser.add_argument("--kernel_size", type=int, default=3,)
     parser.add_argument("--stride", type=int, default=1,)
     parser.add_argument("--padding", type=int, default=0,)
+    parser.add_argument("--noize_bank_size", type=int, default=0, help="学習済みスケールの出力を事前生成してサンプリングする枚数（0 の場合は毎 step 計算する）")
 
     parser.add_argument('--lr', type=float, default=0.0005, help="学習率")
     parser.add_argument('--beta1', type=float, default=0.5, help="学習率の減衰率")
@@ -154,7 +155,7 @@ if __name__ == '__main__':
     # モデルの構造を定義する。
     #================================
     if( args.net_G_type == "patch_gan" ):
-        model_G = SinGANGANGenerator( input_nc=3, output_nc=3, n_fmaps=args.n_fmaps, n_layers=args.n_layers, kernel_size=args.kernel_size, stride=args.stride, padding=args.padding, train_progress_max = args.train_progress_max ).to(device)
+        model_G = SinGANGANGenerator( input_nc=3, output_nc=3, n_fmaps=args.n_fmaps, n_layers=args.n_layers, kernel_size=args.kernel_size, stride=args.stride, padding=args.padding, train_progress_max = args.train_progress_max, noize_bank_size = args.noize_bank_size ).to(device)
     else:
         NotImplementedError()
 
@@ -385,6 +386,9 @@ if __name__ == '__main__':
             save_checkpoint( model_D, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_D_final.pth') )
             print( "saved checkpoints" )
 
+        # 学習が完了したスケールを固定（以降のスケールでは出力をキャッシュして使い回す）
+        model_G.freeze_scale(train_progress)
+
     print("Finished Training Loop.")
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
     save_checkpoint( model_D, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_D_final.pth') )
@@ -19,6 +19,7 @@ from torchvision.utils import save_image
 
 from data.transforms.random_erasing import RandomErasing
 from data.transforms.tps_transform import TPSTransform
+from data.pyramid_cache import build_pyramid_cache, get_pyramid_cache_path
 from utils import set_random_seed, numerical_sort
 
 IMG_EXTENSIONS = (
@@ -27,7 +28,11 @@ IMG_EXTENSIONS = (
 )
 
 class NoizeDataset(data.Dataset):
-    def __init__(self, args, root_dir, datamode = "train", image_size_init = 4, image_size_final = 1024, z_dims = 512, debug = False ):
+    def __init__(self, args, root_dir, datamode = "train", image_size_init = 4, image_size_final = 1024, z_dims = 512, pyramid_cache_dir = None, debug = False ):
+        """
+        [Args]
+            pyramid_cache_dir : <str> 各解像度に縮小済みの画像キャッシュのディレクトリ。指定した場合は、キャッシュから train_progress の解像度の画像のみを読み込む
+        """
         super(NoizeDataset, self).__init__()
         self.args = args
         self.datamode = datamode
@@ -40,22 +45,11 @@ class NoizeDataset(data.Dataset):
         self.progress_init = int(np.log2(image_size_init)) - 2
         self.progress_final = int(np.log2(image_size_final)) -2
 
-        self.noize_sizes_h = []
-        self.noize_sizes_w = []
+        self.image_sizes_h = []
+        self.image_sizes_w = []
         for i in range(self.progress_final+1):
-            self.noize_sizes_h.append(2**(i+2))
-            self.noize_sizes_w.append(2**(i+2))
-
-        # valid データ用の固定ノイズ
-        self.latent_z_fixed = self.get_latent_z(self.z_dims)
-        self.noize_map_fixed_list = []
-        for train_progress in range(self.progress_final):
-            noize_h = self.noize_sizes_h[train_progress]
-            noize_w = self.noize_sizes_w[train_progress]
-
-            # input noize
-            noize_map = self.get_noize_map(c=1, h=noize_h, w=noize_w)
-            self.noize_map_fixed_list.append(noize_map)
+            self.image_sizes_h.append(2**(i+2))
+            self.image_sizes_w.append(2**(i+2))
 
         # 
         self.image_t_dir = os.path.join( root_dir )
@@ -65,98 +59,62 @@ class NoizeDataset(data.Dataset):
             print( "len(self.image_t_names) :", len(self.image_t_names))
             print( "self.image_t_names[0:5] :", self.image_t_names[0:5])
 
+        # 多解像度の画像キャッシュ
+        self.pyramid_cache_dir = pyramid_cache_dir
+        if( self.pyramid_cache_dir is not None ):
+            build_pyramid_cache( self.image_t_dir, self.image_t_names, self.pyramid_cache_dir, image_size_init = 4, image_size_final = self.image_size_final )
+
+        return
+
+    def set_train_progress( self, train_progress ):
+        """
+        読み込む画像の解像度を更新する。DataLoader の worker は iter 毎にデータセットを複製するため、DataLoader の iter 前に呼ぶこと
+        """
+        self.train_progress = train_progress
         return
 
     def __len__(self):
         return len(self.image_t_names)
 
-    def get_latent_z(self, z_dims, noize_type = "uniform" ):
-        if( noize_type == "uniform" ):
-            latent_z = torch.randn([z_dims])
-        else:
-            NotImplementedError()
-
-        return latent_z
-
-    def get_noize_map(self, c, h, w , noize_type = "uniform" ):
-        if( noize_type == "uniform" ):
-            noize_map = torch.randn([1,h,w])
-        else:
-            NotImplementedError()
-
-        # チャネル次元は同じ値にする
-        noize_map = noize_map.expand(c,h,w)
-
-        # zero padding で境界をゼロ埋め
-        pass
-
-        return noize_map
-
     def __getitem__(self, index):
         image_t_name = self.image_t_names[index]
         self.seed_da = random.randint(0,10000)
 
-        #--------------------------------
-        # 入力ノイズ z （潜在空間 x）
-        #--------------------------------
-        if( self.datamode == "train" ):
-            latent_z = self.get_latent_z(self.z_dims)
-        else:
-            latent_z = self.latent_z_fixed
-
-        #--------------------------------
-        # 入力ノイズマップ
-        #--------------------------------
-        if( self.datamode == "train" ):
-            noize_map_list = []
-            for train_progress in range(self.progress_final):
-                noize_h = self.noize_sizes_h[train_progress]
-                noize_w = self.noize_sizes_w[train_progress]
-
-                # input noize
-                noize_map = self.get_noize_map(c=1, h=noize_h, w=noize_w)
-                noize_map_list.append(noize_map)
-        else:
-            noize_map_list = self.noize_map_fixed_list
-
+        # 入力ノイズ z とノイズマップは、学習ループ・生成器側で device 上で生成する
         #---------------------
         # image_t
         #---------------------
-        if( self.datamode == "train" ):
-            image_t_list = []
-            for train_progress in range(self.progress_final):
-                noize_h = self.noize_sizes_h[train_progress]
-                noize_w = self.noize_sizes_w[train_progress]
-
-                # transform
-                self.transform = transforms.Compose(
-                    [
-                        transforms.Resize( (noize_h, noize_w), interpolation=Image.LANCZOS ),
-                        transforms.CenterCrop( size = (noize_h, noize_w) ),
-                        transforms.ToTensor(),
-                        transforms.Normalize( [0.5,0.5,0.5], [0.5,0.5,0.5] ),
-                    ]
-                )
-
-                # image
-                image_t = Image.open( os.path.join(self.image_t_dir, image_t_name) ).convert('RGB')
-                image_t = self.transform(image_t)
-                image_t_list.append(image_t)
+        # 現在の train_progress の解像度の画像のみを生成する
+        image_h = self.image_sizes_h[self.train_progress]
+        image_w = self.image_sizes_w[self.train_progress]
+        if( self.pyramid_cache_dir is not None ):
+            # キャッシュ済みの縮小画像を読み込む
+            self.transform = transforms.Compose(
+                [
+                    transforms.ToTensor(),
+                    transforms.Normalize( [0.5,0.5,0.5], [0.5,0.5,0.5] ),
+                ]
+            )
+            image_t = Image.open( get_pyramid_cache_path(self.pyramid_cache_dir, image_h, image_t_name) ).convert('RGB')
+        else:
+            self.transform = transforms.Compose(
+                [
+                    transforms.Resize( (image_h, image_w), interpolation=Image.LANCZOS ),
+                    transforms.CenterCrop( size = (image_h, image_w) ),
+                    transforms.ToTensor(),
+                    transforms.Normalize( [0.5,0.5,0.5], [0.5,0.5,0.5] ),
+                ]
+            )
+            image_t = Image.open( os.path.join(self.image_t_dir, image_t_name) ).convert('RGB')
+
+        image_t = self.transform(image_t)
 
         #---------------------
         # returns
         #---------------------
-        if( self.datamode == "train" ):
-            results_dict = {
-                "latent_z" : latent_z,
-                "noize_map_list" : noize_map_list,
-                "image_t_name" : image_t_name,
-                "image_t_list" : image_t_list,
-            }
-        else:
-            results_dict = {
-                "latent_z" : latent_z,
-            }
+        results_dict = {
+            "image_t_name" : image_t_name,
+            "image_t" : image_t,
+        }
 
         return results_dict
-
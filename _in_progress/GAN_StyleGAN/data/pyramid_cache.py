@@ -0,0 +1,49 @@
+import os
+import json
+import numpy as np
+from PIL import Image
+from tqdm import tqdm
+
+#====================================================
+# 多解像度（mip-pyramid）画像キャッシュ
+#====================================================
+def get_pyramid_cache_path( cache_dir, image_size, image_name ):
+    return os.path.join( cache_dir, str(image_size), os.path.splitext(image_name)[0] + ".png" )
+
+
+def build_pyramid_cache( image_dir, image_names, cache_dir, image_size_init = 4, image_size_final = 1024 ):
+    """
+    各画像を image_size_final に 1 度だけ resize した後、1/2 ずつ面積平均（Image.BOX）で縮小した画像を
+    cache_dir/{image_size}/{image_name}.png に保存する（オフライン処理）。
+    cache_dir/meta.json の内容が一致する場合は既存のキャッシュを再利用する。
+    """
+    image_sizes = [ 2 ** i for i in range(int(np.log2(image_size_init)), int(np.log2(image_size_final)) + 1) ]
+    meta = {
+        "image_dir" : os.path.abspath(image_dir),
+        "image_names" : list(image_names),
+        "image_sizes" : image_sizes,
+    }
+
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if( os.path.exists(meta_path) ):
+        with open(meta_path, "r") as f:
+            if( json.load(f) == meta ):
+                return meta
+
+    for image_size in image_sizes:
+        if not os.path.exists(os.path.join(cache_dir, str(image_size))):
+            os.makedirs(os.path.join(cache_dir, str(image_size)))
+
+    for image_name in tqdm( image_names, desc = "build pyramid cache" ):
+        image = Image.open( os.path.join(image_dir, image_name) ).convert('RGB')
+        image = image.resize( (image_sizes[-1], image_sizes[-1]), resample = Image.LANCZOS )
+        for image_size in reversed(image_sizes):
+            if( image.size[0] != image_size ):
+                image = image.resize( (image_size, image_size), resample = Image.BOX )
+            image.save( get_pyramid_cache_path(cache_dir, image_size, image_name) )
+
+    # meta.json はキャッシュが揃ってから最後に書き込む
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+
+    return meta
@@ -249,11 +249,16 @@ class SynthesisBlock(nn.Module):
 
 
 class SynthesisNetwork(nn.Module):
-    def __init__( self, in_dim_latent=512, out_dim=3, image_size_init = 4, image_size_final = 1024 ):
+    def __init__( self, in_dim_latent=512, out_dim=3, image_size_init = 4, image_size_final = 1024, fixed_noize_seed = 71 ):
         super( SynthesisNetwork, self ).__init__()
         self.progress_init = int(np.log2(image_size_init)) - 2
         self.progress_final = int(np.log2(image_size_final)) -2
 
+        # 固定ノイズマップ（valid データ等での再現性確保用）/ {(batch_size, 解像度 index, device) : noize_map}
+        self.fixed_noize_seed = fixed_noize_seed
+        self.noize_map_fixed_dict = {}
+        self.noize_map_list = None
+
         in_dims = [in_dim_latent, in_dim_latent, in_dim_latent, in_dim_latent, in_dim_latent, in_dim_latent//2, in_dim_latent//4, in_dim_latent//8, in_dim_latent//16]
         out_dims = [in_dim_latent, in_dim_latent, in_dim_latent, in_dim_latent, in_dim_latent//2, in_dim_latent//4, in_dim_latent//8, in_dim_latent//16, in_dim_latent//32]
         print( "[SynthesisNetwork] in_dims : ", in_dims )
@@ -272,7 +277,34 @@ class SynthesisNetwork(nn.Module):
         )
         return
 
-    def forward( self, latent_z, noize_map_list, progress = 0, alpha = 0.0 ):
+    def get_noize_map_list( self, batch_size, progress, device, fixed_noize = False ):
+        """
+        現在の progress で使用する解像度（4, 8, ..., 4*2^progress）のノイズマップ [B,1,H,W] のリストを device 上で生成する
+
+        [Args]
+            fixed_noize : <bool> True の場合は、シード値 fixed_noize_seed から生成した固定ノイズを返す（生成結果はキャッシュする）
+        """
+        noize_map_list = []
+        for i in range(progress+1):
+            noize_size = 4 * 2 ** i
+            if( fixed_noize ):
+                key = (batch_size, i, str(device))
+                if not( key in self.noize_map_fixed_dict ):
+                    generator = torch.Generator(device=device)
+                    generator.manual_seed(self.fixed_noize_seed + i)
+                    self.noize_map_fixed_dict[key] = torch.randn( (batch_size, 1, noize_size, noize_size), generator = generator, device = device )
+                noize_map_list.append(self.noize_map_fixed_dict[key])
+            else:
+                noize_map_list.append( torch.randn( (batch_size, 1, noize_size, noize_size), device = device ) )
+
+        return noize_map_list
+
+    def forward( self, latent_z, noize_map_list = None, progress = 0, alpha = 0.0, fixed_noize = False ):
+        # ノイズマップが与えられない場合は、必要な解像度分だけ device 上で生成する
+        if( noize_map_list is None ):
+            noize_map_list = self.get_noize_map_list( latent_z.shape[0], progress, latent_z.device, fixed_noize )
+        self.noize_map_list = noize_map_list
+
         if( progress == 0 ):
             output = self.synthesis_head(latent_z, noize_map_list[0])
             output = self.out_layers["conv_{}".format(progress+1)](output)
@@ -307,22 +339,27 @@ class SynthesisNetwork(nn.Module):
 
 
 class StyleGANGenerator(nn.Module):
-    def __init__( self, in_dim=512, out_dim=3, n_mappling_layers=8 ):
+    def __init__( self, in_dim=512, out_dim=3, n_mappling_layers=8, fixed_noize_seed = 71 ):
         super( StyleGANGenerator, self ).__init__()
         self.mapping_network = MappingNetwork(in_dim, in_dim, n_mappling_layers)
-        self.synthesis_network = SynthesisNetwork()
+        self.synthesis_network = SynthesisNetwork(fixed_noize_seed = fixed_noize_seed)
         return
 
     def truncation_trick( self, latent_w, latent_w_center, psi = 0.0 ):
         latent_w = latent_w_center + psi * (latent_w - latent_w_center) 
         return latent_w
 
-    def forward( self, latent_z, noize_map_list, progress = 0, alpha = 0.0, truncation_trick = False ):
+    def forward( self, latent_z, noize_map_list = None, progress = 0, alpha = 0.0, truncation_trick = False, fixed_noize = False ):
+        """
+        [Args]
+            noize_map_list : <list> 各解像度のノイズマップのリスト。None の場合は SynthesisNetwork が device 上で生成する
+            fixed_noize : <bool> noize_map_list = None の場合に、シード固定のノイズマップを使用するか
+        """
         latent_w = self.mapping_network(latent_z)
         #print( "[StyleGANGenerator] latent_w.shape : ", latent_w.shape )
         if( truncation_trick ):
             latent_w = self.truncation_trick( latent_w, latent_w, psi = 0.5)    # dummy
 
-        output = self.synthesis_network(latent_w, noize_map_list, progress, alpha)
+        output = self.synthesis_network(latent_w, noize_map_list, progress, alpha, fixed_noize)
         #print( "[StyleGANGenerator] output.shape : ", output.shape )
         return output
@@ -36,6 +36,7 @@ from models.losses import LSGANLoss, HingeGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
 from utils.scores import calculate_fretchet
+from utils.batch_size_finder import BatchSizeCache, find_batch_size_cached, scale_lr
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -63,7 +64,13 @@ if __name__ == '__main__':
     parser.add_argument("--val_rate", type=float, default=0.01)
     parser.add_argument('--n_display_valid', type=int, default=8, help="valid データの tensorboard への表示数")
     parser.add_argument('--data_augument', action='store_true')
+    parser.add_argument('--pyramid_cache_dir', type=str, default="", help="各解像度に縮小済みの画像キャッシュのディレクトリ（空の場合はキャッシュを使用しない）")
     parser.add_argument('--diaplay_scores', action='store_true')
+    parser.add_argument('--auto_batch_size', action='store_true', help="各解像度スケール毎に、メモリ予算に収まる最大のバッチサイズを探索して使用する（batch_size・lr のリストはその基準値）")
+    parser.add_argument('--memory_budget_mb', type=float, default=0, help="バッチサイズ探索時の GPU メモリ予算 [MB]（0 の場合は GPU の全メモリの 90%%）")
+    parser.add_argument('--batch_size_max', type=int, default=1024, help="バッチサイズ探索時の最大バッチサイズ")
+    parser.add_argument('--lr_scaling', choices=['linear', 'sqrt', 'none'], default="linear", help="探索したバッチサイズに合わせた学習率のスケーリング方法")
+    parser.add_argument('--batch_size_cache_path', type=str, default="checkpoints/batch_size_cache.json", help="探索済みのバッチサイズのキャッシュファイルのパス")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
@@ -144,7 +151,7 @@ if __name__ == '__main__':
     # データセットの読み込み
     #================================    
     # 学習用データセットとテスト用データセットの設定
-    ds_train = NoizeDataset( args, args.dataset_dir, datamode = "train", z_dims = args.z_dims, image_size_init = args.image_size_init, image_size_final = args.image_size_final, debug = args.debug )
+    ds_train = NoizeDataset( args, args.dataset_dir, datamode = "train", z_dims = args.z_dims, image_size_init = args.image_size_init, image_size_final = args.image_size_final, pyramid_cache_dir = args.pyramid_cache_dir if args.pyramid_cache_dir != "" else None, debug = args.debug )
 
     # 学習用データセットとテスト用データセットの設定
     index = np.arange(len(ds_train))
@@ -161,7 +168,7 @@ if __name__ == '__main__':
     #================================
     # モデルの構造を定義する。
     #================================
-    model_G = StyleGANGenerator(in_dim=512, out_dim=3).to(device)
+    model_G = StyleGANGenerator(in_dim=512, out_dim=3, fixed_noize_seed=args.seed).to(device)
     model_D = ProgressiveDiscriminator().to(device)
 
     # モデルを読み込む
@@ -207,6 +214,31 @@ if __name__ == '__main__':
     #================================
     # モデルの学習
     #================================    
+    # valid データ用の固定の入力ノイズ z
+    generator = torch.Generator(device=device)
+    generator.manual_seed(args.seed)
+    latent_z_fixed = torch.randn( (args.batch_size_valid, args.z_dims), generator = generator, device = device )
+
+    # バッチサイズの探索用に、ダミーデータで識別器 → 生成器の 1 step 分の forward / backward を行う関数（fade-in 中の alpha で計測）
+    # 学習ループと同じく、生成器の forward の graph を保持したまま識別器を更新し、同じ出力で生成器を更新する（1 回の計測でピークメモリを測る）
+    def step_dummy( n_batch, progress, alpha = 0.5 ):
+        image_size = 4 * 2 ** progress
+        image_t = torch.randn( (n_batch, 3, image_size, image_size), device = device )
+        latent_z = torch.randn( (n_batch, args.z_dims), device = device )
+        output = model_G( latent_z, None, progress, alpha )
+
+        # 識別器
+        d_real = model_D( image_t, progress, alpha )
+        d_fake = model_D( output.detach(), progress, alpha )
+        ( d_real.mean() + d_fake.mean() ).backward()
+
+        # 生成器
+        d_fake = model_D( output, progress, alpha )
+        d_fake.mean().backward()
+        return
+
+    batch_size_cache = BatchSizeCache( args.batch_size_cache_path )
+
     print("Starting Training Loop...")
     progress_init = int(np.log2(args.image_size_init)) - 2
     progress_final = int(np.log2(args.image_size_final)) - 2
@@ -217,13 +249,22 @@ if __name__ == '__main__':
         # エポック数の更新
         n_epoche = args.n_epoches[progress]
 
-        # バッチサイズの更新
+        # バッチサイズの更新（auto_batch_size の場合は、メモリ予算に収まる最大のバッチサイズを探索する）
         batch_size = args.batch_size[progress]
+        if( args.auto_batch_size ):
+            batch_size_found = find_batch_size_cached(
+                batch_size_cache, [ lambda n_batch : step_dummy(n_batch, progress) ],
+                [ model_G, model_D ], [ optimizer_G, optimizer_D ], device, 4 * 2 ** progress, args.memory_budget_mb, args.batch_size_max,
+            )
+            if( batch_size_found is not None ):
+                batch_size = min( batch_size_found, len(train_index) )
+        ds_train.set_train_progress(progress)
         del dloader_train
         dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
 
-        # 学習率の更新
-        lr = args.lr[progress]
+        # 学習率の更新（バッチサイズを探索した場合は、基準のバッチサイズからの比でスケーリング）
+        lr = scale_lr( args.lr[progress], args.batch_size[progress], batch_size, args.lr_scaling ) if args.auto_batch_size else args.lr[progress]
+        print( "progress={}, image_size={}, batch_size={}, lr={}".format(progress, 4 * 2 ** progress, batch_size, lr) )
         for pam_group in optimizer_G.param_groups:
             mul = pam_group.get('mul', 1)
             pam_group['lr'] = lr * mul
@@ -245,7 +286,7 @@ if __name__ == '__main__':
                 model_D.train()
 
                 # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                if inputs["latent_z"].shape[0] != batch_size:
+                if inputs["image_t"].shape[0] != batch_size:
                     break
 
                 # train progress の更新
@@ -253,29 +294,22 @@ if __name__ == '__main__':
                 #print( "step_per_progress={}, step_per_progress_total={}, alpha={}".format(step_per_progress, step_per_progress_total, alpha) )
 
                 # ミニバッチデータを GPU へ転送
-                latent_z = inputs["latent_z"].to(device)
-                noize_map_list = inputs["noize_map_list"]
-                for i in range(len(noize_map_list)):
-                    noize_map_list[i] = noize_map_list[i].to(device)
-                noize_map = noize_map_list[progress]
-
-                image_t_list = inputs["image_t_list"]          
-                for i in range(len(image_t_list)):
-                    image_t_list[i] = image_t_list[i].to(device)
-                image_t = image_t_list[progress].to(device)
+                image_t = inputs["image_t"].to(device)
+
+                # 入力ノイズ z を device 上で生成（ノイズマップは生成器内部で生成）
+                latent_z = torch.randn( (batch_size, args.z_dims), device = device )
                 if( args.debug and n_print > 0 ):
                     print( "[latent_z] shape={}, dtype={}, min={}, max={}".format(latent_z.shape, latent_z.dtype, torch.min(latent_z), torch.max(latent_z)) )
-                    for i in range(len(noize_map_list)):
-                        print( "noize_map_list[{}] shape={}, device={}, dtype={}, min={}, max={}".format(i, noize_map_list[i].shape, noize_map_list[i].device, noize_map_list[i].dtype, torch.min(noize_map_list[i]), torch.max(noize_map_list[i])) )
-                    for i in range(len(image_t_list)):
-                        print( "image_t_list[{}] shape={}, device={}, dtype={}, min={}, max={}".format(i, image_t_list[i].shape, image_t_list[i].device, image_t_list[i].dtype, torch.min(image_t_list[i]), torch.max(image_t_list[i])) )
+                    print( "[image_t] shape={}, device={}, dtype={}, min={}, max={}".format(image_t.shape, image_t.device, image_t.dtype, torch.min(image_t), torch.max(image_t)) )
 
                 #----------------------------------------------------
                 # 生成器 の forword 処理
                 #----------------------------------------------------
-                output = model_G( latent_z, noize_map_list, progress, alpha )
+                output = model_G( latent_z, None, progress, alpha )
+                noize_map = model_G.synthesis_network.noize_map_list[progress]
                 if( args.debug and n_print > 0 ):
                     print( "output.shape : ", output.shape )
+                    print( "noize_map.shape : ", noize_map.shape )
 
                 # Differentiable Augmentation for Data-Efficient GAN Training
                 if( args.data_augument ):
@@ -381,24 +415,16 @@ if __name__ == '__main__':
                         model_D.eval()
 
                         # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                        if inputs["latent_z"].shape[0] != args.batch_size_valid:
+                        if inputs["image_t"].shape[0] != args.batch_size_valid:
                             break
 
                         # ミニバッチデータを GPU へ転送
-                        latent_z = inputs["latent_z"].to(device)
-                        noize_map_list = inputs["noize_map_list"]
-                        for i in range(len(noize_map_list)):
-                            noize_map_list[i] = noize_map_list[i].to(device)
-                        noize_map = noize_map_list[progress]
-
-                        image_t_list = inputs["image_t_list"]          
-                        for i in range(len(image_t_list)):
-                            image_t_list[i] = image_t_list[i].to(device)
-                        image_t = image_t_list[progress].to(device)
-
-                        # 推論処理
+                        image_t = inputs["image_t"].to(device)
+
+                        # 推論処理 / 入力ノイズ z とノイズマップは固定値を使用
                         with torch.no_grad():
-                            output = model_G( latent_z, noize_map_list, progress, alpha )
+                            output = model_G( latent_z_fixed, None, progress, alpha, fixed_noize = True )
+                            noize_map = model_G.synthesis_network.noize_map_list[progress]
 
                         with torch.no_grad():
                             d_real = model_D( image_t, progress, alpha )
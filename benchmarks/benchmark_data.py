@@ -0,0 +1,266 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import argparse
+import json
+import time
+import shutil
+import fnmatch
+import tempfile
+import itertools
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+from benchmark_utils import get_env_info, save_report, load_baseline
+
+#====================================================
+# データパイプラインのベンチマーク（CPU）
+#====================================================
+BENCHMARKS_DIR = os.path.dirname( os.path.abspath(__file__) )
+ROOT_DIR = os.path.dirname( BENCHMARKS_DIR )
+
+def parse_ints( text ):
+    return [ int(x) for x in text.split(",") if x != "" ]
+
+
+def measure_loader( dataset, batch_size, n_workers, pin_memory, prefetch_factor, n_warmup_batches, n_batches ):
+    """
+    DataLoader から n_warmup_batches 個のミニバッチを取得した後の n_batches 個のミニバッチの samples/sec と、最初のミニバッチまでの時間（worker の起動を含む）
+    """
+    import torch
+    kwargs = { "batch_size" : batch_size, "shuffle" : True, "num_workers" : n_workers, "pin_memory" : pin_memory, "drop_last" : True }
+    if( n_workers > 0 ):
+        kwargs["prefetch_factor"] = prefetch_factor
+
+    dloader = torch.utils.data.DataLoader( dataset, **kwargs )
+    start_time = time.perf_counter()
+    dloader_iter = dloader.__iter__()
+    next(dloader_iter)
+    first_batch_ms = ( time.perf_counter() - start_time ) * 1000
+    for _ in range( n_warmup_batches - 1 ):
+        next(dloader_iter)
+
+    start_time = time.perf_counter()
+    for _ in range( n_batches ):
+        next(dloader_iter)
+    elapsed_time = time.perf_counter() - start_time
+    del dloader_iter
+
+    return { "samples_per_sec" : n_batches * batch_size / elapsed_time, "first_batch_ms" : first_batch_ms }
+
+
+def run_dataset( name, args ):
+    """
+    1 つのデータセットについて、合成データセットを生成して、フェーズ毎の処理時間の計測と DataLoader の設定のスイープを行う。
+    データセット毎にプロジェクトのディレクトリを import パスに追加するため、別プロセスで実行する
+    """
+    import torch
+    from torch.utils.data.dataloader import default_collate
+    from dataset_specs import get_dataset_spec, get_args
+    from pipeline_profiler import PipelineProfiler
+
+    spec = get_dataset_spec( name )
+    project_dir = os.path.join( ROOT_DIR, spec["project"] )
+    sys.path.insert( 0, project_dir )
+    os.chdir( project_dir )
+    torch.manual_seed( args.seed )
+    module = __import__( spec["module"], fromlist = [ spec["class_name"] ] )
+
+    # 合成データセット
+    n_samples = max( ( args.n_warmup_batches + args.n_batches ) * args.batch_size, args.n_profile_samples )
+    work_dir = args.data_dir if args.data_dir != "" else tempfile.mkdtemp( prefix = "benchmark_data_" )
+    dataset_root_dir = os.path.join( work_dir, name )
+    if( os.path.isdir(dataset_root_dir) ):
+        shutil.rmtree( dataset_root_dir )
+    os.makedirs( dataset_root_dir )
+    dataset_dir = spec["make_data"]( dataset_root_dir, n_samples, args.source_size, np.random.RandomState(args.seed) )
+
+    augments = [ bool(x) for x in parse_ints(args.augments) ] if spec["augment"] else [ False ]
+    results = { "name" : name, "n_samples" : n_samples, "profiles" : [], "loaders" : [] }
+    try:
+        for augment in augments:
+            dataset = getattr( module, spec["class_name"] )( **spec["kwargs"]( get_args(args.image_size), dataset_dir, args.image_size, augment ) )
+            if( "setup" in spec ):
+                spec["setup"]( dataset, args.image_size )
+
+            # フェーズ毎の処理時間（シングルプロセス）
+            profile = PipelineProfiler().profile( dataset, list(range(args.n_profile_samples)), args.batch_size, default_collate )
+            profile["augment"] = augment
+            results["profiles"].append( profile )
+
+            # DataLoader の設定のスイープ
+            for n_workers, pin_memory, prefetch_factor in itertools.product( parse_ints(args.n_workers), parse_ints(args.pin_memory), parse_ints(args.prefetch_factors) ):
+                # prefetch_factor は n_workers > 0 の場合のみ有効
+                if( n_workers == 0 and prefetch_factor != parse_ints(args.prefetch_factors)[0] ):
+                    continue
+                loader_result = { "augment" : augment, "n_workers" : n_workers, "pin_memory" : bool(pin_memory), "prefetch_factor" : prefetch_factor if n_workers > 0 else None }
+                loader_result.update( measure_loader( dataset, args.batch_size, n_workers, bool(pin_memory), prefetch_factor, args.n_warmup_batches, args.n_batches ) )
+                results["loaders"].append( loader_result )
+    finally:
+        if( args.data_dir == "" ):
+            shutil.rmtree( work_dir, ignore_errors = True )
+
+    return results
+
+
+def get_loader_key( name, loader_result ):
+    return "{}/aug{}/w{}/pin{}/pf{}".format( name, int(loader_result["augment"]), loader_result["n_workers"], int(loader_result["pin_memory"]), loader_result["prefetch_factor"] )
+
+
+def get_recommendations( results, tolerance = 0.05 ):
+    """
+    データオーギュメンテーションの有無毎に、最大の samples/sec の (1 - tolerance) 倍以上になる最小の n_workers の設定
+    """
+    recommendations = []
+    for augment in sorted( set( loader_result["augment"] for loader_result in results["loaders"] ) ):
+        loader_results = [ loader_result for loader_result in results["loaders"] if loader_result["augment"] == augment ]
+        best_samples_per_sec = max( loader_result["samples_per_sec"] for loader_result in loader_results )
+        candidates = [ loader_result for loader_result in loader_results if loader_result["samples_per_sec"] >= best_samples_per_sec * ( 1 - tolerance ) ]
+        recommendation = min( candidates, key = lambda loader_result : ( loader_result["n_workers"], -loader_result["samples_per_sec"] ) )
+        recommendations.append( recommendation )
+    return recommendations
+
+
+def run_dataset_subprocess( name, args ):
+    """
+    run_dataset() を別プロセスで実行する（各プロジェクトの data / utils などの同名のモジュールが衝突しないように）
+    """
+    cmd = [ sys.executable, os.path.abspath(__file__), "--run_dataset", name ] + sys.argv[1:]
+    env = dict( os.environ, MPLBACKEND = "Agg" )
+    if not args.use_gpu:
+        env["CUDA_VISIBLE_DEVICES"] = ""
+    proc = subprocess.run( cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = env, universal_newlines = True, timeout = args.timeout if args.timeout > 0 else None )
+    if( proc.returncode != 0 ):
+        return { "name" : name, "error" : proc.stderr.strip().split("\n")[-1] }
+
+    # データセットのコンストラクタなどの print の後の最後の行が結果
+    return json.loads( proc.stdout.strip().split("\n")[-1] )
+
+
+def compare_with_baseline( results, baseline, max_regression ):
+    """
+    ベースラインと比較して、samples/sec が許容範囲を超えて低下した DataLoader の設定のリスト
+    """
+    baseline_loaders = {}
+    for result in baseline["results"]:
+        for loader_result in result.get( "loaders", [] ):
+            baseline_loaders[get_loader_key(result["name"], loader_result)] = loader_result
+
+    regressions = []
+    for result in results:
+        for loader_result in result.get( "loaders", [] ):
+            key = get_loader_key( result["name"], loader_result )
+            if( key not in baseline_loaders ):
+                continue
+            value, base_value = loader_result["samples_per_sec"], baseline_loaders[key]["samples_per_sec"]
+            if( value < base_value * ( 1 - max_regression ) ):
+                regressions.append( { "case" : key, "value" : value, "baseline" : base_value, "ratio" : value / base_value } )
+
+    return regressions
+
+
+def print_results( results ):
+    from pipeline_profiler import PHASES
+    for result in results:
+        print( "[{}]".format(result["name"]) )
+        if( "error" in result ):
+            print( "  ERROR : {}".format(result["error"]) )
+            continue
+
+        for profile in result["profiles"]:
+            print( "  augment={} : {:.2f} ms/sample ({})".format(
+                profile["augment"], profile["total_ms_per_sample"],
+                ", ".join( [ "{}={:.2f}ms".format(phase, profile["phases_ms_per_sample"][phase]) for phase in PHASES ] ),
+            ) )
+        for loader_result in result["loaders"]:
+            print( "  augment={}, n_workers={}, pin_memory={}, prefetch_factor={} : {:.1f} samples/sec (first batch {:.0f} ms)".format(
+                loader_result["augment"], loader_result["n_workers"], loader_result["pin_memory"], loader_result["prefetch_factor"], loader_result["samples_per_sec"], loader_result["first_batch_ms"],
+            ) )
+        for recommendation in result["recommendations"]:
+            print( "  recommended (augment={}) : n_workers={}, pin_memory={}, prefetch_factor={}".format(
+                recommendation["augment"], recommendation["n_workers"], recommendation["pin_memory"], recommendation["prefetch_factor"],
+            ) )
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--datasets', type=str, default="*", help="計測するデータセット名（カンマ区切り・ワイルドカード可）")
+    parser.add_argument('--image_size', type=int, default=256, help="データセットの出力画像の解像度")
+    parser.add_argument('--source_size', type=int, default=512, help="合成データセットの画像の解像度")
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--n_workers', type=str, default="0,2,4", help="スイープする DataLoader の num_workers（カンマ区切り）")
+    parser.add_argument('--pin_memory', type=str, default="0,1", help="スイープする DataLoader の pin_memory（カンマ区切りの 0 / 1）")
+    parser.add_argument('--prefetch_factors', type=str, default="2,4", help="スイープする DataLoader の prefetch_factor（カンマ区切り。num_workers > 0 の場合のみ）")
+    parser.add_argument('--augments', type=str, default="0,1", help="スイープするデータオーギュメンテーションの有無（カンマ区切りの 0 / 1）")
+    parser.add_argument('--n_warmup_batches', type=int, default=2, help="計測前に取得するミニバッチ数（worker の起動を含む）")
+    parser.add_argument('--n_batches', type=int, default=10, help="samples/sec の計測に使うミニバッチ数")
+    parser.add_argument('--n_profile_samples', type=int, default=32, help="フェーズ毎の処理時間の計測に使うサンプル数")
+    parser.add_argument('--data_dir', type=str, default="", help="合成データセットの保存ディレクトリ（指定しない場合は一時ディレクトリに作成して計測後に削除する）")
+    parser.add_argument('--use_gpu', action='store_true', help="GPU を有効にして計測する（指定しない場合は CUDA_VISIBLE_DEVICES を空にして実行する。pin_memory は GPU がある場合のみ効果がある）")
+    parser.add_argument('--seed', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=1800, help="1 データセットあたりのタイムアウト [秒]（0 の場合はタイムアウトなし）")
+    parser.add_argument('--results_path', type=str, default=os.path.join(BENCHMARKS_DIR, "results", "benchmark_data.json"), help="計測結果の json ファイル")
+    parser.add_argument('--baseline_path', type=str, default=os.path.join(BENCHMARKS_DIR, "baselines", "benchmark_data_cpu.json"), help="比較するベースラインの json ファイル")
+    parser.add_argument('--save_baseline', action='store_true', help="計測結果をベースラインとして保存する")
+    parser.add_argument('--max_regression', type=float, default=0.15, help="samples/sec の低下の許容割合（ベースライン比）")
+    parser.add_argument('--run_dataset', type=str, default="", help="（内部用）指定したデータセットのみを計測して結果を標準出力に出力する")
+    args = parser.parse_args()
+
+    # 別プロセスでの 1 データセットの計測
+    if( args.run_dataset != "" ):
+        result = run_dataset( args.run_dataset, args )
+        print( json.dumps(result) )
+        sys.exit(0)
+
+    from dataset_specs import DATASET_SPECS
+    patterns = [ pattern for pattern in args.datasets.split(",") if pattern != "" ]
+    specs = [ spec for spec in DATASET_SPECS if any( fnmatch.fnmatchcase(spec["name"], pattern) for pattern in patterns ) ]
+
+    results = []
+    for spec in specs:
+        print( "[{}]".format(spec["name"]) )
+        try:
+            result = run_dataset_subprocess( spec["name"], args )
+        except subprocess.TimeoutExpired:
+            result = { "name" : spec["name"], "error" : "timeout ({} sec)".format(args.timeout) }
+        if( "error" not in result ):
+            result["recommendations"] = get_recommendations( result )
+        results.append( result )
+
+    print( "----------------------------------------------" )
+    print_results( results )
+    print( "----------------------------------------------" )
+
+    # 計測結果の保存
+    report = {
+        "created_at" : datetime.now().isoformat(),
+        "env" : get_env_info(),
+        "config" : {
+            "image_size" : args.image_size, "source_size" : args.source_size, "batch_size" : args.batch_size,
+            "n_warmup_batches" : args.n_warmup_batches, "n_batches" : args.n_batches, "n_profile_samples" : args.n_profile_samples, "seed" : args.seed,
+        },
+        "results" : results,
+    }
+    save_report( report, args.results_path )
+    if( args.save_baseline ):
+        save_report( report, args.baseline_path )
+
+    # ベースラインとの比較
+    n_errors = sum( 1 for result in results if "error" in result )
+    regressions = []
+    baseline = load_baseline( args.baseline_path, report["env"] ) if not args.save_baseline else None
+    if( baseline is not None ):
+        if( baseline["config"] != report["config"] ):
+            print( "[WARNING] baseline was measured with a different config : {}".format(baseline["config"]) )
+        regressions = compare_with_baseline( results, baseline, args.max_regression )
+        for regression in regressions:
+            print( "[REGRESSION] {} samples/sec : {:.1f} -> {:.1f} (x{:.2f})".format( regression["case"], regression["baseline"], regression["value"], regression["ratio"] ) )
+
+    if( n_errors > 0 or len(regressions) > 0 ):
+        print( "FAILED : {} errors, {} regressions".format( n_errors, len(regressions) ) )
+        sys.exit(1)
+
+    print( "PASSED" )
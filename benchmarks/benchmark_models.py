@@ -0,0 +1,257 @@
+# -*- coding:utf-8 -*-
+import os
+import sys
+import argparse
+import json
+import time
+import fnmatch
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+from benchmark_utils import get_env_info, save_report, load_baseline
+
+#====================================================
+# モデルのマイクロベンチマーク（CPU）
+#====================================================
+BENCHMARKS_DIR = os.path.dirname( os.path.abspath(__file__) )
+ROOT_DIR = os.path.dirname( BENCHMARKS_DIR )
+
+# 事前学習済みの重みをダウンロードする torchvision のモデル
+PRETRAINED_MODEL_NAMES = [ "vgg16", "vgg19", "resnet34", "resnet50", "resnet101", "densenet201" ]
+
+def disable_pretrained_weights():
+    """
+    オフラインの環境でも動作するように、torchvision のモデルを事前学習済みの重みなしで生成する（処理時間・メモリ使用量は重みの値に依存しない）。
+    モデルを定義しているモジュールを import する前に呼ぶ
+    """
+    import torchvision.models as models
+    def make_fn( fn ):
+        def fn_wo_pretrained( *args, **kwargs ):
+            kwargs.pop( "pretrained", None )
+            kwargs.pop( "weights", None )
+            return fn( **kwargs )
+        return fn_wo_pretrained
+
+    for name in PRETRAINED_MODEL_NAMES:
+        if hasattr( models, name ):
+            setattr( models, name, make_fn( getattr(models, name) ) )
+    return
+
+
+def get_max_rss_mb():
+    """
+    プロセスの最大常駐メモリ [MB]（Linux の ru_maxrss は KB 単位、macOS は byte 単位）
+    """
+    import resource
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if( sys.platform == "darwin" ):
+        return max_rss / 1024 ** 2
+    return max_rss / 1024
+
+
+def get_loss( outputs ):
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    outputs = outputs if isinstance(outputs, (tuple, list)) else [outputs]
+    return sum( output.float().mean() for output in outputs if hasattr(output, "requires_grad") and output.requires_grad )
+
+
+def get_stats( times_ms ):
+    times_ms = np.array(times_ms)
+    return { "median" : float(np.median(times_ms)), "mean" : float(times_ms.mean()), "std" : float(times_ms.std()), "min" : float(times_ms.min()) }
+
+
+def run_case( name, resolution, batch_size, n_warmups, n_repeats, n_threads, seed ):
+    """
+    1 つの（モデル, 解像度, バッチサイズ）の forward・forward + backward の処理時間とピークメモリ使用量を計測する。
+    モデル毎にプロジェクトのディレクトリを import パスに追加するため、別プロセスで実行する
+    """
+    import torch
+    from model_specs import get_model_spec
+
+    spec = get_model_spec( name )
+    project_dir = os.path.join( ROOT_DIR, spec["project"] )
+    sys.path.insert( 0, project_dir )
+    os.chdir( project_dir )
+
+    disable_pretrained_weights()
+    torch.manual_seed( seed )
+    np.random.seed( seed )
+    if( n_threads > 0 ):
+        torch.set_num_threads( n_threads )
+
+    module = __import__( spec["module"], fromlist = [ spec["class_name"] ] )
+    model = getattr( module, spec["class_name"] )( **spec["kwargs"](resolution) )
+    inputs = spec["inputs"]( batch_size, resolution )
+    forward_kwargs = spec["forward_kwargs"](resolution) if "forward_kwargs" in spec else {}
+    n_params = sum( param.numel() for param in model.parameters() )
+
+    # forward（推論時）
+    model.eval()
+    forward_ms = []
+    with torch.no_grad():
+        for i in range( n_warmups + n_repeats ):
+            start_time = time.perf_counter()
+            model( *inputs, **forward_kwargs )
+            if( i >= n_warmups ):
+                forward_ms.append( ( time.perf_counter() - start_time ) * 1000 )
+
+    # forward + backward（学習時）
+    model.train()
+    max_rss_mb_before = get_max_rss_mb()
+    forward_backward_ms = []
+    for i in range( n_warmups + n_repeats ):
+        model.zero_grad( set_to_none = True )
+        start_time = time.perf_counter()
+        loss = get_loss( model( *inputs, **forward_kwargs ) )
+        loss.backward()
+        if( i >= n_warmups ):
+            forward_backward_ms.append( ( time.perf_counter() - start_time ) * 1000 )
+
+    max_rss_mb = get_max_rss_mb()
+    result = {
+        "name" : name,
+        "resolution" : resolution,
+        "batch_size" : batch_size,
+        "n_params" : n_params,
+        "forward_ms" : get_stats( forward_ms ),
+        "forward_backward_ms" : get_stats( forward_backward_ms ),
+        "peak_memory_mb" : max_rss_mb,
+        "train_peak_memory_increase_mb" : max( max_rss_mb - max_rss_mb_before, 0.0 ),
+        "images_per_sec" : batch_size / ( np.median(forward_backward_ms) / 1000 ),
+    }
+    return result
+
+
+def get_case_key( result ):
+    return "{}/res{}/bs{}".format( result["name"], result["resolution"], result["batch_size"] )
+
+
+def run_case_subprocess( name, resolution, batch_size, args ):
+    """
+    run_case() を別プロセスで実行する（各プロジェクトの models / utils などの同名のモジュールが衝突しないように・ピークメモリをケース毎に計測するため）
+    """
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--run_case", name,
+        "--resolution", str(resolution), "--batch_size", str(batch_size),
+        "--n_warmups", str(args.n_warmups), "--n_repeats", str(args.n_repeats), "--n_threads", str(args.n_threads), "--seed", str(args.seed),
+    ]
+    env = dict( os.environ, CUDA_VISIBLE_DEVICES = "", MPLBACKEND = "Agg" )
+    proc = subprocess.run( cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, env = env, universal_newlines = True, timeout = args.timeout if args.timeout > 0 else None )
+    if( proc.returncode != 0 ):
+        return { "name" : name, "resolution" : resolution, "batch_size" : batch_size, "error" : proc.stderr.strip().split("\n")[-1] }
+
+    # モデルのコンストラクタなどの print の後の最後の行が結果
+    return json.loads( proc.stdout.strip().split("\n")[-1] )
+
+
+def compare_with_baseline( results, baseline, max_time_regression, max_memory_regression ):
+    """
+    ベースラインと比較して、処理時間（中央値）・ピークメモリ使用量が許容範囲を超えて増加したケースのリスト
+    """
+    baseline_results = { get_case_key(result) : result for result in baseline["results"] if "error" not in result }
+    regressions = []
+    for result in results:
+        key = get_case_key(result)
+        if( "error" in result or key not in baseline_results ):
+            continue
+
+        base = baseline_results[key]
+        metrics = [
+            ( "forward_ms", result["forward_ms"]["median"], base["forward_ms"]["median"], max_time_regression ),
+            ( "forward_backward_ms", result["forward_backward_ms"]["median"], base["forward_backward_ms"]["median"], max_time_regression ),
+            ( "peak_memory_mb", result["peak_memory_mb"], base["peak_memory_mb"], max_memory_regression ),
+        ]
+        for metric, value, base_value, max_regression in metrics:
+            if( base_value > 0 and value > base_value * ( 1 + max_regression ) ):
+                regressions.append( { "case" : key, "metric" : metric, "value" : value, "baseline" : base_value, "ratio" : value / base_value } )
+
+    return regressions
+
+
+def print_results( results ):
+    print( "{:<50} {:>10} {:>14} {:>12} {:>12}".format( "case", "fwd [ms]", "fwd+bwd [ms]", "peak [MB]", "images/sec" ) )
+    for result in results:
+        if( "error" in result ):
+            print( "{:<50} ERROR : {}".format( get_case_key(result), result["error"] ) )
+            continue
+        print( "{:<50} {:>10.2f} {:>14.2f} {:>12.1f} {:>12.2f}".format(
+            get_case_key(result), result["forward_ms"]["median"], result["forward_backward_ms"]["median"], result["peak_memory_mb"], result["images_per_sec"],
+        ) )
+    return
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--models', type=str, default="*", help="計測するモデル名（カンマ区切り・ワイルドカード可）")
+    parser.add_argument('--resolutions', type=str, default="", help="計測する解像度（カンマ区切り。指定しない場合はモデル毎のデフォルト値）")
+    parser.add_argument('--batch_sizes', type=str, default="", help="計測するバッチサイズ（カンマ区切り。指定しない場合はモデル毎のデフォルト値）")
+    parser.add_argument('--n_warmups', type=int, default=2, help="計測前のウォームアップの回数")
+    parser.add_argument('--n_repeats', type=int, default=5, help="計測の繰り返し回数")
+    parser.add_argument('--n_threads', type=int, default=1, help="PyTorch の CPU スレッド数（計測値の再現性のため固定する。0 の場合は PyTorch のデフォルト値）")
+    parser.add_argument('--seed', type=int, default=8)
+    parser.add_argument('--timeout', type=float, default=1800, help="1 ケースあたりのタイムアウト [秒]（0 の場合はタイムアウトなし）")
+    parser.add_argument('--results_path', type=str, default=os.path.join(BENCHMARKS_DIR, "results", "benchmark_models.json"), help="計測結果の json ファイル")
+    parser.add_argument('--baseline_path', type=str, default=os.path.join(BENCHMARKS_DIR, "baselines", "benchmark_models_cpu.json"), help="比較するベースラインの json ファイル")
+    parser.add_argument('--save_baseline', action='store_true', help="計測結果をベースラインとして保存する")
+    parser.add_argument('--max_time_regression', type=float, default=0.15, help="処理時間の増加の許容割合（ベースライン比）")
+    parser.add_argument('--max_memory_regression', type=float, default=0.10, help="ピークメモリ使用量の増加の許容割合（ベースライン比）")
+    parser.add_argument('--run_case', type=str, default="", help="（内部用）指定したモデルの 1 ケースのみを計測して結果を標準出力に出力する")
+    parser.add_argument('--resolution', type=int, default=0, help="（内部用）--run_case での解像度")
+    parser.add_argument('--batch_size', type=int, default=0, help="（内部用）--run_case でのバッチサイズ")
+    args = parser.parse_args()
+
+    # 別プロセスでの 1 ケースの計測
+    if( args.run_case != "" ):
+        result = run_case( args.run_case, args.resolution, args.batch_size, args.n_warmups, args.n_repeats, args.n_threads, args.seed )
+        print( json.dumps(result) )
+        sys.exit(0)
+
+    from model_specs import MODEL_SPECS
+    patterns = [ pattern for pattern in args.models.split(",") if pattern != "" ]
+    specs = [ spec for spec in MODEL_SPECS if any( fnmatch.fnmatchcase(spec["name"], pattern) for pattern in patterns ) ]
+
+    results = []
+    for spec in specs:
+        resolutions = [ int(x) for x in args.resolutions.split(",") ] if args.resolutions != "" else spec["resolutions"]
+        batch_sizes = [ int(x) for x in args.batch_sizes.split(",") ] if args.batch_sizes != "" else spec["batch_sizes"]
+        for resolution in resolutions:
+            for batch_size in batch_sizes:
+                print( "[{}] resolution={}, batch_size={}".format( spec["name"], resolution, batch_size ) )
+                try:
+                    result = run_case_subprocess( spec["name"], resolution, batch_size, args )
+                except subprocess.TimeoutExpired:
+                    result = { "name" : spec["name"], "resolution" : resolution, "batch_size" : batch_size, "error" : "timeout ({} sec)".format(args.timeout) }
+                results.append( result )
+
+    print( "----------------------------------------------" )
+    print_results( results )
+    print( "----------------------------------------------" )
+
+    # 計測結果の保存
+    report = {
+        "created_at" : datetime.now().isoformat(),
+        "env" : get_env_info( args.n_threads ),
+        "config" : { "n_warmups" : args.n_warmups, "n_repeats" : args.n_repeats, "seed" : args.seed },
+        "results" : results,
+    }
+    save_report( report, args.results_path )
+    if( args.save_baseline ):
+        save_report( report, args.baseline_path )
+
+    # ベースラインとの比較
+    n_errors = sum( 1 for result in results if "error" in result )
+    regressions = []
+    baseline = load_baseline( args.baseline_path, report["env"] ) if not args.save_baseline else None
+    if( baseline is not None ):
+        regressions = compare_with_baseline( results, baseline, args.max_time_regression, args.max_memory_regression )
+        for regression in regressions:
+            print( "[REGRESSION] {} {} : {:.2f} -> {:.2f} (x{:.2f})".format( regression["case"], regression["metric"], regression["baseline"], regression["value"], regression["ratio"] ) )
+
+    if( n_errors > 0 or len(regressions) > 0 ):
+        print( "FAILED : {} errors, {} regressions".format( n_errors, len(regressions) ) )
+        sys.exit(1)
+
+    print( "PASSED" )
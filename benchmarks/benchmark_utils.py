@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+import os
+import json
+import platform
+
+#====================================================
+# ベンチマークの共通処理
+#====================================================
+def get_env_info( n_threads = 0 ):
+    """
+    計測環境の情報（ベースラインと計測環境が異なる場合の警告用）
+    """
+    try:
+        import torch
+        torch_version = torch.__version__
+        n_threads = n_threads if n_threads > 0 else torch.get_num_threads()
+        cuda_available = torch.cuda.is_available()
+    except ImportError:
+        torch_version = None
+        cuda_available = False
+    return {
+        "python" : platform.python_version(),
+        "torch" : torch_version,
+        "platform" : platform.platform(),
+        "processor" : platform.processor(),
+        "cpu_count" : os.cpu_count(),
+        "n_threads" : n_threads,
+        "cuda_available" : cuda_available,
+    }
+
+
+def save_report( report, save_path ):
+    if( os.path.dirname(save_path) != "" and not os.path.isdir(os.path.dirname(save_path)) ):
+        os.makedirs( os.path.dirname(save_path) )
+    with open( save_path, "w" ) as f:
+        json.dump( report, f, indent = 4 )
+    print( "saved {}".format(save_path) )
+    return
+
+
+def load_baseline( baseline_path, env ):
+    """
+    ベースラインの json ファイル。存在しない場合は None
+    """
+    if not os.path.exists(baseline_path):
+        print( "baseline not found : {}. skip the comparison (run with --save_baseline to create it)".format(baseline_path) )
+        return None
+
+    with open( baseline_path, "r" ) as f:
+        baseline = json.load(f)
+    if( baseline["env"] != env ):
+        print( "[WARNING] baseline was measured in a different environment : {}".format(baseline["env"]) )
+    return baseline
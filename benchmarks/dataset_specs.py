@@ -0,0 +1,239 @@
+# -*- coding:utf-8 -*-
+import os
+import argparse
+
+import numpy as np
+from PIL import Image
+
+#====================================================
+# 合成データセットの生成
+#====================================================
+def make_image( width, height, rng ):
+    """
+    低周波のランダムなパターンに弱いノイズを加えた RGB 画像（一様ノイズよりも自然画像に近い圧縮率・デコード時間になるように）
+    """
+    image = Image.fromarray( rng.randint(0, 256, (8, 8, 3)).astype(np.uint8) ).resize( (width, height), Image.BILINEAR )
+    image = np.asarray(image).astype(np.float32) + rng.normal(0, 8, (height, width, 3))
+    return Image.fromarray( np.clip(image, 0, 255).astype(np.uint8) )
+
+
+def make_label_map( width, height, rng, n_classes = 20 ):
+    """
+    セグメンテーション画像（ラベル値を画素値とするグレースケール画像）
+    """
+    return Image.fromarray( rng.randint(0, n_classes, (8, 8)).astype(np.uint8), mode = "L" ).resize( (width, height), Image.NEAREST )
+
+
+def make_label_map_rgb( width, height, rng, n_classes = 20 ):
+    palette = rng.randint(0, 256, (n_classes, 3)).astype(np.uint8)
+    return Image.fromarray( palette[ np.asarray( make_label_map(width, height, rng, n_classes) ) ] )
+
+
+def save_images( image_dir, names, make_fn, width, height, rng ):
+    if not os.path.isdir(image_dir):
+        os.makedirs(image_dir)
+    for name in names:
+        make_fn( width, height, rng ).save( os.path.join(image_dir, name) )
+    return
+
+
+def make_templete_data( root_dir, n_samples, source_size, rng ):
+    names = [ "{}.png".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "image"), names, make_image, source_size, source_size, rng )
+    save_images( os.path.join(root_dir, "target"), names, make_label_map, source_size, source_size, rng )
+    return root_dir
+
+
+def make_cihp_data( root_dir, n_samples, source_size, rng ):
+    ids = [ "{:07d}".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "Images"), [ id + ".jpg" for id in ids ], make_image, source_size, source_size, rng )
+    save_images( os.path.join(root_dir, "Category_ids"), [ id + ".png" for id in ids ], make_label_map, source_size, source_size, rng )
+    save_images( os.path.join(root_dir, "Category_rev_ids"), [ id + ".png" for id in ids ], make_label_map, source_size, source_size, rng )
+    os.makedirs( os.path.join(root_dir, "lists") )
+    with open( os.path.join(root_dir, "lists", "train_id.txt"), "w" ) as f:
+        f.write( "\n".join(ids) )
+    return root_dir
+
+
+def make_deepsim_data( root_dir, n_samples, source_size, rng ):
+    names = [ "{}.png".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "car", "train_A"), names, make_label_map_rgb, source_size, source_size, rng )
+    save_images( os.path.join(root_dir, "car", "train_B"), names, make_image, source_size, source_size, rng )
+    save_images( os.path.join(root_dir, "car", "test_A"), names[:1], make_label_map_rgb, source_size, source_size, rng )
+    return root_dir
+
+
+def make_zalando_data( root_dir, n_samples, source_size, rng ):
+    names = [ "{}.png".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "pose"), names, make_image, source_size * 3 // 4, source_size, rng )
+    save_images( os.path.join(root_dir, "pose_parsing"), names, make_label_map, source_size * 3 // 4, source_size, rng )
+    return root_dir
+
+
+def make_zalando_pairs_data( root_dir, n_samples, source_size, rng ):
+    names = [ "{}.png".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "pose"), names, make_image, source_size * 3 // 4, source_size, rng )
+    save_images( os.path.join(root_dir, "pose_parsing_rgb"), names, make_label_map_rgb, source_size * 3 // 4, source_size, rng )
+    with open( os.path.join(root_dir, "train_pairs.csv"), "w" ) as f:
+        f.write( "pose_name,pose_parsing_name\n" )
+        f.write( "".join( [ "{},{}\n".format(name, name) for name in names ] ) )
+    return root_dir
+
+
+def make_geo_data( root_dir, n_samples, source_size, rng ):
+    save_images( root_dir, [ "{}.jpg".format(i) for i in range(n_samples) ], make_image, source_size, source_size, rng )
+    return root_dir
+
+
+def make_pf_data( root_dir, n_samples, source_size, rng ):
+    names = [ "{}.jpg".format(i) for i in range(n_samples) ]
+    save_images( os.path.join(root_dir, "car(G)"), names, make_image, source_size, source_size * 3 // 4, rng )
+    save_images( os.path.join(root_dir, "car(M)"), names, make_image, source_size, source_size * 3 // 4, rng )
+    return root_dir
+
+
+def make_map2aerial_data( root_dir, n_samples, source_size, rng ):
+    # 左側に衛星画像、右側に地図画像を並べた画像
+    save_images( os.path.join(root_dir, "train"), [ "{}.jpg".format(i) for i in range(n_samples) ], make_image, source_size * 2, source_size, rng )
+    return root_dir
+
+
+def make_image_folder_data( root_dir, n_samples, source_size, rng ):
+    save_images( root_dir, [ "{}.png".format(i) for i in range(n_samples) ], make_image, source_size, source_size, rng )
+    return root_dir
+
+
+#====================================================
+# ベンチマーク対象のデータセットの定義
+#====================================================
+# 各データセットは、以下の key を持つ dict
+#   name : <str> ベンチマークでのデータセット名
+#   project : <str> データセットを定義しているディレクトリ（リポジトリのルートからの相対パス）
+#   module : <str> データセットのクラスを定義しているモジュール名（project をカレントディレクトリとした import 名）
+#   class_name : <str> データセットのクラス名
+#   make_data : root_dir, n_samples, source_size, rng を引数に、合成データセットを生成してデータセットのディレクトリを返す関数
+#   kwargs : args, dataset_dir, image_size, augment を引数に、データセットのコンストラクタの引数（dict）を返す関数
+#   augment : <bool> データオーギュメンテーションの有無を切り替えられるか
+#   setup : dataset, image_size を引数に、DataLoader の作成前に呼ぶ関数（省略可）
+def get_args( image_size ):
+    """
+    データセットのコンストラクタに渡す学習スクリプトのコマンドライン引数
+    """
+    return argparse.Namespace(
+        image_height = image_size, image_width = image_size, image_size = image_size,
+        n_classes = 20, n_output_channels = 20, tps_points_per_dim = 3, debug = False,
+    )
+
+
+DATASET_SPECS = [
+    {
+        "name" : "TempleteDataset",
+        "project" : "templetes/templete_pytorch",
+        "module" : "data.dataset",
+        "class_name" : "TempleteDataset",
+        "make_data" : make_templete_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "image_height" : image_size, "image_width" : image_size, "data_augument" : augment },
+        "augment" : True,
+    },
+    {
+        "name" : "CIHPDataset",
+        "project" : "GCN_graphonomy",
+        "module" : "dataset",
+        "class_name" : "CIHPDataset",
+        "make_data" : make_cihp_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "flip" : False, "data_augument" : augment },
+        "augment" : True,
+    },
+    {
+        "name" : "DeepSIMDataset",
+        "project" : "DA_DeepSIM",
+        "module" : "data.deepsim_dataset",
+        "class_name" : "DeepSIMDataset",
+        "make_data" : make_deepsim_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "dataset_dir" : dataset_dir, "datamode" : "train", "data_type" : "car", "image_height" : image_size, "image_width" : image_size, "data_augument_type" : "full" if augment else "none" },
+        "augment" : True,
+    },
+    {
+        "name" : "ZalandoDataset",
+        "project" : "AdaIN_SPADE_pix2pixHD",
+        "module" : "data.zalando_dataset",
+        "class_name" : "ZalandoDataset",
+        "make_data" : make_zalando_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "image_height" : image_size, "image_width" : image_size, "n_classes" : 20, "data_augument" : augment },
+        "augment" : True,
+    },
+    {
+        "name" : "ZalandoDataset_UNetBasedDiscriminator",
+        "project" : "GAN_UNetBasedDiscriminator",
+        "module" : "data.zalando_dataset",
+        "class_name" : "ZalandoDataset",
+        "make_data" : make_zalando_pairs_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "dataset_dir" : dataset_dir, "pairs_file" : "train_pairs.csv", "datamode" : "train", "image_height" : image_size, "image_width" : image_size, "data_augument" : augment },
+        "augment" : True,
+    },
+    {
+        "name" : "GeoDataset",
+        "project" : "CNN_GeometricMatchingCNN",
+        "module" : "data.geo_dataset",
+        "class_name" : "GeoDataset",
+        "make_data" : make_geo_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "dataset_dir" : dataset_dir, "image_height" : image_size, "image_width" : image_size, "data_augument" : augment, "geometric_model" : "affine" },
+        "augment" : True,
+    },
+    {
+        "name" : "PFDataset",
+        "project" : "CNN_GeometricMatchingCNN",
+        "module" : "data.pf_dataset",
+        "class_name" : "PFDataset",
+        "make_data" : make_pf_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "dataset_dir" : dataset_dir, "image_height" : image_size, "image_width" : image_size },
+        "augment" : False,
+    },
+    {
+        "name" : "Map2AerialDataset",
+        "project" : "UNet_PyTorch",
+        "module" : "map2aerial_dataset",
+        "class_name" : "Map2AerialDataset",
+        "make_data" : make_map2aerial_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "root_dir" : dataset_dir, "datamode" : "train", "image_height" : image_size, "image_width" : image_size },
+        "augment" : False,
+    },
+    {
+        "name" : "NoizeDataset_LightweightGAN",
+        "project" : "GAN_LightweightGAN",
+        "module" : "data.noize_dataset",
+        "class_name" : "NoizeDataset",
+        "make_data" : make_image_folder_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "image_size" : image_size, "z_dims" : 256 },
+        "augment" : False,
+    },
+    {
+        # 最終解像度の progress での読み込み
+        "name" : "NoizeDataset_StyleGAN",
+        "project" : "_in_progress/GAN_StyleGAN",
+        "module" : "data.noize_dataset",
+        "class_name" : "NoizeDataset",
+        "make_data" : make_image_folder_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "image_size_init" : 4, "image_size_final" : image_size, "z_dims" : 512 },
+        "augment" : False,
+        "setup" : lambda dataset, image_size : dataset.set_train_progress( image_size.bit_length() - 1 - 2 ),
+    },
+    {
+        # 多解像度の画像キャッシュからの読み込み（キャッシュの作成時間は含まない）
+        "name" : "NoizeDataset_StyleGAN_pyramid_cache",
+        "project" : "_in_progress/GAN_StyleGAN",
+        "module" : "data.noize_dataset",
+        "class_name" : "NoizeDataset",
+        "make_data" : make_image_folder_data,
+        "kwargs" : lambda args, dataset_dir, image_size, augment : { "args" : args, "root_dir" : dataset_dir, "datamode" : "train", "image_size_init" : 4, "image_size_final" : image_size, "z_dims" : 512, "pyramid_cache_dir" : dataset_dir + "_pyramid_cache" },
+        "augment" : False,
+        "setup" : lambda dataset, image_size : dataset.set_train_progress( image_size.bit_length() - 1 - 2 ),
+    },
+]
+
+
+def get_dataset_spec( name ):
+    for spec in DATASET_SPECS:
+        if( spec["name"] == name ):
+            return spec
+    raise ValueError( "unknown dataset : {}".format(name) )
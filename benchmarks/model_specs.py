@@ -0,0 +1,193 @@
+# -*- coding:utf-8 -*-
+import torch
+
+#====================================================
+# ベンチマーク対象のモデルの定義
+#====================================================
+# 各モデルは、以下の key を持つ dict
+#   name : <str> ベンチマークでのモデル名
+#   project : <str> モデルを定義しているディレクトリ（リポジトリのルートからの相対パス）
+#   module : <str> モデルのクラスを定義しているモジュール名（project をカレントディレクトリとした import 名）
+#   class_name : <str> モデルのクラス名
+#   kwargs : resolution を引数に、モデルのコンストラクタの引数（dict）を返す関数
+#   inputs : batch_size, resolution を引数に、forward の入力（tuple）を返す関数
+#   forward_kwargs : resolution を引数に、forward のキーワード引数（dict）を返す関数（省略可）
+#   resolutions : <list> デフォルトで計測する解像度（GCN の場合はノード数）
+#   batch_sizes : <list> デフォルトで計測するバッチサイズ
+def get_graphonomy_inputs( batch_size, resolution ):
+    # models.graph_params は Graphonomy のディレクトリを import パスに追加した後に import する
+    from models.graph_params import get_graph_adj_matrix
+    adj_matrix_cihp_to_cihp, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_pascal = get_graph_adj_matrix()
+    adj_matrix_pascal_to_cihp = adj_matrix_cihp_to_pascal.transpose(2,3)
+    image = torch.randn( batch_size, 3, resolution, resolution )
+    return ( image, adj_matrix_pascal_to_pascal, adj_matrix_cihp_to_cihp, adj_matrix_cihp_to_pascal, adj_matrix_pascal_to_cihp )
+
+
+def get_gcn_inputs( batch_size, n_nodes, n_features = 1433, n_edges_per_node = 4 ):
+    """
+    GCN_sample_classication（Cora データセット相当）の入力。行方向に正規化した疎な隣接行列（自己ループあり）
+    """
+    features = torch.randn( n_nodes, n_features )
+    rows = torch.arange(n_nodes).repeat_interleave(n_edges_per_node + 1)
+    cols = torch.cat( [ torch.arange(n_nodes).unsqueeze(1), torch.randint(0, n_nodes, (n_nodes, n_edges_per_node)) ], dim = 1 ).view(-1)
+    values = torch.full( (rows.shape[0],), 1.0 / ( n_edges_per_node + 1 ) )
+    adj = torch.sparse_coo_tensor( torch.stack([rows, cols]), values, (n_nodes, n_nodes) ).coalesce()
+    return ( features, adj )
+
+
+MODEL_SPECS = [
+    {
+        "name" : "Pix2PixHDGenerator",
+        "project" : "Attention_pix2pixHD",
+        "module" : "models.generators",
+        "class_name" : "Pix2PixHDGenerator",
+        "kwargs" : lambda resolution : { "input_nc" : 3, "output_nc" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "Pix2PixHDAttentionGenerator",
+        "project" : "Attention_pix2pixHD",
+        "module" : "models.generators",
+        "class_name" : "Pix2PixHDAttentionGenerator",
+        "kwargs" : lambda resolution : { "input_nc" : 3, "output_nc" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "Pix2PixHDAdaINGenerator",
+        "project" : "AdaIN_SPADE_pix2pixHD",
+        "module" : "models.generators",
+        "class_name" : "Pix2PixHDAdaINGenerator",
+        "kwargs" : lambda resolution : { "input_nc" : 20, "output_nc" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 20, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "Pix2PixHDSPADEGenerator",
+        "project" : "AdaIN_SPADE_pix2pixHD",
+        "module" : "models.generators",
+        "class_name" : "Pix2PixHDSPADEGenerator",
+        "kwargs" : lambda resolution : { "input_nc" : 20, "output_nc" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 20, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "Pix2PixHDSPADEGenerator_fused",
+        "project" : "AdaIN_SPADE_pix2pixHD",
+        "module" : "models.generators",
+        "class_name" : "Pix2PixHDSPADEGenerator",
+        "kwargs" : lambda resolution : { "input_nc" : 20, "output_nc" : 3, "fused_spade" : True },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 20, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "UNetGenerator",
+        "project" : "UNet_PyTorch",
+        "module" : "networks",
+        "class_name" : "UNetGenerator",
+        "kwargs" : lambda resolution : { "n_in_channels" : 3, "n_out_channels" : 3, "n_fmaps" : 64, "n_downsampling" : 4 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "resolutions" : [128, 256],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "LightweightGANGenerator",
+        "project" : "GAN_LightweightGAN",
+        "module" : "models.generators",
+        "class_name" : "LightweightGANGenerator",
+        "kwargs" : lambda resolution : { "z_dims" : 256, "n_fmaps" : 64, "out_dims" : 3, "image_size" : resolution },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 256), ),
+        "resolutions" : [256, 512],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        "name" : "LightweightGANDiscriminator",
+        "project" : "GAN_LightweightGAN",
+        "module" : "models.discriminators",
+        "class_name" : "LightweightGANDiscriminator",
+        "kwargs" : lambda resolution : { "in_dim" : 3, "n_fmaps" : 64, "image_size" : resolution },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "resolutions" : [256, 512],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        # progress = log2(resolution) - 2 で、resolution の解像度のみの（α = 1.0 の）ネットワーク
+        "name" : "ProgressiveGenerator",
+        "project" : "GAN_PGGAN_PyTorch",
+        "module" : "networks",
+        "class_name" : "ProgressiveGenerator",
+        "kwargs" : lambda resolution : { "init_image_size" : 4, "final_image_size" : resolution, "n_input_noize_z" : 128, "n_rgb" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 128, 1, 1), ),
+        "forward_kwargs" : lambda resolution : { "progress" : float( resolution.bit_length() - 1 - 2 ) },
+        "resolutions" : [8, 32],
+        "batch_sizes" : [16, 64],
+    },
+    {
+        "name" : "ProgressiveDiscriminator",
+        "project" : "GAN_PGGAN_PyTorch",
+        "module" : "networks",
+        "class_name" : "ProgressiveDiscriminator",
+        "kwargs" : lambda resolution : { "init_image_size" : 4, "final_image_size" : resolution, "n_fmaps" : 128, "n_rgb" : 3 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "forward_kwargs" : lambda resolution : { "progress" : float( resolution.bit_length() - 1 - 2 ) },
+        "resolutions" : [8, 32],
+        "batch_sizes" : [16, 64],
+    },
+    {
+        # 特徴抽出（VGG）の事前学習済みの重みはダウンロードしない
+        "name" : "GeometricMatchingCNN",
+        "project" : "CNN_GeometricMatchingCNN",
+        "module" : "models.geometric_matching_cnn",
+        "class_name" : "GeometricMatchingCNN",
+        "kwargs" : lambda resolution : { "n_out_channels" : 6, "image_height" : resolution, "image_width" : resolution },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), torch.randn(batch_size, 3, resolution, resolution) ),
+        "resolutions" : [240],
+        "batch_sizes" : [1, 4],
+    },
+    {
+        # backbone（ResNet-101）の事前学習済みの重みはダウンロードしない
+        "name" : "Graphonomy",
+        "project" : "GCN_graphonomy",
+        "module" : "models.graphonomy",
+        "class_name" : "Graphonomy",
+        "kwargs" : lambda resolution : { "n_in_channels" : 3, "n_classes_source" : 7, "n_classes_target" : 20, "n_node_features" : 128, "n_output_channels" : 20 },
+        "inputs" : get_graphonomy_inputs,
+        "resolutions" : [256],
+        "batch_sizes" : [1, 2],
+    },
+    {
+        # AvgPool2d( 7 ) のため、入力は 224 x 224 固定
+        "name" : "ResNet18",
+        "project" : "ResNet_PyTorch",
+        "module" : "networks",
+        "class_name" : "ResNet18",
+        "kwargs" : lambda resolution : { "n_in_channels" : 3, "n_fmaps" : 64, "n_classes" : 10 },
+        "inputs" : lambda batch_size, resolution : ( torch.randn(batch_size, 3, resolution, resolution), ),
+        "resolutions" : [224],
+        "batch_sizes" : [1, 8],
+    },
+    {
+        # グラフ全体を 1 回で処理するため、resolution はノード数・バッチサイズは 1 のみ
+        "name" : "GraphConvolutionNetworks",
+        "project" : "GCN_sample_classication",
+        "module" : "networks",
+        "class_name" : "GraphConvolutionNetworks",
+        "kwargs" : lambda resolution : { "n_inputs" : 1433, "n_outputs" : 7 },
+        "inputs" : get_gcn_inputs,
+        "resolutions" : [2708, 10000],
+        "batch_sizes" : [1],
+    },
+]
+
+
+def get_model_spec( name ):
+    for spec in MODEL_SPECS:
+        if( spec["name"] == name ):
+            return spec
+    raise ValueError( "unknown model : {}".format(name) )
@@ -0,0 +1,105 @@
+# -*- coding:utf-8 -*-
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#====================================================
+# データセットの読み込み処理のフェーズ毎の処理時間の計測
+#====================================================
+PHASES = [ "file_open", "decode", "resize", "augmentation", "to_tensor", "other", "collate" ]
+
+# transforms.Compose 内の変換の分類（ここにない変換はデータオーギュメンテーションとみなす）
+RESIZE_TRANSFORMS = [ "Resize", "CenterCrop" ]
+TO_TENSOR_TRANSFORMS = [ "ToTensor", "PILToTensor", "ConvertImageDtype", "Normalize" ]
+
+def get_transform_phase( transform ):
+    name = type(transform).__name__
+    if( name in RESIZE_TRANSFORMS ):
+        return "resize"
+    elif( name in TO_TENSOR_TRANSFORMS ):
+        return "to_tensor"
+    return "augmentation"
+
+
+class PipelineProfiler(object):
+    """
+    PIL / cv2 / torchvision.transforms の関数を一時的に置き換えて、データセットの __getitem__ の処理時間を
+    ファイルオープン・デコード・リサイズ・データオーギュメンテーション・Tensor への変換・その他（__getitem__ 内のそれ以外の処理）に分けて計測する。
+    ・各フェーズの時間は、内側で呼ばれた別のフェーズの時間を除いた時間（PIL の遅延デコードがリサイズ内で行われた場合はデコードに計上される）
+    ・関数の置き換えはプロセス内でのみ有効なため、シングルプロセス（num_workers = 0）で計測する
+    """
+    def __init__( self ):
+        self.times = OrderedDict( [ ( phase, 0.0 ) for phase in PHASES ] )
+        self.child_times = []
+        return
+
+    def call( self, phase, fn, *args, **kwargs ):
+        self.child_times.append( 0.0 )
+        start_time = time.perf_counter()
+        try:
+            return fn( *args, **kwargs )
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+            self.times[phase] += elapsed_time - self.child_times.pop()
+            if( len(self.child_times) > 0 ):
+                self.child_times[-1] += elapsed_time
+
+    def wrap( self, phase, fn ):
+        def wrapper( *args, **kwargs ):
+            return self.call( phase, fn, *args, **kwargs )
+        return wrapper
+
+    @contextmanager
+    def instrument( self ):
+        """
+        with ブロック内で、ファイルオープン・デコード・transforms の関数を計測用の関数に置き換える
+        """
+        from PIL import Image, ImageFile
+        import torchvision.transforms as transforms
+        profiler = self
+
+        def compose_call( compose, image ):
+            for transform in compose.transforms:
+                image = profiler.call( get_transform_phase(transform), transform, image )
+            return image
+
+        patches = [
+            ( Image, "open", self.wrap( "file_open", Image.open ) ),
+            ( ImageFile.ImageFile, "load", self.wrap( "decode", ImageFile.ImageFile.load ) ),
+            ( transforms.Compose, "__call__", compose_call ),
+        ]
+        try:
+            import cv2
+            patches.append( ( cv2, "imread", self.wrap( "decode", cv2.imread ) ) )
+        except ImportError:
+            pass
+
+        originals = [ ( obj, name, getattr(obj, name) ) for obj, name, _ in patches ]
+        try:
+            for obj, name, fn in patches:
+                setattr( obj, name, fn )
+            yield
+        finally:
+            for obj, name, fn in originals:
+                setattr( obj, name, fn )
+
+    def profile( self, dataset, indices, batch_size, collate_fn ):
+        """
+        indices のサンプルを読み込み、1 サンプルあたりのフェーズ毎の処理時間 [ms] を返す
+        """
+        with self.instrument():
+            samples = []
+            for index in indices:
+                samples.append( self.call( "other", dataset.__getitem__, index ) )
+                if( len(samples) == batch_size ):
+                    self.call( "collate", collate_fn, samples )
+                    samples = []
+
+        n_samples = max( len(indices), 1 )
+        phases_ms = OrderedDict( [ ( phase, t * 1000 / n_samples ) for phase, t in self.times.items() ] )
+        total_ms = sum( phases_ms.values() )
+        return {
+            "phases_ms_per_sample" : phases_ms,
+            "total_ms_per_sample" : total_ms,
+            "phases_ratio" : OrderedDict( [ ( phase, t / max(total_ms, 1e-9) ) for phase, t in phases_ms.items() ] ),
+        }
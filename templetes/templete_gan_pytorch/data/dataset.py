@@ -122,6 +122,12 @@ class TempleteDataset(data.Dataset):
     def __len__(self):
         return len(self.image_s_names)
 
+    def get_file_paths(self, index):
+        """
+        index 番目のサンプルの読み込み元ファイルパスのリスト
+        """
+        return [ os.path.join(self.image_s_dir, self.image_s_names[index]), os.path.join(self.image_t_dir, self.image_t_names[index]) ]
+
     def __getitem__(self, index):
         image_s_name = self.image_s_names[index]
         image_t_name = self.image_t_names[index]
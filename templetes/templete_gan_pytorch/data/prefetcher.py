@@ -0,0 +1,120 @@
+# -*- coding:utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+#====================================================
+# 次のミニバッチを先読みして device に転送するイテレーター
+#====================================================
+class DevicePrefetcher(object):
+    """
+    DataLoader（のイテレーター）をラップし、次のミニバッチの device への転送を現在の学習ステップの計算と並行して行うイテレーター（ダブルバッファリング）。
+    ・GPU の場合は、ピン留めメモリからの non_blocking なコピーを別の CUDA stream で行い、ミニバッチを返す前に現在の stream をコピーの完了まで待機させる
+    ・CPU の場合は、バックグラウンドのスレッドで次のミニバッチの読み込みと変換を行う
+    ・ミニバッチ内の dict / list / tuple は再帰的に転送し、Tensor 以外（ファイル名など）はそのまま返す
+
+    [Args]
+        data_iter : <DataLoader or iterator> ミニバッチを返すイテラブル。DataLoader は pin_memory = True にしておくこと
+        channels_last : <bool> 4 次元の Tensor を channels_last のメモリ配置に変換するか
+        dtype : <torch.dtype> 浮動小数点の Tensor を変換する型（AMP の入力の型）。None の場合は変換しない
+    """
+    def __init__( self, data_iter, device, channels_last = False, dtype = None ):
+        self.data_iter = data_iter.__iter__()
+        self.device = device
+        self.channels_last = channels_last
+        self.dtype = dtype
+        self.len = len(data_iter) if hasattr(data_iter, "__len__") else None
+        if( device.type == "cuda" ):
+            self.stream = torch.cuda.Stream(device)
+            self.executor = None
+        else:
+            self.stream = None
+            self.executor = ThreadPoolExecutor( max_workers = 1 )
+
+        self.next_batch = None
+        self.preload()
+        return
+
+    def __len__( self ):
+        return self.len
+
+    def __iter__( self ):
+        return self
+
+    def to_device( self, data ):
+        if isinstance(data, torch.Tensor):
+            if( self.dtype is not None and data.is_floating_point() ):
+                data = data.to( self.device, dtype = self.dtype, non_blocking = True )
+            else:
+                data = data.to( self.device, non_blocking = True )
+            if( self.channels_last and data.dim() == 4 ):
+                data = data.contiguous( memory_format = torch.channels_last )
+            return data
+        elif isinstance(data, dict):
+            return { key : self.to_device(value) for key, value in data.items() }
+        elif isinstance(data, (list, tuple)):
+            return type(data)( [ self.to_device(value) for value in data ] )
+        return data
+
+    def record_stream( self, data, stream ):
+        """
+        別の stream で確保した Tensor のメモリが、現在の stream での使用中に再利用されないようにする
+        """
+        if isinstance(data, torch.Tensor):
+            data.record_stream( stream )
+        elif isinstance(data, dict):
+            for value in data.values():
+                self.record_stream( value, stream )
+        elif isinstance(data, (list, tuple)):
+            for value in data:
+                self.record_stream( value, stream )
+        return
+
+    def load( self ):
+        try:
+            batch = next(self.data_iter)
+        except StopIteration:
+            return None
+
+        if( self.stream is not None ):
+            with torch.cuda.stream(self.stream):
+                batch = self.to_device(batch)
+        else:
+            batch = self.to_device(batch)
+        return batch
+
+    def preload( self ):
+        if( self.executor is not None ):
+            self.next_batch = self.executor.submit( self.load )
+        else:
+            self.next_batch = self.load()
+        return
+
+    def close( self ):
+        """
+        先読み用のスレッドを終了する。読み込み中のミニバッチがある場合は、その読み込みの完了を待つ（DataLoader のイテレーターを別スレッドから進めたままにしないため）
+        """
+        if( self.executor is not None ):
+            self.executor.shutdown( wait = True )
+            self.executor = None
+        self.next_batch = None
+        return
+
+    def __next__( self ):
+        if( self.stream is not None ):
+            batch = self.next_batch
+            if( batch is None ):
+                raise StopIteration
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream( self.stream )
+            self.record_stream( batch, current_stream )
+        else:
+            if( self.executor is None ):
+                raise StopIteration
+            batch = self.next_batch.result()
+            if( batch is None ):
+                self.close()
+                raise StopIteration
+
+        self.preload()
+        return batch
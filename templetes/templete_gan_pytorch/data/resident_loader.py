@@ -0,0 +1,98 @@
+import os
+import hashlib
+from tqdm import tqdm
+
+import torch
+
+#====================================================
+# 変換済みテンソルを常駐させる DataLoader
+#====================================================
+def get_dataset_cache_key( dataset, indices ):
+    """
+    dataset の設定（画像サイズ・data_augument・transform）と、indices に対応するファイルの名前・サイズ・更新時刻から作成したキャッシュキー。
+    データセットのファイルや transform の設定が変わった場合は異なる値になる
+
+    [Args]
+        dataset : <Dataset> get_file_paths(index) で 1 サンプル分のファイルパスのリストを返すデータセット
+    """
+    keys = [
+        type(dataset).__name__,
+        str(getattr(dataset, "datamode", "")),
+        str(getattr(dataset, "image_height", "")),
+        str(getattr(dataset, "image_width", "")),
+        str(getattr(dataset, "data_augument", "")),
+        repr(getattr(dataset, "transform", "")),
+        repr(getattr(dataset, "transform_mask", "")),
+    ]
+    for index in indices:
+        for file_path in dataset.get_file_paths(index):
+            if( os.path.exists(file_path) ):
+                stat = os.stat(file_path)
+                keys.append( "{}:{}:{}".format(file_path, stat.st_size, stat.st_mtime_ns) )
+            else:
+                keys.append( "{}:-".format(file_path) )
+
+    return hashlib.md5( "\n".join(keys).encode("utf-8") ).hexdigest()
+
+
+class ResidentDataLoader(object):
+    """
+    dataset[indices] の全サンプルを 1 度だけ読み込んで変換済みのテンソルとして保持し、スライスでミニバッチを返す DataLoader。
+    torch.utils.data.DataLoader と同じ dict 形式（Tensor はバッチ方向にスタック、文字列は list）のミニバッチを返す。
+    イテレーションの開始時にキャッシュキーを確認し、データセットや transform の設定が変わっていれば作り直す。
+
+    ※ data_augument 有効時は、最初の読み込み時の 1 回分のランダムな変換結果が固定で使われる
+
+    [Args]
+        device : <torch.device> テンソルの保持先。CPU の場合は pin_memory = True でピン留めメモリに保持する
+        drop_last : <bool> バッチサイズに満たない最後のミニバッチを返さないか
+    """
+    def __init__( self, dataset, indices, batch_size = 1, device = torch.device("cpu"), pin_memory = True, drop_last = False ):
+        self.dataset = dataset
+        self.indices = list(indices)
+        self.batch_size = batch_size
+        self.device = device
+        self.pin_memory = pin_memory and device.type == "cpu" and torch.cuda.is_available()
+        self.drop_last = drop_last
+        self.cache_key = None
+        self.batch = None
+        return
+
+    def __len__( self ):
+        if( self.drop_last ):
+            return len(self.indices) // self.batch_size
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def build( self ):
+        """
+        全サンプルを読み込み、キー毎にスタックしたテンソルを保持先に転送する
+        """
+        self.batch = None
+        samples = [ self.dataset[index] for index in tqdm( self.indices, desc = "build resident valid data" ) ]
+        batch = {}
+        if( len(samples) == 0 ):
+            self.batch = batch
+            return
+
+        for key in samples[0].keys():
+            if isinstance(samples[0][key], torch.Tensor):
+                value = torch.stack( [sample[key] for sample in samples], dim = 0 )
+                if( self.pin_memory ):
+                    value = value.pin_memory()
+                else:
+                    value = value.to(self.device)
+                batch[key] = value
+            else:
+                batch[key] = [ sample[key] for sample in samples ]
+
+        self.batch = batch
+        return
+
+    def __iter__( self ):
+        cache_key = get_dataset_cache_key( self.dataset, self.indices )
+        if( self.batch is None or cache_key != self.cache_key ):
+            self.build()
+            self.cache_key = cache_key
+
+        for i in range(len(self)):
+            yield { key : value[i*self.batch_size:(i+1)*self.batch_size] for key, value in self.batch.items() }
@@ -22,12 +22,16 @@ from tensorboardX import SummaryWriter
 
 # 自作モジュール
 from data.dataset import TempleteDataset, TempleteDataLoader
+from data.prefetcher import DevicePrefetcher
 from models.generators import Pix2PixHDGenerator
 from models.discriminators import PatchGANDiscriminator, MultiscaleDiscriminator
 from models.inception import InceptionV3
 from models.losses import VGGLoss, LSGANLoss
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
+from utils.gan_step import RequiresGradSwitch, forward_D_fused, StepPerfMeter
+from utils.eval_worker import EvalWorker
+from utils.valid_evaluator import build_valid_loader, build_valid_evaluator, evaluate_valid
 from utils.scores import calculate_fretchet
 
 if __name__ == '__main__':
@@ -49,16 +53,23 @@ if __name__ == '__main__':
     parser.add_argument('--lambda_l1', type=float, default=10.0, help="L1損失関数の係数値")
     parser.add_argument('--lambda_vgg', type=float, default=10.0, help="VGG perceptual loss の係数値")
     parser.add_argument('--lambda_adv', type=float, default=1.0, help="Adv loss の係数値")
+    parser.add_argument('--d_forward_type', choices=['fused','separate'], default="fused", help="識別器の本物画像・偽物画像の forward 方法（fused : 結合した 1 つのバッチで forward）")
+    parser.add_argument('--d_bn_mode', choices=['per_half','joint'], default="per_half", help="fused 時の識別器内の BatchNorm の正規化方法（per_half : 本物画像・偽物画像毎に正規化）")
     parser.add_argument("--n_diaplay_step", type=int, default=100,)
     parser.add_argument('--n_display_valid_step', type=int, default=500, help="valid データの tensorboard への表示間隔")
     parser.add_argument("--n_save_epoches", type=int, default=10,)
     parser.add_argument("--val_rate", type=float, default=0.01)
     parser.add_argument('--n_display_valid', type=int, default=8, help="valid データの tensorboard への表示数")
     parser.add_argument('--data_augument', action='store_true')
+    parser.add_argument('--valid_data_cache', choices=['none','device','pinned'], default="none", help="valid データを変換済みのテンソルとして 1 度だけ読み込んで保持する（device : 学習デバイス上, pinned : CPU のピン留めメモリ上）")
     parser.add_argument('--diaplay_scores', action='store_true')
+    parser.add_argument('--use_eval_worker', action='store_true', help="valid データでの評価を別プロセスで非同期に行う（学習を止めない）")
+    parser.add_argument('--eval_worker_device', choices=['same', 'cpu'], default="same", help="評価用プロセスの実行デバイス（same : 学習と同じデバイス）")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
+    parser.add_argument('--prefetch', action='store_true', help="次のミニバッチの device への転送を学習ステップの計算と並行して行う（GPU : 別の CUDA stream, CPU : バックグラウンドのスレッド）")
+    parser.add_argument('--channels_last', action='store_true', help="モデルと入力画像を channels_last のメモリ配置にする")
     parser.add_argument('--use_cuda_benchmark', action='store_true', help="torch.backends.cudnn.benchmark の使用有効化")
     parser.add_argument('--use_cuda_deterministic', action='store_true', help="再現性確保のために cuDNN に決定論的振る舞い有効化")
     parser.add_argument('--detect_nan', action='store_true')
@@ -112,7 +123,8 @@ if __name__ == '__main__':
 
     # tensorboard 出力
     board_train = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name) )
-    board_valid = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid") )
+    if not( args.use_eval_worker ):
+        board_valid = SummaryWriter( log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid") )
 
     #================================
     # データセットの読み込み
@@ -130,7 +142,16 @@ if __name__ == '__main__':
         print( "valid_index[0:10] : ", valid_index[0:10] )
 
     dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
-    dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
+
+    # valid データの評価用プロセス（自前のデータローダー・評価用モデルを持ち、同じ TensorBoard のディレクトリに書き込む）
+    # 評価用プロセスを使う場合は、学習側では valid データのデータローダー（デバイス上のキャッシュ）を作らない
+    if( args.use_eval_worker ):
+        eval_worker = EvalWorker(
+            build_valid_evaluator, args, valid_index, log_dir = os.path.join(args.tensorboard_dir, args.exper_name + "_valid"),
+            device_name = str(device) if args.eval_worker_device == "same" else "cpu",
+        )
+    else:
+        dloader_valid = build_valid_loader( args, ds_train, valid_index, device )
 
     #================================
     # モデルの構造を定義する。
@@ -142,6 +163,10 @@ if __name__ == '__main__':
     if not args.load_checkpoints_path == '' and os.path.exists(args.load_checkpoints_path):
         load_checkpoint(model_G, device, args.load_checkpoints_path )
 
+    if( args.channels_last ):
+        model_G = model_G.to( memory_format = torch.channels_last )
+        model_D = model_D.to( memory_format = torch.channels_last )
+
     if( args.debug ):
         print( "model_G\n", model_G )
         print( "model_D\n", model_D )
@@ -156,6 +181,10 @@ if __name__ == '__main__':
     optimizer_G = optim.Adam( params = model_G.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
     optimizer_D = optim.Adam( params = model_D.parameters(), lr = args.lr, betas = (args.beta1,args.beta2) )
 
+    # 識別器のパラメーターの勾配計算の切り替え / 学習ステップの処理時間・メモリ使用量の計測
+    requires_grad_D = RequiresGradSwitch( model_D )
+    perf_meter = StepPerfMeter( device )
+
     #================================
     # loss 関数の設定
     #================================
@@ -170,175 +199,137 @@ if __name__ == '__main__':
     n_print = 1
     step = 0
     for epoch in tqdm( range(args.n_epoches), desc = "epoches" ):
-        for iter, inputs in enumerate( tqdm( dloader_train, desc = "epoch={}".format(epoch) ) ):
-            model_G.train()
-            model_D.train()
-
-            # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-            if inputs["image_s"].shape[0] != args.batch_size:
-                break
-
-            # ミニバッチデータを GPU へ転送
-            image_s = inputs["image_s"].to(device)
-            image_t = inputs["image_t"].to(device)
-            if( args.debug and n_print > 0):
-                print( "[image_s] shape={}, dtype={}, min={}, max={}".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s)) )
-                print( "[image_t] shape={}, dtype={}, min={}, max={}".format(image_t.shape, image_t.dtype, torch.min(image_t), torch.max(image_t)) )
-
-            #----------------------------------------------------
-            # 生成器 の forword 処理
-            #----------------------------------------------------
-            output = model_G( image_s )
-            if( args.debug and n_print > 0 ):
-                print( "output.shape : ", output.shape )
-
-            #----------------------------------------------------
-            # 識別器の更新処理
-            #----------------------------------------------------
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = True
-
-            # 学習用データをモデルに流し込む
-            d_real = model_D( torch.cat([image_s, image_t], dim=1) )
-            d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
-            if( args.debug and n_print > 0 ):
-                print( "d_real.shape :", d_real.shape )
-                print( "d_fake.shape :", d_fake.shape )
-
-            # 損失関数を計算する
-            loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-
-            # ネットワークの更新処理
-            optimizer_D.zero_grad()
-            loss_D.backward(retain_graph=True)
-            optimizer_D.step()
-
-            # 無効化していた識別器 D のネットワークの勾配計算を有効化。
-            for param in model_D.parameters():
-                param.requires_grad = False
-
-            #----------------------------------------------------
-            # 生成器の更新処理
-            #----------------------------------------------------
-            # 損失関数を計算する
-            loss_l1 = loss_l1_fn( image_t, output )
-            loss_vgg = loss_vgg_fn( image_t, output )
-            loss_adv = loss_adv_fn.forward_G( d_fake )
-            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-
-            # ネットワークの更新処理
-            optimizer_G.zero_grad()
-            loss_G.backward()
-            optimizer_G.step()
-
-            #====================================================
-            # 学習過程の表示
-            #====================================================
-            if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
-                # lr
-                for param_group in optimizer_G.param_groups:
-                    lr = param_group['lr']
-
-                board_train.add_scalar('lr/learning rate', lr, step )
-
-                # loss
-                board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
-                board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
-                board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
-                board_train.add_scalar('G/loss_G', loss_G.item(), step)
-                board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
-                board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
-                board_train.add_scalar('D/loss_D', loss_D.item(), step)
-                print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
-                print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
-
-                # visual images
-                visuals = [
-                    [ image_s.detach(), image_t.detach(), output.detach() ],
-                ]
-                board_add_images(board_train, 'train', visuals, step+1)
-
-                # scores
-                if( args.diaplay_scores ):
-                    score_fid = calculate_fretchet(image_t, output, inception)
-                    board_train.add_scalar('scores/FID', score_fid.item(), step)
-                    print( "step={}, FID={:.5f}".format(step, score_fid.item()) )
-
-            #====================================================
-            # valid データでの処理
-            #====================================================
-            if( step % args.n_display_valid_step == 0 ):
-                loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total = 0, 0, 0, 0
-                loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
-                score_fid_total = 0
-                n_valid_loop = 0
-                for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid") ):
-                    model_G.eval()            
-                    model_D.eval()
-
-                    # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
-                    if inputs["image_s"].shape[0] != args.batch_size_valid:
-                        break
-
-                    # ミニバッチデータを GPU へ転送
-                    image_s = inputs["image_s"].to(device)
-                    image_t = inputs["image_t"].to(device)
-
-                    # 推論処理
-                    with torch.no_grad():
-                        output = model_G( image_s )
-
-                    with torch.no_grad():
-                        d_real = model_D( torch.cat([image_s, image_t], dim=1) )
-                        d_fake = model_D( torch.cat([image_s, output.detach()], dim=1) )
-
-                    # 損失関数を計算する
-                    loss_l1 = loss_l1_fn( image_t, output )
-                    loss_vgg = loss_vgg_fn( image_t, output )
-                    loss_adv = loss_adv_fn.forward_G( d_fake )
-                    loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
-
-                    loss_l1_total += loss_l1
-                    loss_vgg_total += loss_vgg
-                    loss_adv_total += loss_adv
-                    loss_G_total += loss_G
-
-                    loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
-                    loss_D_total += loss_D
-                    loss_D_real_total += loss_D_real
-                    loss_D_fake_total += loss_D_fake
+        # 次のミニバッチを先読みして device に転送する（転送済みの Tensor の .to(device) は何もしない）
+        if( args.prefetch ):
+            dloader_train_iter = DevicePrefetcher( dloader_train, device, channels_last = args.channels_last )
+        else:
+            dloader_train_iter = dloader_train
+
+        # break で最後のミニバッチを読み飛ばした場合や例外の発生時にも、先読み用のスレッドを終了させる
+        try:
+            for iter, inputs in enumerate( tqdm( dloader_train_iter, desc = "epoch={}".format(epoch) ) ):
+                model_G.train()
+                model_D.train()
+
+                # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+                if inputs["image_s"].shape[0] != args.batch_size:
+                    break
+
+                # ミニバッチデータを GPU へ転送
+                image_s = inputs["image_s"].to(device)
+                image_t = inputs["image_t"].to(device)
+                if( args.channels_last ):
+                    image_s = image_s.contiguous( memory_format = torch.channels_last )
+                    image_t = image_t.contiguous( memory_format = torch.channels_last )
+                if( args.debug and n_print > 0):
+                    print( "[image_s] shape={}, dtype={}, min={}, max={}".format(image_s.shape, image_s.dtype, torch.min(image_s), torch.max(image_s)) )
+                    print( "[image_t] shape={}, dtype={}, min={}, max={}".format(image_t.shape, image_t.dtype, torch.min(image_t), torch.max(image_t)) )
+
+                #----------------------------------------------------
+                # 生成器 の forword 処理
+                #----------------------------------------------------
+                output = model_G( image_s )
+                if( args.debug and n_print > 0 ):
+                    print( "output.shape : ", output.shape )
+
+                #----------------------------------------------------
+                # 識別器の更新処理
+                #----------------------------------------------------
+                # 無効化していた識別器 D のネットワークの勾配計算を有効化。
+                requires_grad_D.set(True)
+
+                # 学習用データをモデルに流し込む（本物画像・偽物画像を結合した 1 つのバッチで forward）
+                d_real, d_fake = forward_D_fused(
+                    model_D, [ torch.cat([image_s, image_t], dim=1), torch.cat([image_s, output.detach()], dim=1) ],
+                    fused = ( args.d_forward_type == "fused" ), split_bn = ( args.d_bn_mode == "per_half" ),
+                )
+                if( args.debug and n_print > 0 ):
+                    print( "d_real.shape :", d_real.shape )
+                    print( "d_fake.shape :", d_fake.shape )
+
+                # 損失関数を計算する
+                loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+
+                # ネットワークの更新処理
+                optimizer_D.zero_grad()
+                loss_D.backward()
+                optimizer_D.step()
+
+                # 識別器 D のネットワークの勾配計算を無効化。
+                requires_grad_D.set(False)
+
+                #----------------------------------------------------
+                # 生成器の更新処理
+                #----------------------------------------------------
+                # 更新後の識別器での偽物画像の出力（生成器へ勾配を伝搬させるため、output は detach しない）
+                d_fake = model_D( torch.cat([image_s, output], dim=1) )
+
+                # 損失関数を計算する
+                loss_l1 = loss_l1_fn( image_t, output )
+                loss_vgg = loss_vgg_fn( image_t, output )
+                loss_adv = loss_adv_fn.forward_G( d_fake )
+                loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+
+                # ネットワークの更新処理
+                optimizer_G.zero_grad()
+                loss_G.backward()
+                optimizer_G.step()
+                perf_meter.update()
+
+                #====================================================
+                # 学習過程の表示
+                #====================================================
+                if( step == 0 or ( step % args.n_diaplay_step == 0 ) ):
+                    # lr
+                    for param_group in optimizer_G.param_groups:
+                        lr = param_group['lr']
+
+                    board_train.add_scalar('lr/learning rate', lr, step )
+
+                    # loss
+                    board_train.add_scalar('G/loss_l1', loss_l1.item(), step)
+                    board_train.add_scalar('G/loss_vgg', loss_vgg.item(), step)
+                    board_train.add_scalar('G/loss_adv', loss_adv.item(), step)
+                    board_train.add_scalar('G/loss_G', loss_G.item(), step)
+                    board_train.add_scalar('D/loss_D_real', loss_D_real.item(), step)
+                    board_train.add_scalar('D/loss_D_fake', loss_D_fake.item(), step)
+                    board_train.add_scalar('D/loss_D', loss_D.item(), step)
+
+                    # 学習ステップの処理時間・ピークメモリ使用量
+                    step_time, max_memory = perf_meter.report()
+                    board_train.add_scalar('perf/step_time_ms', step_time, step)
+                    board_train.add_scalar('perf/max_memory_allocated_MB', max_memory, step)
+                    print( "step={}, loss_G={:.5f}, loss_l1={:.5f}, loss_vgg={:.5f}, loss_adv={:.5f}".format(step, loss_G.item(), loss_l1.item(), loss_vgg.item(), loss_adv.item()) )
+                    print( "step={}, loss_D={:.5f}, loss_D_real={:.5f}, loss_D_fake={:.5f}".format(step, loss_D.item(), loss_D_real.item(), loss_D_fake.item()) )
+                    print( "step={}, step_time={:.2f}ms, max_memory_allocated={:.1f}MB".format(step, step_time, max_memory) )
+
+                    # visual images
+                    visuals = [
+                        [ image_s.detach(), image_t.detach(), output.detach() ],
+                    ]
+                    board_add_images(board_train, 'train', visuals, step+1)
 
                     # scores
                     if( args.diaplay_scores ):
                         score_fid = calculate_fretchet(image_t, output, inception)
-                        score_fid_total += score_fid
-
-                    # 生成画像表示
-                    if( iter <= args.n_display_valid ):
-                        # visual images
-                        visuals = [
-                            [ image_s.detach(), image_t.detach(), output.detach() ],
-                        ]
-                        board_add_images(board_valid, 'valid/{}'.format(iter), visuals, step+1)
-
-                    n_valid_loop += 1
-
-                # loss 値表示
-                board_valid.add_scalar('G/loss_l1', loss_l1_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_vgg', loss_vgg_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_adv', loss_adv_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('G/loss_G', loss_G_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D', loss_D_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_real', loss_D_real_total.item()/n_valid_loop, step)
-                board_valid.add_scalar('D/loss_D_fake', loss_D_fake_total.item()/n_valid_loop, step)
-                
-                # scores
-                if( args.diaplay_scores ):
-                    board_valid.add_scalar('scores/FID', score_fid_total.item()/n_valid_loop, step)
-
-            step += 1
-            n_print -= 1
+                        board_train.add_scalar('scores/FID', score_fid.item(), step)
+                        print( "step={}, FID={:.5f}".format(step, score_fid.item()) )
+
+                #====================================================
+                # valid データでの処理
+                #====================================================
+                if( args.use_eval_worker and step % args.n_display_valid_step == 0 ):
+                    # 重みのスナップショットを評価用プロセスに渡すのみで、評価の完了は待たない
+                    if not( eval_worker.submit( step, { "model_G" : model_G, "model_D" : model_D } ) ):
+                        print( "step={}, eval worker is busy. skip valid evaluation (n_skipped={})".format(step, eval_worker.n_skipped) )
+                elif( step % args.n_display_valid_step == 0 ):
+                    evaluate_valid( args, model_G, model_D, dloader_valid, loss_l1_fn, loss_vgg_fn, loss_adv_fn, inception if args.diaplay_scores else None, board_valid, step, device )
+
+                step += 1
+                n_print -= 1
+        finally:
+            if( args.prefetch ):
+                dloader_train_iter.close()
 
         #====================================================
         # モデルの保存
@@ -351,5 +342,8 @@ if __name__ == '__main__':
             print( "saved checkpoints" )
 
     print("Finished Training Loop.")
+    if( args.use_eval_worker ):
+        eval_worker.close()
+
     save_checkpoint( model_G, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_G_final.pth') )
     save_checkpoint( model_D, device, os.path.join(args.save_checkpoints_dir, args.exper_name, 'model_D_final.pth') )
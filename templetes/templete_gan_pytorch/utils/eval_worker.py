@@ -0,0 +1,123 @@
+# -*- coding:utf-8 -*-
+import atexit
+import queue
+
+import torch
+import torch.multiprocessing as mp
+from tensorboardX import SummaryWriter
+
+#====================================================
+# 別プロセスでの valid データの評価
+#====================================================
+def snapshot_state_dict( model ):
+    """
+    学習中のモデルの重みを CPU 上にコピーする（学習側でその後に重みが更新されても影響を受けない）
+    """
+    return { key : value.detach().cpu().clone() for key, value in model.state_dict().items() }
+
+
+def eval_worker_loop( task_queue, build_evaluator, args, valid_index, log_dir, device_name ):
+    """
+    評価用プロセスのメインループ。build_evaluator() でデータローダー・モデル・評価用モデルを自前で構築し、
+    task_queue から受け取った重みのスナップショットを評価して、学習側と同じ TensorBoard のディレクトリに書き込む
+    """
+    device = torch.device(device_name)
+    board_valid = SummaryWriter( log_dir = log_dir )
+    models, evaluate_fn = build_evaluator( args, valid_index, device )
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+
+        step = task["step"]
+        for name, state_dict in task["models"].items():
+            models[name].load_state_dict(state_dict)
+        evaluate_fn( models, board_valid, step )
+
+        # EMA の重みがある場合は、該当するモデルの重みを置き換えて別のタグで評価
+        if task["ema_models"] is not None:
+            for name, state_dict in task["ema_models"].items():
+                models[name].load_state_dict(state_dict)
+            evaluate_fn( models, board_valid, step, tag = "_ema" )
+
+        board_valid.flush()
+
+    board_valid.close()
+    return
+
+
+class EvalWorker(object):
+    """
+    valid データでの評価を別プロセスで非同期に行うワーカー。
+    submit() は重みを CPU にコピーしてキューに入れるだけで、評価の完了を待たない。
+    評価中でキューが一杯の場合は、学習を止めないようにその step の評価をスキップする
+
+    [Args]
+        build_evaluator : <function> build_evaluator(args, valid_index, device) で、モデルの dict と評価関数 evaluate_fn(models, board_valid, step, tag = "") を返す関数。
+                          評価用プロセス内で呼ばれるため、モジュールのトップレベルで定義した関数を渡す（spawn で pickle できるようにするため）
+    """
+    def __init__( self, build_evaluator, args, valid_index, log_dir, device_name = "cpu", max_queue_size = 1, exit_timeout = 60 ):
+        ctx = mp.get_context("spawn")
+        self.task_queue = ctx.Queue(max_queue_size)
+        # 評価用プロセス内で DataLoader のワーカープロセスを起動するため daemon にはしない
+        self.process = ctx.Process( target = eval_worker_loop, args = (self.task_queue, build_evaluator, args, valid_index, log_dir, device_name) )
+        self.process.start()
+        self.n_submitted = 0
+        self.n_skipped = 0
+        self.exit_timeout = exit_timeout
+        self.closed = False
+
+        # 学習ループが例外で抜けた場合でも、評価用プロセス（daemon ではない）の終了待ちでインタプリタが終了しなくならないようにする
+        atexit.register( self.close, timeout = self.exit_timeout )
+        return
+
+    def submit( self, step, models, ema_models = None ):
+        """
+        [Args]
+            models : <dict> build_evaluator() が返すモデルの dict と同じキーの、学習中のモデルの dict
+            ema_models : <dict> EMA の重みで置き換えるモデルの dict
+        """
+        if not self.process.is_alive():
+            raise RuntimeError( "eval worker process is not alive (exitcode={})".format(self.process.exitcode) )
+
+        if self.task_queue.full():
+            self.n_skipped += 1
+            return False
+
+        task = {
+            "step" : step,
+            "models" : { name : snapshot_state_dict(model) for name, model in models.items() },
+            "ema_models" : { name : snapshot_state_dict(model) for name, model in ema_models.items() } if ema_models is not None else None,
+        }
+        try:
+            self.task_queue.put_nowait(task)
+        except queue.Full:
+            self.n_skipped += 1
+            return False
+
+        self.n_submitted += 1
+        return True
+
+    def close( self, timeout = None ):
+        """
+        キューに残っている評価が全て終わるまで待ってからプロセスを終了する。
+        timeout [sec] を指定した場合は、時間内に終了しなければプロセスを強制終了する（2 回目以降の呼び出しは何もしない）
+        """
+        if self.closed:
+            return
+        self.closed = True
+        atexit.unregister( self.close )
+
+        if self.process.is_alive():
+            try:
+                self.task_queue.put( None, timeout = timeout )
+            except queue.Full:
+                pass
+            self.process.join( timeout )
+
+        if self.process.is_alive():
+            print( "eval worker process did not exit within {} sec. terminate it".format(timeout) )
+            self.process.terminate()
+            self.process.join()
+        return
@@ -0,0 +1,128 @@
+# -*- coding:utf-8 -*-
+from tqdm import tqdm
+
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader, Subset
+
+from data.dataset import TempleteDataset
+from data.resident_loader import ResidentDataLoader
+from models.generators import Pix2PixHDGenerator
+from models.discriminators import PatchGANDiscriminator
+from models.inception import InceptionV3
+from models.losses import VGGLoss, LSGANLoss
+from utils.utils import board_add_images
+from utils.scores import calculate_fretchet
+
+#====================================================
+# valid データでの評価
+#====================================================
+def evaluate_valid( args, model_G, model_D, dloader_valid, loss_l1_fn, loss_vgg_fn, loss_adv_fn, inception, board_valid, step, device, tag = "" ):
+    """
+    valid データ全体での loss 値・スコアを計算して board_valid に書き込む（学習ループ内の valid データでの処理と同じ内容）
+    """
+    loss_G_total, loss_l1_total, loss_vgg_total, loss_adv_total = 0, 0, 0, 0
+    loss_D_total, loss_D_real_total, loss_D_fake_total = 0, 0, 0
+    score_fid_total = 0
+    n_valid_loop = 0
+    model_G.eval()
+    model_D.eval()
+    for iter, inputs in enumerate( tqdm(dloader_valid, desc = "valid (step={})".format(step)) ):
+        # 一番最後のミニバッチループで、バッチサイズに満たない場合は無視する（後の計算で、shape の不一致をおこすため）
+        if inputs["image_s"].shape[0] != args.batch_size_valid:
+            break
+
+        # ミニバッチデータを GPU へ転送
+        image_s = inputs["image_s"].to(device)
+        image_t = inputs["image_t"].to(device)
+
+        with torch.no_grad():
+            # 推論処理
+            output = model_G( image_s )
+            d_real = model_D( torch.cat([image_s, image_t], dim=1) )
+            d_fake = model_D( torch.cat([image_s, output], dim=1) )
+
+            # 損失関数を計算する
+            loss_l1 = loss_l1_fn( image_t, output )
+            loss_vgg = loss_vgg_fn( image_t, output )
+            loss_adv = loss_adv_fn.forward_G( d_fake )
+            loss_G =  args.lambda_l1 * loss_l1 + args.lambda_vgg * loss_vgg + args.lambda_adv * loss_adv
+            loss_D, loss_D_real, loss_D_fake = loss_adv_fn.forward_D( d_real, d_fake )
+
+            loss_l1_total += loss_l1
+            loss_vgg_total += loss_vgg
+            loss_adv_total += loss_adv
+            loss_G_total += loss_G
+            loss_D_total += loss_D
+            loss_D_real_total += loss_D_real
+            loss_D_fake_total += loss_D_fake
+
+            # scores
+            if( inception is not None ):
+                score_fid = calculate_fretchet(image_t, output, inception)
+                score_fid_total += score_fid
+
+        # 生成画像表示
+        if( iter <= args.n_display_valid ):
+            visuals = [
+                [ image_s, image_t, output ],
+            ]
+            board_add_images(board_valid, 'valid{}/{}'.format(tag, iter), visuals, step+1)
+
+        n_valid_loop += 1
+
+    if( n_valid_loop == 0 ):
+        return
+
+    # loss 値表示
+    board_valid.add_scalar('G{}/loss_l1'.format(tag), loss_l1_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('G{}/loss_vgg'.format(tag), loss_vgg_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('G{}/loss_adv'.format(tag), loss_adv_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('G{}/loss_G'.format(tag), loss_G_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('D{}/loss_D'.format(tag), loss_D_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('D{}/loss_D_real'.format(tag), loss_D_real_total.item()/n_valid_loop, step)
+    board_valid.add_scalar('D{}/loss_D_fake'.format(tag), loss_D_fake_total.item()/n_valid_loop, step)
+
+    # scores
+    if( inception is not None ):
+        board_valid.add_scalar('scores{}/FID'.format(tag), score_fid_total.item()/n_valid_loop, step)
+
+    return
+
+
+def build_valid_loader( args, ds_train, valid_index, device ):
+    """
+    valid データのデータローダーを構築する（学習側と評価用プロセスで共通）
+    """
+    if( args.valid_data_cache == "none" ):
+        dloader_valid = DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
+    else:
+        dloader_valid = ResidentDataLoader( ds_train, valid_index, batch_size = args.batch_size_valid, device = device if args.valid_data_cache == "device" else torch.device("cpu"), pin_memory = True )
+    return dloader_valid
+
+
+def build_valid_evaluator( args, valid_index, device ):
+    """
+    EvalWorker の評価用プロセス内で、データローダー・モデル・評価用モデルを構築し、モデルの dict と評価関数を返す
+    """
+    # データセット
+    ds_train = TempleteDataset( args, args.dataset_dir, datamode = "train", image_height = args.image_height, image_width = args.image_width, data_augument = args.data_augument, debug = False )
+    dloader_valid = build_valid_loader( args, ds_train, valid_index, device )
+
+    # モデル
+    models = {
+        "model_G" : Pix2PixHDGenerator().to(device),
+        "model_D" : PatchGANDiscriminator( in_dim = 3+3, n_fmaps = 64 ).to( device ),
+    }
+
+    # 評価用モデル
+    loss_l1_fn = nn.L1Loss()
+    loss_vgg_fn = VGGLoss(device, n_channels=3)
+    loss_adv_fn = LSGANLoss(device)
+    inception = InceptionV3().to(device) if args.diaplay_scores else None
+
+    def evaluate_fn( models, board_valid, step, tag = "" ):
+        evaluate_valid( args, models["model_G"], models["model_D"], dloader_valid, loss_l1_fn, loss_vgg_fn, loss_adv_fn, inception, board_valid, step, device, tag = tag )
+        return
+
+    return models, evaluate_fn
@@ -120,6 +120,12 @@ class TempleteDataset(data.Dataset):
     def __len__(self):
         return len(self.image_names)
 
+    def get_file_paths(self, index):
+        """
+        index 番目のサンプルの読み込み元ファイルパスのリスト
+        """
+        return [ os.path.join(self.image_dir, self.image_names[index]), os.path.join(self.target_dir, self.target_names[index]) ]
+
     def __getitem__(self, index):
         image_name = self.image_names[index]
         target_name = self.target_names[index]
@@ -22,6 +22,7 @@ from tensorboardX import SummaryWriter
 
 # 自作モジュール
 from data.dataset import TempleteDataset, TempleteDataLoader
+from data.resident_loader import ResidentDataLoader
 from models.networks import TempleteNetworks
 from utils.utils import save_checkpoint, load_checkpoint
 from utils.utils import board_add_image, board_add_images, save_image_w_norm
@@ -48,6 +49,7 @@ if __name__ == '__main__':
     parser.add_argument("--val_rate", type=float, default=0.01)
     parser.add_argument('--n_display_valid', type=int, default=8, help="valid データの tensorboard への表示数")
     parser.add_argument('--data_augument', action='store_true')
+    parser.add_argument('--valid_data_cache', choices=['none','device','pinned'], default="none", help="valid データを変換済みのテンソルとして 1 度だけ読み込んで保持する（device : 学習デバイス上, pinned : CPU のピン留めメモリ上）")
     parser.add_argument("--seed", type=int, default=71)
     parser.add_argument('--device', choices=['cpu', 'gpu'], default="gpu", help="使用デバイス (CPU or GPU)")
     parser.add_argument('--n_workers', type=int, default=4, help="CPUの並列化数（0 で並列化なし）")
@@ -122,7 +124,10 @@ if __name__ == '__main__':
         print( "valid_index[0:10] : ", valid_index[0:10] )
 
     dloader_train = torch.utils.data.DataLoader(Subset(ds_train, train_index), batch_size=args.batch_size, shuffle=True, num_workers = args.n_workers, pin_memory = True )
-    dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
+    if( args.valid_data_cache == "none" ):
+        dloader_valid = torch.utils.data.DataLoader(Subset(ds_train, valid_index), batch_size=args.batch_size_valid, shuffle=False, num_workers = args.n_workers, pin_memory = True )
+    else:
+        dloader_valid = ResidentDataLoader( ds_train, valid_index, batch_size = args.batch_size_valid, device = device if args.valid_data_cache == "device" else torch.device("cpu"), pin_memory = True )
 
     #================================
     # モデルの構造を定義する。